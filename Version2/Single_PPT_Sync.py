@@ -1,133 +1,302 @@
 # Combined Spotlight Server and Client Script
 # Run this script and choose to operate in 'server' or 'client' mode.
 
+import itertools
+import os
 import socket
+import sys
 import threading
 import time
 
-# --- PyAutoGUI is server-specific, import conditionally or handle if not present ---
-try:
-    import pyautogui
-except ImportError:
-    pyautogui = None  # Will be checked in server mode
-
-# --- Pynput is client-specific, import conditionally or handle if not present ---
-try:
-    from pynput import keyboard
-except ImportError:
-    keyboard = None  # Will be checked in client mode
+# The shared protocol code lives in the spotlight_core package at the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spotlight_core import protocol
+from spotlight_core.arbiter import NAVIGATION_COMMANDS, CommandArbiter
+from spotlight_core.capture import CaptureQueue, KeyDebouncer, SenderThread
+from spotlight_core.config import ConfigError, ask, describe_sources, load_config
+from spotlight_core.connection import Backoff
+from spotlight_core.discovery import DISCOVERY_PREFIX, MULTICAST_GROUP, build_discovery_reply, discover
+from spotlight_core.injection import InjectionWorker
+from spotlight_core.injectors import LazyInjector
+from spotlight_core.interfaces import describe_advertised_ip
+from spotlight_core.keymap import RELOAD_INTERVAL, KeymapError, KeymapWatcher, compile_keys
+from spotlight_core.keys import CaptureUnavailable, key_name, load_pynput, preload_pynput
+from spotlight_core.log import get_logger, setup_logging
+from spotlight_core.metrics import LatencyRecorder, now_us, start_periodic_export
+from spotlight_core.overlay import OverlayUnavailable, SpotlightOverlay
+from spotlight_core.pointer import MotionAccumulator
+from spotlight_core.server import CommandTable, serve_connection
+from spotlight_core.smoothing import PointerSmoother
+from spotlight_core.server_cache import DEFAULT_CACHE_PATH, ServerCache, locate_server
+from spotlight_core.sessions import ResumableSessions, ResumeRejected, pair_resumable, resume
+from spotlight_core.startup import EarlyListener
+from spotlight_core.udp_commands import UdpSessions, start_udp_command_server
+
+# Nothing mode-specific is imported up front: pynput is loaded in client mode only (and in the
+# background while the server is located), the input backend and asyncio in server mode only.
+keyboard = None  # pynput.keyboard, loaded when client mode starts
 
 # --- Common Configuration ---
+# Mode and pairing ID: set them in the configuration (see CONFIG_OPTIONS below); if they are
+# left empty, they are asked for when the script is started from a terminal.
+RUN_MODE = ""  # "server" or "client"
+PAIRING_ID = ""  # Server: the ID clients must send. Client: the server's ID
 DISCOVERY_PORT = 50000
+DISCOVERY_MULTICAST_GROUP = MULTICAST_GROUP  # Also answer discovery sent to this IPv4 group (None = broadcast only)
+ADVERTISED_IP = None  # IP sent in discovery responses; None = the address of the interface facing each client
 COMMAND_PORT = 50001  # Server listens on this, client gets it via discovery
+# Optional UDP command channel: clients that ask for it (on their paired TCP connection) send
+# clicks as datagrams, so one lost packet on Wi-Fi does not hold back the following clicks.
+UDP_COMMAND_PORT = COMMAND_PORT  # UDP port for it (a UDP port, so no clash with the TCP one); None = TCP only
 BUFFER_SIZE = 1024
-RETRY_DELAY = 2  # Client uses this
+# Client: a lost session or a failed search is retried automatically, after RETRY_INITIAL_DELAY
+# seconds and then backing off (with jitter) up to RETRY_DELAY seconds between attempts.
+RETRY_INITIAL_DELAY = 0.05
+RETRY_DELAY = 2
 
 # --- Server Specific Globals & Config ---
 SERVER_NAME = "SpotlightReceiverPC"
 SERVER_PAIRING_ID_GLOBAL = ""  # Global for server's pairing ID
-COMMAND_ACTIONS = {
-    "NEXT": lambda: pyautogui.press('right') if pyautogui else print("[SERVER] PyAutoGUI not available"),
-    "PREVIOUS": lambda: pyautogui.press('left') if pyautogui else print("[SERVER] PyAutoGUI not available"),
-    "BLACK_SCREEN": lambda: pyautogui.press('b') if pyautogui else print("[SERVER] PyAutoGUI not available"),
-    "START_PRESENTATION": lambda: pyautogui.press('f5') if pyautogui else print("[SERVER] PyAutoGUI not available"),
-    "EXIT_SLIDESHOW": lambda: pyautogui.press('esc') if pyautogui else print("[SERVER] PyAutoGUI not available"),
-    "LASER_ON": lambda: print("[SERVER] Laser ON command received (action not implemented)"),
-    "LASER_OFF": lambda: print("[SERVER] Laser OFF command received (action not implemented)"),
+COMMAND_KEYS = {  # Commands that are a single key press (the injection worker can batch these)
+    "NEXT": 'right',
+    "PREVIOUS": 'left',
+    "BLACK_SCREEN": 'b',
+    "START_PRESENTATION": 'f5',
+    "EXIT_SLIDESHOW": 'esc',
 }
+COMMAND_ACTIONS = None  # Built from COMMAND_KEYS by build_command_table_for_server()
+COMMAND_TABLE = None  # Dispatch table keyed by wire opcode, built once in server mode
+# Commands from all controllers run in one global order. With floor control only the controller
+# holding the floor may navigate; it takes the floor when it is free, when the holder has been idle
+# for FLOOR_IDLE_TIMEOUT seconds, or when its priority is higher. Subscribed controllers get state updates.
+FLOOR_CONTROL = True
+FLOOR_IDLE_TIMEOUT = 30  # seconds
+CONTROLLER_PRIORITIES = {}  # Client IP -> priority (default 0), e.g. {"192.168.1.50": 10} for the stage manager
+ARBITER = None  # CommandArbiter, created in server mode
+# The asyncio engine serves every connection and the discovery responder from one event loop
+# with a fixed number of threads. Set to False for the old thread-per-connection server.
+USE_ASYNC_SERVER = True
+MAX_CONNECTIONS = 64  # Further connections are refused (asyncio engine only)
+LISTEN_BACKLOG = 128  # Queued, not yet accepted TCP connections
+IDLE_TIMEOUT = 3600  # Seconds without any data before a paired connection is dropped (asyncio engine only)
+PAIRING_TIMEOUT = 10  # Seconds a new connection has to complete pairing (asyncio engine only)
+SESSION_TTL = 300  # Seconds a dropped client may resume its session without pairing (None = always pair)
+# All key presses run on one injection worker thread; runs of repeated NEXT/PREVIOUS become one multi-press.
+# Input backend (server-specific): "pyautogui" (default), "xdotool" or "uinput" (Linux), or
+# "recording" (presses nothing, records the keys; for headless tests and benchmarks)
+INJECTOR_BACKEND = "pyautogui"
+RECORDING_LOG_PATH = None  # "recording" backend only: optional JSON-lines file of injected keys
+INJECTOR = None  # injectors.LazyInjector, created in server mode (it opens in the background)
+USE_INJECTION_WORKER = True
+ACK_MODE = "completed"  # "completed": ACK once the key press has returned; "queued": ACK as soon as it is queued
+KEY_PAUSE = 0.02  # Seconds between injected key presses (also pyautogui's PAUSE, which defaults to 0.1)
+INJECTION_WORKER = None  # Created in server mode
+# Virtual spotlight for LASER_ON / LASER_OFF: a dimmed overlay with a clear circle following the
+# pointer positions streamed by the client. Needs tkinter and a display, else the commands only print.
+SPOTLIGHT_OVERLAY = True
+SPOTLIGHT_RADIUS = 150  # Pixels
+SPOTLIGHT_DIM = 0.6  # Opacity of the dimmed area: 0 = invisible, 1 = black
+SPOTLIGHT_REFRESH_HZ = 60  # Highest redraw rate; match the display's refresh rate
+# Relative pointer motion streamed by clients moves the spotlight, or with "cursor" this
+# computer's mouse pointer through the input backend (e.g. for the presentation program's own pointer).
+MOTION_TARGET = "spotlight"  # "spotlight", "cursor" or None (ignore motion)
+MOTION_GAIN = 1.0  # Pixels moved here per pixel moved on the client
+MOTION_RATE_HZ = 60  # "cursor" only: pointer moves per second at most; motion in between is added up
+# Streamed positions go through a One-Euro filter with prediction before they are drawn, so
+# Wi-Fi jitter does not make the spotlight stutter. The lag it adds is in the latency metrics
+# ("pointer_smoothing" stage).
+POINTER_SMOOTHING = True
+SMOOTHING_MIN_CUTOFF = 1.0  # Hz at rest: lower = steadier spotlight, but slow moves lag more
+SMOOTHING_BETA = 20.0  # Higher = less lag on fast moves, but more jitter gets through
+SMOOTHING_PREDICTION = 0.0  # Seconds to draw ahead, e.g. 0.01 (hides lag, but overshoots on sudden stops)
+OVERLAY = None  # Created in server mode
+CURSOR_MOTION = None  # MotionAccumulator feeding INJECTOR.move(), created in server mode for MOTION_TARGET "cursor"
+# Per-command server latency (receipt -> action start, key press duration). Written on shutdown and
+# every METRICS_EXPORT_INTERVAL seconds; .prom/.txt paths get Prometheus text, others JSON.
+METRICS_EXPORT_PATH = None  # e.g. "spotlight_server_metrics.prom"; None = don't export
+METRICS_EXPORT_INTERVAL = 30  # seconds
+UDP_SESSIONS = None  # Threaded engine, created in server mode
+RESUMABLE_SESSIONS = None  # Threaded engine, created in server mode
+LATENCY_METRICS = LatencyRecorder("server")
+# Logging goes through a background writer thread. "INFO" = connections and errors only,
+# "DEBUG" = every command as well (slower on Windows consoles).
+LOG_LEVEL = "INFO"
+EVENT_LOG_PATH = None  # e.g. "spotlight_events.jsonl": every event, DEBUG included, as JSON lines
+log = get_logger("single_ppt_sync")
 
 # --- Client Specific Globals & Config ---
 CLIENT_PAIRING_ID_GLOBAL = ""  # Global for client's pairing ID
-DISCOVERY_TIMEOUT_CLIENT = 5  # Client specific
-KEYS_TO_COMMANDS_CLIENT = {}  # Will be populated if keyboard is available
+DISCOVERY_TIMEOUT_CLIENT = 5  # Client specific; discovery returns as soon as a server answers
+# Servers we paired with are remembered here and tried directly on the next start
+SERVER_CACHE_PATH = DEFAULT_CACHE_PATH  # None = remember them in memory only
+SERVER_CACHE = None  # ServerCache, created when client mode starts
+# Keys by name (keys.key_name(): pynput's keyboard.Key names, or the character typed)
+KEYS_TO_COMMANDS_CLIENT = {
+    "right": "NEXT",
+    "left": "PREVIOUS",
+    "f5": "START_PRESENTATION",
+    "b": "BLACK_SCREEN",
+    "B": "BLACK_SCREEN",
+    "esc": "EXIT_SLIDESHOW",
+}
+# Held and bouncing keys: a held remote button makes the OS repeat its press many times a second,
+# and cheap remotes report one click as several. Only real presses are sent.
+REPEAT_POLICY = "ignore"  # Repeats of a held key: "ignore", "rate-limit" (one per REPEAT_INTERVAL) or "hold"
+REPEAT_POLICY_PER_COMMAND = {}  # Overrides REPEAT_POLICY, e.g. {"NEXT": "rate-limit", "LASER_ON": "hold"}
+REPEAT_INTERVAL = 0.25  # seconds ("rate-limit")
+BOUNCE_TIME = 0.03  # A press this soon (seconds) after the key came up is the same press bouncing; 0 = off
+HOLD_RELEASE_COMMANDS = {"LASER_ON": "LASER_OFF"}  # "hold": sent when the key of the command comes up
+KEY_DEBOUNCER = None  # KeyDebouncer, created when client mode starts
+# Key presses are queued by the key listener and sent (and a lost session resumed) from a
+# separate thread, so network I/O never runs inside the OS input hook.
+CAPTURE_QUEUE_SIZE = 64  # Max key presses waiting to be sent
+CAPTURE_OVERFLOW_POLICY = "drop-oldest"  # When full: "drop-oldest" or "coalesce" (fold repeats of the newest press)
+# Keymap file (see spotlight_core/keymap.py) for both modes: the "keys" of one of its device
+# profiles replace KEYS_TO_COMMANDS_CLIENT in client mode, its "commands" replace COMMAND_KEYS in
+# server mode. The file is watched, so an edit applies without restarting or reconnecting.
+KEYMAP_PATH = None  # e.g. "keymap.json"; None = use the mappings above
+KEYMAP_PROFILE = None  # Profile to use; None = the file's "profile"
+KEYMAP_RELOAD_INTERVAL = RELOAD_INTERVAL  # Seconds between checks for changes
+# A dropped connection is resumed with the token the server gave at pairing (no pairing round
+# trip), and the command being sent goes out in the same packet; the server runs it exactly once.
+SESSION_RESUMPTION = True
+
+# --- Configuration File, Environment and Command Line ---
+# The settings above can be changed without editing this script, so either mode can start
+# unattended: in CONFIG_PATH (JSON, e.g. {"mode": "server", "pairing-id": "1234"}), in SPOTLIGHT_*
+# environment variables (SPOTLIGHT_MODE=client) or on the command line (--mode client
+# --pairing-id 1234; --help lists them all). Later sources win; --config names another file.
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "single_ppt_sync.json")  # Read if it exists
+CONFIG_OPTIONS = {
+    "mode": "RUN_MODE",
+    "pairing-id": "PAIRING_ID",
+    "discovery-port": "DISCOVERY_PORT",
+    "command-port": "COMMAND_PORT",
+    "udp-command-port": "UDP_COMMAND_PORT",
+    "multicast-group": "DISCOVERY_MULTICAST_GROUP",
+    "retry-initial-delay": "RETRY_INITIAL_DELAY",
+    "retry-delay": "RETRY_DELAY",
+    "server-name": "SERVER_NAME",
+    "advertised-ip": "ADVERTISED_IP",
+    "async-server": "USE_ASYNC_SERVER",
+    "max-connections": "MAX_CONNECTIONS",
+    "idle-timeout": "IDLE_TIMEOUT",
+    "pairing-timeout": "PAIRING_TIMEOUT",
+    "session-ttl": "SESSION_TTL",
+    "backend": "INJECTOR_BACKEND",
+    "recording-log": "RECORDING_LOG_PATH",
+    "injection-worker": "USE_INJECTION_WORKER",
+    "ack-mode": "ACK_MODE",
+    "key-pause": "KEY_PAUSE",
+    "command-keys": "COMMAND_KEYS",
+    "overlay": "SPOTLIGHT_OVERLAY",
+    "motion-target": "MOTION_TARGET",
+    "floor-control": "FLOOR_CONTROL",
+    "floor-idle-timeout": "FLOOR_IDLE_TIMEOUT",
+    "controller-priorities": "CONTROLLER_PRIORITIES",
+    "metrics-path": "METRICS_EXPORT_PATH",
+    "log-level": "LOG_LEVEL",
+    "event-log": "EVENT_LOG_PATH",
+    "discovery-timeout": "DISCOVERY_TIMEOUT_CLIENT",
+    "server-cache": "SERVER_CACHE_PATH",
+    "keymap": "KEYS_TO_COMMANDS_CLIENT",
+    "repeat-policy": "REPEAT_POLICY",
+    "repeat-policies": "REPEAT_POLICY_PER_COMMAND",
+    "repeat-interval": "REPEAT_INTERVAL",
+    "bounce-time": "BOUNCE_TIME",
+    "hold-release-commands": "HOLD_RELEASE_COMMANDS",
+    "capture-queue-size": "CAPTURE_QUEUE_SIZE",
+    "capture-overflow": "CAPTURE_OVERFLOW_POLICY",
+    "keymap-file": "KEYMAP_PATH",
+    "keymap-profile": "KEYMAP_PROFILE",
+    "keymap-reload-interval": "KEYMAP_RELOAD_INTERVAL",
+    "session-resumption": "SESSION_RESUMPTION",
+}
+# Options that also take None ("none"), besides those whose default is None
+CONFIG_NULLABLE = {"udp-command-port", "multicast-group", "session-ttl", "motion-target", "server-cache"}
+# Options in seconds: they take fractions even where the default is a whole number
+CONFIG_SECONDS = {"retry-initial-delay", "retry-delay", "idle-timeout", "pairing-timeout", "session-ttl",
+                  "key-pause", "floor-idle-timeout", "discovery-timeout", "repeat-interval", "bounce-time",
+                  "keymap-reload-interval"}
+
+client_session_token = None
+client_session_grants = {}  # Paired socket -> token, filled by the pairing handshake (several may race)
+client_command_seq = itertools.count(1)  # Command sequence numbers, so the server can spot a re-sent one
 tcp_socket_client_global = None
+tcp_decoder_client_global = None
+client_capture_queue = None  # CaptureQueue filled by the key callbacks, drained by the sender thread
 keyboard_listener_client_global = None
 client_running_flag = True
 
 
 # --- Server Mode Functions ---
+def build_command_table_for_server():
+    """COMMAND_ACTIONS and COMMAND_TABLE for the configured COMMAND_KEYS. Called again when the keymap file changes."""
+    global COMMAND_ACTIONS, COMMAND_TABLE
+    actions = {command: (lambda key=key: INJECTOR.press(key)) for command, key in COMMAND_KEYS.items()}
+    actions.update({
+        "LASER_ON": lambda: set_spotlight_for_server(True),
+        "LASER_OFF": lambda: set_spotlight_for_server(False),
+    })
+    COMMAND_ACTIONS = actions
+    if COMMAND_TABLE is None:
+        COMMAND_TABLE = CommandTable(actions)
+    else:
+        COMMAND_TABLE.update(actions)  # Every connection holds this table and sees the new actions at once
 
-def handle_client_connection_for_server(conn, addr):
-    """Handles an incoming TCP connection for the server."""
-    # Uses SERVER_PAIRING_ID_GLOBAL
-    print(f"[TCP SERVER] Accepted connection from {addr}")
-    paired = False
-    try:
-        pairing_data = conn.recv(BUFFER_SIZE)
-        if not pairing_data:
-            print(f"[TCP SERVER] Connection closed by {addr} before pairing attempt.")
-            return
-
-        client_pairing_message = pairing_data.decode().strip()
-        print(f"[TCP SERVER] Received pairing message: '{client_pairing_message}' from {addr}")
-
-        expected_pairing_prefix = "PAIR_WITH_SERVER:"
-        if client_pairing_message.startswith(expected_pairing_prefix):
-            client_pairing_id = client_pairing_message[len(expected_pairing_prefix):]
-            if client_pairing_id == SERVER_PAIRING_ID_GLOBAL:
-                paired = True
-                conn.sendall(f"ACK:PAIRING_SUCCESSFUL".encode())
-                print(f"[TCP SERVER] Pairing successful with {addr}")
-            else:
-                conn.sendall(f"NACK:PAIRING_FAILED_MISMATCH".encode())
-                print(
-                    f"[TCP SERVER] Pairing failed with {addr}: ID mismatch. Expected '{SERVER_PAIRING_ID_GLOBAL}', got '{client_pairing_id}'.")
-                return
-        else:
-            conn.sendall(f"NACK:PAIRING_FAILED_BAD_FORMAT".encode())
-            print(f"[TCP SERVER] Pairing failed with {addr}: Bad pairing message format.")
-            return
 
-        if not paired:
-            print(f"[TCP SERVER] Pairing not established with {addr}. Closing connection.")
-            return
+def apply_keymap_for_server(keymap):
+    """Swaps in the command keys of a (re)loaded keymap. Runs on the keymap watcher's thread after start."""
+    global COMMAND_KEYS
+    COMMAND_KEYS = keymap.commands
+    build_command_table_for_server()
+    if INJECTION_WORKER is not None:
+        INJECTION_WORKER.keys = keymap.commands
+
+
+
+def set_spotlight_for_server(visible):
+    """LASER_ON / LASER_OFF action in server mode."""
+    if OVERLAY is None:
+        log.debug("[SPOTLIGHT] Laser %s command received (no overlay available)", "ON" if visible else "OFF")
+        return
+    if visible:
+        OVERLAY.show()
+    else:
+        OVERLAY.hide()
+
+
+def on_pointer_for_server(x, y, sampled_at):
+    """Pointer position from a client, as fractions of the screen size."""
+    if OVERLAY is not None:
+        OVERLAY.move(x, y, sampled_at)
+
+
+def on_motion_for_server(dx, dy):
+    """Relative pointer motion from a client, in the client's pixels."""
+    dx, dy = dx * MOTION_GAIN, dy * MOTION_GAIN
+    if MOTION_TARGET == "cursor" and CURSOR_MOTION is not None:
+        CURSOR_MOTION.add(dx, dy)  # Applied on the accumulator's thread; moving the cursor may block
+    elif MOTION_TARGET == "spotlight" and OVERLAY is not None:
+        OVERLAY.move_by(dx, dy)
 
-        while True:
-            data = conn.recv(BUFFER_SIZE)
-            if not data:
-                print(f"[TCP SERVER] Connection closed by {addr} after pairing.")
-                break
-            command = data.decode().strip()
-            print(f"[TCP SERVER] Received command: {command} from {addr}")
-
-            action = COMMAND_ACTIONS.get(command)
-            if action:
-                try:
-                    action()
-                    print(f"[TCP SERVER] Executed: {command}")
-                    conn.sendall(f"ACK:{command}".encode())
-                except Exception as e:
-                    print(f"[TCP SERVER] Error executing command {command}: {e}")
-                    print(f"[TCP SERVER] Ensure PyAutoGUI is working and the target window is active.")
-                    conn.sendall(f"NACK:{command} - Error: {e}".encode())
-            else:
-                print(f"[TCP SERVER] Unknown command: {command}")
-                conn.sendall(f"NACK:Unknown command {command}".encode())
-    except ConnectionResetError:
-        print(f"[TCP SERVER] Connection reset by {addr}")
-    except socket.timeout:
-        print(f"[TCP SERVER] Socket timeout during communication with {addr}.")
-    except Exception as e:
-        print(f"[TCP SERVER] Error during TCP communication with {addr}: {e}")
-    finally:
-        conn.close()
-        print(f"[TCP SERVER] Closed connection from {addr}")
+
+def handle_client_connection_for_server(conn, addr):
+    """Handles an incoming TCP connection for the server."""
+    serve_connection(conn, addr, COMMAND_TABLE, pairing_id=SERVER_PAIRING_ID_GLOBAL, bufsize=BUFFER_SIZE,
+                     metrics=LATENCY_METRICS, injector=INJECTION_WORKER, ack_mode=ACK_MODE,
+                     udp_sessions=UDP_SESSIONS, pointer=on_pointer_for_server,
+                     motion=on_motion_for_server, arbiter=ARBITER, sessions=RESUMABLE_SESSIONS)
 
 
-def start_tcp_server_mode():
-    """Starts the TCP server to listen for commands in server mode."""
+def start_tcp_server_mode(server_socket):
+    """Accepts commands on the (already listening) TCP socket in server mode."""
     # Uses SERVER_PAIRING_ID_GLOBAL
-    if not pyautogui:
-        print(
-            "[SERVER ERROR] PyAutoGUI library is not installed or failed to import. Server cannot simulate key presses.")
+    if not INJECTOR:
+        print("[SERVER ERROR] No input backend is available. Server cannot simulate key presses.")
         return
 
-    host_ip = '0.0.0.0'
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((host_ip, COMMAND_PORT))
-        server_socket.listen(5)
         print(f"[TCP SERVER] Listening for commands on TCP port {COMMAND_PORT}")
         print(
             f"[TCP SERVER] Server Pairing ID for this session: '{SERVER_PAIRING_ID_GLOBAL}'. Clients must match this.")
@@ -138,7 +307,7 @@ def start_tcp_server_mode():
             client_thread.daemon = True
             client_thread.start()
     except OSError as e:
-        print(f"[TCP SERVER] Error binding to port {COMMAND_PORT}: {e}. Is another program using it?")
+        print(f"[TCP SERVER] Error on TCP port {COMMAND_PORT}: {e}")
     except Exception as e:
         print(f"[TCP SERVER] An unexpected error occurred in TCP server: {e}")
     finally:
@@ -146,107 +315,52 @@ def start_tcp_server_mode():
         print("[TCP SERVER] TCP Server stopped.")
 
 
-def start_udp_discovery_server_mode():
-    """Starts the UDP server to listen for discovery broadcasts in server mode."""
-    # Uses SERVER_PAIRING_ID_GLOBAL
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def answer_discovery_for_server(message, client_address):
+    return build_discovery_reply(message, client_address, ADVERTISED_IP, COMMAND_PORT, SERVER_NAME,
+                                 SERVER_PAIRING_ID_GLOBAL)
 
-    server_ip_determined = "0.0.0.0"  # Default
-    try:
-        hostname = socket.gethostname()
-        try:
-            s_temp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s_temp.settimeout(1)
-            s_temp.connect(("8.8.8.8", 80))
-            server_ip_determined = s_temp.getsockname()[0]
-            s_temp.close()
-        except (OSError, socket.timeout):
-            server_ip_determined = socket.gethostbyname(hostname)
-            if server_ip_determined == "127.0.0.1":
-                all_ips = socket.getaddrinfo(hostname, None, socket.AF_INET)
-                for item in all_ips:
-                    if not item[4][0].startswith("127."):
-                        server_ip_determined = item[4][0]
-                        break
-    except socket.gaierror:
-        server_ip_determined = "127.0.0.1"
-        print("[UDP DISCOVERY] Warning: Could not determine reliable local IP. Responding with localhost.")
-    except Exception as e:
-        print(f"[UDP DISCOVERY] Error determining server IP: {e}. Will rely on client seeing UDP source IP.")
 
-    try:
-        udp_socket.bind(('', DISCOVERY_PORT))
-        print(f"[UDP DISCOVERY] Listening for discovery broadcasts on UDP port {DISCOVERY_PORT}")
-        print(f"[UDP DISCOVERY] Server Pairing ID: '{SERVER_PAIRING_ID_GLOBAL}'.")
-        print(f"[UDP DISCOVERY] Server will respond with IP: {server_ip_determined}")
-    except OSError as e:
-        print(f"[UDP DISCOVERY] Error binding to UDP port {DISCOVERY_PORT}: {e}.")
-        udp_socket.close()
-        return
+def on_injector_error_for_server(error):
+    """The input backend could not be opened (on its loading thread): nothing can be pressed."""
+    print(f"[FATAL SERVER ERROR] Input backend '{INJECTOR_BACKEND}' is required for server mode "
+          f"but is not usable: {error}")
+    os._exit(1)
+
+
+def start_udp_discovery_server_mode(udp_socket):
+    """Answers discovery broadcasts on the (already bound) UDP socket in server mode."""
+    # Uses SERVER_PAIRING_ID_GLOBAL
+    print(f"[UDP DISCOVERY] Listening for discovery broadcasts on UDP port {DISCOVERY_PORT}")
+    print(f"[UDP DISCOVERY] Server Pairing ID: '{SERVER_PAIRING_ID_GLOBAL}'.")
+    print(f"[UDP DISCOVERY] Server will respond with IP: {describe_advertised_ip(ADVERTISED_IP)}")
 
     while True:
         try:
             message, client_address = udp_socket.recvfrom(BUFFER_SIZE)
-            message_str = message.decode().strip()
-            print(f"[UDP DISCOVERY] Received discovery: '{message_str}' from {client_address}")
-
-            discovery_prefix = "SPOTLIGHT_CLIENT_DISCOVERY:"
-            if message_str.startswith(discovery_prefix):
-                client_pairing_id = message_str[len(discovery_prefix):]
-                if client_pairing_id == SERVER_PAIRING_ID_GLOBAL:
-                    ip_to_respond = server_ip_determined if server_ip_determined != "0.0.0.0" else client_address[0]
-                    response = f"SPOTLIGHT_SERVER_RESPONSE:{ip_to_respond}:{COMMAND_PORT}:{SERVER_NAME}"
-                    udp_socket.sendto(response.encode(), client_address)
-                    print(f"[UDP DISCOVERY] Correct Pairing ID. Sent response to {client_address}: {response}")
-                else:
-                    print(
-                        f"[UDP DISCOVERY] Incorrect Pairing ID from {client_address}. Expected '{SERVER_PAIRING_ID_GLOBAL}', got '{client_pairing_id}'. Ignoring.")
-            else:
-                print(f"[UDP DISCOVERY] Message from {client_address} not in expected format. Ignoring.")
+            response = answer_discovery_for_server(message, client_address)
+            if response:
+                udp_socket.sendto(response, client_address)
         except ConnectionResetError:
-            print(f"[UDP DISCOVERY] Connection reset error (UDP) from {client_address}. Ignoring.")
+            log.debug("[UDP DISCOVERY] Connection reset error (UDP) from %s. Ignoring.", client_address)
         except Exception as e:
-            print(f"[UDP DISCOVERY] Error in discovery loop: {e}")
+            log.error("[UDP DISCOVERY] Error in discovery loop: %s", e)
             time.sleep(1)
 
 
 # --- Client Mode Functions ---
+def apply_keymap_for_client(keymap):
+    """Swaps in the key mappings of a (re)loaded keymap. Runs on the keymap watcher's thread after start."""
+    global KEYS_TO_COMMANDS_CLIENT
+    KEYS_TO_COMMANDS_CLIENT = keymap.keys
 
-def discover_server_for_client(pairing_id_to_use):
-    """Attempts to discover the server in client mode."""
-    print(f"\n[CLIENT UDP DISCOVERY] Attempting discovery with Pairing ID: {pairing_id_to_use}...")
-    discover_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    discover_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    discover_socket.settimeout(DISCOVERY_TIMEOUT_CLIENT)
 
-    discovery_message = f"SPOTLIGHT_CLIENT_DISCOVERY:{pairing_id_to_use}"
-    server_details = None
-    try:
-        discover_socket.sendto(discovery_message.encode(), ('<broadcast>', DISCOVERY_PORT))
-        print(f"[CLIENT UDP DISCOVERY] Sent: '{discovery_message}'")
-        while True:
-            try:
-                data, addr = discover_socket.recvfrom(BUFFER_SIZE)
-                response = data.decode().strip()
-                print(f"[CLIENT UDP DISCOVERY] Received: '{response}' from {addr}")
-                response_prefix = "SPOTLIGHT_SERVER_RESPONSE:"
-                if response.startswith(response_prefix):
-                    parts = response[len(response_prefix):].split(':')
-                    if len(parts) == 3:
-                        server_ip, port_str, name = parts
-                        server_details = (server_ip, int(port_str), name)
-                        print(f"[CLIENT UDP DISCOVERY] Server '{name}' found at {server_ip}:{port_str}")
-                        break
-            except socket.timeout:
-                print(f"[CLIENT UDP DISCOVERY] No server responded.")
-                break
-    except Exception as e:
-        print(f"[CLIENT UDP DISCOVERY] Error: {e}")
-    finally:
-        discover_socket.close()
-    return server_details
+
+def discover_server_for_client(pairing_id_to_use, cancel=None):
+    """Attempts to discover the server in client mode. Returns (ip, port, name) or None."""
+    log.info("[CLIENT UDP DISCOVERY] Attempting discovery with Pairing ID: %s...", pairing_id_to_use)
+    return discover(DISCOVERY_PREFIX + pairing_id_to_use, DISCOVERY_PORT, timeout=DISCOVERY_TIMEOUT_CLIENT,
+                    multicast_group=DISCOVERY_MULTICAST_GROUP, bufsize=BUFFER_SIZE, cancel=cancel,
+                    tag="[CLIENT UDP DISCOVERY]")
 
 
 def send_command_from_client(command):
@@ -254,24 +368,34 @@ def send_command_from_client(command):
     global tcp_socket_client_global, client_running_flag, keyboard_listener_client_global
     if tcp_socket_client_global:
         try:
-            print(f"[CLIENT KEY CAPTURE] Sending: {command}")
-            tcp_socket_client_global.sendall(command.encode())
+            log.debug("[CLIENT KEY CAPTURE] Sending: %s", command)
+            seq = next(client_command_seq)
+            sent_us = now_us()
+            tcp_socket_client_global.sendall(protocol.encode_command(command, seq, sent_us))
             tcp_socket_client_global.settimeout(5.0)
-            response_data = tcp_socket_client_global.recv(BUFFER_SIZE)
+            reply = protocol.recv_frame(tcp_socket_client_global, tcp_decoder_client_global, BUFFER_SIZE)
             tcp_socket_client_global.settimeout(None)
-            if not response_data:
-                print("[CLIENT TCP] Server disconnected after command.")
+            if reply is None and client_session_token and resume_client_session(command, seq):
+                return True
+            if reply is None:
+                log.warning("[CLIENT TCP] Server disconnected after command.")
                 if keyboard_listener_client_global and keyboard_listener_client_global.is_alive():
                     keyboard_listener_client_global.stop()
                 client_running_flag = False
                 return False
-            print(f"[CLIENT TCP] Server response: {response_data.decode().strip()}")
+            rtt_ms = (now_us() - sent_us) / 1000
+            parsed = protocol.parse_reply(reply)
+            server_ms = (parsed.server_queue_us + parsed.injection_us) / 1000 if parsed else 0.0
+            log.debug("[CLIENT TCP] Server response: %s (%.1f ms round trip, server %.1f ms)",
+                      protocol.format_reply(reply), rtt_ms, server_ms)
             return True
         except socket.timeout:
-            print("[CLIENT TCP] Timeout waiting for server ACK/NACK.")
+            log.warning("[CLIENT TCP] Timeout waiting for server ACK/NACK.")
             return False
-        except socket.error as e:
-            print(f"[CLIENT TCP] Socket error sending '{command}': {e}")
+        except (socket.error, protocol.ProtocolError) as e:
+            log.error("[CLIENT TCP] Socket error sending '%s': %s", command, e)
+            if client_session_token and resume_client_session(command, seq):
+                return True
             if keyboard_listener_client_global and keyboard_listener_client_global.is_alive():
                 keyboard_listener_client_global.stop()
             client_running_flag = False
@@ -279,58 +403,116 @@ def send_command_from_client(command):
     return False
 
 
+def resume_client_session(command, seq):
+    """
+    Reconnects after a drop by resuming the session instead of pairing, with the command that was
+    being sent in the same packet (the server runs it only if it had not already). Returns True
+    once the command is acknowledged on the new connection.
+    """
+    global tcp_socket_client_global, tcp_decoder_client_global, client_session_token
+    log.warning("[CLIENT TCP] Connection lost while sending '%s'. Resuming the session...", command)
+    rejected = []
+
+    def handshake(sock, decoder):
+        sock.settimeout(10.0)
+        try:
+            return resume(sock, decoder, client_session_token, [(seq, command)], BUFFER_SIZE)
+        except ResumeRejected as e:
+            rejected.append(e)
+            raise
+
+    server = locate_server(SERVER_CACHE, CLIENT_PAIRING_ID_GLOBAL,
+                           lambda cancel: discover_server_for_client(CLIENT_PAIRING_ID_GLOBAL, cancel),
+                           handshake=handshake, tag="[CLIENT TCP]")
+    if server is None:
+        if rejected:
+            log.warning("[CLIENT TCP] The server no longer knows this session (restarted?).")
+            client_session_token = None
+        return False
+    old_socket = tcp_socket_client_global
+    tcp_socket_client_global, tcp_decoder_client_global = server.sock, server.decoder
+    if old_socket:
+        old_socket.close()
+    try:
+        server.sock.settimeout(5.0)
+        reply = protocol.recv_frame(server.sock, server.decoder, BUFFER_SIZE)
+        server.sock.settimeout(None)
+    except (socket.error, protocol.ProtocolError) as e:
+        log.error("[CLIENT TCP] Resumed session lost again: %s", e)
+        return False
+    if reply is None:
+        return False
+    log.info("[CLIENT TCP] Resumed session with '%s' at %s:%s (no pairing round trip). %s: %s",
+             server.name, server.ip, server.port, command, protocol.format_reply(reply))
+    return True
+
+
 def on_press_for_client(key):
     """Callback for key presses in client mode."""
     # Uses KEYS_TO_COMMANDS_CLIENT
-    command = KEYS_TO_COMMANDS_CLIENT.get(key)
+    name = key_name(key)
+    command = KEYS_TO_COMMANDS_CLIENT.get(name)
+    if command and KEY_DEBOUNCER.press(name, command):  # Auto-repeats and bounces stop here
+        # Only timestamp and enqueue here: this runs inside the OS input hook.
+        client_capture_queue.put(command)
+
+
+def on_release_for_client(key):
+    """Callback for key releases in client mode."""
+    KEY_DEBOUNCER.release(key_name(key))  # The end of a "hold" press goes to on_hold_release_for_client
+
+
+def on_hold_release_for_client(name):
+    """Called by KEY_DEBOUNCER once the key of a "hold" press has come up for good (maybe on its timer thread)."""
+    command = HOLD_RELEASE_COMMANDS.get(KEYS_TO_COMMANDS_CLIENT.get(name))
     if command:
-        send_command_from_client(command)
+        client_capture_queue.put(command)
 
 
-def connect_and_listen_as_client(server_ip, server_port, pairing_id_to_use):
-    """Connects to server, pairs, and starts key listener in client mode."""
-    global tcp_socket_client_global, keyboard_listener_client_global, client_running_flag
-    client_running_flag = True
-    tcp_socket_client_global = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        print(f"\n[CLIENT TCP] Connecting to server at {server_ip}:{server_port}...")
-        tcp_socket_client_global.connect((server_ip, server_port))
-        print(f"[CLIENT TCP] Connected.")
-
-        tcp_pairing_msg = f"PAIR_WITH_SERVER:{pairing_id_to_use}"
-        print(f"[CLIENT TCP] Sending pairing: '{tcp_pairing_msg}'")
-        tcp_socket_client_global.sendall(tcp_pairing_msg.encode())
-        tcp_socket_client_global.settimeout(10.0)
-        pairing_response_data = tcp_socket_client_global.recv(BUFFER_SIZE)
-        tcp_socket_client_global.settimeout(None)
-
-        if not pairing_response_data:
-            print("[CLIENT TCP] Server disconnected during pairing.")
-            client_running_flag = False
-            return
+def send_captured_command_from_client(command, captured_at):
+    """Called on the sender thread for every key press taken from client_capture_queue."""
+    if not send_command_from_client(command):
+        log.warning("[CLIENT KEY CAPTURE] Failed to send command '%s'.", command)
 
-        pairing_response = pairing_response_data.decode().strip()
-        print(f"[CLIENT TCP] Pairing response: '{pairing_response}'")
 
-        if pairing_response == "ACK:PAIRING_SUCCESSFUL":
-            print("[CLIENT TCP] Pairing successful!")
-            print("\n--- CLIENT LISTENING FOR KEYS ---")
-            print("Press mapped keys to send commands. To STOP: Ctrl+C or close terminal.")
+def pair_with_server_as_client(sock, decoder, pairing_id_to_use):
+    """Pairing on a fresh connection (locate_server's handshake). Returns True if the server accepted us."""
+    log.info("[CLIENT TCP] Sending pairing request with ID '%s' to %s", pairing_id_to_use, sock.getpeername()[0])
+    sock.settimeout(10.0)
+    if SESSION_RESUMPTION:
+        paired, pairing_response, token = pair_resumable(sock, decoder, pairing_id_to_use, BUFFER_SIZE)
+        if token:
+            client_session_grants[sock] = token
+    else:
+        paired, pairing_response = protocol.pair(sock, decoder, pairing_id_to_use, BUFFER_SIZE)
+    if pairing_response is None:
+        log.warning("[CLIENT TCP] Server disconnected during pairing.")
+    elif not paired:
+        log.warning("[CLIENT TCP] Pairing failed: %s.", pairing_response)
+    return paired
 
-            if keyboard_listener_client_global and keyboard_listener_client_global.is_alive():
-                keyboard_listener_client_global.stop()
-            keyboard_listener_client_global = keyboard.Listener(on_press=on_press_for_client)
-            keyboard_listener_client_global.start()
-            while client_running_flag and keyboard_listener_client_global.is_alive():
-                time.sleep(0.1)
-            print("[CLIENT TCP] Exited listening loop.")
-        else:
-            print(f"[CLIENT TCP] Pairing failed: {pairing_response}.")
-            client_running_flag = False
-    except socket.timeout:
-        print(f"[CLIENT TCP] Timeout during pairing.")
-        client_running_flag = False
-    except socket.error as e:
+
+def connect_and_listen_as_client(server):
+    """Starts the key listener in client mode on a connected, paired server (a server_cache.FoundServer)."""
+    global tcp_socket_client_global, tcp_decoder_client_global, keyboard_listener_client_global, client_running_flag
+    client_running_flag = True
+    tcp_socket_client_global = server.sock
+    tcp_decoder_client_global = server.decoder
+    try:
+        print(f"[CLIENT TCP] Pairing successful with '{server.name}' at {server.ip}:{server.port} "
+              f"(via {server.source}, connect RTT {server.connect_rtt * 1000:.1f} ms)!")
+        print("\n--- CLIENT LISTENING FOR KEYS ---")
+        print("Press mapped keys to send commands. To STOP: Ctrl+C or close terminal.")
+
+        if keyboard_listener_client_global and keyboard_listener_client_global.is_alive():
+            keyboard_listener_client_global.stop()
+        keyboard_listener_client_global = keyboard.Listener(on_press=on_press_for_client,
+                                                            on_release=on_release_for_client)
+        keyboard_listener_client_global.start()
+        while client_running_flag and keyboard_listener_client_global.is_alive():
+            time.sleep(0.1)
+        print("[CLIENT TCP] Exited listening loop.")
+    except (socket.error, protocol.ProtocolError) as e:
         print(f"[CLIENT TCP] Socket error: {e}")
         client_running_flag = False
     finally:
@@ -340,107 +522,214 @@ def connect_and_listen_as_client(server_ip, server_port, pairing_id_to_use):
         if tcp_socket_client_global:
             tcp_socket_client_global.close()
         tcp_socket_client_global = None
+        tcp_decoder_client_global = None
         keyboard_listener_client_global = None
 
 
+def start_keymap(apply):
+    """
+    Loads KEYMAP_PATH, hands it to apply (apply_keymap_for_server or apply_keymap_for_client) and
+    starts watching the file. Raises KeymapError.
+    """
+    watcher = KeymapWatcher(KEYMAP_PATH, apply, KEYMAP_PROFILE, base_keys=KEYS_TO_COMMANDS_CLIENT,
+                            base_commands=COMMAND_KEYS, interval=KEYMAP_RELOAD_INTERVAL)
+    keymap = watcher.load()
+    apply(keymap)
+    watcher.start()
+    print(f"[KEYMAP] Using profile '{keymap.profile}' from {KEYMAP_PATH}")
+
+
 # --- Main Execution Logic ---
 if __name__ == "__main__":
+    try:
+        config_sources = load_config(globals(), CONFIG_OPTIONS, default_path=CONFIG_PATH,
+                                     nullable=CONFIG_NULLABLE, seconds=CONFIG_SECONDS,
+                                     description="Combined Spotlight server & client (Version 2)")
+        if RUN_MODE and RUN_MODE.strip().lower() not in ("server", "client"):
+            raise ConfigError(f"mode: expected 'server' or 'client', got {RUN_MODE!r}")
+    except ConfigError as e:
+        print(f"[FATAL ERROR] Configuration: {e}")
+        sys.exit(2)
+    setup_logging(LOG_LEVEL, EVENT_LOG_PATH)
     print("--- Combined Spotlight Server & Client ---")
+    if config_sources:
+        print(f"[CONFIG] Settings from outside this script: {describe_sources(config_sources)}")
 
-    selected_mode = ""
-    while selected_mode not in ["server", "client"]:
-        selected_mode = input("Run as 'server' or 'client'?: ").strip().lower()
+    try:
+        selected_mode = RUN_MODE.strip().lower() or ask("mode", "Run as 'server' or 'client'?: ", ("server", "client"))
+    except ConfigError as e:
+        print(f"[FATAL ERROR] {e}")
+        sys.exit(2)
 
     if selected_mode == "server":
         print("\n--- Starting in SERVER Mode ---")
-        if not pyautogui:
-            print(
-                "[FATAL SERVER ERROR] PyAutoGUI library is required for server mode but not found. Please install it (`pip install pyautogui`) and try again.")
+        try:
+            if KEYMAP_PATH:
+                start_keymap(apply_keymap_for_server)
+            else:
+                build_command_table_for_server()
+        except KeymapError as e:
+            print(f"[FATAL SERVER ERROR] {e}")
+            sys.exit(2)
+        try:
+            INJECTOR = LazyInjector(INJECTOR_BACKEND, pause=KEY_PAUSE, record_path=RECORDING_LOG_PATH,
+                                    on_error=on_injector_error_for_server)
+        except ValueError as e:
+            print(f"[FATAL SERVER ERROR] Input backend '{INJECTOR_BACKEND}' is required for server mode "
+                  f"but is not usable: {e}")
             exit()
+        INJECTOR.load()  # Opens while the pairing ID is read (or typed)
 
-        while not SERVER_PAIRING_ID_GLOBAL:
-            temp_id = input("Enter Pairing ID for this server session (cannot be empty): ").strip()
-            if temp_id:
-                SERVER_PAIRING_ID_GLOBAL = temp_id
-            else:
-                print("Pairing ID cannot be empty.")
+        try:
+            SERVER_PAIRING_ID_GLOBAL = PAIRING_ID or ask(
+                "pairing-id", "Enter Pairing ID for this server session (cannot be empty): ")
+        except ConfigError as e:
+            print(f"[FATAL SERVER ERROR] {e}")
+            sys.exit(2)
         print(f"Server Pairing ID set to: '{SERVER_PAIRING_ID_GLOBAL}'")
+        UDP_SESSIONS = UdpSessions(UDP_COMMAND_PORT) if UDP_COMMAND_PORT is not None else None
+        RESUMABLE_SESSIONS = ResumableSessions(SESSION_TTL) if SESSION_TTL is not None else None
+        ARBITER = CommandArbiter(CONTROLLER_PRIORITIES, NAVIGATION_COMMANDS if FLOOR_CONTROL else (),
+                                 FLOOR_IDLE_TIMEOUT)
+        # Ports first: clients starting at the same time find this server while the rest loads
+        listener = EarlyListener(COMMAND_PORT, DISCOVERY_PORT, answer_discovery_for_server,
+                                 DISCOVERY_MULTICAST_GROUP, LISTEN_BACKLOG, bufsize=BUFFER_SIZE)
+        try:
+            listener.start()
+        except OSError as e:
+            print(f"[FATAL SERVER ERROR] Could not bind TCP port {COMMAND_PORT} / UDP port {DISCOVERY_PORT}: {e}. "
+                  f"Is another program using it?")
+            exit()
         print("Ensure client uses this exact ID.")
         print("Server will simulate key presses based on received commands.")
         print("To stop server: Ctrl+C in this terminal.")
 
-        # Start UDP discovery in a separate thread
-        discovery_thread = threading.Thread(target=start_udp_discovery_server_mode)
-        discovery_thread.daemon = True
-        discovery_thread.start()
-
-        # Start TCP command server in the main thread (blocks here)
-        start_tcp_server_mode()
+        if USE_INJECTION_WORKER:
+            INJECTION_WORKER = InjectionWorker(INJECTOR.press, COMMAND_KEYS, pause=KEY_PAUSE)
+            INJECTION_WORKER.start()
+            LATENCY_METRICS.add_gauge_source("injection", INJECTION_WORKER.stats)
+        if MOTION_TARGET == "cursor":
+            CURSOR_MOTION = MotionAccumulator(INJECTOR.move, MOTION_RATE_HZ)
+            CURSOR_MOTION.start()
+            LATENCY_METRICS.add_gauge_source("cursor_motion", CURSOR_MOTION.stats)
+        if SPOTLIGHT_OVERLAY:
+            try:  # Waits up to 5 s for the window; clients can already connect meanwhile
+                smoother = PointerSmoother(SMOOTHING_MIN_CUTOFF, SMOOTHING_BETA, prediction=SMOOTHING_PREDICTION,
+                                           metrics=LATENCY_METRICS) if POINTER_SMOOTHING else None
+                overlay = SpotlightOverlay(SPOTLIGHT_RADIUS, SPOTLIGHT_DIM, SPOTLIGHT_REFRESH_HZ, smoother)
+                overlay.start()
+                OVERLAY = overlay
+                LATENCY_METRICS.add_gauge_source("spotlight", OVERLAY.stats)
+                if smoother is not None:
+                    LATENCY_METRICS.add_gauge_source("pointer_smoothing", smoother.stats)
+            except OverlayUnavailable as e:
+                print(f"[SPOTLIGHT] Overlay not available ({e}); LASER_ON/LASER_OFF will only be logged.")
+        LATENCY_METRICS.add_gauge_source("arbiter", ARBITER.stats)
+        if METRICS_EXPORT_PATH:
+            start_periodic_export(LATENCY_METRICS, METRICS_EXPORT_PATH, METRICS_EXPORT_INTERVAL)
+        if USE_ASYNC_SERVER:
+            from spotlight_core.aio_server import AsyncSpotlightServer  # asyncio takes a while to import
+
+            # TCP commands and UDP discovery on one event loop (blocks here)
+            AsyncSpotlightServer(COMMAND_TABLE, pairing_id=SERVER_PAIRING_ID_GLOBAL, port=COMMAND_PORT,
+                                 discovery_port=DISCOVERY_PORT, server_name=SERVER_NAME,
+                                 advertised_ip=ADVERTISED_IP, max_connections=MAX_CONNECTIONS,
+                                 backlog=LISTEN_BACKLOG, idle_timeout=IDLE_TIMEOUT,
+                                 pairing_timeout=PAIRING_TIMEOUT, bufsize=BUFFER_SIZE,
+                                 metrics=LATENCY_METRICS, injector=INJECTION_WORKER, ack_mode=ACK_MODE,
+                                 multicast_group=DISCOVERY_MULTICAST_GROUP, udp_command_port=UDP_COMMAND_PORT,
+                                 pointer=on_pointer_for_server, motion=on_motion_for_server,
+                                 arbiter=ARBITER, session_ttl=SESSION_TTL, sockets=listener.take_over()).run()
+        else:
+            # Start UDP discovery in a separate thread
+            tcp_socket, udp_socket = listener.take_over()
+            discovery_thread = threading.Thread(target=start_udp_discovery_server_mode, args=(udp_socket,))
+            discovery_thread.daemon = True
+            discovery_thread.start()
+            if UDP_SESSIONS is not None:
+                start_udp_command_server(UDP_SESSIONS, bufsize=BUFFER_SIZE)
+
+            # Start TCP command server in the main thread (blocks here)
+            start_tcp_server_mode(tcp_socket)
+        if METRICS_EXPORT_PATH:
+            try:
+                LATENCY_METRICS.write(METRICS_EXPORT_PATH)
+                print(f"[METRICS] Latency metrics written to {METRICS_EXPORT_PATH}")
+            except OSError as e:
+                print(f"[METRICS] Could not write metrics to {METRICS_EXPORT_PATH}: {e}")
         print("Server mode has shut down.")
 
     elif selected_mode == "client":
         print("\n--- Starting in CLIENT Mode ---")
+        preload_pynput()  # Imports while the pairing ID is read (or typed) and the server located
         print(
             "IMPORTANT: Ensure your presentation remote (e.g., Logitech Spotlight) is connected to THIS computer.")  # ADDED THIS LINE
-        if not keyboard:
-            print(
-                "[FATAL CLIENT ERROR] Pynput library is required for client mode but not found. Please install it (`pip install pynput`) and try again.")
-            exit()
 
-        # Populate client key mappings now that we know pynput.keyboard is available
-        KEYS_TO_COMMANDS_CLIENT = {
-            keyboard.Key.right: "NEXT",
-            keyboard.Key.left: "PREVIOUS",
-            keyboard.Key.f5: "START_PRESENTATION",
-            keyboard.KeyCode.from_char('b'): "BLACK_SCREEN",
-            keyboard.KeyCode.from_char('B'): "BLACK_SCREEN",
-            keyboard.Key.esc: "EXIT_SLIDESHOW",
-        }
-
-        while not CLIENT_PAIRING_ID_GLOBAL:
-            temp_id = input("Enter Pairing ID to connect to server (must match server's, cannot be empty): ").strip()
-            if temp_id:
-                CLIENT_PAIRING_ID_GLOBAL = temp_id
-            else:
-                print("Pairing ID cannot be empty.")
+        try:
+            CLIENT_PAIRING_ID_GLOBAL = PAIRING_ID or ask(
+                "pairing-id", "Enter Pairing ID to connect to server (must match server's, cannot be empty): ")
+        except ConfigError as e:
+            print(f"[FATAL CLIENT ERROR] {e}")
+            sys.exit(2)
         print(f"Client will use Pairing ID: '{CLIENT_PAIRING_ID_GLOBAL}'")
+        try:
+            if KEYMAP_PATH:
+                start_keymap(apply_keymap_for_client)
+            else:
+                KEYS_TO_COMMANDS_CLIENT = compile_keys(KEYS_TO_COMMANDS_CLIENT, "KEYS_TO_COMMANDS_CLIENT")
+        except KeymapError as e:
+            print(f"[FATAL CLIENT ERROR] {e}")
+            sys.exit(2)
         print(
             "Client will capture key presses from the connected remote and send commands to the server.")  # Slightly rephrased
         print("To stop client: Ctrl+C in this terminal.")
 
-        # Main client loop
-        while client_running_flag:
-            server_info = discover_server_for_client(CLIENT_PAIRING_ID_GLOBAL)
-            if server_info:
-                ip, port, name = server_info
-                connect_and_listen_as_client(ip, port, CLIENT_PAIRING_ID_GLOBAL)
-
-                if not client_running_flag:  # If connect_and_listen set it to False (e.g. error)
-                    retry_choice = input(
-                        "Session ended or error. Attempt new discovery & connection? (y/n): ").strip().lower()
-                    if retry_choice == 'y':
-                        client_running_flag = True  # Reset for new attempt
-                        CLIENT_PAIRING_ID_GLOBAL = ""  # Prompt for new pairing ID for a fresh session
-                        while not CLIENT_PAIRING_ID_GLOBAL:
-                            temp_id = input("Enter Pairing ID for new session: ").strip()
-                            if temp_id:
-                                CLIENT_PAIRING_ID_GLOBAL = temp_id
-                            else:
-                                print("Pairing ID cannot be empty.")
-                        print(f"Using new Pairing ID: '{CLIENT_PAIRING_ID_GLOBAL}'")
+        try:
+            client_capture_queue = CaptureQueue(CAPTURE_QUEUE_SIZE, CAPTURE_OVERFLOW_POLICY)
+            KEY_DEBOUNCER = KeyDebouncer(REPEAT_POLICY, REPEAT_INTERVAL, BOUNCE_TIME, REPEAT_POLICY_PER_COMMAND,
+                                         on_release=on_hold_release_for_client)
+        except ValueError as e:
+            print(f"[FATAL CLIENT ERROR] {e}")
+            sys.exit(2)
+        client_sender_thread = SenderThread(client_capture_queue, send_captured_command_from_client)
+        client_sender_thread.start()
+        SERVER_CACHE = ServerCache(SERVER_CACHE_PATH)
+
+        # Main client loop: runs until Ctrl+C. Lost sessions and failed searches are retried
+        # automatically, the first time after RETRY_INITIAL_DELAY seconds.
+        retry_backoff = Backoff(RETRY_INITIAL_DELAY, maximum=RETRY_DELAY)
+        try:
+            while True:
+                # Cached servers for this pairing ID are tried directly while discovery runs in the background
+                client_session_grants.clear()
+                server = locate_server(
+                    SERVER_CACHE, CLIENT_PAIRING_ID_GLOBAL,
+                    lambda cancel: discover_server_for_client(CLIENT_PAIRING_ID_GLOBAL, cancel),
+                    handshake=lambda sock, decoder: pair_with_server_as_client(sock, decoder, CLIENT_PAIRING_ID_GLOBAL),
+                    tag="[CLIENT TCP]")
+                if server:
+                    client_session_token = client_session_grants.pop(server.sock, None)  # The winning connection's
+                    if keyboard is None:  # pynput was importing in the background while the server was located
+                        try:
+                            keyboard = load_pynput().keyboard
+                        except CaptureUnavailable as e:
+                            print(f"[FATAL CLIENT ERROR] {e}. Pynput is required for client mode.")
+                            server.sock.close()
+                            break
+                    retry_backoff.reset()
+                    connect_and_listen_as_client(server)
+
+                    if not client_running_flag:  # connect_and_listen set it to False (e.g. error)
+                        print("Session ended due to an error.")
                     else:
-                        break  # Exit main client loop
-            else:  # Server not found
-                print("Server not found with current Pairing ID.")
-
-            if client_running_flag:  # If still running (no critical error, or user chose to retry current ID)
-                retry_choice = input(
-                    f"Retry discovery with Pairing ID '{CLIENT_PAIRING_ID_GLOBAL}'? (y/n): ").strip().lower()
-                if retry_choice != 'y':
-                    break  # Exit main client loop
-                print(f"Waiting {RETRY_DELAY} seconds before retrying...")
-                time.sleep(RETRY_DELAY)
+                        print("Session ended.")
+                else:  # Server not found
+                    print("Server not found with current Pairing ID.")
+
+                delay = retry_backoff.next()
+                print(f"Retrying with Pairing ID '{CLIENT_PAIRING_ID_GLOBAL}' in {delay:.2f} seconds...")
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            print("\nClient interrupted by Ctrl+C. Shutting down.")
+        client_sender_thread.stop()
         print("Client mode has shut down.")
-
-    else:
-        print("Invalid mode selected. Exiting.")
@@ -3,138 +3,337 @@
 # Now with direct key capture for presenter controls!
 # ESC key no longer exits this client script. It can be mapped to a command.
 
+import os
 import socket
+import sys
 import time
 import threading  # For handling listener in a way that allows main thread to manage connection
-from pynput import keyboard  # For capturing key presses
+
+# The shared protocol code lives in the spotlight_core package at the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spotlight_core import protocol
+from spotlight_core.capture import CaptureQueue, KeyDebouncer, SenderThread
+from spotlight_core.config import ConfigError, ask, describe_sources, load_config
+from spotlight_core.connection import Backoff
+from spotlight_core.discovery import DISCOVERY_PREFIX, MULTICAST_GROUP, discover
+from spotlight_core.keymap import RELOAD_INTERVAL, KeymapError, KeymapWatcher, compile_keys
+from spotlight_core.keys import CaptureUnavailable, key_name, load_pynput, preload_pynput
+from spotlight_core.log import get_logger, setup_logging
+from spotlight_core.metrics import LatencyRecorder, now_us, record_reply, start_periodic_export
+from spotlight_core.pipeline import PipelinedSender
+from spotlight_core.server_cache import DEFAULT_CACHE_PATH, ServerCache, locate_server
+from spotlight_core.sessions import ResumeRejected, pair_resumable, resume
 
 # --- Configuration ---
 DISCOVERY_PORT = 50000
 BUFFER_SIZE = 1024
-DISCOVERY_TIMEOUT = 5
+DISCOVERY_TIMEOUT = 5  # Upper bound; discovery returns as soon as a server answers
+DISCOVERY_MULTICAST_GROUP = MULTICAST_GROUP  # Discovery is also sent to this IPv4 group (None = broadcast only)
+# A lost session or a failed search is retried automatically, after RETRY_INITIAL_DELAY seconds
+# and then backing off (with jitter) up to RETRY_DELAY seconds between attempts.
+RETRY_INITIAL_DELAY = 0.05
 RETRY_DELAY = 2
+# Servers we paired with are remembered here (pairing ID, name, IP, port, RTT) and tried
+# directly on the next start, so the same-room case connects without waiting for discovery.
+SERVER_CACHE_PATH = DEFAULT_CACHE_PATH  # None = remember them in memory only
+ACK_TIMEOUT = 5.0  # seconds to wait for the server's ACK/NACK of a command
+# Pipelined mode sends each command immediately and matches ACKs on a background thread
+# instead of blocking the key listener for a full round trip. False = stop-and-wait.
+PIPELINED_SENDING = True
+PIPELINE_WINDOW = 8  # Max commands awaiting an ACK at once
+# In pipelined mode the client PINGs the server every HEARTBEAT_INTERVAL seconds. After
+# HEARTBEAT_MISSES intervals without any data from the server the connection counts as lost,
+# and the client reconnects (and re-pairs) in the background while the key listener keeps running.
+HEARTBEAT_INTERVAL = 1.0  # seconds; None = no heartbeat (TCP keepalive still applies)
+HEARTBEAT_MISSES = 3
+RECONNECT_MAX_DELAY = 5  # Background reconnects back off up to this many seconds between attempts
+# The server hands out a session token at pairing. A background reconnect presents it instead of
+# pairing again, in the same packet as the commands still waiting for an ACK, and the server runs
+# each of those exactly once. False = pair again on every reconnect (unacknowledged commands are lost).
+SESSION_RESUMPTION = True
+# Key presses are queued by the key listener and sent from a separate thread, so network I/O
+# never runs inside the OS input hook.
+CAPTURE_QUEUE_SIZE = 64  # Max key presses waiting to be sent
+CAPTURE_OVERFLOW_POLICY = "drop-oldest"  # When full: "drop-oldest" or "coalesce" (fold repeats of the newest press)
+# Held and bouncing keys: a held remote button makes the OS repeat its press many times a second,
+# and cheap remotes report one click as several. Only real presses are queued and sent.
+REPEAT_POLICY = "ignore"  # Repeats of a held key: "ignore", "rate-limit" (one per REPEAT_INTERVAL) or "hold"
+REPEAT_POLICY_PER_COMMAND = {}  # Overrides REPEAT_POLICY, e.g. {"NEXT": "rate-limit", "LASER_ON": "hold"}
+REPEAT_INTERVAL = 0.25  # seconds ("rate-limit")
+BOUNCE_TIME = 0.03  # A press this soon (seconds) after the key came up is the same press bouncing; 0 = off
+HOLD_RELEASE_COMMANDS = {"LASER_ON": "LASER_OFF"}  # "hold": sent when the key of the command comes up
+# Latency metrics (key press -> ACK per stage, p50/p95/p99 per command). Written on exit and
+# every METRICS_EXPORT_INTERVAL seconds: Prometheus text for .prom/.txt paths, JSON otherwise.
+METRICS_EXPORT_PATH = None  # e.g. "spotlight_client_metrics.json"; None = don't export
+METRICS_EXPORT_INTERVAL = 30  # seconds
+# Logging goes through a background writer thread so console output never delays a key press.
+# "INFO" = connection events and errors only, "DEBUG" = every command and ACK as well.
+LOG_LEVEL = "INFO"
+EVENT_LOG_PATH = None  # e.g. "spotlight_client_events.jsonl": every event, DEBUG included, as JSON lines
 
 # --- Client Specific ---
-CLIENT_PAIRING_ID = ""  # Will be set from user input
+# Must match the server's pairing ID. Set it in the configuration (see CONFIG_OPTIONS below);
+# if it is left empty, it is asked for when the client is started from a terminal.
+CLIENT_PAIRING_ID = ""
 
 # --- Key Mappings (from user) ---
 # Map specific keys to commands to be sent to the server.
+# Keys are given by name: pynput's keyboard.Key names ('right', 'f5', 'esc', ...) or the
+# character typed ('b'), so pynput can be imported in the background while the client starts.
 KEYS_TO_COMMANDS = {
-    keyboard.Key.right: "NEXT",
-    keyboard.Key.left: "PREVIOUS",
-    keyboard.Key.f5: "START_PRESENTATION",
-    keyboard.KeyCode.from_char('b'): "BLACK_SCREEN",
-    keyboard.KeyCode.from_char('B'): "BLACK_SCREEN",  # Case-insensitive for 'b'
+    "right": "NEXT",
+    "left": "PREVIOUS",
+    "f5": "START_PRESENTATION",
+    "b": "BLACK_SCREEN",
+    "B": "BLACK_SCREEN",  # Case-insensitive for 'b'
     # To make ESC key send a command to exit slideshow on the server:
     # 1. Uncomment the line below (or add it).
     # 2. Ensure your server's COMMAND_ACTIONS has "EXIT_SLIDESHOW": lambda: pyautogui.press('esc')
-    keyboard.Key.esc: "EXIT_SLIDESHOW",  # Example: Map ESC to send "EXIT_SLIDESHOW"
+    "esc": "EXIT_SLIDESHOW",  # Example: Map ESC to send "EXIT_SLIDESHOW"
+}
+# Keymap file (see spotlight_core/keymap.py): the "keys" of one of its device profiles replace
+# KEYS_TO_COMMANDS, and the file is watched, so a remap for another remote applies to the next
+# key press without restarting or reconnecting.
+KEYMAP_PATH = None  # e.g. "keymap.json"; None = use KEYS_TO_COMMANDS
+KEYMAP_PROFILE = None  # Profile to use; None = the file's "profile"
+KEYMAP_RELOAD_INTERVAL = RELOAD_INTERVAL  # Seconds between checks for changes
+
+# --- Configuration File, Environment and Command Line ---
+# The settings above can be changed without editing this script, so the client can start
+# unattended: in CONFIG_PATH (JSON, e.g. {"pairing-id": "1234", "keymap": {"pagedown": "NEXT"}}),
+# in SPOTLIGHT_* environment variables (SPOTLIGHT_PAIRING_ID=1234) or on the command line
+# (--pairing-id 1234; --help lists them all). Later sources win; --config names another file.
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spotlight_client.json")  # Read if it exists
+CONFIG_OPTIONS = {
+    "pairing-id": "CLIENT_PAIRING_ID",
+    "keymap": "KEYS_TO_COMMANDS",
+    "keymap-file": "KEYMAP_PATH",
+    "keymap-profile": "KEYMAP_PROFILE",
+    "keymap-reload-interval": "KEYMAP_RELOAD_INTERVAL",
+    "discovery-port": "DISCOVERY_PORT",
+    "discovery-timeout": "DISCOVERY_TIMEOUT",
+    "multicast-group": "DISCOVERY_MULTICAST_GROUP",
+    "server-cache": "SERVER_CACHE_PATH",
+    "ack-timeout": "ACK_TIMEOUT",
+    "pipelined": "PIPELINED_SENDING",
+    "pipeline-window": "PIPELINE_WINDOW",
+    "heartbeat-interval": "HEARTBEAT_INTERVAL",
+    "heartbeat-misses": "HEARTBEAT_MISSES",
+    "reconnect-max-delay": "RECONNECT_MAX_DELAY",
+    "retry-initial-delay": "RETRY_INITIAL_DELAY",
+    "retry-delay": "RETRY_DELAY",
+    "session-resumption": "SESSION_RESUMPTION",
+    "capture-queue-size": "CAPTURE_QUEUE_SIZE",
+    "capture-overflow": "CAPTURE_OVERFLOW_POLICY",
+    "repeat-policy": "REPEAT_POLICY",
+    "repeat-policies": "REPEAT_POLICY_PER_COMMAND",
+    "repeat-interval": "REPEAT_INTERVAL",
+    "bounce-time": "BOUNCE_TIME",
+    "hold-release-commands": "HOLD_RELEASE_COMMANDS",
+    "metrics-path": "METRICS_EXPORT_PATH",
+    "log-level": "LOG_LEVEL",
+    "event-log": "EVENT_LOG_PATH",
 }
+# Options that also take None ("none"), besides those whose default is None
+CONFIG_NULLABLE = {"multicast-group", "server-cache", "heartbeat-interval"}
+# Options in seconds: they take fractions even where the default is a whole number
+CONFIG_SECONDS = {"discovery-timeout", "ack-timeout", "heartbeat-interval", "reconnect-max-delay",
+                  "retry-initial-delay", "retry-delay", "repeat-interval", "bounce-time", "keymap-reload-interval"}
 
 # Global variable to hold the active TCP socket and listener
 tcp_socket_global = None
+tcp_decoder_global = None  # Frame decoder for replies on tcp_socket_global
+command_sender_global = None  # PipelinedSender for tcp_socket_global when PIPELINED_SENDING is on
+keyboard = None  # pynput.keyboard, loaded once a server is found (keys.load_pynput())
 keyboard_listener_global = None
+session_token = None  # Resumption token for the current session (SESSION_RESUMPTION)
+session_grants = {}  # Paired socket -> token, filled by the pairing handshake (several may race)
 client_running = True  # Flag to control the main loop and listener
+capture_queue = None  # CaptureQueue filled by on_press, drained by the sender thread; created at start
+key_debouncer = None  # KeyDebouncer used by the key callbacks; created at start
+server_cache = None  # ServerCache, created at start
+latency_metrics = LatencyRecorder("client")
+log = get_logger("client")
 
 
-def discover_server(pairing_id_to_use):
+def discover_server(pairing_id_to_use, cancel=None):
     """
-    Attempts to discover the Spotlight server on the network using UDP broadcast.
+    Attempts to discover the Spotlight server on the network using UDP broadcast and multicast.
+    Returns (server_ip, command_port, server_name), or None if no server answered.
     """
-    print(f"\n[UDP DISCOVERY] Attempting to discover server with Pairing ID: {pairing_id_to_use}...")
-    print(f"[UDP DISCOVERY] Broadcasting on port {DISCOVERY_PORT} for {DISCOVERY_TIMEOUT} seconds...")
-
-    discover_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    discover_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    discover_socket.settimeout(DISCOVERY_TIMEOUT)
-
-    discovery_message = f"SPOTLIGHT_CLIENT_DISCOVERY:{pairing_id_to_use}"
-    server_details = None
-
-    try:
-        discover_socket.sendto(discovery_message.encode(), ('<broadcast>', DISCOVERY_PORT))
-        print(f"[UDP DISCOVERY] Sent: '{discovery_message}'")
-
-        while True:  # Keep listening until timeout or valid response
-            try:
-                data, addr = discover_socket.recvfrom(BUFFER_SIZE)
-                response = data.decode().strip()
-                print(f"[UDP DISCOVERY] Received response: '{response}' from {addr}")
-
-                response_prefix = "SPOTLIGHT_SERVER_RESPONSE:"
-                if response.startswith(response_prefix):
-                    parts = response[len(response_prefix):].split(':')
-                    if len(parts) == 3:
-                        server_ip, command_port_str, server_name = parts
-                        try:
-                            command_port = int(command_port_str)
-                            print(f"[UDP DISCOVERY] Server '{server_name}' found at {server_ip}:{command_port}")
-                            server_details = (server_ip, command_port, server_name)
-                            break  # Found a valid server
-                        except ValueError:
-                            print(f"[UDP DISCOVERY] Invalid port in response: {command_port_str}")
-                    else:
-                        print(f"[UDP DISCOVERY] Malformed server response: {response}")
-                else:
-                    print(f"[UDP DISCOVERY] Unknown response format: {response}")
-            except socket.timeout:
-                print(f"[UDP DISCOVERY] No server responded within the timeout period.")
-                break  # Exit while loop on timeout
-            except Exception as e:
-                print(f"[UDP DISCOVERY] Error receiving discovery response: {e}")
-                break
-    except Exception as e:
-        print(f"[UDP DISCOVERY] Error during discovery broadcast: {e}")
-    finally:
-        discover_socket.close()
-        print("[UDP DISCOVERY] Discovery socket closed.")
-    return server_details
+    log.info("[UDP DISCOVERY] Attempting to discover server with Pairing ID: %s...", pairing_id_to_use)
+    return discover(DISCOVERY_PREFIX + pairing_id_to_use, DISCOVERY_PORT, timeout=DISCOVERY_TIMEOUT,
+                    multicast_group=DISCOVERY_MULTICAST_GROUP, bufsize=BUFFER_SIZE, cancel=cancel,
+                    tag="[UDP DISCOVERY]")
 
 
-def send_command_to_server(command):
+def send_command_to_server(command, captured_at=None):
     """Sends a command to the globally connected server if available."""
     global tcp_socket_global, client_running, keyboard_listener_global
+    if PIPELINED_SENDING:
+        sender = command_sender_global
+        if sender is None or sender.send(command, captured_at=captured_at) is None:
+            log.warning("[KEY CAPTURE] Connection is down (reconnecting). Command '%s' not sent.", command)
+            return False
+        log.debug("[KEY CAPTURE] Sent command: %s", command)
+        return True  # ACK/NACK is reported by on_command_reply
+
     if tcp_socket_global:
         try:
-            print(f"[KEY CAPTURE] Sending command: {command}")
-            tcp_socket_global.sendall(command.encode())
+            log.debug("[KEY CAPTURE] Sending command: %s", command)
+            tcp_socket_global.sendall(protocol.encode_command(command, sent_us=now_us()))
             # Wait for ACK/NACK
             # Set a timeout for receiving command responses
-            tcp_socket_global.settimeout(5.0)  # 5 seconds timeout
-            response_data = tcp_socket_global.recv(BUFFER_SIZE)
+            tcp_socket_global.settimeout(ACK_TIMEOUT)
+            reply = protocol.recv_frame(tcp_socket_global, tcp_decoder_global, BUFFER_SIZE)
             tcp_socket_global.settimeout(None)  # Reset timeout
-            if not response_data:
-                print("[TCP CLIENT] Server closed connection unexpectedly after command.")
+            if reply is None:
+                log.warning("[TCP CLIENT] Server closed connection unexpectedly after command.")
                 if keyboard_listener_global and keyboard_listener_global.is_alive():  # Attempt to stop listener
                     print("[KEY CAPTURE] Stopping listener due to server disconnect.")
                     keyboard_listener_global.stop()
-                client_running = False  # Signal main loop to exit
+                client_running = False  # Ends the session; the main loop reconnects
                 return False
-            response = response_data.decode().strip()
-            print(f"[TCP CLIENT] Server response: {response}")
+            log.debug("[TCP CLIENT] Server response: %s", protocol.format_reply(reply))
+            parsed = protocol.parse_reply(reply)
+            if parsed:
+                record_reply(latency_metrics, command, parsed, time.perf_counter(), captured_at)
             return True
         except socket.timeout:
-            print("[TCP CLIENT] Timeout waiting for server response to command.")
+            log.warning("[TCP CLIENT] Timeout waiting for server response to command.")
             return False  # Command likely not received or acknowledged
-        except socket.error as e:  # Covers ConnectionResetError, BrokenPipeError, etc.
-            print(f"[TCP CLIENT] Socket error sending/receiving for command '{command}': {e}")
+        except (socket.error, protocol.ProtocolError) as e:  # Covers ConnectionResetError, BrokenPipeError, etc.
+            log.error("[TCP CLIENT] Socket error sending/receiving for command '%s': %s", command, e)
             if keyboard_listener_global and keyboard_listener_global.is_alive():
                 print("[KEY CAPTURE] Stopping listener due to socket error.")
                 keyboard_listener_global.stop()
-            client_running = False  # Signal main loop to exit
+            client_running = False  # Ends the session; the main loop reconnects
             return False
         except Exception as e:
-            print(f"[TCP CLIENT] Unexpected error sending/receiving for command '{command}': {e}")
+            log.error("[TCP CLIENT] Unexpected error sending/receiving for command '%s': %s", command, e)
             # For unexpected errors, also try to gracefully shut down
             if keyboard_listener_global and keyboard_listener_global.is_alive():
                 keyboard_listener_global.stop()
             client_running = False
             return False  # Indicate failure
     else:
-        print("[KEY CAPTURE] No active server connection to send command.")
+        log.warning("[KEY CAPTURE] No active server connection to send command.")
         return False
 
 
+def on_command_reply(command, reply, rtt):
+    """Called by the pipelined sender's reader thread for every ACK/NACK."""
+    if not reply.ok:
+        log.warning("[TCP CLIENT] Server response for %s: NACK (%s)", command, reply.reason)
+        return
+    log.debug("[TCP CLIENT] Server response for %s: ACK after %.1f ms (server %.1f ms)",
+              command, rtt * 1000, (reply.server_queue_us + reply.injection_us) / 1000)
+
+
+def on_presentation_state(state):
+    """Called by the pipelined sender's reader thread for every state update from the server."""
+    log.info("[STATE] Command #%s: %s from %s (floor: %s)", state.seq, state.command or "-",
+             state.controller or "-", state.floor or "free")
+
+
+def on_command_failure(command, reason):
+    """Called when a command could not be confirmed by the server."""
+    log.warning("[TCP CLIENT] Command '%s' was not acknowledged: %s", command, reason)
+
+
+def on_sender_disconnect(error):
+    """
+    Called once by the pipelined sender when the connection drops or stops answering heartbeats.
+    Reconnects in the background; the key listener keeps running meanwhile.
+    """
+    global command_sender_global
+    log.warning("[TCP CLIENT] Lost connection to server: %s", error)
+    sender = command_sender_global
+    command_sender_global = None
+    pending, next_seq = [], 1
+    if sender:
+        pending, next_seq = sender.take_unacked(), sender.next_seq
+        if session_token is None:
+            report_lost(pending)
+            pending = []
+    if client_running:
+        threading.Thread(target=reconnect_in_background, args=(pending, next_seq), name="reconnect",
+                         daemon=True).start()
+
+
+def report_lost(pending):
+    for entry in pending:
+        on_command_failure(entry.command, "connection lost before ACK")
+
+
+def reconnect_in_background(pending=(), next_seq=1):
+    """
+    Locates the server again and swaps the new connection in. With a session token the session
+    is resumed and `pending` (unacknowledged pipeline.PendingCommands) re-sent with it; otherwise,
+    or if the server no longer knows the session, it pairs again.
+    """
+    global tcp_socket_global, tcp_decoder_global, session_token
+    log.info("[TCP CLIENT] Reconnecting to the server...")
+    backoff = Backoff(maximum=RECONNECT_MAX_DELAY)  # Jittered 0.25, 0.5, 1 ... second delays
+    while client_running:
+        token = session_token
+        if token is not None:
+            server, rejected = locate_resumed_server(CLIENT_PAIRING_ID, token, pending)
+            if server is None and rejected:
+                log.warning("[TCP CLIENT] The server no longer knows this session (restarted?). Pairing again.")
+                session_token = None
+                report_lost(pending)
+                pending, next_seq = [], 1
+                continue
+        else:
+            server = locate_paired_server(CLIENT_PAIRING_ID)
+        if server is None:
+            delay = backoff.next()
+            log.info("[TCP CLIENT] Reconnect failed. Trying again in %.1f seconds...", delay)
+            time.sleep(delay)
+            continue
+        if not client_running:  # The session ended while we were reconnecting
+            server.sock.close()
+            return
+        old_socket = tcp_socket_global
+        tcp_socket_global = server.sock
+        tcp_decoder_global = server.decoder
+        if old_socket:
+            old_socket.close()
+        if token is not None:
+            now = time.perf_counter()
+            start_command_sender(next_seq, [entry._replace(sent_at=now, attempts=entry.attempts + 1)
+                                            for entry in pending])
+            log.info("[TCP CLIENT] Resumed session with server '%s' at %s:%s (via %s); %s unacknowledged "
+                     "command(s) re-sent.", server.name, server.ip, server.port, server.source, len(pending))
+        else:
+            start_command_sender()
+            log.info("[TCP CLIENT] Reconnected to server '%s' at %s:%s (via %s).", server.name, server.ip,
+                     server.port, server.source)
+        return
+
+
+def apply_keymap(keymap):
+    """Swaps in the key mappings of a reloaded keymap. Runs on the keymap watcher's thread."""
+    global KEYS_TO_COMMANDS
+    KEYS_TO_COMMANDS = keymap.keys
+
+
+def start_keymap():
+    """Loads KEYS_TO_COMMANDS (from KEYMAP_PATH, which is then watched, or the mapping above). Raises KeymapError."""
+    global KEYS_TO_COMMANDS
+    if not KEYMAP_PATH:
+        KEYS_TO_COMMANDS = compile_keys(KEYS_TO_COMMANDS, "KEYS_TO_COMMANDS")
+        return
+    watcher = KeymapWatcher(KEYMAP_PATH, apply_keymap, KEYMAP_PROFILE, base_keys=KEYS_TO_COMMANDS,
+                            interval=KEYMAP_RELOAD_INTERVAL)
+    keymap = watcher.load()
+    KEYS_TO_COMMANDS = keymap.keys
+    watcher.start()
+    latency_metrics.add_gauge_source("keymap", watcher.stats)
+    print(f"[KEYMAP] Using profile '{keymap.profile}' from {KEYMAP_PATH}")
+
+
 def on_press(key):
     """Callback function for when a key is pressed."""
     global keyboard_listener_global, client_running
@@ -149,13 +348,11 @@ def on_press(key):
     #     client_running = False # Signal main loop to exit
     #     return False # Stop listener callback chain
 
-    command = KEYS_TO_COMMANDS.get(key)
-    if command:
-        if not send_command_to_server(command):
-            # If sending command failed critically (e.g., socket error),
-            # client_running might be set to False by send_command_to_server.
-            # The listener should also be stopped in that case by send_command_to_server.
-            print(f"[KEY CAPTURE] Failed to send command '{command}' or critical error occurred.")
+    name = key_name(key)
+    command = KEYS_TO_COMMANDS.get(name)
+    if command and key_debouncer.press(name, command):  # Auto-repeats and bounces stop here
+        # Only timestamp and enqueue here: this runs inside the OS input hook.
+        capture_queue.put(command)
     # else: # Optional: for debugging unmapped keys
     #     try:
     #         print(f"Key pressed: {key.char} (not mapped to a command)")
@@ -163,138 +360,228 @@ def on_press(key):
     #         print(f"Special key pressed: {key} (not mapped to a command)")
 
 
-def connect_and_listen(server_ip, command_port, pairing_id_to_use):
+def on_release(key):
+    """Callback function for when a key is released."""
+    key_debouncer.release(key_name(key))  # The end of a "hold" press goes to on_hold_release
+
+
+def on_hold_release(name):
+    """Called by key_debouncer once the key of a "hold" press has come up for good (maybe on its timer thread)."""
+    command = HOLD_RELEASE_COMMANDS.get(KEYS_TO_COMMANDS.get(name))
+    if command:
+        capture_queue.put(command)
+
+
+def send_captured_command(command, captured_at):
+    """Called on the sender thread for every key press taken from capture_queue."""
+    latency_metrics.observe("queue_wait", command, time.perf_counter() - captured_at)
+    if not send_command_to_server(command, captured_at):
+        # If sending command failed critically (e.g., socket error),
+        # client_running might be set to False by send_command_to_server.
+        # The listener should also be stopped in that case by send_command_to_server.
+        log.warning("[KEY CAPTURE] Failed to send command '%s' or critical error occurred.", command)
+
+
+def pair_with_server(sock, decoder, pairing_id_to_use):
+    """TCP pairing on a fresh connection (locate_server's handshake). Returns True if the server accepted us."""
+    log.info("[TCP CLIENT] Sending TCP pairing request with ID '%s' to %s", pairing_id_to_use,
+             sock.getpeername()[0])
+    sock.settimeout(10.0)  # 10 seconds for pairing response
+    if SESSION_RESUMPTION:
+        paired, pairing_response, token = pair_resumable(sock, decoder, pairing_id_to_use, BUFFER_SIZE)
+        if token:
+            session_grants[sock] = token
+    else:
+        paired, pairing_response = protocol.pair(sock, decoder, pairing_id_to_use, BUFFER_SIZE)
+    if pairing_response is None:
+        log.warning("[TCP CLIENT] Server closed connection during TCP pairing.")
+    elif not paired:
+        log.warning("[TCP CLIENT] TCP Pairing failed: %s.", pairing_response)
+    return paired
+
+
+def locate_paired_server(pairing_id_to_use):
+    """Connects and pairs. Cached servers for this pairing ID are tried while discovery runs in the background."""
+    global session_token
+    session_grants.clear()
+    server = locate_server(server_cache, pairing_id_to_use,
+                           lambda cancel: discover_server(pairing_id_to_use, cancel),
+                           handshake=lambda sock, decoder: pair_with_server(sock, decoder, pairing_id_to_use),
+                           tag="[TCP CLIENT]")
+    if server is not None:
+        session_token = session_grants.pop(server.sock, None)  # The winning connection's session
+    return server
+
+
+def locate_resumed_server(pairing_id_to_use, token, pending):
+    """
+    Like locate_paired_server(), but resumes the session instead of pairing, sending the pending
+    commands in the same packet. Returns (server or None, True if the server refused the session).
+    """
+    rejected = []
+
+    def handshake(sock, decoder):
+        sock.settimeout(10.0)
+        try:
+            return resume(sock, decoder, token, [(entry.seq, entry.command) for entry in pending], BUFFER_SIZE)
+        except ResumeRejected as e:
+            rejected.append(e)
+            raise
+
+    server = locate_server(server_cache, pairing_id_to_use, lambda cancel: discover_server(pairing_id_to_use, cancel),
+                           handshake=handshake, tag="[TCP CLIENT]")
+    return server, bool(rejected)
+
+
+def start_command_sender(next_seq=1, in_flight=()):
+    """Starts pipelined sending (with heartbeats) on tcp_socket_global; a resumed session goes on from next_seq."""
+    global command_sender_global
+    command_sender_global = PipelinedSender(
+        tcp_socket_global, tcp_decoder_global, window=PIPELINE_WINDOW, ack_timeout=ACK_TIMEOUT,
+        max_attempts=2 if session_token else 1, bufsize=BUFFER_SIZE, on_reply=on_command_reply,
+        on_failure=on_command_failure, on_disconnect=on_sender_disconnect, metrics=latency_metrics,
+        heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_misses=HEARTBEAT_MISSES, on_state=on_presentation_state,
+        next_seq=next_seq, in_flight=in_flight)
+    command_sender_global.subscribe_state()  # Hear about clicks from other controllers and who has the floor
+
+
+def connect_and_listen(server):
     """
-    Connects to the server, performs pairing, and starts listening for key presses.
+    Starts listening for key presses on a connected, paired server (a server_cache.FoundServer).
     """
-    global tcp_socket_global, keyboard_listener_global, client_running
+    global tcp_socket_global, tcp_decoder_global, command_sender_global, keyboard_listener_global, client_running
     # Ensure client_running is true at the start of a new connection attempt
     client_running = True
 
-    tcp_socket_global = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_socket_global = server.sock
+    tcp_decoder_global = server.decoder
     try:
-        print(f"\n[TCP CLIENT] Attempting to connect to server at {server_ip}:{command_port}...")
-        tcp_socket_global.connect((server_ip, command_port))
-        print(f"[TCP CLIENT] Connected to server.")
-
-        # --- Perform TCP Pairing ---
-        tcp_pairing_message = f"PAIR_WITH_SERVER:{pairing_id_to_use}"
-        print(f"[TCP CLIENT] Sending TCP pairing message: '{tcp_pairing_message}'")
-        tcp_socket_global.sendall(tcp_pairing_message.encode())
-
-        # Set a timeout for receiving the pairing response
-        tcp_socket_global.settimeout(10.0)  # 10 seconds for pairing response
-        pairing_response_data = tcp_socket_global.recv(BUFFER_SIZE)
-        tcp_socket_global.settimeout(None)  # Reset timeout after recv
-
-        if not pairing_response_data:
-            print("[TCP CLIENT] Server closed connection during TCP pairing.")
-            client_running = False  # Ensure main loop knows to exit
-            return
-
-        pairing_response = pairing_response_data.decode().strip()
-        print(f"[TCP CLIENT] Received pairing response: '{pairing_response}'")
-
-        if pairing_response == "ACK:PAIRING_SUCCESSFUL":
-            print("[TCP CLIENT] TCP Pairing successful with server!")
-            print("\n--- Listening for Presentation Key Presses ---")
-            print("Press mapped keys (e.g., Right Arrow for NEXT, Left Arrow for PREVIOUS).")
-            print("To STOP this client: Close the terminal window or press Ctrl+C.")
+        print(f"[TCP CLIENT] TCP Pairing successful with server '{server.name}' at {server.ip}:{server.port} "
+              f"(via {server.source}, connect RTT {server.connect_rtt * 1000:.1f} ms)!")
+        print("\n--- Listening for Presentation Key Presses ---")
+        print("Press mapped keys (e.g., Right Arrow for NEXT, Left Arrow for PREVIOUS).")
+        print("To STOP this client: Close the terminal window or press Ctrl+C.")
 
-            # Ensure no old listener is running if retrying
-            if keyboard_listener_global and keyboard_listener_global.is_alive():
-                keyboard_listener_global.stop()
+        # Ensure no old listener is running if retrying
+        if keyboard_listener_global and keyboard_listener_global.is_alive():
+            keyboard_listener_global.stop()
 
-            keyboard_listener_global = keyboard.Listener(on_press=on_press)
-            keyboard_listener_global.start()
+        if PIPELINED_SENDING:
+            start_command_sender()
 
-            # Keep the main thread alive while the listener is running and client is active
-            while client_running and keyboard_listener_global.is_alive():
-                time.sleep(0.1)  # Keep main thread responsive, check flags
+        keyboard_listener_global = keyboard.Listener(on_press=on_press, on_release=on_release)
+        keyboard_listener_global.start()
 
-            print("[TCP CLIENT] Exited listening loop.")
+        # Keep the main thread alive while the listener is running and client is active
+        while client_running and keyboard_listener_global.is_alive():
+            time.sleep(0.1)  # Keep main thread responsive, check flags
 
-        else:
-            print(f"[TCP CLIENT] TCP Pairing failed: {pairing_response}. Aborting session.")
-            client_running = False  # Ensure main loop knows to exit if pairing fails
-            return
+        print("[TCP CLIENT] Exited listening loop.")
 
-    except socket.timeout:  # Catch timeout specifically for pairing
-        print(f"[TCP CLIENT] Timeout during TCP pairing with server.")
-        client_running = False
-    except socket.error as e:
-        print(f"[TCP CLIENT] Socket error during connection/pairing: {e}")
-        client_running = False  # Signal main loop to exit
+    except (socket.error, protocol.ProtocolError) as e:
+        print(f"[TCP CLIENT] Socket error during session: {e}")
+        client_running = False  # Ends the session; the main loop reconnects
     except Exception as e:
-        print(f"[TCP CLIENT] An unexpected error occurred during connection/listen setup: {e}")
-        client_running = False  # Signal main loop to exit
+        print(f"[TCP CLIENT] An unexpected error occurred during listen setup: {e}")
+        client_running = False  # Ends the session; the main loop reconnects
     finally:
         print("[TCP CLIENT] Cleaning up session...")
         if keyboard_listener_global and keyboard_listener_global.is_alive():
             print("[TCP CLIENT] Ensuring listener is stopped.")
             keyboard_listener_global.stop()
             # keyboard_listener_global.join() # Optionally wait for listener thread to fully finish
+        if command_sender_global:
+            command_sender_global.close()
+            command_sender_global = None
         if tcp_socket_global:
             print("[TCP CLIENT] Closing TCP connection.")
             tcp_socket_global.close()
             tcp_socket_global = None  # Clear global for next session
+        tcp_decoder_global = None
         keyboard_listener_global = None  # Clear global for next session
         # client_running might be True here if loop exited due to listener stopping but not error
-        # The main loop will decide based on client_running if to retry or exit.
+        # The main loop reconnects either way.
 
 
 if __name__ == "__main__":
+    preload_pynput()  # Imports in the background while the configuration is read and the server located
+    try:
+        config_sources = load_config(globals(), CONFIG_OPTIONS, default_path=CONFIG_PATH,
+                                     nullable=CONFIG_NULLABLE, seconds=CONFIG_SECONDS,
+                                     description="Spotlight client (Version 2)")
+        capture_queue = CaptureQueue(CAPTURE_QUEUE_SIZE, CAPTURE_OVERFLOW_POLICY)
+        key_debouncer = KeyDebouncer(REPEAT_POLICY, REPEAT_INTERVAL, BOUNCE_TIME, REPEAT_POLICY_PER_COMMAND,
+                                     on_release=on_hold_release)
+    except (ConfigError, ValueError) as e:
+        print(f"[FATAL CLIENT ERROR] Configuration: {e}")
+        sys.exit(2)
+    server_cache = ServerCache(SERVER_CACHE_PATH)
+    latency_metrics.add_gauge_source("capture_queue", capture_queue.stats)
+    latency_metrics.add_gauge_source("key_debounce", key_debouncer.stats)
+    setup_logging(LOG_LEVEL, EVENT_LOG_PATH)
     print("--- Logitech Spotlight Client (ESC key sends command, does not exit client) ---")
     print("IMPORTANT: Ensure 'pynput' is installed: pip install pynput")
+    if config_sources:
+        print(f"[CONFIG] Settings from outside this script: {describe_sources(config_sources)}")
 
-    while not CLIENT_PAIRING_ID:  # Loop until a valid pairing ID is entered
-        temp_id = input("Enter the Pairing ID for this session (must match server's ID, cannot be empty): ").strip()
-        if temp_id:
-            CLIENT_PAIRING_ID = temp_id
-        else:
-            print("Pairing ID cannot be empty. Please try again.")
+    if not CLIENT_PAIRING_ID:
+        try:
+            CLIENT_PAIRING_ID = ask("pairing-id",
+                                    "Enter the Pairing ID for this session (must match server's ID, cannot be empty): ")
+        except ConfigError as e:
+            print(f"[FATAL CLIENT ERROR] {e}")
+            sys.exit(2)
     print(f"Using Pairing ID for this session: '{CLIENT_PAIRING_ID}'")
-
-    # Main application loop
-    # client_running is True initially. It's set to False on critical errors or if user chooses not to retry.
-    while client_running:
-        server_info = discover_server(CLIENT_PAIRING_ID)
-
-        if server_info:
-            ip, port, name = server_info
-            connect_and_listen(ip, port, CLIENT_PAIRING_ID)
-
-            # After connect_and_listen returns, client_running might have been set to False
-            # by an error within it or by the listener stopping.
-            if not client_running:
-                print("\nClient session ended or was stopped due to an error.")
-                # Ask if user wants to try a completely new attempt if it wasn't a clean exit choice
-                retry_choice = input("Attempt to start a new discovery and connection? (y/n): ").strip().lower()
-                if retry_choice == 'y':
-                    client_running = True  # Allow the loop to try again
-                    CLIENT_PAIRING_ID = ""  # Reset pairing ID to prompt again for a new session
-                    while not CLIENT_PAIRING_ID:
-                        temp_id = input("Enter Pairing ID for the new session: ").strip()
-                        if temp_id:
-                            CLIENT_PAIRING_ID = temp_id
-                        else:
-                            print("Pairing ID cannot be empty.")
-                    print(f"Using new Pairing ID: '{CLIENT_PAIRING_ID}'")
+    try:
+        start_keymap()
+    except KeymapError as e:
+        print(f"[FATAL CLIENT ERROR] {e}")
+        sys.exit(2)
+
+    # Sends whatever the key listener enqueues, for the lifetime of the program
+    sender_thread = SenderThread(capture_queue, send_captured_command)
+    sender_thread.start()
+    if METRICS_EXPORT_PATH:
+        start_periodic_export(latency_metrics, METRICS_EXPORT_PATH, METRICS_EXPORT_INTERVAL)
+
+    # Main application loop: runs until Ctrl+C. Lost sessions and failed searches are retried
+    # automatically, the first time after RETRY_INITIAL_DELAY seconds.
+    retry_backoff = Backoff(RETRY_INITIAL_DELAY, maximum=RETRY_DELAY)
+    try:
+        while True:
+            server = locate_paired_server(CLIENT_PAIRING_ID)
+
+            if server:
+                if keyboard is None:
+                    try:
+                        keyboard = load_pynput().keyboard
+                    except CaptureUnavailable as e:
+                        print(f"[FATAL CLIENT ERROR] {e}")
+                        server.sock.close()
+                        break
+                retry_backoff.reset()
+                connect_and_listen(server)
+
+                # After connect_and_listen returns, client_running is False if an error ended the session
+                if not client_running:
+                    print("\nClient session ended due to an error.")
                 else:
-                    break  # Exit main application loop
-            else:  # This case implies connect_and_listen exited but client_running is still true (e.g. listener stopped but no error)
-                # This path might be less common with current logic but good to have a clear distinction.
-                print("\nSession ended.")
-        else:  # Server not found
-            print("Could not find a server or discovery failed with the current Pairing ID.")
-
-        if client_running:  # Only ask to retry current pairing ID if not explicitly stopped or choosing new session
-            retry_choice = input(f"Retry discovery with Pairing ID '{CLIENT_PAIRING_ID}'? (y/n): ").strip().lower()
-            if retry_choice != 'y':
-                print("Exiting client.")
-                break  # Exit main application loop
-            print(f"Waiting {RETRY_DELAY} seconds before retrying...")
-            time.sleep(RETRY_DELAY)
-        # If client_running became false inside the loop, it will exit here.
-
+                    print("\nSession ended.")
+            else:  # Server not found
+                print("Could not find or pair with a server for the current Pairing ID.")
+
+            delay = retry_backoff.next()
+            print(f"Retrying with Pairing ID '{CLIENT_PAIRING_ID}' in {delay:.2f} seconds...")
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        print("\nClient interrupted by Ctrl+C. Shutting down.")
+
+    sender_thread.stop()
+    print(f"[KEY CAPTURE] Capture queue stats: {capture_queue.stats()}")
+    if METRICS_EXPORT_PATH:
+        try:
+            latency_metrics.write(METRICS_EXPORT_PATH)
+            print(f"[METRICS] Latency metrics written to {METRICS_EXPORT_PATH}")
+        except OSError as e:
+            print(f"[METRICS] Could not write metrics to {METRICS_EXPORT_PATH}: {e}")
     print("Client program terminated.")
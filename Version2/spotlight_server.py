@@ -1,118 +1,320 @@
 # spotlight_server.py
 # Run this script on Computer 2 (the presentation machine)
 
-import socket
+import os
+import sys
 import threading
-import pyautogui
 import time
 
+# The shared protocol code lives in the spotlight_core package at the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spotlight_core.arbiter import NAVIGATION_COMMANDS, CommandArbiter
+from spotlight_core.config import ConfigError, ask, describe_sources, load_config
+from spotlight_core.discovery import MULTICAST_GROUP, build_discovery_reply
+from spotlight_core.injection import InjectionWorker
+from spotlight_core.injectors import LazyInjector
+from spotlight_core.interfaces import describe_advertised_ip
+from spotlight_core.keymap import RELOAD_INTERVAL, KeymapError, KeymapWatcher
+from spotlight_core.log import get_logger, setup_logging
+from spotlight_core.metrics import LatencyRecorder, start_periodic_export
+from spotlight_core.overlay import OverlayUnavailable, SpotlightOverlay
+from spotlight_core.pointer import MotionAccumulator
+from spotlight_core.server import CommandTable, serve_connection
+from spotlight_core.sessions import ResumableSessions
+from spotlight_core.smoothing import PointerSmoother
+from spotlight_core.startup import EarlyListener
+from spotlight_core.udp_commands import UdpSessions, start_udp_command_server
+
 # Configuration
 DISCOVERY_PORT = 50000  # UDP port for discovery
+DISCOVERY_MULTICAST_GROUP = MULTICAST_GROUP  # Also answer discovery sent to this IPv4 group (None = broadcast only)
+ADVERTISED_IP = None  # IP sent in discovery responses; None = the address of the interface facing each client
 COMMAND_PORT = 50001  # TCP port for receiving commands
+# Optional UDP command channel: clients that ask for it (on their paired TCP connection) send
+# clicks as datagrams, so one lost packet on Wi-Fi does not hold back the following clicks.
+UDP_COMMAND_PORT = COMMAND_PORT  # UDP port for it (a UDP port, so no clash with the TCP one); None = TCP only
 BUFFER_SIZE = 1024
 SERVER_NAME = "SpotlightReceiverPC"  # Identifiable name for this server
-# --- MODIFIED: Custom Pairing ID to be set at runtime ---
-SERVER_PAIRING_ID = ""  # Will be set from user input when script runs
+# Clients must send the same pairing ID. Set it in the configuration (see CONFIG_OPTIONS below);
+# if it is left empty, it is asked for when the server is started from a terminal.
+SERVER_PAIRING_ID = ""
+
+# --- Server Engine ---
+# The asyncio engine serves every connection and the discovery responder from one event loop
+# with a fixed number of threads. Set to False for the old thread-per-connection server.
+# Either way the ports are bound and discovery is answered as soon as the pairing ID is known;
+# the engine, the input backend and the overlay load afterwards
+# (python -m spotlight_core.startup --pairing-id <ID> Version2/spotlight_server.py measures it).
+USE_ASYNC_SERVER = True
+MAX_CONNECTIONS = 64  # Further connections are refused (asyncio engine only)
+LISTEN_BACKLOG = 128  # Queued, not yet accepted TCP connections
+IDLE_TIMEOUT = 3600  # Seconds without any data before a paired connection is dropped (asyncio engine only)
+PAIRING_TIMEOUT = 10  # Seconds a new connection has to complete pairing (asyncio engine only)
+# Clients that lose the connection may resume their session for SESSION_TTL seconds without
+# pairing again; commands they re-send after the drop run only once. None = always pair again.
+SESSION_TTL = 300  # seconds
+
+# --- Virtual Spotlight ---
+# LASER_ON / LASER_OFF show and hide a dimmed overlay with a clear circle that follows the
+# pointer positions streamed by the client. Needs tkinter and a display; without them the
+# commands only print a message.
+SPOTLIGHT_OVERLAY = True
+SPOTLIGHT_RADIUS = 150  # Pixels
+SPOTLIGHT_DIM = 0.6  # Opacity of the dimmed area: 0 = invisible, 1 = black
+SPOTLIGHT_REFRESH_HZ = 60  # Highest redraw rate; match the display's refresh rate
+# Relative pointer motion streamed by clients moves the spotlight, or with "cursor" this
+# computer's mouse pointer through the input backend (e.g. for the presentation program's own pointer).
+MOTION_TARGET = "spotlight"  # "spotlight", "cursor" or None (ignore motion)
+MOTION_GAIN = 1.0  # Pixels moved here per pixel moved on the client
+MOTION_RATE_HZ = 60  # "cursor" only: pointer moves per second at most; motion in between is added up
+# Streamed positions go through a One-Euro filter with prediction before they are drawn, so
+# Wi-Fi jitter does not make the spotlight stutter. The lag it adds is in the latency metrics
+# ("pointer_smoothing" stage).
+POINTER_SMOOTHING = True
+SMOOTHING_MIN_CUTOFF = 1.0  # Hz at rest: lower = steadier spotlight, but slow moves lag more
+SMOOTHING_BETA = 20.0  # Higher = less lag on fast moves, but more jitter gets through
+SMOOTHING_PREDICTION = 0.0  # Seconds to draw ahead, e.g. 0.01 (hides lag, but overshoots on sudden stops)
+
+# --- Latency Metrics ---
+# Time from frame receipt to action start and the duration of each key press, per command.
+# Written on shutdown and every METRICS_EXPORT_INTERVAL seconds: Prometheus text for .prom/.txt
+# paths, JSON otherwise. None = keep them in memory only.
+METRICS_EXPORT_PATH = None  # e.g. "spotlight_server_metrics.prom"
+METRICS_EXPORT_INTERVAL = 30  # seconds
+
+# --- Logging ---
+# Output goes through a background writer thread. "INFO" shows connections and errors only;
+# "DEBUG" also logs every command received and executed (slower on Windows consoles).
+LOG_LEVEL = "INFO"
+EVENT_LOG_PATH = None  # e.g. "spotlight_server_events.jsonl": every event, DEBUG included, as JSON lines
+
+# --- Multiple Controllers ---
+# Commands from every connected controller (clickers, a stage manager's laptop) run in one
+# global order, never overlapping. With floor control only the controller holding the floor
+# may navigate; it takes the floor with its first navigation command when the floor is free,
+# when the holder has been idle for FLOOR_IDLE_TIMEOUT seconds, or when its priority is higher.
+# Controllers that subscribe are told about every accepted command and floor change.
+FLOOR_CONTROL = True
+FLOOR_IDLE_TIMEOUT = 30  # seconds
+CONTROLLER_PRIORITIES = {}  # Client IP -> priority (default 0), e.g. {"192.168.1.50": 10} for the stage manager
+
+# --- Key Injection ---
+# Every key press runs on one injection worker thread, so reading commands never waits for
+# the input backend. Runs of repeated NEXT/PREVIOUS commands are sent as a single multi-press.
+# Backends: "pyautogui" (default), "xdotool" or "uinput" (Linux), "recording" (presses nothing and
+# records the keys it would have pressed; for headless tests and benchmarks).
+INJECTOR_BACKEND = "pyautogui"
+RECORDING_LOG_PATH = None  # "recording" backend only: optional JSON-lines file of injected keys
+USE_INJECTION_WORKER = True
+ACK_MODE = "completed"  # "completed": ACK once the key press has returned; "queued": ACK as soon as it is queued
+KEY_PAUSE = 0.02  # Seconds between injected key presses (also pyautogui's PAUSE, which defaults to 0.1)
+
+# --- Configuration File, Environment and Command Line ---
+# The settings below can be changed without editing this script, so the server can start
+# unattended: in CONFIG_PATH (JSON, e.g. {"pairing-id": "1234", "backend": "xdotool"}), in
+# SPOTLIGHT_* environment variables (SPOTLIGHT_PAIRING_ID=1234) or on the command line
+# (--pairing-id 1234; --help lists them all). Later sources win; --config names another file.
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spotlight_server.json")  # Read if it exists
+CONFIG_OPTIONS = {
+    "pairing-id": "SERVER_PAIRING_ID",
+    "server-name": "SERVER_NAME",
+    "discovery-port": "DISCOVERY_PORT",
+    "command-port": "COMMAND_PORT",
+    "udp-command-port": "UDP_COMMAND_PORT",
+    "advertised-ip": "ADVERTISED_IP",
+    "multicast-group": "DISCOVERY_MULTICAST_GROUP",
+    "async-server": "USE_ASYNC_SERVER",
+    "max-connections": "MAX_CONNECTIONS",
+    "idle-timeout": "IDLE_TIMEOUT",
+    "pairing-timeout": "PAIRING_TIMEOUT",
+    "session-ttl": "SESSION_TTL",
+    "backend": "INJECTOR_BACKEND",
+    "recording-log": "RECORDING_LOG_PATH",
+    "injection-worker": "USE_INJECTION_WORKER",
+    "ack-mode": "ACK_MODE",
+    "key-pause": "KEY_PAUSE",
+    "command-keys": "COMMAND_KEYS",
+    "keymap-file": "KEYMAP_PATH",
+    "keymap-profile": "KEYMAP_PROFILE",
+    "keymap-reload-interval": "KEYMAP_RELOAD_INTERVAL",
+    "overlay": "SPOTLIGHT_OVERLAY",
+    "motion-target": "MOTION_TARGET",
+    "floor-control": "FLOOR_CONTROL",
+    "floor-idle-timeout": "FLOOR_IDLE_TIMEOUT",
+    "controller-priorities": "CONTROLLER_PRIORITIES",
+    "metrics-path": "METRICS_EXPORT_PATH",
+    "log-level": "LOG_LEVEL",
+    "event-log": "EVENT_LOG_PATH",
+}
+# Options that also take None ("none"), besides those whose default is None
+CONFIG_NULLABLE = {"udp-command-port", "multicast-group", "session-ttl", "motion-target"}
+# Options in seconds: they take fractions even where the default is a whole number
+CONFIG_SECONDS = {"idle-timeout", "pairing-timeout", "session-ttl", "key-pause", "keymap-reload-interval",
+                  "floor-idle-timeout"}
 
 # --- Key Mappings ---
 # These are the commands the server expects from the client.
 # The client (with key capture) maps actual key presses to these command strings.
-COMMAND_ACTIONS = {
-    "NEXT": lambda: pyautogui.press('right'),
-    "PREVIOUS": lambda: pyautogui.press('left'),
-    "BLACK_SCREEN": lambda: pyautogui.press('b'),
-    "START_PRESENTATION": lambda: pyautogui.press('f5'),
-    "EXIT_SLIDESHOW": lambda: pyautogui.press('esc'),  # ADDED: Handle ESC key from client
-    "LASER_ON": lambda: print("Server: Laser ON command received (action not implemented)"),  # Placeholder
-    "LASER_OFF": lambda: print("Server: Laser OFF command received (action not implemented)"),  # Placeholder
+# Commands that are a single key press (the injection worker can batch these):
+COMMAND_KEYS = {
+    "NEXT": 'right',
+    "PREVIOUS": 'left',
+    "BLACK_SCREEN": 'b',
+    "START_PRESENTATION": 'f5',
+    "EXIT_SLIDESHOW": 'esc',  # ADDED: Handle ESC key from client
 }
+# Keymap file (see spotlight_core/keymap.py): the "commands" of one of its device profiles
+# replace COMMAND_KEYS, and the file is watched, so an edit applies to the next command without
+# restarting the server or reconnecting the clients.
+KEYMAP_PATH = None  # e.g. "keymap.json"; None = use COMMAND_KEYS
+KEYMAP_PROFILE = None  # Profile to use; None = the file's "profile"
+KEYMAP_RELOAD_INTERVAL = RELOAD_INTERVAL  # Seconds between checks for changes
+COMMAND_ACTIONS = None  # Built from COMMAND_KEYS by build_command_table()
+COMMAND_TABLE = None  # Dispatch table built from COMMAND_ACTIONS (keyed by wire opcode for fast lookup)
 
+# Created at start from the (configured) settings
+UDP_SESSIONS = None  # Threaded engine
+RESUMABLE_SESSIONS = None  # Threaded engine
+ARBITER = None  # Shared by every connection
+LATENCY_METRICS = LatencyRecorder("server")  # Shared by every connection
+INJECTOR = None  # Input backend (injectors.LazyInjector), created by start_injection()
+INJECTION_WORKER = None  # Created by start_injection() when USE_INJECTION_WORKER is on
+OVERLAY = None  # Virtual spotlight, created by start_overlay()
+CURSOR_MOTION = None  # MotionAccumulator feeding INJECTOR.move(), created by start_injection() for MOTION_TARGET "cursor"
+log = get_logger("spotlight_server")
 
-def handle_client_connection(conn, addr):
-    """Handles an incoming TCP connection from a client."""
-    global SERVER_PAIRING_ID  # Ensure access to the runtime-set global
-    print(f"[TCP SERVER] Accepted connection from {addr}")
-    paired = False
+
+def build_command_table():
+    """COMMAND_ACTIONS and COMMAND_TABLE for the configured COMMAND_KEYS. Called again when the keymap file changes."""
+    global COMMAND_ACTIONS, COMMAND_TABLE
+    actions = {command: (lambda key=key: INJECTOR.press(key)) for command, key in COMMAND_KEYS.items()}
+    actions.update({
+        "LASER_ON": lambda: set_spotlight(True),
+        "LASER_OFF": lambda: set_spotlight(False),
+    })
+    COMMAND_ACTIONS = actions
+    if COMMAND_TABLE is None:
+        COMMAND_TABLE = CommandTable(actions)
+    else:
+        COMMAND_TABLE.update(actions)  # Every connection holds this table and sees the new actions at once
+
+
+def apply_keymap(keymap):
+    """Swaps in the command keys of a reloaded keymap. Runs on the keymap watcher's thread."""
+    global COMMAND_KEYS
+    COMMAND_KEYS = keymap.commands
+    build_command_table()
+    if INJECTION_WORKER is not None:
+        INJECTION_WORKER.keys = keymap.commands
+
+
+def start_keymap():
+    """Loads KEYMAP_PATH into COMMAND_KEYS and starts watching it. Raises KeymapError."""
+    global COMMAND_KEYS
+    watcher = KeymapWatcher(KEYMAP_PATH, apply_keymap, KEYMAP_PROFILE, base_commands=COMMAND_KEYS,
+                            interval=KEYMAP_RELOAD_INTERVAL)
+    keymap = watcher.load()
+    COMMAND_KEYS = keymap.commands
+    watcher.start()
+    LATENCY_METRICS.add_gauge_source("keymap", watcher.stats)
+    print(f"[KEYMAP] Using profile '{keymap.profile}' from {KEYMAP_PATH}: {COMMAND_KEYS}")
+
+
+def start_injection():
+    """Starts opening the input backend in the background and, if enabled, starts the injection worker."""
+    global INJECTOR, INJECTION_WORKER, CURSOR_MOTION
+    INJECTOR = LazyInjector(INJECTOR_BACKEND, pause=KEY_PAUSE, record_path=RECORDING_LOG_PATH,
+                            on_error=on_injector_error)
+    INJECTOR.load()
+    if MOTION_TARGET == "cursor":
+        CURSOR_MOTION = MotionAccumulator(INJECTOR.move, MOTION_RATE_HZ)
+        CURSOR_MOTION.start()
+        LATENCY_METRICS.add_gauge_source("cursor_motion", CURSOR_MOTION.stats)
+    if USE_INJECTION_WORKER:
+        INJECTION_WORKER = InjectionWorker(INJECTOR.press, COMMAND_KEYS, pause=KEY_PAUSE)
+        INJECTION_WORKER.start()
+        LATENCY_METRICS.add_gauge_source("injection", INJECTION_WORKER.stats)
+
+
+def on_injector_error(error):
+    """The input backend could not be opened (on its loading thread): nothing can be pressed."""
+    print(f"[FATAL SERVER ERROR] Input backend '{INJECTOR_BACKEND}' is not usable: {error}")
+    os._exit(1)
+
+
+def answer_discovery(message, client_address):
+    # Only clients sending the matching "SPOTLIGHT_CLIENT_DISCOVERY:<pairing_id>" get a response
+    return build_discovery_reply(message, client_address, ADVERTISED_IP, COMMAND_PORT, SERVER_NAME,
+                                 SERVER_PAIRING_ID)
+
+
+def start_overlay():
+    """Creates the virtual spotlight window, if enabled and possible on this machine."""
+    global OVERLAY
+    if not SPOTLIGHT_OVERLAY:
+        return
+    smoother = PointerSmoother(SMOOTHING_MIN_CUTOFF, SMOOTHING_BETA, prediction=SMOOTHING_PREDICTION,
+                               metrics=LATENCY_METRICS) if POINTER_SMOOTHING else None
+    overlay = SpotlightOverlay(SPOTLIGHT_RADIUS, SPOTLIGHT_DIM, SPOTLIGHT_REFRESH_HZ, smoother)
     try:
-        # --- Pairing ID Verification over TCP ---
-        # Expect the first message to be the pairing ID
-        pairing_data = conn.recv(BUFFER_SIZE)
-        if not pairing_data:
-            print(f"[TCP SERVER] Connection closed by {addr} before pairing attempt.")
-            return
-
-        client_pairing_message = pairing_data.decode().strip()
-        print(f"[TCP SERVER] Received pairing message: '{client_pairing_message}' from {addr}")
-
-        expected_pairing_prefix = "PAIR_WITH_SERVER:"
-        if client_pairing_message.startswith(expected_pairing_prefix):
-            client_pairing_id = client_pairing_message[len(expected_pairing_prefix):]
-            if client_pairing_id == SERVER_PAIRING_ID:
-                paired = True
-                conn.sendall(f"ACK:PAIRING_SUCCESSFUL".encode())
-                print(f"[TCP SERVER] Pairing successful with {addr}")
-            else:
-                conn.sendall(f"NACK:PAIRING_FAILED_MISMATCH".encode())
-                print(
-                    f"[TCP SERVER] Pairing failed with {addr}: ID mismatch. Expected '{SERVER_PAIRING_ID}', got '{client_pairing_id}'.")
-                return  # Close connection if pairing fails
-        else:
-            conn.sendall(f"NACK:PAIRING_FAILED_BAD_FORMAT".encode())
-            print(f"[TCP SERVER] Pairing failed with {addr}: Bad pairing message format.")
-            return  # Close connection
-
-        if not paired:
-            # Should have already returned, but as a safeguard
-            print(f"[TCP SERVER] Pairing not established with {addr}. Closing connection.")
-            return
-
-        # Proceed with command handling if paired
-        while True:
-            data = conn.recv(BUFFER_SIZE)
-            if not data:
-                print(f"[TCP SERVER] Connection closed by {addr} after pairing.")
-                break
-            command = data.decode().strip()
-            print(f"[TCP SERVER] Received command: {command} from {addr}")
-
-            action = COMMAND_ACTIONS.get(command)
-            if action:
-                try:
-                    action()
-                    print(f"[TCP SERVER] Executed: {command}")
-                    conn.sendall(f"ACK:{command}".encode())
-                except Exception as e:
-                    print(f"[TCP SERVER] Error executing command {command}: {e}")
-                    print(
-                        f"[TCP SERVER] Ensure the target application window (e.g., PowerPoint) is active and in the foreground.")
-                    print(
-                        f"[TCP SERVER] If issues persist, try running this server script with Administrator privileges.")
-                    conn.sendall(f"NACK:{command} - Error: {e}".encode())
-            else:
-                print(f"[TCP SERVER] Unknown command: {command}")
-                conn.sendall(f"NACK:Unknown command {command}".encode())
-    except ConnectionResetError:
-        print(f"[TCP SERVER] Connection reset by {addr}")
-    except socket.timeout:  # Catch socket timeouts specifically if they occur
-        print(f"[TCP SERVER] Socket timeout during communication with {addr}.")
-    except Exception as e:
-        print(f"[TCP SERVER] Error during TCP communication with {addr}: {e}")
-    finally:
-        conn.close()
-        print(f"[TCP SERVER] Closed connection from {addr}")
+        overlay.start()
+    except OverlayUnavailable as e:
+        print(f"[SPOTLIGHT] Overlay not available ({e}); LASER_ON/LASER_OFF will only be logged.")
+        return
+    OVERLAY = overlay
+    LATENCY_METRICS.add_gauge_source("spotlight", OVERLAY.stats)
+    if smoother is not None:
+        LATENCY_METRICS.add_gauge_source("pointer_smoothing", smoother.stats)
+
+
+def set_spotlight(visible):
+    """LASER_ON / LASER_OFF action."""
+    if OVERLAY is None:
+        log.debug("[SPOTLIGHT] Laser %s command received (no overlay available)", "ON" if visible else "OFF")
+        return
+    if visible:
+        OVERLAY.show()
+    else:
+        OVERLAY.hide()
+
+
+def on_pointer(x, y, sampled_at):
+    """Pointer position from a client, as fractions of the screen size."""
+    if OVERLAY is not None:
+        OVERLAY.move(x, y, sampled_at)
+
 
+def on_motion(dx, dy):
+    """Relative pointer motion from a client, in the client's pixels."""
+    dx, dy = dx * MOTION_GAIN, dy * MOTION_GAIN
+    if MOTION_TARGET == "cursor" and CURSOR_MOTION is not None:
+        CURSOR_MOTION.add(dx, dy)  # Applied on the accumulator's thread; moving the cursor may block
+    elif MOTION_TARGET == "spotlight" and OVERLAY is not None:
+        OVERLAY.move_by(dx, dy)
 
-def start_tcp_server():
-    """Starts the TCP server to listen for commands."""
-    global SERVER_PAIRING_ID  # Ensure access to the runtime-set global
-    host_ip = '0.0.0.0'  # Listen on all available network interfaces
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def handle_client_connection(conn, addr):
+    """Handles an incoming TCP connection from a client: pairing first, then commands."""
+    serve_connection(conn, addr, COMMAND_TABLE, pairing_id=SERVER_PAIRING_ID, bufsize=BUFFER_SIZE,
+                     metrics=LATENCY_METRICS, injector=INJECTION_WORKER, ack_mode=ACK_MODE,
+                     udp_sessions=UDP_SESSIONS, pointer=on_pointer, motion=on_motion, arbiter=ARBITER,
+                     sessions=RESUMABLE_SESSIONS)
+
+
+def export_latency_metrics():
+    """Writes LATENCY_METRICS to METRICS_EXPORT_PATH, if one is configured."""
+    if not METRICS_EXPORT_PATH:
+        return
+    try:
+        LATENCY_METRICS.write(METRICS_EXPORT_PATH)
+        print(f"[METRICS] Latency metrics written to {METRICS_EXPORT_PATH}")
+    except OSError as e:
+        print(f"[METRICS] Could not write metrics to {METRICS_EXPORT_PATH}: {e}")
+
+
+def start_tcp_server(server_socket):
+    """Accepts commands on the (already listening) TCP socket."""
     try:
-        # Allow address reuse
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((host_ip, COMMAND_PORT))
-        server_socket.listen(5)  # Allow up to 5 queued connections
         print(f"[TCP SERVER] Listening for commands on TCP port {COMMAND_PORT}")
         print(f"[TCP SERVER] Server Pairing ID for this session: '{SERVER_PAIRING_ID}'. Clients must match this.")
 
@@ -124,11 +326,7 @@ def start_tcp_server():
             client_thread.daemon = True  # Allows main program to exit even if thread is running
             client_thread.start()
     except OSError as e:
-        print(
-            f"[TCP SERVER] Error binding to port {COMMAND_PORT}: {e}. Is another program (or this script already) using it?")
-        print(f"[TCP SERVER] On Windows, check Task Manager for conflicting processes or try a different port.")
-        print(
-            f"[TCP SERVER] If the error is 'Address already in use', please wait a moment and try again, or ensure no other instance of this server is running.")
+        print(f"[TCP SERVER] Error on TCP port {COMMAND_PORT}: {e}")
     except Exception as e:
         print(f"[TCP SERVER] An unexpected error occurred in TCP server: {e}")
     finally:
@@ -136,85 +334,23 @@ def start_tcp_server():
         print("[TCP SERVER] TCP Server stopped.")
 
 
-def start_udp_discovery_server():
-    """Starts the UDP server to listen for discovery broadcasts."""
-    global SERVER_PAIRING_ID  # Ensure access to the runtime-set global
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    # Allow address reuse for UDP socket as well, can be helpful on some systems
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-    try:
-        hostname = socket.gethostname()
-        # Try to get an IP address that is likely on the LAN
-        try:
-            s_temp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s_temp.settimeout(1)  # Add a timeout for the dummy connection
-            s_temp.connect(("8.8.8.8", 80))  # Google's DNS server, common practice
-            server_ip = s_temp.getsockname()[0]
-            s_temp.close()
-        except (OSError, socket.timeout):  # Fallback if the above fails (e.g. no internet, or 8.8.8.8 blocked)
-            server_ip = socket.gethostbyname(hostname)  # This might return 127.0.0.1
-            if server_ip == "127.0.0.1":  # Try to find a non-loopback IP
-                # Get all address info for AF_INET (IPv4)
-                all_ips = socket.getaddrinfo(hostname, None, socket.AF_INET)
-                for item in all_ips:
-                    # item[4][0] is the IP address
-                    if not item[4][0].startswith("127."):
-                        server_ip = item[4][0]
-                        break
-    except socket.gaierror:
-        server_ip = "127.0.0.1"  # Fallback IP
-        print(
-            "[UDP DISCOVERY] Warning: Could not determine a reliable local IP via hostname or dummy connection. Responding with localhost.")
-        print(
-            "[UDP DISCOVERY] Client might not be able to connect if it's on a different machine and this IP is 127.0.0.1.")
-    except Exception as e:  # Catch any other unexpected errors during IP detection
-        server_ip = "0.0.0.0"  # Fallback, client will see the source IP of UDP packet
-        print(f"[UDP DISCOVERY] Error determining server IP: {e}. Will rely on client seeing UDP source IP.")
-
-    try:
-        udp_socket.bind(('', DISCOVERY_PORT))  # Bind to all interfaces for receiving
-        print(f"[UDP DISCOVERY] Listening for discovery broadcasts on UDP port {DISCOVERY_PORT}")
-        print(
-            f"[UDP DISCOVERY] Server Pairing ID for this session: '{SERVER_PAIRING_ID}'. Will only respond to clients sending the correct ID.")
-        print(
-            f"[UDP DISCOVERY] Server will respond indicating its IP as: {server_ip} (ensure this is reachable by client if not 0.0.0.0)")
-    except OSError as e:
-        print(f"[UDP DISCOVERY] Error binding to UDP port {DISCOVERY_PORT}: {e}. Is another program using it?")
-        print(
-            f"[UDP DISCOVERY] On Windows, check Task Manager or use 'netstat -ano' in cmd to find conflicting processes.")
-        udp_socket.close()
-        return
+def start_udp_discovery_server(udp_socket):
+    """Answers discovery broadcasts on the (already bound) UDP socket."""
+    print(f"[UDP DISCOVERY] Listening for discovery broadcasts on UDP port {DISCOVERY_PORT}")
+    print(
+        f"[UDP DISCOVERY] Server Pairing ID for this session: '{SERVER_PAIRING_ID}'. Will only respond to clients sending the correct ID.")
+    print(f"[UDP DISCOVERY] Server will respond indicating its IP as: {describe_advertised_ip(ADVERTISED_IP)}")
 
     while True:
         try:
             message, client_address = udp_socket.recvfrom(BUFFER_SIZE)
-            message_str = message.decode().strip()
-            print(f"[UDP DISCOVERY] Received discovery message: '{message_str}' from {client_address}")
-
-            # Expected client discovery message format: "SPOTLIGHT_CLIENT_DISCOVERY:<pairing_id>"
-            discovery_prefix = "SPOTLIGHT_CLIENT_DISCOVERY:"
-            if message_str.startswith(discovery_prefix):
-                client_pairing_id = message_str[len(discovery_prefix):]
-                if client_pairing_id == SERVER_PAIRING_ID:
-                    # If server_ip was determined as 0.0.0.0, the client will use the source IP of the UDP packet.
-                    # Otherwise, use the determined server_ip.
-                    ip_to_respond_with = server_ip if server_ip != "0.0.0.0" else client_address[0]
-                    response = f"SPOTLIGHT_SERVER_RESPONSE:{ip_to_respond_with}:{COMMAND_PORT}:{SERVER_NAME}"
-                    udp_socket.sendto(response.encode(), client_address)
-                    print(f"[UDP DISCOVERY] Correct Pairing ID. Sent response to {client_address}: {response}")
-                else:
-                    print(
-                        f"[UDP DISCOVERY] Incorrect Pairing ID from {client_address}. Expected '{SERVER_PAIRING_ID}', got '{client_pairing_id}'. Ignoring.")
-            else:
-                print(
-                    f"[UDP DISCOVERY] Message from {client_address} not in expected format ('{discovery_prefix}...'). Ignoring.")
-
+            response = answer_discovery(message, client_address)
+            if response:
+                udp_socket.sendto(response, client_address)
         except ConnectionResetError:  # client_address might not be fully established for UDP "connections"
-            print(f"[UDP DISCOVERY] Connection reset error likely from {client_address} (UDP). Ignoring.")
+            log.debug("[UDP DISCOVERY] Connection reset error likely from %s (UDP). Ignoring.", client_address)
         except Exception as e:
-            print(f"[UDP DISCOVERY] Error in discovery loop: {e}")
+            log.error("[UDP DISCOVERY] Error in discovery loop: %s", e)
             time.sleep(1)  # Prevent rapid looping on persistent error
 
     # This part will likely not be reached in normal operation as the loop above is infinite
@@ -223,16 +359,47 @@ def start_udp_discovery_server():
 
 
 if __name__ == "__main__":
+    try:
+        config_sources = load_config(globals(), CONFIG_OPTIONS, default_path=CONFIG_PATH,
+                                     nullable=CONFIG_NULLABLE, seconds=CONFIG_SECONDS,
+                                     description="Spotlight receiver server (Version 2)")
+    except ConfigError as e:
+        print(f"[FATAL SERVER ERROR] Configuration: {e}")
+        sys.exit(2)
+    setup_logging(LOG_LEVEL, EVENT_LOG_PATH)
     print("--- Logitech Spotlight Receiver Server (Runtime Pairing ID) ---")
+    if config_sources:
+        print(f"[CONFIG] Settings from outside this script: {describe_sources(config_sources)}")
 
-    # --- Get Pairing ID from user input ---
-    while not SERVER_PAIRING_ID:  # Loop until a non-empty ID is provided
-        temp_id = input("Enter the custom Pairing ID for this server session (cannot be empty): ").strip()
-        if temp_id:
-            SERVER_PAIRING_ID = temp_id
-        else:
-            print("Pairing ID cannot be empty. Please try again.")
+    # --- Pairing ID: from the configuration, else asked for when there is someone to ask ---
+    if not SERVER_PAIRING_ID:
+        try:
+            SERVER_PAIRING_ID = ask("pairing-id", "Enter the custom Pairing ID for this server session (cannot be empty): ")
+        except ConfigError as e:
+            print(f"[FATAL SERVER ERROR] {e}")
+            sys.exit(2)
+    if KEYMAP_PATH:
+        try:
+            start_keymap()
+        except KeymapError as e:
+            print(f"[FATAL SERVER ERROR] {e}")
+            sys.exit(2)
+    build_command_table()
+
+    UDP_SESSIONS = UdpSessions(UDP_COMMAND_PORT) if UDP_COMMAND_PORT is not None else None
+    RESUMABLE_SESSIONS = ResumableSessions(SESSION_TTL) if SESSION_TTL is not None else None
+    ARBITER = CommandArbiter(CONTROLLER_PRIORITIES, NAVIGATION_COMMANDS if FLOOR_CONTROL else (), FLOOR_IDLE_TIMEOUT)
 
+    # Ports first: clients starting at the same time find this server while the rest loads
+    listener = EarlyListener(COMMAND_PORT, DISCOVERY_PORT, answer_discovery, DISCOVERY_MULTICAST_GROUP,
+                             LISTEN_BACKLOG, bufsize=BUFFER_SIZE)
+    try:
+        listener.start()
+    except OSError as e:
+        print(f"[FATAL SERVER ERROR] Could not bind TCP port {COMMAND_PORT} / UDP port {DISCOVERY_PORT}: {e}. "
+              f"Is another program (or this script already) using it?")
+        print(f"On Windows, check Task Manager or use 'netstat -ano' in cmd to find conflicting processes.")
+        exit()
     print(f"IMPORTANT: SERVER PAIRING ID FOR THIS SESSION IS SET TO: '{SERVER_PAIRING_ID}'")
     print("The client application MUST be configured to use this exact Pairing ID.")
     print("This script listens for commands from the Spotlight Client and simulates key presses.")
@@ -240,6 +407,8 @@ if __name__ == "__main__":
     print("\n--- Windows Specific Notes ---")
     print(f"1. Windows Firewall: You may be prompted to allow Python/this script network access.")
     print(f"   Ensure inbound rules are allowed for Python on UDP port {DISCOVERY_PORT} and TCP port {COMMAND_PORT}.")
+    if UDP_COMMAND_PORT is not None:
+        print(f"   UDP commands also need UDP port {UDP_COMMAND_PORT} (clients fall back to TCP if it is blocked).")
     print(f"2. Administrator Privileges: If controlling certain applications (e.g., those running as admin),")
     print(f"   you might need to run this script as an Administrator for 'pyautogui' to function correctly.")
     print(
@@ -251,13 +420,41 @@ if __name__ == "__main__":
         f"5. If 'Address already in use' error persists, ensure no other instance of this server is running or wait a minute for the OS to release the port.")
     print("--- Starting Server ---")
 
-    discovery_thread = threading.Thread(target=start_udp_discovery_server)
-    discovery_thread.daemon = True
-    discovery_thread.start()
+    try:
+        start_injection()
+    except ValueError as e:
+        print(f"[FATAL SERVER ERROR] Input backend '{INJECTOR_BACKEND}' is not usable: {e}")
+        exit()
+    threading.Thread(target=start_overlay, name="overlay-start", daemon=True).start()
+    LATENCY_METRICS.add_gauge_source("arbiter", ARBITER.stats)
+    if METRICS_EXPORT_PATH:
+        start_periodic_export(LATENCY_METRICS, METRICS_EXPORT_PATH, METRICS_EXPORT_INTERVAL)
+    if USE_ASYNC_SERVER:
+        from spotlight_core.aio_server import AsyncSpotlightServer  # asyncio takes a while to import
+
+        # TCP commands and UDP discovery share one event loop (blocks until Ctrl+C)
+        print(f"[TCP SERVER] Server Pairing ID for this session: '{SERVER_PAIRING_ID}'. Clients must match this.")
+        AsyncSpotlightServer(COMMAND_TABLE, pairing_id=SERVER_PAIRING_ID, port=COMMAND_PORT,
+                             discovery_port=DISCOVERY_PORT, server_name=SERVER_NAME,
+                             advertised_ip=ADVERTISED_IP, max_connections=MAX_CONNECTIONS,
+                             backlog=LISTEN_BACKLOG, idle_timeout=IDLE_TIMEOUT,
+                             pairing_timeout=PAIRING_TIMEOUT, bufsize=BUFFER_SIZE, metrics=LATENCY_METRICS,
+                             injector=INJECTION_WORKER, ack_mode=ACK_MODE,
+                             multicast_group=DISCOVERY_MULTICAST_GROUP, udp_command_port=UDP_COMMAND_PORT,
+                             pointer=on_pointer, motion=on_motion, arbiter=ARBITER,
+                             session_ttl=SESSION_TTL, sockets=listener.take_over()).run()
+    else:
+        tcp_socket, udp_socket = listener.take_over()
+        discovery_thread = threading.Thread(target=start_udp_discovery_server, args=(udp_socket,))
+        discovery_thread.daemon = True
+        discovery_thread.start()
+        if UDP_SESSIONS is not None:
+            start_udp_command_server(UDP_SESSIONS, bufsize=BUFFER_SIZE)
 
-    # Run TCP command server in the main thread
-    # This will block until an error or the script is interrupted (e.g., Ctrl+C)
-    start_tcp_server()
+        # Run TCP command server in the main thread
+        # This will block until an error or the script is interrupted (e.g., Ctrl+C)
+        start_tcp_server(tcp_socket)
 
+    export_latency_metrics()
     print("Server shutting down.")
 
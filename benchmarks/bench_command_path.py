@@ -0,0 +1,274 @@
+# bench_command_path.py
+# Load generator for the Spotlight command path.
+#
+# Starts a server (bench_server.py, recording input backend) and drives it with N synthetic
+# clients that use the real discovery message, pairing handshake and binary protocol. It
+# measures:
+#   - discovery time        (discovery.discover() call -> first valid server response)
+#   - connection setup time (TCP connect + pairing ACK)
+#   - ACK latency           (command written -> its ACK received), p50/p95/p99
+#   - throughput            (acknowledged commands per second over all clients)
+# and prints one JSON document (or writes it with --output), so runs of different targets,
+# engines and releases can be compared by a script.
+#
+#   python benchmarks/bench_command_path.py --target v2 --clients 16 --commands 500
+#   python benchmarks/bench_command_path.py --target v1 --engine threaded --window 1 --output v1.json
+#   python benchmarks/bench_command_path.py --transport udp   # UDP command channel instead of TCP
+#   python benchmarks/bench_command_path.py --host 192.168.1.20 --port 50001 --no-spawn   # existing server
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from spotlight_core import protocol
+from spotlight_core.discovery import DISCOVERY_MESSAGE, DISCOVERY_PREFIX, MULTICAST_GROUP, discover
+from spotlight_core.metrics import LatencyHistogram
+from spotlight_core.pipeline import PipelinedSender
+from spotlight_core.udp_commands import UdpCommandSender, request_udp_session
+
+BENCH_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_server.py")
+PAIRING_TARGETS = ("v2", "single")  # Targets that expect the pairing handshake
+
+
+def summarize(histogram):
+    """LatencyHistogram summary in milliseconds, for the report."""
+    summary = histogram.summary()
+    return {key: (round(value * 1000, 3) if key != "count" and value is not None else value)
+            for key, value in summary.items()}
+
+
+def start_server(args):
+    """Launches bench_server.py and waits until its TCP port accepts connections."""
+    command = [sys.executable, BENCH_SERVER, "--target", args.target, "--engine", args.engine,
+               "--ack-mode", args.ack_mode, "--port", str(args.port), "--discovery-port", str(args.discovery_port),
+               "--pairing-id", args.pairing_id, "--max-connections", str(max(64, args.clients * 2))]
+    if args.no_worker:
+        command.append("--no-worker")
+    # Server output goes to stderr so stdout carries only the JSON report
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=sys.stderr)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"benchmark server exited with code {process.returncode}")
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.2).close()
+            time.sleep(0.2)  # Let the probe connection's close be processed before measuring
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("benchmark server did not start listening within 15 s")
+
+
+def measure_discovery(args, histogram):
+    """Times discovery.discover() (the clients' lookup) against the server, `discovery_rounds` times."""
+    message = DISCOVERY_PREFIX + args.pairing_id if args.target in PAIRING_TARGETS else DISCOVERY_MESSAGE
+    targets = {
+        "unicast": {"unicast_hosts": [args.host], "broadcast_address": None, "multicast_group": None},
+        "broadcast": {"multicast_group": None},
+        "multicast": {"broadcast_address": None, "multicast_group": MULTICAST_GROUP},
+    }[args.discovery_via]
+    failures = 0
+    for _ in range(args.discovery_rounds):
+        started = time.perf_counter()
+        if discover(message, args.discovery_port, timeout=args.timeout, **targets):
+            histogram.observe(time.perf_counter() - started)
+        else:
+            failures += 1
+    return failures
+
+
+class SyntheticClient(threading.Thread):
+    """One controller: connect, pair, then send `commands` commands with up to `window` in flight."""
+
+    def __init__(self, args, index, start_event, results):
+        super().__init__(name=f"bench-client-{index}", daemon=True)
+        self.args = args
+        self.start_event = start_event
+        self.results = results
+        self.acked = 0
+        self.failed = 0
+        self.error = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    def run(self):
+        args = self.args
+        self.start_event.wait()
+        try:
+            started = time.perf_counter()
+            sock = socket.create_connection((args.host, args.port), timeout=args.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            decoder = protocol.FrameDecoder()
+            if args.target in PAIRING_TARGETS:
+                sock.sendall(protocol.encode_pair(args.pairing_id))
+                reply = protocol.recv_frame(sock, decoder)
+                if reply is None or not protocol.is_pairing_ack(reply):
+                    raise RuntimeError(f"pairing failed: {reply and protocol.format_reply(reply)}")
+            udp_session = None
+            if args.transport == "udp":
+                udp_session = request_udp_session(sock, decoder)
+                if udp_session is None:
+                    raise RuntimeError("server offers no UDP command channel")
+            self.results.observe_setup(time.perf_counter() - started)
+            sock.settimeout(None)  # The sender's reader thread blocks; it applies its own ACK timeout
+        except Exception as e:
+            self.error = f"setup: {e}"
+            self.failed = args.commands
+            return
+
+        if udp_session is not None:
+            # No window over UDP: every command goes out at once, lost ones are retransmitted
+            sender = UdpCommandSender((args.host, udp_session[0]), udp_session[1], on_reply=self._on_reply,
+                                      on_failure=lambda command, captured_at, reason, seq: self._on_failure(command, reason))
+        else:
+            sender = PipelinedSender(sock, decoder, window=args.window, ack_timeout=args.timeout,
+                                     on_reply=self._on_reply, on_failure=self._on_failure,
+                                     on_disconnect=self._on_disconnect)
+        commands = args.command_list
+        for i in range(args.commands):
+            if sender.send(commands[i % len(commands)]) is None:
+                break
+        self._done.wait(args.timeout + args.commands * 0.01)
+        self.finished_at = time.perf_counter()
+        sender.close()
+        sock.close()
+
+    def _check_done(self):
+        if self.acked + self.failed >= self.args.commands:
+            self._done.set()
+
+    def _on_reply(self, command, reply, rtt):
+        if reply.ok:
+            self.acked += 1
+            self.results.observe_ack(rtt)
+        else:
+            self.failed += 1
+        self._check_done()
+
+    def _on_failure(self, command, reason):
+        self.failed += 1
+        self._check_done()
+
+    def _on_disconnect(self, error):
+        if self.acked + self.failed < self.args.commands:
+            self.error = f"disconnected: {error}"
+        self._done.set()
+
+
+class Results:
+    """Histograms shared by all client threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.setup = LatencyHistogram()
+        self.ack = LatencyHistogram()
+
+    def observe_setup(self, seconds):
+        with self._lock:
+            self.setup.observe(seconds)
+
+    def observe_ack(self, seconds):
+        with self._lock:
+            self.ack.observe(seconds)
+
+
+def run_benchmark(args):
+    results = Results()
+    discovery = LatencyHistogram()
+    discovery_failures = measure_discovery(args, discovery) if args.discovery_rounds else 0
+
+    start_event = threading.Event()
+    clients = [SyntheticClient(args, i, start_event, results) for i in range(args.clients)]
+    for client in clients:
+        client.start()
+    started = time.perf_counter()
+    start_event.set()
+    for client in clients:
+        client.join()
+    finished = max([client.finished_at for client in clients if client.finished_at] or [time.perf_counter()])
+
+    acked = sum(client.acked for client in clients)
+    duration = finished - started
+    return {
+        "benchmark": "command_path",
+        "target": args.target,
+        "engine": args.engine,
+        "ack_mode": args.ack_mode,
+        "injection_worker": not args.no_worker,
+        "clients": args.clients,
+        "commands_per_client": args.commands,
+        "window": args.window,
+        "transport": args.transport,
+        "commands": args.command_list,
+        "discovery_via": args.discovery_via,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "throughput": {
+            "acked": acked,
+            "failed": sum(client.failed for client in clients),
+            "duration_s": round(duration, 4),
+            "commands_per_second": round(acked / duration, 1) if duration > 0 else None,
+        },
+        "ack_latency_ms": summarize(results.ack),
+        "connection_setup_ms": summarize(results.setup),
+        "discovery_ms": dict(summarize(discovery), failures=discovery_failures),
+        "errors": sorted({client.error for client in clients if client.error}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Spotlight command path with synthetic clients.")
+    parser.add_argument("--target", choices=["v1", "v2", "single"], default="v2")
+    parser.add_argument("--engine", choices=["async", "threaded"], default="async")
+    parser.add_argument("--ack-mode", choices=["completed", "queued"], default="completed")
+    parser.add_argument("--no-worker", action="store_true", help="server runs actions inline, without the injection worker")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--commands", type=int, default=200, help="commands sent by each client")
+    parser.add_argument("--window", type=int, default=8, help="commands in flight per client (1 = stop-and-wait)")
+    parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp",
+                        help="send commands over the TCP connection or the UDP command channel")
+    parser.add_argument("--command-mix", default="NEXT,PREVIOUS", help="comma-separated commands, sent in rotation")
+    parser.add_argument("--discovery-rounds", type=int, default=20)
+    parser.add_argument("--discovery-via", choices=["unicast", "broadcast", "multicast"], default="unicast",
+                        help="where discovery requests are sent (unicast goes to --host)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=51001)
+    parser.add_argument("--discovery-port", type=int, default=51000)
+    parser.add_argument("--pairing-id", default="bench")
+    parser.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--no-spawn", action="store_true", help="benchmark a server that is already running")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    args.command_list = [command.strip() for command in args.command_mix.split(",") if command.strip()]
+
+    server = None if args.no_spawn else start_server(args)
+    try:
+        report = run_benchmark(args)
+    finally:
+        if server:
+            server.terminate()
+            try:
+                server.wait(5)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# bench_server.py
+# Starts one of the Spotlight servers for benchmarking, with the "recording" input backend so
+# no real keys are pressed and no display is needed. Normally launched by bench_command_path.py,
+# but it can be run by hand to benchmark from another machine:
+#
+#   python benchmarks/bench_server.py --target v2 --pairing-id bench
+#
+# The target script is imported as a module (its configuration and functions, not its
+# interactive __main__ block), so the benchmark measures that release's own connection
+# handling code.
+
+import argparse
+import importlib.util
+import os
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from spotlight_core.aio_server import AsyncSpotlightServer
+from spotlight_core.injection import InjectionWorker
+from spotlight_core.injectors import get_injector
+from spotlight_core.log import setup_logging
+from spotlight_core.startup import EarlyListener
+from spotlight_core.udp_commands import UdpSessions, start_udp_command_server
+
+# name -> (script path relative to the repo root, pairing ID variable or None for no pairing)
+TARGETS = {
+    "v1": ("spotlight_server.py", None),
+    "v2": (os.path.join("Version2", "spotlight_server.py"), "SERVER_PAIRING_ID"),
+    "single": (os.path.join("Version2", "Single_PPT_Sync.py"), "SERVER_PAIRING_ID_GLOBAL"),
+}
+# Version 3 is not a target: its roles are reversed (the key-capturing side is the TCP server
+# and pushes commands to clients that never ACK), so it has no command/ACK path to measure.
+
+
+def load_target(name):
+    """Imports a target server script under a private module name and returns the module."""
+    script, _ = TARGETS[name]
+    path = os.path.join(ROOT, script)
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(f"spotlight_bench_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_command_table(module):
+    """Builds the module's COMMAND_TABLE, for scripts that build it at start rather than on import."""
+    for builder in ("build_command_table", "build_command_table_for_server"):
+        if hasattr(module, builder):
+            getattr(module, builder)()
+
+
+def start_recording_injection(module, use_worker):
+    """Points the module's key actions at a recording backend (and injection worker)."""
+    module.INJECTOR = get_injector("recording")
+    module.INJECTION_WORKER = None
+    if use_worker:
+        module.INJECTION_WORKER = InjectionWorker(module.INJECTOR.press, module.COMMAND_KEYS, pause=0.0)
+        module.INJECTION_WORKER.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a Spotlight server with a recording input backend.")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="v2")
+    parser.add_argument("--engine", choices=["async", "threaded"], default="async")
+    parser.add_argument("--ack-mode", choices=["completed", "queued"], default="completed")
+    parser.add_argument("--no-worker", action="store_true", help="run actions inline instead of on the injection worker")
+    parser.add_argument("--port", type=int, default=51001)
+    parser.add_argument("--discovery-port", type=int, default=51000)
+    parser.add_argument("--pairing-id", default="bench")
+    parser.add_argument("--max-connections", type=int, default=1024)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+    module = load_target(args.target)
+    _, pairing_attr = TARGETS[args.target]
+    pairing_id = args.pairing_id if pairing_attr else None
+    if pairing_attr:
+        setattr(module, pairing_attr, pairing_id)
+    module.COMMAND_PORT = args.port
+    module.DISCOVERY_PORT = args.discovery_port
+    module.ACK_MODE = args.ack_mode
+    module.UDP_COMMAND_PORT = args.port  # UDP command channel on the same port number as TCP
+    module.UDP_SESSIONS = UdpSessions(args.port)
+    module.ARBITER = None  # As with the asyncio engine below: no floor control between the synthetic clients
+    build_command_table(module)
+    start_recording_injection(module, not args.no_worker)
+
+    if args.engine == "async":
+        AsyncSpotlightServer(module.COMMAND_TABLE, pairing_id=pairing_id, port=args.port,
+                             discovery_port=args.discovery_port, server_name=module.SERVER_NAME,
+                             advertised_ip="127.0.0.1", max_connections=args.max_connections,
+                             backlog=args.max_connections, bufsize=module.BUFFER_SIZE,
+                             injector=module.INJECTION_WORKER, ack_mode=args.ack_mode,
+                             multicast_group=module.DISCOVERY_MULTICAST_GROUP, udp_command_port=args.port).run()
+        return
+
+    # Thread-per-connection engine, through the script's own functions
+    if args.target == "single":
+        discovery, tcp = module.start_udp_discovery_server_mode, module.start_tcp_server_mode
+    else:
+        discovery, tcp = module.start_udp_discovery_server, module.start_tcp_server
+    listener = EarlyListener(args.port, args.discovery_port, lambda message, client_address: None,
+                             module.DISCOVERY_MULTICAST_GROUP, args.max_connections, bufsize=module.BUFFER_SIZE)
+    listener.start()
+    tcp_socket, udp_socket = listener.take_over()
+    threading.Thread(target=discovery, args=(udp_socket,), daemon=True).start()
+    start_udp_command_server(module.UDP_SESSIONS, bufsize=module.BUFFER_SIZE)
+    try:
+        tcp(tcp_socket)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
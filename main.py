@@ -1,9 +1,24 @@
 # spotlight_client.py
 # Run this script on Computer 1 (where the Logitech Spotlight is connected)
 
+import itertools
 import socket
+import threading
 import time
-from pynput import keyboard  # For listening to global key presses
+
+from spotlight_core import protocol
+from spotlight_core.capture import CaptureQueue, KeyDebouncer, SenderThread
+from spotlight_core.connection import READY, Backoff, ConnectionManager, ReplayBuffer
+from spotlight_core.discovery import DISCOVERY_MESSAGE, MULTICAST_GROUP, discover, discover_all
+from spotlight_core.fanout import FanoutSender, parse_targets
+from spotlight_core.keymap import RELOAD_INTERVAL, KeymapError, KeymapWatcher, compile_keys
+from spotlight_core.keys import CaptureUnavailable, key_name, load_pynput, preload_pynput
+from spotlight_core.log import get_logger, setup_logging
+from spotlight_core.metrics import LatencyRecorder, now_us, record_reply, start_periodic_export
+from spotlight_core.pipeline import PipelinedSender
+from spotlight_core.pointer import MotionAccumulator, PointerStreamer, screen_size
+from spotlight_core.server_cache import DEFAULT_CACHE_PATH, ServerCache
+from spotlight_core.udp_commands import UdpCommandSender, request_udp_session
 
 # Configuration
 DISCOVERY_PORT = 50000
@@ -11,215 +26,430 @@ DISCOVERY_TIMEOUT = 5  # seconds to wait for server discovery
 BROADCAST_ADDRESS = '<broadcast>'  # Special address for broadcasting
 # For some systems, you might need to use a specific broadcast IP like '192.168.1.255'
 # if '<broadcast>' doesn't work.
+DISCOVERY_MULTICAST_GROUP = MULTICAST_GROUP  # Discovery is also sent to this IPv4 group (None = broadcast only)
 BUFFER_SIZE = 1024
+CONNECT_TIMEOUT = 5  # seconds for the TCP connect to a discovered server
+# Servers we connected to are remembered here (pairing ID, name, IP, port, RTT) and tried
+# directly on the next start, so the same-room case connects without waiting for discovery.
+SERVER_CACHE_PATH = DEFAULT_CACHE_PATH  # None = remember them in memory only (for reconnects)
+ACK_TIMEOUT = 3  # seconds to wait for the server's ACK/NACK of a command
+# Pipelined mode sends each command immediately and matches ACKs in the background,
+# so a key press never waits for the previous command's round trip.
+# Set to False to go back to stop-and-wait (send, then block for the ACK).
+PIPELINED_SENDING = True
+PIPELINE_WINDOW = 8  # Max commands awaiting an ACK at once; more are held back until ACKs arrive
+# The client PINGs the server every HEARTBEAT_INTERVAL seconds (pipelined mode). After
+# HEARTBEAT_MISSES intervals without any data from the server the connection counts as dead
+# and a reconnect starts in the background, before the next key press finds out the hard way.
+HEARTBEAT_INTERVAL = 1.0  # seconds; None = no heartbeat (TCP keepalive still applies)
+HEARTBEAT_MISSES = 3
+# Optional UDP command channel (pipelined mode, needs a server with UDP_COMMAND_PORT set).
+# Each click is its own datagram, repeated in the next one and re-sent until ACKed, so a lost
+# packet on Wi-Fi does not hold back later clicks the way it does on TCP. The TCP connection
+# stays up for heartbeats; a click that gets no UDP ACK is sent over TCP instead.
+UDP_COMMANDS = False
+# Fan-out: one remote driving several presentation machines (stage screen, confidence monitor,
+# overflow room). Every key press is written to all of them at once and each one's ACK is
+# tracked on its own; on exit the client prints every server's round trip and how far behind
+# the fastest one it ran the commands (also recorded as the target_rtt / fanout_skew metrics).
+# None = one server, the first that answers discovery. A list such as ["192.168.1.20",
+# "192.168.1.21:50001"] = those servers. "discover" = every server that answers discovery
+# within FANOUT_DISCOVERY_WINDOW seconds.
+FANOUT_TARGETS = None
+FANOUT_DISCOVERY_WINDOW = 2  # seconds
+DEFAULT_COMMAND_PORT = 50001  # For FANOUT_TARGETS entries without a port
+# Reconnect attempts are retried after 0.25, 0.5, 1, 2 ... seconds (randomly shortened by up
+# to half), never more than RECONNECT_MAX_DELAY apart.
+RECONNECT_INITIAL_DELAY = 0.25  # seconds
+RECONNECT_MAX_DELAY = 5  # seconds
+# Key presses made while the connection is down are sent once it is back, unless they are
+# older than REPLAY_MAX_AGE by then: a "next slide" from ten seconds ago is worse than none.
+REPLAY_MAX_AGE = 2.0  # seconds after the key press
+REPLAY_MAX_AGE_PER_COMMAND = {"START_PRESENTATION": 10.0}  # Overrides REPLAY_MAX_AGE for these commands
+# Key presses are queued by the key listener and sent from a separate thread, so slow network
+# I/O or a reconnect never stalls the OS input hook.
+CAPTURE_QUEUE_SIZE = 64  # Max key presses waiting to be sent
+CAPTURE_OVERFLOW_POLICY = "drop-oldest"  # When full: "drop-oldest" or "coalesce" (fold repeats of the newest press)
+# Held and bouncing keys: a held remote button makes the OS repeat its press many times a second,
+# and cheap remotes report one click as several. Only real presses are queued and sent.
+REPEAT_POLICY = "ignore"  # Repeats of a held key: "ignore", "rate-limit" (one per REPEAT_INTERVAL) or "hold"
+REPEAT_POLICY_PER_COMMAND = {}  # Overrides REPEAT_POLICY, e.g. {"NEXT": "rate-limit", "LASER_ON": "hold"}
+REPEAT_INTERVAL = 0.25  # seconds ("rate-limit")
+BOUNCE_TIME = 0.03  # A press this soon (seconds) after the key came up is the same press bouncing; 0 = off
+HOLD_RELEASE_COMMANDS = {"LASER_ON": "LASER_OFF"}  # "hold": sent when the key of the command comes up
+# Virtual spotlight: between LASER_ON and LASER_OFF the mouse pointer position is streamed to
+# the server (over UDP when the UDP channel is up), which moves its spotlight overlay with it.
+# "absolute" sends where the pointer is on this screen; "relative" sends how far the mouse moved
+# (added up between ticks, so a 1000 Hz mouse still costs one small frame per tick), which suits
+# screens of different sizes and remotes that only report motion.
+POINTER_MODE = "absolute"
+POINTER_RATE_HZ = 60  # Frames per second at most; match the presentation display's refresh rate
+SCREEN_SIZE = None  # (width, height) of this computer's screen; None = ask the display ("absolute" only)
+# Latency metrics (key press -> ACK, split per stage, p50/p95/p99 per command).
+# Written on exit and every METRICS_EXPORT_INTERVAL seconds; a path ending in .prom or .txt
+# gets Prometheus text format, anything else JSON. None = keep them in memory only.
+METRICS_EXPORT_PATH = None  # e.g. "spotlight_client_metrics.json"
+METRICS_EXPORT_INTERVAL = 30  # seconds
+# Logging goes through a background writer thread so console output never delays a key press.
+# "INFO" = connection events and errors only, "DEBUG" = every command and ACK as well.
+LOG_LEVEL = "INFO"
+EVENT_LOG_PATH = None  # e.g. "spotlight_client_events.jsonl": every event, DEBUG included, as JSON lines
 
 # --- Key Mappings ---
 # Map specific keys to commands to be sent to the server.
 # You'll need to identify which keys your Logitech Spotlight presenter sends.
 # This configuration assumes your Spotlight sends right arrow for next and left for previous.
+# Keys are given by name: pynput's keyboard.Key names ('right', 'f5', 'esc', ...) or the
+# character typed ('b'). That way pynput is only imported (in the background) once the client
+# is already looking for its server.
 KEYS_TO_COMMANDS = {
-    keyboard.Key.right: "NEXT",  # If Spotlight sends 'right arrow' for next
-    keyboard.Key.left: "PREVIOUS",  # If Spotlight sends 'left arrow' for previous
-    keyboard.Key.f5: "START_PRESENTATION",
-    keyboard.KeyCode.from_char('b'): "BLACK_SCREEN",
-    keyboard.KeyCode.from_char('B'): "BLACK_SCREEN",  # Case-insensitive for 'b'
+    "right": "NEXT",  # If Spotlight sends 'right arrow' for next
+    "left": "PREVIOUS",  # If Spotlight sends 'left arrow' for previous
+    "f5": "START_PRESENTATION",
+    "b": "BLACK_SCREEN",
+    "B": "BLACK_SCREEN",  # Case-insensitive for 'b'
     # Add more mappings here if your Spotlight has other buttons/keys
     # e.g., if a button sends 'g', and you want to map it:
-    # keyboard.KeyCode.from_char('g'): "LASER_ON",
+    # "g": "LASER_ON",
+    # "h": "LASER_OFF",
 }
+# Keymap file (see spotlight_core/keymap.py): the "keys" of one of its device profiles replace
+# KEYS_TO_COMMANDS, and the file is watched, so a remap for another remote applies to the next
+# key press without restarting or reconnecting.
+KEYMAP_PATH = None  # e.g. "keymap.json"; None = use KEYS_TO_COMMANDS
+KEYMAP_PROFILE = None  # Profile to use; None = the file's "profile"
+KEYMAP_RELOAD_INTERVAL = RELOAD_INTERVAL  # Seconds between checks for changes
 
 # Global variable to store the client socket
 client_socket = None
+client_decoder = None  # Frame decoder for replies on client_socket (one per connection)
 server_address_global = None
-
-
-def discover_server():
-    """Broadcasts to find the server and returns its IP and port."""
-    print("[DISCOVERY] Looking for Spotlight Receiver Server...")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.settimeout(DISCOVERY_TIMEOUT)
-
-    message = "SPOTLIGHT_CLIENT_DISCOVERY".encode()
-
-    discovered_servers = []
-
-    try:
-        # Send a few discovery packets in case of UDP packet loss
-        for i in range(3):
-            sock.sendto(message, (BROADCAST_ADDRESS, DISCOVERY_PORT))
-            print(f"[DISCOVERY] Sent discovery broadcast ({i + 1}/3) to {BROADCAST_ADDRESS}:{DISCOVERY_PORT}")
-            time.sleep(0.2)  # Small delay between broadcasts
-
-        print(f"[DISCOVERY] Listening for responses for {DISCOVERY_TIMEOUT} seconds...")
-        start_time = time.time()
-        while time.time() - start_time < DISCOVERY_TIMEOUT:
-            try:
-                # Check remaining time for recvfrom timeout
-                remaining_time = DISCOVERY_TIMEOUT - (time.time() - start_time)
-                if remaining_time <= 0:
-                    break
-                sock.settimeout(remaining_time)
-
-                data, server_addr_info = sock.recvfrom(BUFFER_SIZE)  # server_addr_info is (ip, port)
-                response = data.decode()
-                print(f"[DISCOVERY] Received response: '{response}' from {server_addr_info}")
-                if response.startswith("SPOTLIGHT_SERVER_RESPONSE:"):
-                    parts = response.split(':', 3)  # Split max 3 times for RESPONSE_TYPE:IP:PORT:NAME
-                    if len(parts) == 4:
-                        server_ip = parts[1]
-                        try:
-                            server_cmd_port = int(parts[2])
-                            server_name = parts[3]
-                            print(f"[DISCOVERY] Found server '{server_name}' at {server_ip}:{server_cmd_port}")
-                            # For simplicity, connect to the first one found.
-                            # You could extend this to list all and let user choose.
-                            # Store it, but we will return the first valid one outside loop if needed.
-                            discovered_servers.append({'ip': server_ip, 'port': server_cmd_port, 'name': server_name})
-                            # Return immediately with the first server found
-                            return server_ip, server_cmd_port
-                        except ValueError:
-                            print(f"[DISCOVERY] Invalid port in response: {parts[2]}")
-                    else:
-                        print(f"[DISCOVERY] Malformed response: {response}")
-            except socket.timeout:
-                # This is expected if no more responses are coming in the remaining time
-                break  # Break from while loop if overall DISCOVERY_TIMEOUT is reached
-            except Exception as e:
-                print(f"[DISCOVERY] Error receiving discovery response: {e}")
-                # Continue trying to receive other responses until DISCOVERY_TIMEOUT
-                pass
-
-
-    except socket.gaierror as e:
-        print(f"[DISCOVERY] Socket error during discovery (check broadcast address or network): {e}")
-        print(
-            f"[DISCOVERY] Tip: If '{BROADCAST_ADDRESS}' fails, try your network's specific broadcast IP (e.g., '192.168.1.255').")
-    except Exception as e:
-        print(f"[DISCOVERY] Error during discovery: {e}")
-    finally:
-        sock.close()
-
-    if not discovered_servers:  # Should not happen if we return early
-        print("[DISCOVERY] No servers found after timeout.")
-        return None, None
-
-    # This part is mostly redundant if we return immediately upon finding a server above.
-    # If for some reason we collected servers and didn't return, this would pick the first.
-    if discovered_servers:
-        first_server = discovered_servers[0]
-        return first_server['ip'], first_server['port']
-
-    return None, None
-
-
-def connect_to_server(server_ip, server_port):
-    """Connects to the server via TCP."""
+command_sender = None  # PipelinedSender for client_socket when PIPELINED_SENDING is on
+udp_sender = None  # UdpCommandSender when UDP_COMMANDS is on and the server offers a UDP session
+fanout_sender = None  # FanoutSender when FANOUT_TARGETS is set (then there is no connection manager)
+replay_buffer = ReplayBuffer(REPLAY_MAX_AGE, REPLAY_MAX_AGE_PER_COMMAND)  # Commands waiting for a connection
+capture_queue = CaptureQueue(CAPTURE_QUEUE_SIZE, CAPTURE_OVERFLOW_POLICY)  # Filled by on_press, drained by the sender thread
+server_cache = ServerCache(SERVER_CACHE_PATH)
+connection = None  # ConnectionManager: (re)connects in the background, created at startup
+pointer_streamer = None  # PointerStreamer or MotionAccumulator (POINTER_MODE), created at startup
+mouse_controller = None  # pynput mouse.Controller, created with pointer_streamer
+motion_seq = itertools.count(1)  # Sequence numbers of OP_MOTION frames
+latency_metrics = LatencyRecorder("client")
+stop_and_wait_lock = threading.Lock()  # Stop-and-wait sends come from the sender thread and from replays
+key_debouncer = None  # KeyDebouncer used by the key callbacks; created at start
+latency_metrics.add_gauge_source("capture_queue", capture_queue.stats)
+log = get_logger("client")
+
+
+def discover_server(cancel=None):
+    """Broadcasts (and multicasts) to find the server. Returns (ip, port, name), or None."""
+    log.info("[DISCOVERY] Looking for Spotlight Receiver Server...")
+    # Sends and listens at the same time, re-sending after 10, 30, 90 ms ... and returns on the first reply
+    server = discover(DISCOVERY_MESSAGE, DISCOVERY_PORT, timeout=DISCOVERY_TIMEOUT,
+                      broadcast_address=BROADCAST_ADDRESS, multicast_group=DISCOVERY_MULTICAST_GROUP,
+                      bufsize=BUFFER_SIZE, cancel=cancel, tag="[DISCOVERY]")
+    if server is None and not (cancel and cancel.is_set()):
+        log.info("[DISCOVERY] Tip: If '%s' fails, try your network's specific broadcast IP (e.g., '192.168.1.255').",
+                 BROADCAST_ADDRESS)
+    return server
+
+
+def fanout_targets():
+    """The (ip, port) list for FANOUT_TARGETS, discovering the servers if it is "discover"."""
+    if FANOUT_TARGETS != "discover":
+        return parse_targets(FANOUT_TARGETS, DEFAULT_COMMAND_PORT)
+    print(f"[DISCOVERY] Looking for all Spotlight Receiver Servers ({FANOUT_DISCOVERY_WINDOW} s)...")
+    servers = discover_all(DISCOVERY_MESSAGE, DISCOVERY_PORT, timeout=FANOUT_DISCOVERY_WINDOW,
+                           broadcast_address=BROADCAST_ADDRESS, multicast_group=DISCOVERY_MULTICAST_GROUP,
+                           bufsize=BUFFER_SIZE, tag="[DISCOVERY]")
+    return [(ip, port) for ip, port, _ in servers]
+
+
+def on_fanout_reply(target, command, reply, rtt):
+    """Called by the fan-out sender's I/O thread for every ACK/NACK from one of the servers."""
+    if not reply.ok:
+        log.warning("[FANOUT] %s answered %s with NACK (%s)", target, command, reply.reason)
+        return
+    log.debug("[FANOUT] %s: ACK for %s after %.1f ms", target, command, rtt * 1000)
+
+
+def on_fanout_failure(target, command, reason):
+    """Called when one of the servers did not confirm a command."""
+    log.warning("[FANOUT] %s did not acknowledge '%s': %s", target, command, reason)
+
+
+def use_connection(server):
+    """Takes over a connection made by the connection manager (a server_cache.FoundServer)."""
     global client_socket
+    global client_decoder
     global server_address_global
-
-    if not server_ip or not server_port:
-        print("[TCP CLIENT] No server address provided. Cannot connect.")
-        return False
-
-    server_address_global = (server_ip, server_port)
-    if client_socket:  # Close existing socket if any before creating new one
+    global command_sender
+
+    server_address_global = (server.ip, server.port)
+    if command_sender:  # Keep whatever the old connection never got an ACK for
+        command_sender.close()
+        buffer_for_replay(command_sender.take_unacked())
+        command_sender = None
+    close_udp_sender()
+    if client_socket:  # Close existing socket if any before taking the new one
         try:
             client_socket.close()
         except:
             pass  # Ignore errors on close
 
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.settimeout(5)  # Set a timeout for connection attempts
-
+    client_socket = server.sock
+    client_decoder = server.decoder
+    log.info("[TCP CLIENT] Successfully connected to server at %s:%s (via %s, connect RTT %.1f ms)",
+             server.ip, server.port, server.source, server.connect_rtt * 1000)
+    seqs = itertools.count(1)  # One sequence for TCP and UDP, so the server runs each command once
+    if PIPELINED_SENDING and UDP_COMMANDS:
+        start_udp_sender(server, seqs)  # Asked for on the TCP connection before its reader thread starts
+    if PIPELINED_SENDING:
+        # A drop reported by the reader thread from here on clears command_sender again
+        sender = command_sender = PipelinedSender(
+            client_socket, client_decoder, window=PIPELINE_WINDOW, ack_timeout=ACK_TIMEOUT, bufsize=BUFFER_SIZE,
+            on_reply=on_command_reply, on_failure=on_command_failure, on_disconnect=on_sender_disconnect,
+            metrics=latency_metrics, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_misses=HEARTBEAT_MISSES,
+            on_state=on_presentation_state, seqs=seqs)
+        sender.subscribe_state()  # Hear about clicks from other controllers and who has the floor
+
+
+def start_udp_sender(server, seqs):
+    """Opens a UDP command session on the freshly paired connection, if the server offers one."""
+    global udp_sender
     try:
-        print(f"[TCP CLIENT] Attempting to connect to {server_ip}:{server_port}...")
-        client_socket.connect(server_address_global)
-        print(f"[TCP CLIENT] Successfully connected to server at {server_ip}:{server_port}")
-        client_socket.settimeout(None)  # Remove timeout for subsequent operations if needed, or keep for send/recv
-        return True
-    except socket.timeout:
-        print(f"[TCP CLIENT] Connection attempt timed out to {server_ip}:{server_port}.")
-        client_socket = None
-        return False
-    except socket.error as e:
-        print(f"[TCP CLIENT] Failed to connect to server {server_ip}:{server_port}: {e}")
+        session = request_udp_session(server.sock, server.decoder, BUFFER_SIZE)
+    except (OSError, protocol.ProtocolError) as e:
+        log.warning("[UDP COMMANDS] Could not set up UDP commands: %s. Using TCP.", e)
+        return
+    if session is None:
+        log.info("[UDP COMMANDS] Server has no UDP command channel. Using TCP.")
+        return
+    port, token = session
+    udp_sender = UdpCommandSender((server.ip, port), token, on_reply=on_command_reply, on_failure=on_udp_failure,
+                                  bufsize=BUFFER_SIZE, metrics=latency_metrics, seqs=seqs)
+    log.info("[UDP COMMANDS] Sending commands over UDP to %s:%s", server.ip, port)
+
+
+def close_udp_sender():
+    """Closes the UDP channel; its unacknowledged commands are kept for replay."""
+    global udp_sender
+    sender = udp_sender
+    udp_sender = None
+    if sender:
+        sender.close()
+        for entry in sender.take_unacked():
+            replay_buffer.add(entry.command, entry.captured_at, 1)
+
+
+def on_udp_failure(command, captured_at, reason, seq):
+    """
+    A click got no UDP ACK (UDP blocked or badly lossy): send it over TCP. It keeps its sequence
+    number, so the server does not run it again if only the ACKs were lost.
+    """
+    log.warning("[UDP COMMANDS] %s: %s. Sending it over TCP.", command, reason)
+    sender = command_sender
+    if sender and sender.alive:
+        sender.send(command, captured_at=captured_at, seq=seq)
+    else:
+        replay_buffer.add(command, captured_at)
+
+
+def on_connection_state(state):
+    """Called by the connection manager on every state change. Replays buffered commands once READY."""
+    if state != READY:
+        return
+    live, expired = replay_buffer.take()
+    for entry in expired:
+        on_command_failure(entry.command, "dropped, too old to replay after reconnecting")
+    for entry in live:
+        log.info("[TCP CLIENT] Re-sending command: %s", entry.command)
+        if PIPELINED_SENDING and command_sender:
+            command_sender.send(entry.command, attempts=entry.attempts, captured_at=entry.captured_at)
+        else:
+            send_command(entry.command, entry.captured_at)
+
+
+def buffer_for_replay(entries):
+    """Keeps unacknowledged pipeline.PendingCommands for the next connection."""
+    for entry in entries:
+        replay_buffer.add(entry.command, entry.captured_at, entry.attempts)
+
+
+def on_command_reply(command, reply, rtt):
+    """Called by the pipelined sender's reader thread for every ACK/NACK."""
+    if not reply.ok:
+        log.warning("[TCP CLIENT] Server response for %s: NACK (%s)", command, reply.reason)
+        return
+    log.debug("[TCP CLIENT] Server response for %s: ACK after %.1f ms (server %.1f ms)",
+              command, rtt * 1000, (reply.server_queue_us + reply.injection_us) / 1000)
+
+
+def on_presentation_state(state):
+    """Called by the pipelined sender's reader thread for every state update from the server."""
+    log.info("[STATE] Command #%s: %s from %s (floor: %s)", state.seq, state.command or "-",
+             state.controller or "-", state.floor or "free")
+
+
+def on_command_failure(command, reason):
+    """Called when a command could not be confirmed (timeout or repeated connection loss)."""
+    log.warning("[TCP CLIENT] Command '%s' was not acknowledged: %s", command, reason)
+
+
+def on_sender_disconnect(error):
+    """Called once by the pipelined sender when the connection drops (or stops answering heartbeats)."""
+    global client_socket, command_sender
+    sender = command_sender
+    if sender:
+        buffer_for_replay(sender.take_unacked())
+    command_sender = None
+    close_udp_sender()
+    if client_socket:
+        try:
+            client_socket.close()
+        except OSError:
+            pass
         client_socket = None
-        return False
+    connection.connection_lost(error)
 
 
-def send_command(command):
-    """Sends a command to the connected server."""
+def send_command(command, captured_at=None):
+    """
+    Sends a command to the connected server. captured_at is the key press time, for latency metrics.
+    Never reconnects itself: while the connection is down, commands wait in replay_buffer.
+    """
     global client_socket
-    if client_socket:
+    if fanout_sender:
+        log.debug("[FANOUT] Sending command to %s server(s): %s", fanout_sender.connected_count(), command)
+        fanout_sender.send(command, captured_at)  # Missed by a disconnected server: replayed when it is back
+        return
+    if PIPELINED_SENDING:
+        if udp_sender and udp_sender.alive:
+            log.debug("[UDP COMMANDS] Sending command: %s", command)
+            udp_sender.send(command, captured_at=captured_at)
+            return
+        sender = command_sender
+        if sender and sender.alive:
+            log.debug("[TCP CLIENT] Sending command: %s", command)
+            sender.send(command, captured_at=captured_at)  # Returns right away; the ACK is handled by on_command_reply
+        else:
+            log.warning("[TCP CLIENT] Not connected to server (%s). Command '%s' will be sent after reconnecting.",
+                        connection.state, command)
+            replay_buffer.add(command, captured_at)
+        return
+
+    with stop_and_wait_lock:
+        if not client_socket:
+            log.warning("[TCP CLIENT] Not connected to server (%s). Command '%s' will be sent after reconnecting.",
+                        connection.state, command)
+            replay_buffer.add(command, captured_at)
+            return
         try:
-            print(f"[TCP CLIENT] Sending command: {command}")
-            client_socket.sendall(command.encode())
+            log.debug("[TCP CLIENT] Sending command: %s", command)
+            client_socket.sendall(protocol.encode_command(command, sent_us=now_us()))
             # It's good practice to set a timeout for recv if you expect a timely response
-            client_socket.settimeout(3)  # Timeout for ACK/NACK
-            response = client_socket.recv(BUFFER_SIZE).decode()
+            client_socket.settimeout(ACK_TIMEOUT)  # Timeout for ACK/NACK
+            reply = protocol.recv_frame(client_socket, client_decoder, BUFFER_SIZE)
             client_socket.settimeout(None)  # Reset timeout
-            print(f"[TCP CLIENT] Server response: {response}")
+            if reply is None:
+                raise ConnectionResetError("server closed the connection")
+            log.debug("[TCP CLIENT] Server response: %s", protocol.format_reply(reply))
+            parsed = protocol.parse_reply(reply)
+            if parsed:
+                record_reply(latency_metrics, command, parsed, time.perf_counter(), captured_at)
+            return
         except socket.timeout:
-            print(f"[TCP CLIENT] Timeout waiting for ACK/NACK from server for command '{command}'.")
-            # Consider this a failure, may need to reconnect
-            client_socket.close()
-            client_socket = None
-            attempt_reconnect_and_send(command)
-        except socket.error as e:
-            print(f"[TCP CLIENT] Error sending command '{command}': {e}. Attempting to reconnect...")
-            client_socket.close()
-            client_socket = None
-            attempt_reconnect_and_send(command)
-    else:
-        print("[TCP CLIENT] Not connected to server. Command not sent.")
-        attempt_reconnect_and_send(command)
+            log.warning("[TCP CLIENT] Timeout waiting for ACK/NACK from server for command '%s'.", command)
+            error = "ACK timeout"
+        except (socket.error, protocol.ProtocolError) as e:
+            log.warning("[TCP CLIENT] Error sending command '%s': %s.", command, e)
+            error = e
+        # Consider the connection broken: the manager reconnects, the command is replayed if still in time
+        client_socket.close()
+        client_socket = None
+        replay_buffer.add(command, captured_at)
+    connection.connection_lost(error)
 
 
-def attempt_reconnect_and_send(original_command=None):
-    """Attempts to rediscover, reconnect, and optionally resend a command."""
-    global server_address_global
-    print("[TCP CLIENT] Attempting to rediscover and connect...")
-    # Try reconnecting with last known address first if available
-    if server_address_global:
-        print(
-            f"[TCP CLIENT] Retrying connection to last known server: {server_address_global[0]}:{server_address_global[1]}")
-        if connect_to_server(server_address_global[0], server_address_global[1]):
-            if original_command:
-                print("[TCP CLIENT] Reconnected. Retrying command...")
-                send_command(original_command)  # Retry sending after reconnect
-            return True  # Reconnected
-
-    # If last known failed or not available, try full discovery
-    print("[TCP CLIENT] Last known server connection failed or address unknown. Starting full discovery...")
-    server_ip, server_port = discover_server()
-    if server_ip and server_port:
-        if connect_to_server(server_ip, server_port):
-            if original_command:
-                print("[TCP CLIENT] Rediscovered and reconnected. Retrying command...")
-                send_command(original_command)  # Retry after successful connection
-            return True  # Rediscovered and reconnected
-    else:
-        print("[TCP CLIENT] Rediscovery failed. Please ensure server is running.")
-    return False
+def pointer_position():
+    """The mouse pointer position as fractions of SCREEN_SIZE."""
+    x, y = mouse_controller.position
+    return x / SCREEN_SIZE[0], y / SCREEN_SIZE[1]
+
+
+def send_pointer_frame(frame):
+    """Sends a pointer position over UDP if available, else over TCP. Dropped while disconnected."""
+    if fanout_sender:
+        fanout_sender.send_frame(frame)
+        return
+    if udp_sender and udp_sender.alive:
+        udp_sender.send_unreliable(frame)
+        return
+    sender = command_sender
+    if sender and sender.alive:
+        sender.send_frame(frame)
+
+
+def send_motion(dx, dy):
+    """Sends the mouse motion added up over one tick."""
+    send_pointer_frame(protocol.encode_motion(dx, dy, next(motion_seq)))
+
+
+# --- Keymap ---
+def apply_keymap(keymap):
+    """Swaps in the key mappings of a reloaded keymap. Runs on the keymap watcher's thread."""
+    global KEYS_TO_COMMANDS
+    KEYS_TO_COMMANDS = keymap.keys
+
+
+def start_keymap():
+    """Loads KEYS_TO_COMMANDS (from KEYMAP_PATH, which is then watched, or the mapping above). Raises KeymapError."""
+    global KEYS_TO_COMMANDS
+    if not KEYMAP_PATH:
+        KEYS_TO_COMMANDS = compile_keys(KEYS_TO_COMMANDS, "KEYS_TO_COMMANDS")
+        return
+    watcher = KeymapWatcher(KEYMAP_PATH, apply_keymap, KEYMAP_PROFILE, base_keys=KEYS_TO_COMMANDS,
+                            interval=KEYMAP_RELOAD_INTERVAL)
+    keymap = watcher.load()
+    KEYS_TO_COMMANDS = keymap.keys
+    watcher.start()
+    latency_metrics.add_gauge_source("keymap", watcher.stats)
+    print(f"[KEYMAP] Using profile '{keymap.profile}' from {KEYMAP_PATH}")
 
 
 # --- pynput Key Listener Callbacks ---
 def on_press(key):
-    """Callback function for when a key is pressed."""
-    # print(f"Key pressed: {key}") # For debugging what keys are detected
-    command = KEYS_TO_COMMANDS.get(key)
+    """Callback function for when a key is pressed. Runs inside the OS input hook, so it only enqueues."""
+    name = key_name(key)
+    command = KEYS_TO_COMMANDS.get(name)
+    if command and key_debouncer.press(name, command):  # Auto-repeats and bounces stop here
+        capture_queue.put(command)
+
+
+def send_captured_command(command, captured_at):
+    """Called on the sender thread for every key press taken from capture_queue."""
+    latency_metrics.observe("queue_wait", command, time.perf_counter() - captured_at)
+    log.debug("[KEY EVENT] Mapped key press to command: %s (queue depth %s)", command, capture_queue.depth())
+    send_command(command, captured_at)
+    if command == "LASER_ON" and pointer_streamer:
+        pointer_streamer.activate()
+    elif command == "LASER_OFF" and pointer_streamer:
+        pointer_streamer.deactivate()
+
+
+def on_hold_release(name):
+    """Called by key_debouncer once the key of a "hold" press has come up for good (maybe on its timer thread)."""
+    command = HOLD_RELEASE_COMMANDS.get(KEYS_TO_COMMANDS.get(name))
     if command:
-        print(f"\n[KEY EVENT] Mapped key {key} to command: {command}")
-        send_command(command)
-    # else:
-    #     print(f"Key {key} is not mapped to any command.") # Enable for debugging unmapped keys
+        capture_queue.put(command)
 
 
 def on_release(key):
     """Callback function for when a key is released."""
-    if key == keyboard.Key.esc:
-        print("[KEY EVENT] Escape key detected. To stop client, use Ctrl+C in terminal.")
+    name = key_name(key)
+    key_debouncer.release(name)  # The end of a "hold" press goes to on_hold_release
+    if name == "esc":
+        log.info("[KEY EVENT] Escape key detected. To stop client, use Ctrl+C in terminal.")
         # If you want Esc to stop the listener thread (but not necessarily the client app):
         # print("Escape key pressed, stopping listener.")
         # return False # This would stop the listener thread.
@@ -227,46 +457,90 @@ def on_release(key):
 
 
 if __name__ == "__main__":
+    setup_logging(LOG_LEVEL, EVENT_LOG_PATH)
+    preload_pynput()  # Imports in the background while the server is located
     print("--- Logitech Spotlight Client ---")
     print(f"Ensure pynput is installed: pip install pynput")
     print(f"This will listen for global key presses defined in KEYS_TO_COMMANDS.")
     print(f"Press Ctrl+C in the terminal to stop the client.")
-
-    # 1. Discover the server and connect
-    if not attempt_reconnect_and_send():  # Initial attempt to connect (no command to send yet)
-        print("Could not connect to server during initial setup. Exiting.")
+    try:
+        start_keymap()
+    except KeymapError as e:
+        print(f"[FATAL CLIENT ERROR] {e}")
         exit()
 
+    # 1. Discover the server and connect. From here on the connection manager's thread owns
+    # (re)connecting: cached servers first, discovery in parallel, backoff between attempts.
+    # In fan-out mode the fan-out sender keeps a connection to each server instead.
+    if FANOUT_TARGETS:
+        targets = fanout_targets()
+        if not targets:
+            print("No servers to fan out to. Exiting.")
+            exit()
+        fanout_sender = FanoutSender(targets, ack_timeout=ACK_TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+                                     heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_misses=HEARTBEAT_MISSES,
+                                     replay_max_age=REPLAY_MAX_AGE, replay_deadlines=REPLAY_MAX_AGE_PER_COMMAND,
+                                     backoff_initial=RECONNECT_INITIAL_DELAY, backoff_max=RECONNECT_MAX_DELAY,
+                                     on_reply=on_fanout_reply, on_failure=on_fanout_failure,
+                                     bufsize=BUFFER_SIZE, metrics=latency_metrics)
+        latency_metrics.add_gauge_source("fanout", fanout_sender.stats)
+        print(f"[FANOUT] Connecting to {len(targets)} server(s): {', '.join(t.name for t in fanout_sender.targets)}")
+        fanout_sender.start()
+        if not fanout_sender.wait_connected(1, CONNECT_TIMEOUT):
+            print("Could not connect to any server during initial setup. Please ensure the servers are running. "
+                  "Exiting.")
+            exit()
+        fanout_sender.wait_connected(len(targets), CONNECT_TIMEOUT)  # The rest keep retrying in the background
+        print(f"[FANOUT] Connected to {fanout_sender.connected_count()} of {len(targets)} server(s).")
+    else:
+        connection = ConnectionManager(server_cache, discover_server, use_connection, connect_timeout=CONNECT_TIMEOUT,
+                                       backoff=Backoff(RECONNECT_INITIAL_DELAY, maximum=RECONNECT_MAX_DELAY),
+                                       on_state=on_connection_state)
+        print("[TCP CLIENT] Connecting to the server (cached addresses first, discovery in parallel)...")
+        connection.start()
+        if not connection.wait_ready(DISCOVERY_TIMEOUT + CONNECT_TIMEOUT):
+            print("Could not connect to server during initial setup. Please ensure server is running. Exiting.")
+            exit()
+
     # 2. Start listening for key presses
+    try:
+        pynput = load_pynput()
+    except CaptureUnavailable as e:
+        print(f"[FATAL CLIENT ERROR] {e}")
+        exit()
     print("\n[KEY LISTENER] Starting key listener. Press mapped keys to send commands.")
-    # Making the displayed keys more readable
-    readable_keys_to_commands = {}
-    for k, v in KEYS_TO_COMMANDS.items():
-        key_name = ""
-        if isinstance(k, keyboard.Key):
-            key_name = k.name
-        elif isinstance(k, keyboard.KeyCode):
-            key_name = k.char
-        readable_keys_to_commands[key_name] = v
-    print(f"Mapped keys: {readable_keys_to_commands}")
+    print(f"Mapped keys: {KEYS_TO_COMMANDS}")
     print("Ensure the window of the application you want to control on Computer 2 is active on that machine.")
 
-    listener = keyboard.Listener(on_press=on_press, on_release=on_release)
+    mouse_listener = None
+    if (PIPELINED_SENDING or fanout_sender) and POINTER_MODE == "relative":
+        pointer_streamer = MotionAccumulator(send_motion, POINTER_RATE_HZ, active=False)
+        pointer_streamer.start()
+        latency_metrics.add_gauge_source("pointer_motion", pointer_streamer.stats)
+        mouse_listener = pynput.mouse.Listener(on_move=pointer_streamer.on_move)  # Only adds up; sent once per tick
+        mouse_listener.start()
+    elif PIPELINED_SENDING or fanout_sender:  # Positions are sent without waiting for ACKs, which stop-and-wait cannot do
+        SCREEN_SIZE = SCREEN_SIZE or screen_size()
+        if SCREEN_SIZE:
+            mouse_controller = pynput.mouse.Controller()
+            pointer_streamer = PointerStreamer(pointer_position, send_pointer_frame, POINTER_RATE_HZ)
+            pointer_streamer.start()
+        else:
+            print("[POINTER] Screen size unknown (set SCREEN_SIZE); the virtual spotlight will not follow the mouse.")
+
+    key_debouncer = KeyDebouncer(REPEAT_POLICY, REPEAT_INTERVAL, BOUNCE_TIME, REPEAT_POLICY_PER_COMMAND,
+                                 on_release=on_hold_release)
+    latency_metrics.add_gauge_source("key_debounce", key_debouncer.stats)
+    sender_thread = SenderThread(capture_queue, send_captured_command)
+    sender_thread.start()
+    if METRICS_EXPORT_PATH:
+        start_periodic_export(latency_metrics, METRICS_EXPORT_PATH, METRICS_EXPORT_INTERVAL)
+    listener = pynput.keyboard.Listener(on_press=on_press, on_release=on_release)
     listener.start()
 
     try:
         while True:  # Keep main thread alive
             time.sleep(1)
-            # You could add a periodic check here to see if client_socket is still valid
-            # and if not, trigger attempt_reconnect_and_send(None)
-            if not client_socket:
-                print("[MAIN LOOP] Client socket is not connected. Attempting to reconnect...")
-                if not attempt_reconnect_and_send():
-                    print("[MAIN LOOP] Reconnect attempt failed. Will try again later.")
-                    time.sleep(5)  # Wait before next auto-reconnect attempt
-                else:
-                    print("[MAIN LOOP] Successfully reconnected.")
-
 
     except KeyboardInterrupt:
         print("\nClient interrupted by Ctrl+C. Shutting down.")
@@ -274,6 +548,28 @@ if __name__ == "__main__":
         if listener.is_alive():
             listener.stop()
             listener.join()  # Wait for listener thread to finish
+        sender_thread.stop()
+        if mouse_listener:
+            mouse_listener.stop()
+        if pointer_streamer:
+            pointer_streamer.stop()
+        print(f"[KEY LISTENER] Capture queue stats: {capture_queue.stats()}")
+        if METRICS_EXPORT_PATH:
+            try:
+                latency_metrics.write(METRICS_EXPORT_PATH)
+                print(f"[METRICS] Latency metrics written to {METRICS_EXPORT_PATH}")
+            except OSError as e:
+                print(f"[METRICS] Could not write metrics to {METRICS_EXPORT_PATH}: {e}")
+        if fanout_sender:
+            for target in fanout_sender.report():
+                print(f"[FANOUT] {target['name']}: {target['acked']} ACKed, {target['failed']} failed, "
+                      f"RTT {target['rtt_ms']} ms, {target['lag_ms']} ms behind the fastest server")
+            fanout_sender.stop()
+        if connection:
+            connection.stop()
+        close_udp_sender()
+        if command_sender:
+            command_sender.close()
         if client_socket:
             try:
                 client_socket.close()
@@ -0,0 +1,2 @@
+# spotlight_core
+# Code shared by the Spotlight server and client scripts (all versions).
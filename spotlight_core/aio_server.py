@@ -0,0 +1,282 @@
+# aio_server.py
+# asyncio server engine for the Spotlight receiver.
+#
+# The original servers start one daemon thread per accepted socket with listen(5) and no
+# limit, so a room full of controllers (or one client stuck in a reconnect loop) keeps
+# adding threads. This engine runs every TCP connection and the UDP discovery responder
+# on a single event loop. Key presses still block, so actions run on one dedicated
+# thread, which also keeps them in arrival order: the injection worker when one is given
+# (the event loop keeps reading while it presses keys), otherwise a one-thread executor
+# that each connection awaits. The process therefore uses a fixed number of threads no
+# matter how many controllers are connected.
+
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from spotlight_core import protocol
+from spotlight_core.discovery import build_discovery_reply, join_multicast_group
+from spotlight_core.injection import ACK_COMPLETED
+from spotlight_core.interfaces import describe_advertised_ip
+from spotlight_core.log import get_logger
+from spotlight_core.server import ServerConnection
+from spotlight_core.sessions import ResumableSessions
+from spotlight_core.sockopts import tune_tcp_socket
+from spotlight_core.udp_commands import UdpCommandHandler, UdpSessions
+
+log = get_logger("aio_server")
+
+
+class DiscoveryResponder(asyncio.DatagramProtocol):
+    """Answers UDP discovery broadcasts from the event loop."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = build_discovery_reply(data, addr, self.server.advertised_ip, self.server.port,
+                                             self.server.server_name, self.server.pairing_id)
+            if response:
+                self.transport.sendto(response, addr)
+        except Exception as e:
+            log.error("[UDP DISCOVERY] Error handling discovery message from %s: %s", addr, e)
+
+    def error_received(self, exc):
+        # e.g. ConnectionResetError on Windows after sending to a closed port. Harmless for UDP.
+        log.debug("[UDP DISCOVERY] Socket error (ignored): %s", exc)
+
+
+class UdpCommandReceiver(asyncio.DatagramProtocol):
+    """Receives UDP commands (see udp_commands) on the event loop."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.handler = UdpCommandHandler(server.udp_sessions, run=self._run)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        loop = asyncio.get_running_loop()
+        # Replies also come from the injection or executor thread that ran the command
+        self.handler.handle(data, addr, lambda reply: loop.call_soon_threadsafe(self._send, reply, addr))
+
+    def _send(self, reply, addr):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(reply, addr)
+
+    def _run(self, connection, step, reply):
+        if connection.injector is not None:
+            connection.dispatch(step, reply)
+        else:
+            # Same one-thread executor as the TCP connections, so commands stay in order
+            self.server._executor.submit(lambda: reply(connection.execute(step)))
+
+    def error_received(self, exc):
+        log.debug("[UDP COMMANDS] Socket error (ignored): %s", exc)
+
+
+class AsyncSpotlightServer:
+    """
+    TCP command server + UDP discovery responder on one asyncio event loop.
+
+    max_connections  - connections beyond this are closed immediately after accept
+    backlog          - listen() backlog for the TCP socket
+    idle_timeout     - seconds without any data before a paired connection is dropped (None = never);
+                       clients that send heartbeats are dropped after server.HEARTBEAT_MISSES missed intervals
+    pairing_timeout  - seconds an unpaired connection may stay open without completing pairing
+    injector         - optional injection.InjectionWorker that runs all actions
+    ack_mode         - with an injector: ACK when a command is "queued" or "completed"
+    advertised_ip    - IP sent in discovery responses (None = the interface facing each client)
+    multicast_group  - IPv4 group the discovery socket also joins (None = broadcast only)
+    udp_command_port - UDP port for the optional UDP command channel (None = TCP only)
+    pointer          - pointer(x, y, sampled_at) for streamed spotlight positions (runs on the event loop, must not block)
+    motion           - motion(dx, dy) for streamed relative pointer motion (same rules as pointer)
+    arbiter          - optional arbiter.CommandArbiter ordering and admitting every connection's commands
+    session_ttl      - seconds a client may resume its session without pairing again (None = no resumption)
+    sockets          - (tcp_socket, udp_socket) already bound, e.g. by startup.EarlyListener.take_over(),
+                       used instead of binding port and discovery_port
+    """
+
+    def __init__(self, commands, pairing_id=None, host="0.0.0.0", port=50001, discovery_port=50000,
+                 server_name="SpotlightReceiverPC", advertised_ip=None, max_connections=64,
+                 backlog=128, idle_timeout=3600, pairing_timeout=10, bufsize=1024, metrics=None,
+                 injector=None, ack_mode=ACK_COMPLETED, multicast_group=None, udp_command_port=None,
+                 pointer=None, motion=None, arbiter=None, session_ttl=None, sockets=None):
+        self.commands = commands
+        self.pairing_id = pairing_id
+        self.host = host
+        self.port = port
+        self.discovery_port = discovery_port
+        self.server_name = server_name
+        self.advertised_ip = advertised_ip
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.pairing_timeout = pairing_timeout
+        self.bufsize = bufsize
+        self.metrics = metrics  # Optional metrics.LatencyRecorder shared by all connections
+        self.injector = injector
+        self.ack_mode = ack_mode
+        self.multicast_group = multicast_group
+        self.udp_sessions = UdpSessions(udp_command_port) if udp_command_port is not None else None
+        self.pointer = pointer
+        self.motion = motion
+        self.arbiter = arbiter
+        self.sessions = ResumableSessions(session_ttl) if session_ttl is not None else None
+        self.sockets = sockets
+
+        self.connection_count = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spotlight-actions")
+        self._tcp_server = None
+        self._udp_transport = None
+        self._udp_command_transport = None
+
+    def run(self):
+        """Runs the server until interrupted (blocking)."""
+        try:
+            asyncio.run(self.serve_forever())
+        except OSError as e:
+            log.error("[ASYNC SERVER] Error binding to TCP port %s / UDP port %s: %s. "
+                      "Is another program (or this script already) using it?", self.port, self.discovery_port, e)
+        except KeyboardInterrupt:
+            log.info("[ASYNC SERVER] Interrupted. Shutting down.")
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._tcp_server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+
+        tcp_socket, udp_socket = self.sockets or (None, None)
+        if tcp_socket is None:
+            tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcp_socket.bind((self.host, self.port))
+        self._tcp_server = await asyncio.start_server(self._handle_connection, sock=tcp_socket,
+                                                      backlog=self.backlog)
+        log.info("[TCP SERVER] Listening for commands on TCP port %s (asyncio engine, max %s connections, backlog %s)",
+                 self.port, self.max_connections, self.backlog)
+
+        if udp_socket is None and self.discovery_port is not None:
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp_socket.bind(("", self.discovery_port))
+            join_multicast_group(udp_socket, self.multicast_group)
+        if udp_socket is not None:
+            self._udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: DiscoveryResponder(self), sock=udp_socket)
+            log.info("[UDP DISCOVERY] Listening for discovery broadcasts on UDP port %s", self.discovery_port)
+            log.info("[UDP DISCOVERY] Server will respond with IP: %s", describe_advertised_ip(self.advertised_ip))
+
+        if self.udp_sessions is not None:
+            self._udp_command_transport, _ = await loop.create_datagram_endpoint(
+                lambda: UdpCommandReceiver(self), local_addr=(self.host, self.udp_sessions.port))
+            log.info("[UDP COMMANDS] Listening for commands on UDP port %s", self.udp_sessions.port)
+
+    async def stop(self):
+        if self._udp_command_transport:
+            self._udp_command_transport.close()
+            self._udp_command_transport = None
+        if self._udp_transport:
+            self._udp_transport.close()
+            self._udp_transport = None
+        if self._tcp_server:
+            self._tcp_server.close()
+            await self._tcp_server.wait_closed()
+            self._tcp_server = None
+        log.info("[TCP SERVER] TCP Server stopped.")
+
+    async def _handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        if self.connection_count >= self.max_connections:
+            log.warning("[TCP SERVER] Connection limit (%s) reached. Refusing %s.", self.max_connections, addr)
+            writer.close()
+            return
+
+        self.connection_count += 1
+        log.info("[TCP SERVER] Accepted connection from %s (%s open)", addr, self.connection_count)
+        tune_tcp_socket(writer.get_extra_info("socket"))
+        connection = ServerConnection(self.commands, self.pairing_id, addr, metrics=self.metrics,
+                                      injector=self.injector, ack_mode=self.ack_mode, udp_sessions=self.udp_sessions,
+                                      pointer=self.pointer, motion=self.motion, arbiter=self.arbiter,
+                                      sessions=self.sessions)
+        loop = asyncio.get_running_loop()
+
+        def write_reply(reply):
+            if not writer.is_closing():
+                writer.write(reply)
+
+        def send_threadsafe(reply):
+            # Completed-mode ACKs come from the injection worker thread
+            loop.call_soon_threadsafe(write_reply, reply)
+
+        connection.push = send_threadsafe  # State updates come from whichever thread ran the command
+
+        # One deadline for the whole pairing: a client trickling in a byte at a time must not
+        # hold a connection slot any longer than one that sends nothing
+        pairing_deadline = loop.time() + self.pairing_timeout if self.pairing_timeout is not None else None
+
+        try:
+            while True:
+                if not connection.paired:
+                    timeout = None if pairing_deadline is None else max(0.0, pairing_deadline - loop.time())
+                elif connection.heartbeat_timeout:
+                    timeout = connection.heartbeat_timeout  # The client promised a PING at least this often
+                else:
+                    timeout = self.idle_timeout
+                try:
+                    data = await asyncio.wait_for(reader.read(self.bufsize), timeout)
+                except asyncio.TimeoutError:
+                    if not connection.paired:
+                        log.info("[TCP SERVER] %s did not pair within %s s. Dropping connection.",
+                                 addr, self.pairing_timeout)
+                    elif connection.heartbeat_timeout:
+                        log.info("[TCP SERVER] No heartbeat from %s for %.1f s. Dropping connection.", addr, timeout)
+                    else:
+                        log.info("[TCP SERVER] No data from %s for %s s. Dropping idle connection.", addr, timeout)
+                    break
+                if not data:
+                    state = "after pairing" if connection.paired else "before pairing attempt"
+                    log.info("[TCP SERVER] Connection closed by %s %s.", addr, state)
+                    break
+
+                steps = connection.feed(data)
+                for step in steps:
+                    reply = step.reply
+                    if step.action is not None and self.injector is not None:
+                        connection.dispatch(step, send_threadsafe)
+                        continue
+                    if step.action is not None:
+                        reply = await loop.run_in_executor(self._executor, connection.execute, step)
+                    if reply:
+                        writer.write(reply)
+                    if step.close:
+                        break
+                await writer.drain()
+                if steps and steps[-1].close:
+                    break
+        except protocol.ProtocolError as e:
+            log.warning("[TCP SERVER] Protocol error from %s: %s. Dropping connection.", addr, e)
+        except (ConnectionResetError, BrokenPipeError):
+            log.info("[TCP SERVER] Connection reset by %s", addr)
+        except Exception as e:
+            log.error("[TCP SERVER] Error during TCP communication with %s: %s", addr, e)
+        finally:
+            self.connection_count -= 1
+            connection.close()
+            writer.close()
+            log.info("[TCP SERVER] Closed connection from %s", addr)
@@ -0,0 +1,152 @@
+# arbiter.py
+# Fan-in of several controllers (clickers, a stage manager's laptop, ...) on one server.
+#
+# Every connection used to run its commands on its own: two controllers clicking at the same
+# moment could interleave their key presses, and nothing stopped a second clicker from paging
+# through the deck while the presenter was talking. CommandArbiter is the one place every
+# command passes, whichever engine or transport (TCP or UDP) it came in on:
+#   - Global ordering: each accepted command gets the next global sequence number and is started
+#     (or handed to the injection worker) while the arbiter's lock is held, so commands run in
+#     exactly that order and never overlap.
+#   - Floor control: only the controller holding the floor may send navigation commands. A
+#     controller takes the floor with its first navigation command when the floor is free, when
+#     the holder has been idle (or gone) for floor_idle_timeout seconds, or when its own priority
+#     is higher. Everyone else gets a NACK naming the holder. The floor belongs to the controller,
+#     not to one connection: its resumable session, or else its IP address. A holder whose
+#     connection drops (a Wi-Fi blip) gets the floor back when it reconnects in time.
+#   - State broadcast: controllers that subscribed (protocol.OP_STATE) get the new state after
+#     every accepted command and every change of the floor.
+
+import threading
+import time
+
+from spotlight_core import protocol
+from spotlight_core.log import get_logger
+
+log = get_logger("arbiter")
+
+NAVIGATION_COMMANDS = frozenset({"NEXT", "PREVIOUS", "START_PRESENTATION", "EXIT_SLIDESHOW", "BLACK_SCREEN"})
+FLOOR_IDLE_TIMEOUT = 30.0  # Seconds without a navigation command after which anyone may take the floor
+
+
+def controller_key(connection):
+    """Who a server.ServerConnection's commands come from: its resumable session, else its IP address."""
+    session = getattr(connection, "session", None)
+    if session is not None:
+        return session.token
+    return connection.addr[0] if isinstance(connection.addr, tuple) else connection.addr
+
+
+def controller_name(connection):
+    """'ip:port' of a server.ServerConnection."""
+    if isinstance(connection.addr, tuple) and len(connection.addr) >= 2:
+        return f"{connection.addr[0]}:{connection.addr[1]}"
+    return str(connection.addr)
+
+
+class CommandArbiter:
+    """
+    Orders and admits commands from every server.ServerConnection. Thread-safe.
+
+    priorities maps a controller's IP address to its priority (default 0, higher wins the floor).
+    floor_commands are the commands that need the floor; an empty set turns floor control off.
+    """
+
+    def __init__(self, priorities=None, floor_commands=NAVIGATION_COMMANDS, floor_idle_timeout=FLOOR_IDLE_TIMEOUT,
+                 tag="[ARBITER]"):
+        self.priorities = priorities or {}
+        self.floor_commands = frozenset(floor_commands)
+        self.floor_idle_timeout = floor_idle_timeout
+        self.tag = tag
+        self.seq = 0  # Global sequence number of the last accepted command
+        self.floor = None  # The holder's most recent ServerConnection (maybe closed since)
+        self._floor_key = None  # controller_key() of the holder
+        self.last_command = ""
+        self.last_controller = ""
+        self.accepted = 0
+        self.rejected = 0
+        self.floor_changes = 0
+        self._floor_used_at = 0.0
+        self._lock = threading.Lock()
+        self._subscribers = {}  # ServerConnection -> push(bytes)
+
+    def priority(self, connection):
+        addr = connection.addr
+        return self.priorities.get(addr[0] if isinstance(addr, tuple) else addr, 0)
+
+    def run(self, connection, command, start):
+        """
+        Admits a command and, if it is accepted, calls start() (which runs or queues it) in the
+        global order. Returns None if it was accepted, else the reason for the NACK.
+        """
+        with self._lock:
+            reason = self._admit_locked(connection, command)
+            if reason is not None:
+                self.rejected += 1
+                return reason
+            self.seq += 1
+            self.accepted += 1
+            self.last_command = command
+            self.last_controller = controller_name(connection)
+            start()
+            state, subscribers = self._state_locked()
+        self._push(state, subscribers)
+        return None
+
+    def subscribe(self, connection, push):
+        """Sends push(bytes) every state change from now on. Returns the current state as a frame."""
+        with self._lock:
+            self._subscribers[connection] = push
+            state, _ = self._state_locked()
+        return state
+
+    def leave(self, connection):
+        """
+        A connection closed: forgets its subscription. If it held the floor, the floor stays its
+        controller's for floor_idle_timeout seconds from now, in case it reconnects.
+        """
+        with self._lock:
+            self._subscribers.pop(connection, None)
+            if self.floor is not connection:
+                return
+            self._floor_used_at = time.perf_counter()
+        log.info("%s %s left; it keeps the floor for %s s unless it is back.", self.tag,
+                 controller_name(connection), self.floor_idle_timeout)
+
+    def stats(self):
+        return {"seq": self.seq, "accepted": self.accepted, "rejected": self.rejected,
+                "floor_changes": self.floor_changes, "subscribers": len(self._subscribers)}
+
+    def _admit_locked(self, connection, command):
+        if command not in self.floor_commands:
+            return None
+        now = time.perf_counter()
+        holder = self.floor
+        key = controller_key(connection)
+        if key != self._floor_key:
+            if (holder is not None and now - self._floor_used_at < self.floor_idle_timeout
+                    and self.priority(connection) <= self.priority(holder)):
+                log.info("%s %s from %s refused: %s has the floor.", self.tag, command,
+                         controller_name(connection), controller_name(holder))
+                return f"FLOOR_HELD:{controller_name(holder)}"
+            log.info("%s %s takes the floor%s.", self.tag, controller_name(connection),
+                     f" from {controller_name(holder)}" if holder is not None else "")
+            self._floor_key = key
+            self.floor_changes += 1
+        self.floor = connection  # The holder may be back on a new connection
+        self._floor_used_at = now
+        return None
+
+    def _state_locked(self):
+        floor = controller_name(self.floor) if self.floor is not None else ""
+        state = protocol.encode_state(self.seq, self.last_command, self.last_controller, floor)
+        return state, list(self._subscribers.values())
+
+    def _push(self, state, subscribers):
+        # Outside the lock: a slow controller must not hold up the others. Each state carries
+        # its sequence number, so a client can ignore one that overtook a newer one.
+        for push in subscribers:
+            try:
+                push(state)
+            except Exception as e:
+                log.debug("%s Could not push state: %s", self.tag, e)
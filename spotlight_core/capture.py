@@ -0,0 +1,317 @@
+# capture.py
+# Capture-to-send pipeline for the Spotlight clients.
+#
+# pynput calls on_press() from inside the OS input hook. If that callback does network I/O
+# (or worse, a 5 second rediscovery) every key press on the machine stalls with it. Here
+# the callback only timestamps the key press and appends it to a bounded ring buffer.
+# A dedicated sender thread drains the buffer and does the actual sending.
+#
+# Before a press is queued, KeyDebouncer decides whether it is a press at all. A held remote
+# button makes the OS repeat on_press() many times a second; each of those used to be sent and
+# run, so holding NEXT skipped slides. Cheap remotes also "bounce": one click arrives as a quick
+# press, release, press, release. The debouncer tracks each key's press/release pairs and drops
+# both before they are queued, so they cost no network traffic at all.
+
+import threading
+import time
+from collections import deque
+
+from spotlight_core.log import get_logger
+
+log = get_logger("capture")
+
+# Overflow policies for when the sender falls behind and the ring buffer is full
+DROP_OLDEST = "drop-oldest"  # Discard the oldest queued press to make room for the new one
+COALESCE = "coalesce"  # Fold a repeat of the newest queued command into it (sent count times), else drop oldest
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE)
+
+# What KeyDebouncer does with the OS auto-repeat of a held key
+REPEAT_IGNORE = "ignore"  # Send the first press only
+REPEAT_RATE_LIMIT = "rate-limit"  # Send repeats, at most one per repeat_interval
+REPEAT_HOLD = "hold"  # Send the press, and the release when the key comes up (e.g. LASER_ON ... LASER_OFF)
+REPEAT_POLICIES = (REPEAT_IGNORE, REPEAT_RATE_LIMIT, REPEAT_HOLD)
+REPEAT_INTERVAL = 0.25  # seconds
+BOUNCE_TIME = 0.03  # A press this soon after the key's release is the same press bouncing (seconds)
+
+
+class CapturedEvent:
+    """One captured key press (or several identical ones folded together)."""
+    __slots__ = ("command", "captured_at", "count")
+
+    def __init__(self, command, captured_at):
+        self.command = command
+        self.captured_at = captured_at  # time.perf_counter() when the key callback ran
+        self.count = 1
+
+    def __repr__(self):
+        return f"CapturedEvent({self.command!r}, count={self.count})"
+
+
+class CaptureQueue:
+    """
+    Bounded ring buffer with a single consumer.
+
+    Producers (the key callbacks, and KeyDebouncer's release timer) take `_put_lock` around
+    put(), which keeps the counters and the coalescing step consistent; it is uncontended
+    unless a release is reported just as a key goes down. The consumer (the sender) takes no
+    lock: deque.append(), pop() and popleft() are atomic, and with maxlen set the deque drops
+    its oldest entry by itself when full. An event belongs to whichever thread took it out of
+    the deque, so coalescing pops the newest event, counts the press and puts it back, and
+    never changes an event the sender already has. The only cross-thread signal is a wake-up
+    Event for the sender, which never waits on I/O.
+    """
+
+    def __init__(self, capacity=64, overflow=DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}; expected one of {OVERFLOW_POLICIES}")
+        self.capacity = capacity
+        self.overflow = overflow
+        self._events = deque(maxlen=capacity)
+        self._wakeup = threading.Event()
+        self._put_lock = threading.Lock()  # Producers only
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_watermark = 0
+
+    def put(self, command):
+        """Called from the key callbacks: timestamp and enqueue. Never waits on the sender."""
+        with self._put_lock:
+            return self._put_locked(command)
+
+    def _put_locked(self, command):
+        now = time.perf_counter()
+        events = self._events
+        if len(events) >= self.capacity:
+            if self.overflow == COALESCE:
+                try:
+                    tail = events.pop()  # Ours now: the sender can no longer pop it half-counted
+                except IndexError:  # The sender emptied the queue in the meantime
+                    tail = None
+                if tail is not None:
+                    merged = tail.command == command
+                    if merged:
+                        tail.count += 1
+                    events.append(tail)  # Back in its place: the sender only pops from the other end
+                    if merged:
+                        self.coalesced += 1
+                        self._wakeup.set()
+                        return True
+            self.dropped += 1  # maxlen makes append() below discard the oldest event
+        events.append(CapturedEvent(command, now))
+        self.enqueued += 1
+        depth = len(events)
+        if depth > self.high_watermark:
+            self.high_watermark = depth
+        self._wakeup.set()
+        return True
+
+    def get(self, timeout=None):
+        """Called by the sender thread. Returns the next event, or None after `timeout` seconds."""
+        while True:
+            try:
+                return self._events.popleft()
+            except IndexError:
+                pass
+            self._wakeup.clear()
+            if self._events:  # Something arrived between popleft() and clear()
+                continue
+            if not self._wakeup.wait(timeout):
+                return None
+
+    def wake(self):
+        """Wakes a sender blocked in get() (used when shutting down)."""
+        self._wakeup.set()
+
+    def depth(self):
+        return len(self._events)
+
+    def stats(self):
+        """Snapshot of queue depth and drop counters."""
+        return {
+            "depth": len(self._events),
+            "capacity": self.capacity,
+            "overflow_policy": self.overflow,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "high_watermark": self.high_watermark,
+        }
+
+
+class KeyState:
+    """Press/release state of one key."""
+    __slots__ = ("down", "held", "sent_at", "released_at")
+
+    def __init__(self):
+        self.down = False
+        self.held = False  # A REPEAT_HOLD press was sent and its release was not reported yet
+        self.sent_at = 0.0
+        self.released_at = float("-inf")
+
+
+class KeyDebouncer:
+    """
+    Per-key press/release state machine for the key callbacks. press() says whether a press
+    should be sent; the release of a REPEAT_HOLD press is reported through on_release(key).
+
+    A press while the key is already down is an auto-repeat, handled by the repeat policy.
+    A press within bounce_time of the key's release counts as the key never having come up
+    (contact bounce, or an X11 auto-repeat, which arrives as a release/press pair) and is never
+    sent, whatever the policy. REPEAT_RATE_LIMIT therefore only lets repeats through where the
+    OS repeats presses without releases (Windows, macOS); on X11 it acts like REPEAT_IGNORE.
+
+    For the same reason the release of a REPEAT_HOLD press is only final once the key has stayed
+    up for bounce_time: release() holds it back, a press within that time takes it back, and
+    after it on_release(key) is called from a timer thread (see releases_due()). With
+    bounce_time 0 it is called from release() itself.
+
+    `policies` ({command: policy}) overrides the policy for some commands. A lock keeps the
+    timer and the key listener's thread apart; on_release is called without it.
+    """
+
+    def __init__(self, policy=REPEAT_IGNORE, repeat_interval=REPEAT_INTERVAL, bounce_time=BOUNCE_TIME, policies=None,
+                 on_release=None):
+        for checked in [policy] + list((policies or {}).values()):
+            if checked not in REPEAT_POLICIES:
+                raise ValueError(f"Unknown repeat policy {checked!r}; expected one of {REPEAT_POLICIES}")
+        self.policy = policy
+        self.policies = dict(policies or {})
+        self.repeat_interval = repeat_interval
+        self.bounce_time = bounce_time
+        self.on_release = on_release
+        self._keys = {}  # key name -> KeyState
+        self._lock = threading.Lock()
+        self.presses = 0
+        self.sent = 0
+        self.repeats = 0  # Auto-repeats not sent
+        self.bounces = 0  # Presses taken for bounce
+        self.releases = 0  # REPEAT_HOLD releases reported
+
+    def press(self, key, command=None, now=None):
+        """The key (mapped to command) went down. Returns True if the press should be sent."""
+        now = time.perf_counter() if now is None else now
+        policy = self.policies.get(command, self.policy)
+        released = False
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = KeyState()
+            self.presses += 1
+            if state.down:
+                send = policy == REPEAT_RATE_LIMIT and now - state.sent_at >= self.repeat_interval
+                if not send:
+                    self.repeats += 1
+            elif now - state.released_at < self.bounce_time:
+                state.down = True  # It never came up: a held-back REPEAT_HOLD release is taken back
+                self.bounces += 1
+                send = False
+            else:
+                state.down = True
+                if state.held:  # The last release is final, but the timer has not reported it yet
+                    state.held = False
+                    self.releases += 1
+                    released = True
+                state.held = policy == REPEAT_HOLD
+                send = True
+            if send:
+                state.sent_at = now
+                self.sent += 1
+        if released:
+            self._report_release(key)  # Before this press is sent
+        return send
+
+    def release(self, key, now=None):
+        """A key came up. The release of a REPEAT_HOLD press is reported through on_release once final."""
+        timed = now is None
+        now = time.perf_counter() if now is None else now
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None or not state.down:  # e.g. held down before the listener started
+                return
+            state.down = False
+            state.released_at = now
+            if not state.held:
+                return
+            final = self.bounce_time <= 0
+            if final:
+                state.held = False
+                self.releases += 1
+        if final:
+            self._report_release(key)
+        elif timed:
+            self._schedule(self.bounce_time)
+
+    def releases_due(self, now=None):
+        """
+        Reports the REPEAT_HOLD releases that are final at `now` (the key has been up for
+        bounce_time) and returns their keys. A timer runs this after each held-back release;
+        callers that pass their own `now` to release() call it themselves.
+        """
+        timed = now is None
+        now = time.perf_counter() if now is None else now
+        due, wait = [], None
+        with self._lock:
+            for key, state in self._keys.items():
+                if not state.held or state.down:
+                    continue
+                left = state.released_at + self.bounce_time - now
+                if left > 0:
+                    wait = left if wait is None else min(wait, left)
+                    continue
+                state.held = False
+                self.releases += 1
+                due.append(key)
+        if timed and wait is not None:
+            self._schedule(wait)
+        for key in due:
+            self._report_release(key)
+        return due
+
+    def _schedule(self, delay):
+        timer = threading.Timer(delay, self.releases_due)
+        timer.daemon = True
+        timer.start()
+
+    def _report_release(self, key):
+        if self.on_release is None:
+            return
+        try:
+            self.on_release(key)
+        except Exception as e:  # On the timer thread there is nobody else to catch it
+            log.error("[CAPTURE] Error handling the release of '%s': %s", key, e)
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "presses": self.presses,
+            "sent": self.sent,
+            "repeats_suppressed": self.repeats,
+            "bounces_suppressed": self.bounces,
+            "releases": self.releases,
+        }
+
+
+class SenderThread(threading.Thread):
+    """Drains a CaptureQueue and calls send(command, captured_at) for every captured press, off the input hook."""
+
+    def __init__(self, queue, send, name="capture-sender"):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue
+        self.send = send
+        self._stopping = False
+
+    def run(self):
+        while not self._stopping:
+            event = self.queue.get(timeout=0.5)
+            if event is None:
+                continue
+            for _ in range(event.count):
+                try:
+                    self.send(event.command, event.captured_at)
+                except Exception as e:  # Keep draining even if one send blows up
+                    log.error("[CAPTURE] Error sending '%s': %s", event.command, e)
+
+    def stop(self):
+        self._stopping = True
+        self.queue.wake()
@@ -0,0 +1,175 @@
+# config.py
+# Non-interactive configuration for the Spotlight scripts.
+#
+# The scripts used to ask for the mode and the pairing ID with input(), and again on every
+# retry, so a presentation PC could not start (or recover) without someone at the keyboard.
+# Settings are still the module-level constants at the top of each script; those are the
+# defaults. Each script lists the ones that may be set from outside in an options table
+# (option name -> constant name), and load_config() overrides them, later sources winning:
+#   1. a JSON config file, e.g. {"pairing-id": "1234", "command-port": 50011}
+#      (the script's own file if it exists, or the one named by --config / SPOTLIGHT_CONFIG)
+#   2. environment variables: SPOTLIGHT_PAIRING_ID=1234
+#   3. command line options: --pairing-id 1234
+# Text values (environment, command line) are converted to the type of the default: numbers,
+# true/false for switches, JSON for mappings and lists. Values are checked against that type, so
+# a bad port is reported here rather than by bind() later. Two further lists of option names
+# loosen the check: `nullable` settings also take None ("none"; settings whose default is None
+# always do), and `seconds` settings with a whole-number default also take fractions ("0.5").
+
+import json
+import os
+import sys
+
+ENV_PREFIX = "SPOTLIGHT_"
+CONFIG_OPTION = "config"  # --config PATH / SPOTLIGHT_CONFIG=PATH
+
+TRUE_WORDS = ("1", "true", "yes", "on")
+FALSE_WORDS = ("0", "false", "no", "off")
+
+
+class ConfigError(ValueError):
+    """An unknown option, a malformed config file or a value that does not fit the setting."""
+
+
+def env_name(option):
+    """'pairing-id' -> 'SPOTLIGHT_PAIRING_ID'."""
+    return ENV_PREFIX + option.upper().replace("-", "_")
+
+
+def parse_value(option, text, default, nullable=False, seconds=False):
+    """Converts the text given for an option to the type of its default."""
+    if text.strip().lower() in ("none", "null") and (nullable or default is None):
+        return None
+    try:
+        if isinstance(default, bool):
+            word = text.strip().lower()
+            if word in TRUE_WORDS or word in FALSE_WORDS:
+                return word in TRUE_WORDS
+            raise ValueError(f"expected one of {TRUE_WORDS + FALSE_WORDS}")
+        if isinstance(default, int):
+            if seconds:  # Whole-second defaults still take fractions: "0.5"
+                number = float(text)
+                return int(number) if number.is_integer() else number
+            try:
+                return int(text)
+            except ValueError:
+                raise ValueError("expected a whole number")
+        if isinstance(default, float):
+            return float(text)
+        if isinstance(default, str):
+            return text
+        if default is None:  # No type to go by: JSON if it parses (numbers, lists ...), else the text itself
+            try:
+                return json.loads(text)
+            except ValueError:
+                return text
+        return check_value(option, json.loads(text), default, nullable, seconds)
+    except ConfigError:
+        raise
+    except ValueError as e:
+        raise ConfigError(f"{option}: {text!r} is not a valid value ({e})")
+
+
+def check_value(option, value, default, nullable=False, seconds=False):
+    """A value from the config file (already typed by JSON), checked against the default."""
+    if isinstance(value, str) and not isinstance(default, str) and default is not None:
+        return parse_value(option, value, default, nullable, seconds)
+    if default is None or (value is None and nullable):
+        return value
+    if isinstance(default, tuple) and isinstance(value, list):
+        return tuple(value)
+    if isinstance(default, float) and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(default, int) and not isinstance(default, bool) and isinstance(value, float):
+        if seconds:
+            return value
+        raise ConfigError(f"{option}: expected a whole number, got {value!r}")
+    if isinstance(default, bool) != isinstance(value, bool) or not isinstance(value, type(default)):
+        raise ConfigError(f"{option}: expected {type(default).__name__}, got {value!r}")
+    return value
+
+
+def read_config_file(path, options):
+    """The option values in a JSON config file. Option names may also be written with '_'."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"could not read config file {path}: {e}")
+    if not isinstance(data, dict):
+        raise ConfigError(f"config file {path}: expected a JSON object")
+    values = {}
+    for key, value in data.items():
+        option = key.replace("_", "-").lower()
+        if option not in options:
+            raise ConfigError(f"config file {path}: unknown option {key!r}; expected one of {sorted(options)}")
+        values[option] = value
+    return values
+
+
+def parse_args(argv, options, settings, description=None):
+    """The options given on the command line (text values), plus 'config' if --config was given."""
+    import argparse  # A few milliseconds; only paid when there are arguments
+
+    parser = argparse.ArgumentParser(description=description, argument_default=argparse.SUPPRESS)
+    parser.add_argument(f"--{CONFIG_OPTION}", metavar="PATH", help=f"JSON config file (or {env_name(CONFIG_OPTION)})")
+    for option, name in options.items():
+        parser.add_argument(f"--{option}", metavar="VALUE",
+                            help=f"{name} (default: {settings[name]!r}; or {env_name(option)})")
+    return {option.replace("_", "-"): value for option, value in vars(parser.parse_args(argv)).items()}
+
+
+def load_config(settings, options, argv=None, default_path=None, environ=None, description=None,
+                nullable=(), seconds=()):
+    """
+    Applies the config file, environment and command line to `settings` (the script's
+    globals()) for the constants named in `options`. default_path is read if it exists and no
+    other file was named. `nullable` and `seconds` name the options that also take None and
+    fractions of a second. Returns {option: source} for every option that was set. Raises
+    ConfigError; `--help` exits after printing the options.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    environ = os.environ if environ is None else environ
+    given = parse_args(argv, options, settings, description) if argv else {}
+
+    path = given.pop(CONFIG_OPTION, None) or environ.get(env_name(CONFIG_OPTION))
+    if path is None and default_path and os.path.exists(default_path):
+        path = default_path
+    values, sources = {}, {}
+    if path:
+        for option, value in read_config_file(path, options).items():
+            values[option] = check_value(option, value, settings[options[option]],
+                                         option in nullable, option in seconds)
+            sources[option] = path
+    for option, name in options.items():
+        text = environ.get(env_name(option))
+        if text is not None:
+            values[option] = parse_value(option, text, settings[name], option in nullable, option in seconds)
+            sources[option] = env_name(option)
+    for option, text in given.items():
+        values[option] = parse_value(option, text, settings[options[option]],
+                                     option in nullable, option in seconds)
+        sources[option] = "command line"
+
+    for option, value in values.items():
+        settings[options[option]] = value
+    return sources
+
+
+def describe_sources(sources):
+    """'pairing-id (SPOTLIGHT_PAIRING_ID), command-port (command line)' for the start-up banner."""
+    return ", ".join(f"{option} ({source})" for option, source in sources.items())
+
+
+def ask(option, prompt, choices=None):
+    """
+    Asks for a setting that was not configured, until the answer is non-empty (and one of
+    `choices`, if given). Raises ConfigError instead when there is no terminal to ask on.
+    """
+    if not sys.stdin or not sys.stdin.isatty():
+        raise ConfigError(f"{option} is not set (use --{option}, {env_name(option)} or a config file)")
+    while True:
+        answer = input(prompt).strip()
+        if answer and (choices is None or answer.lower() in choices):
+            return answer.lower() if choices else answer
+        print(f"Please enter one of: {', '.join(choices)}." if choices else f"The {option} cannot be empty.")
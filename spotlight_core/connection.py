@@ -0,0 +1,230 @@
+# connection.py
+# Client connection state machine with bounded backoff and a replay buffer.
+#
+# The v1 client used to reconnect from inside send_command(): a failed send called
+# attempt_reconnect_and_send(), which called send_command() again, and so on. Every level
+# could block on a 5 second discovery, and a flaky network could recurse until the stack ran
+# out, replaying clicks long after anyone wanted them. ConnectionManager does the same job
+# on one thread, in a loop:
+#
+#   DISCONNECTED -> DISCOVERING -> CONNECTING -> PAIRING -> READY
+#         ^                                                   |
+#         +------------------- connection_lost() -------------+
+#
+# Failed attempts are retried after a jittered, capped backoff. Commands that could not be
+# sent wait in a ReplayBuffer, each with its own deadline; when the connection is back, the
+# ones still in time are sent and the stale ones are dropped.
+
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+from spotlight_core.log import get_logger
+from spotlight_core.server_cache import CONNECT_TIMEOUT, locate_server
+
+log = get_logger("connection")
+
+DISCONNECTED = "DISCONNECTED"
+DISCOVERING = "DISCOVERING"  # Cached endpoints and discovery are being raced
+CONNECTING = "CONNECTING"  # Discovery answered; TCP connect to that server
+PAIRING = "PAIRING"  # Connected; handshake (pairing) in progress
+READY = "READY"
+
+BACKOFF_INITIAL = 0.25  # Seconds before the first retry
+BACKOFF_FACTOR = 2.0
+BACKOFF_MAX = 5.0  # Retries are never further apart than this
+BACKOFF_JITTER = 0.5  # Each delay is randomly shortened by up to this fraction
+
+REPLAY_MAX_AGE = 2.0  # Seconds after the key press a command may still be replayed
+REPLAY_BUFFER_SIZE = 64
+
+# A command waiting for a connection. deadline is a time.perf_counter() value.
+ReplayEntry = namedtuple("ReplayEntry", "command captured_at attempts deadline")
+
+
+class Backoff:
+    """Exponential backoff with jitter, capped at `maximum` seconds."""
+
+    def __init__(self, initial=BACKOFF_INITIAL, factor=BACKOFF_FACTOR, maximum=BACKOFF_MAX, jitter=BACKOFF_JITTER):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.failures = 0
+
+    def next(self):
+        """The delay before the next attempt. Every call counts as one more failure."""
+        delay = min(self.maximum, self.initial * self.factor ** self.failures)
+        self.failures += 1
+        # Jitter keeps several clients from retrying against a restarted server in lockstep
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.failures = 0
+
+
+class ReplayBuffer:
+    """
+    Commands that could not be sent, until the connection is back. Thread-safe.
+
+    Each command gets a deadline of its key press time plus max_age seconds, or the
+    per-command value from `deadlines` (a dict of command name -> seconds). Beyond
+    `maxlen` the oldest command is dropped.
+    """
+
+    def __init__(self, max_age=REPLAY_MAX_AGE, deadlines=None, maxlen=REPLAY_BUFFER_SIZE):
+        self.max_age = max_age
+        self.deadlines = deadlines or {}
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, command, captured_at=None, attempts=0):
+        """Buffers a command. captured_at is the key press time (time.perf_counter()); None = now."""
+        if captured_at is None:
+            captured_at = time.perf_counter()
+        deadline = captured_at + self.deadlines.get(command, self.max_age)
+        with self._lock:
+            if len(self._entries) == self._entries.maxlen:
+                log.warning("[REPLAY] Buffer full; dropping '%s'.", self._entries[0].command)
+            self._entries.append(ReplayEntry(command, captured_at, attempts, deadline))
+
+    def take(self):
+        """Empties the buffer. Returns (live, expired) lists of ReplayEntry, oldest first."""
+        now = time.perf_counter()
+        with self._lock:
+            entries = list(self._entries)
+            self._entries.clear()
+        live = [entry for entry in entries if entry.deadline >= now]
+        expired = [entry for entry in entries if entry.deadline < now]
+        return live, expired
+
+
+class ConnectionManager:
+    """
+    Keeps one client connection up, from a single background thread.
+
+    Each attempt is a locate_server() call: cached endpoints and discovery are raced, then the
+    handshake (e.g. pairing) runs. On success on_connected(server) is called with the
+    server_cache.FoundServer and the state becomes READY. The owner calls connection_lost()
+    when the connection breaks, which may already happen inside on_connected() (e.g. from a
+    reader thread it started); the thread then starts over after the backoff delay.
+    on_state(state), if given, is called on every state change.
+    """
+
+    def __init__(self, cache, discover_fn, on_connected, pairing_id=None, handshake=None,
+                 connect_timeout=CONNECT_TIMEOUT, backoff=None, on_state=None, tag="[TCP CLIENT]"):
+        self.cache = cache
+        self.discover_fn = discover_fn
+        self.on_connected = on_connected
+        self.pairing_id = pairing_id
+        self.handshake = handshake
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff or Backoff()
+        self.on_state = on_state
+        self.tag = tag
+        self.state = DISCONNECTED
+        self._state_changed = threading.Condition()
+        self._wake = threading.Event()  # Set when a connection is needed (or on stop)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._handover_losses = None  # Errors reported while on_connected() runs; None outside of it
+
+    def start(self):
+        self._wake.set()
+        self._thread = threading.Thread(target=self._run, name="connection-manager", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def wait_ready(self, timeout=None):
+        """Blocks until READY (True) or until timeout seconds have passed (False)."""
+        with self._state_changed:
+            return self._state_changed.wait_for(lambda: self.state == READY, timeout)
+
+    def connection_lost(self, error=None):
+        """Reports that the connection handed to on_connected() broke. Safe to call more than once."""
+        with self._state_changed:
+            if self._handover_losses is not None:  # Not READY yet: _attempt() retries once on_connected() returns
+                self._handover_losses.append(error)
+                return
+            if self.state != READY:
+                return
+            self.state = DISCONNECTED
+            self._state_changed.notify_all()
+        log.warning("%s Connection lost%s. Reconnecting.", self.tag, f": {error}" if error else "")
+        if self.on_state:
+            self.on_state(DISCONNECTED)
+        self._wake.set()
+
+    def _set_state(self, state, unless=None):
+        with self._state_changed:
+            if state == self.state or (unless is not None and unless.is_set()):
+                return
+            log.debug("%s Connection state %s -> %s", self.tag, self.state, state)
+            self.state = state
+            self._state_changed.notify_all()
+        if self.on_state:
+            self.on_state(state)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            if self._stopped.is_set():
+                return
+            self._wake.clear()
+            if self._attempt():
+                self.backoff.reset()
+                continue
+            delay = self.backoff.next()
+            log.info("%s Could not reach the server. Retrying in %.1f s.", self.tag, delay)
+            self._set_state(DISCONNECTED)
+            if self._stopped.wait(delay):
+                return
+            self._wake.set()
+
+    def _attempt(self):
+        finished = threading.Event()  # Losing connect attempts may still run after locate_server() returns
+
+        def discover(cancel):
+            server = self.discover_fn(cancel)
+            if server is not None and not cancel.is_set():
+                self._set_state(CONNECTING, unless=finished)
+            return server
+
+        def handshake(sock, decoder):
+            self._set_state(PAIRING, unless=finished)
+            return self.handshake(sock, decoder)
+
+        self._set_state(DISCOVERING)
+        server = locate_server(self.cache, self.pairing_id, discover,
+                               handshake=handshake if self.handshake is not None else None,
+                               connect_timeout=self.connect_timeout, tag=self.tag)
+        finished.set()
+        if server is None:
+            return False
+        with self._state_changed:
+            self._handover_losses = []
+        self.on_connected(server)
+        with self._state_changed:
+            losses, self._handover_losses = self._handover_losses, None
+            if not losses:  # In the same lock, so a drop from now on finds the state READY
+                log.debug("%s Connection state %s -> %s", self.tag, self.state, READY)
+                self.state = READY
+                self._state_changed.notify_all()
+        if losses:
+            error = losses[0]
+            log.warning("%s Connection lost while it was being set up%s.", self.tag, f": {error}" if error else "")
+            return False
+        if self.on_state:
+            self.on_state(READY)  # The place to replay buffered commands
+        return True
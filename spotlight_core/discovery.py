@@ -0,0 +1,207 @@
+# discovery.py
+# UDP discovery messages shared by the Spotlight servers and clients.
+#
+# Client -> server (broadcast):  SPOTLIGHT_CLIENT_DISCOVERY[:<pairing_id>]
+# Server -> client (unicast):    SPOTLIGHT_SERVER_RESPONSE:<ip>:<command_port>:<server_name>
+#
+# Requests go to the broadcast address and to an IPv4 multicast group, because some networks
+# (guest Wi-Fi, managed switches) filter broadcast but pass multicast, or the other way round.
+
+import select
+import socket
+import struct
+import time
+
+from spotlight_core.interfaces import address_for_peer
+from spotlight_core.log import get_logger
+
+DISCOVERY_MESSAGE = "SPOTLIGHT_CLIENT_DISCOVERY"
+DISCOVERY_PREFIX = DISCOVERY_MESSAGE + ":"
+RESPONSE_PREFIX = "SPOTLIGHT_SERVER_RESPONSE:"
+
+MULTICAST_GROUP = "239.255.50.50"  # Administratively scoped (organisation-local) group the servers join
+MULTICAST_TTL = 1  # Don't let discovery requests leave the local network
+FIRST_RESEND_INTERVAL = 0.01  # Seconds before the first re-send; then x RESEND_BACKOFF each time (10, 30, 90 ms, ...)
+RESEND_BACKOFF = 3
+MAX_RESEND_INTERVAL = 1.0
+
+log = get_logger("discovery")
+
+
+def build_discovery_reply(message, client_address, server_ip, command_port, server_name, pairing_id=None,
+                          tag="[UDP DISCOVERY]"):
+    """
+    Works out the reply to one discovery datagram. Returns the bytes to send back, or None
+    if the datagram should be ignored. Servers without a pairing ID (Version 1) answer the
+    bare discovery message; servers with one only answer clients that send the same ID.
+    server_ip None (or "0.0.0.0") advertises the address of the interface facing the client.
+    """
+    message_str = message.decode(errors="replace").strip()
+    log.debug("%s Received discovery message: '%s' from %s", tag, message_str, client_address)
+
+    if pairing_id is None:
+        if message_str != DISCOVERY_MESSAGE:
+            return None
+    else:
+        if not message_str.startswith(DISCOVERY_PREFIX):
+            log.debug("%s Message from %s not in expected format ('%s...'). Ignoring.", tag, client_address,
+                      DISCOVERY_PREFIX)
+            return None
+        client_pairing_id = message_str[len(DISCOVERY_PREFIX):]
+        if client_pairing_id != pairing_id:
+            log.warning("%s Incorrect Pairing ID from %s. Expected '%s', got '%s'. Ignoring.",
+                        tag, client_address, pairing_id, client_pairing_id)
+            return None
+
+    ip_to_respond_with = server_ip if server_ip not in (None, "0.0.0.0") else address_for_peer(client_address[0])
+    response = f"{RESPONSE_PREFIX}{ip_to_respond_with}:{command_port}:{server_name}"
+    log.info("%s Sent response to %s: %s", tag, client_address, response)
+    return response.encode()
+
+
+def parse_discovery_response(data, source_address=None):
+    """
+    Parses "SPOTLIGHT_SERVER_RESPONSE:<ip>:<port>:<name>". Returns (ip, port, name), or None if
+    the datagram is not a valid response. A 0.0.0.0 (or empty) IP is replaced by the UDP source address.
+    """
+    response = data.decode(errors="replace").strip()
+    if not response.startswith(RESPONSE_PREFIX):
+        return None
+    parts = response[len(RESPONSE_PREFIX):].split(":", 2)  # The server name may contain ':'
+    if len(parts) != 3:
+        return None
+    server_ip, port_str, server_name = parts
+    try:
+        port = int(port_str)
+    except ValueError:
+        return None
+    if server_ip in ("", "0.0.0.0") and source_address:
+        server_ip = source_address[0]
+    return server_ip, port, server_name
+
+
+def join_multicast_group(sock, group=MULTICAST_GROUP, tag="[UDP DISCOVERY]"):
+    """Makes a bound UDP discovery socket also receive datagrams sent to `group`. Returns True on success."""
+    if not group:
+        return False
+    try:
+        membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    except OSError as e:  # e.g. no multicast route; broadcast discovery still works
+        log.warning("%s Could not join multicast group %s (broadcast discovery still works): %s", tag, group, e)
+        return False
+    log.info("%s Also listening on multicast group %s", tag, group)
+    return True
+
+
+def discover(message, port, timeout=5.0, broadcast_address="<broadcast>", multicast_group=MULTICAST_GROUP,
+             unicast_hosts=(), first_interval=FIRST_RESEND_INTERVAL, backoff=RESEND_BACKOFF,
+             max_interval=MAX_RESEND_INTERVAL, bufsize=1024, cancel=None, tag="[DISCOVERY]"):
+    """
+    Looks for a server and returns (ip, port, name) from the first valid response, or None
+    after `timeout` seconds (or soon after the optional threading.Event `cancel` is set).
+
+    Sending and listening happen together. The request goes to every target (broadcast address,
+    multicast group, any unicast hosts) right away. It is re-sent after 10 ms, 30 ms, 90 ms, ...
+    (first_interval, multiplied by backoff, capped at max_interval) until a reply arrives, so a
+    lost packet costs milliseconds and a server that answers the first packet is found in one round trip.
+    """
+    found = []
+
+    def on_server(server):
+        found.append(server)
+        return True  # Stop at the first one
+
+    _run_discovery(message, port, timeout, broadcast_address, multicast_group, unicast_hosts, first_interval,
+                   backoff, max_interval, bufsize, cancel, tag, on_server)
+    return found[0] if found else None
+
+
+def discover_all(message, port, timeout=2.0, expected=None, broadcast_address="<broadcast>",
+                 multicast_group=MULTICAST_GROUP, unicast_hosts=(), first_interval=FIRST_RESEND_INTERVAL,
+                 backoff=RESEND_BACKOFF, max_interval=MAX_RESEND_INTERVAL, bufsize=1024, cancel=None,
+                 tag="[DISCOVERY]"):
+    """
+    Like discover(), but keeps listening for `timeout` seconds (or until `expected` servers have
+    answered) and returns every server that responded, as a list of (ip, port, name).
+    """
+    found = {}
+
+    def on_server(server):
+        found.setdefault((server[0], server[1]), server)
+        return expected is not None and len(found) >= expected
+
+    _run_discovery(message, port, timeout, broadcast_address, multicast_group, unicast_hosts, first_interval,
+                   backoff, max_interval, bufsize, cancel, tag, on_server)
+    return list(found.values())
+
+
+def _run_discovery(message, port, timeout, broadcast_address, multicast_group, unicast_hosts, first_interval,
+                   backoff, max_interval, bufsize, cancel, tag, on_server):
+    # Sends and re-sends the request and passes each valid response to on_server(server)
+    # until it returns True, the timeout passes or `cancel` is set.
+    if isinstance(message, str):
+        message = message.encode()
+    targets = [(host, port) for host in unicast_hosts]
+    if broadcast_address:
+        targets.append((broadcast_address, port))
+    if multicast_group:
+        targets.append((multicast_group, port))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    if multicast_group:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    sock.setblocking(False)
+
+    started = time.perf_counter()
+    deadline = started + timeout
+    next_send = started
+    interval = first_interval
+    packets = 0
+    responses = 0
+    try:
+        while targets:
+            now = time.perf_counter()
+            if now >= deadline or (cancel is not None and cancel.is_set()):
+                break
+            if now >= next_send:
+                for target in list(targets):
+                    try:
+                        sock.sendto(message, target)
+                    except OSError as e:  # e.g. unresolvable broadcast address or no multicast route
+                        log.warning("%s Cannot send discovery to %s:%s, skipping it: %s", tag, target[0], target[1], e)
+                        targets.remove(target)
+                packets += 1
+                next_send = now + interval
+                interval = min(interval * backoff, max_interval)
+                continue
+
+            wait = min(next_send, deadline) - now
+            if cancel is not None:
+                wait = min(wait, 0.05)  # Notice cancellation promptly
+            readable, _, _ = select.select([sock], [], [], max(0.0, wait))
+            if not readable:
+                continue
+            try:
+                data, source = sock.recvfrom(bufsize)
+            except (BlockingIOError, ConnectionResetError):  # Windows reports ICMP port-unreachable here
+                continue
+            server = parse_discovery_response(data, source)
+            if server is None:
+                log.debug("%s Ignoring unexpected datagram from %s: %r", tag, source, data[:64])
+                continue
+            log.info("%s Found server '%s' at %s:%s in %.1f ms (%s request round(s))", tag, server[2], server[0],
+                     server[1], (time.perf_counter() - started) * 1000, packets)
+            responses += 1
+            if on_server(server):
+                return
+    finally:
+        sock.close()
+
+    if cancel is not None and cancel.is_set():
+        log.debug("%s Discovery cancelled", tag)
+    elif not targets:
+        log.error("%s No usable discovery address (check the broadcast address / multicast group settings)", tag)
+    elif not responses:
+        log.info("%s No server responded within %s seconds", tag, timeout)
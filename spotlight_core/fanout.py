@@ -0,0 +1,465 @@
+# fanout.py
+# One controller driving several presentation machines at once (fan-out).
+#
+# The clients talk to one server: the first that answers discovery. For a talk shown on a
+# stage screen, a confidence monitor and an overflow room, every machine has to turn the page
+# at the same moment. FanoutSender keeps a paired TCP connection to each server and:
+#   - encodes every command once and writes it to all connections from one thread, with
+#     non-blocking sockets and a selector, so a slow or dead machine never holds up the others;
+#   - matches each server's ACK by sequence number and records its round trip as the
+#     "target_rtt" stage (labelled with the server, not the command);
+#   - estimates when each server actually ran the command (write time + network / 2 + the
+#     server's queue time) and records the spread between the first and the last as the
+#     "fanout_skew" stage, per command;
+#   - reconnects lost servers in the background with a Backoff each; clicks made meanwhile wait
+#     in that server's ReplayBuffer, so it catches up if it is back in time.
+
+import selectors
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from spotlight_core import protocol
+from spotlight_core.connection import Backoff, ReplayBuffer
+from spotlight_core.log import get_logger
+from spotlight_core.metrics import record_reply
+from spotlight_core.sockopts import tune_tcp_socket
+
+log = get_logger("fanout")
+
+CONNECT_TIMEOUT = 5.0  # Seconds for the TCP connect and the handshake to one server
+MAX_BUFFERED = 64 * 1024  # Bytes queued for a server beyond which pointer frames are dropped for it
+SKEW_SMOOTHING = 8  # Commands averaged in a server's lag behind the fastest one
+
+# A command written to one server and not acknowledged yet
+FanoutPending = namedtuple("FanoutPending", "command sent_at attempts captured_at")
+
+
+def parse_targets(targets, default_port):
+    """["host", "host:port", ("host", port), ...] -> [(host, port), ...] without duplicates."""
+    parsed = []
+    for target in targets:
+        if isinstance(target, str):
+            host, _, port = target.strip().partition(":")
+            target = (host, int(port) if port else default_port)
+        target = (target[0], int(target[1]))
+        if target not in parsed:
+            parsed.append(target)
+    return parsed
+
+
+class FanoutTarget:
+    """One server of a FanoutSender. Its fields belong to the sender (and its lock)."""
+
+    def __init__(self, address, replay, backoff):
+        self.address = address
+        self.name = f"{address[0]}:{address[1]}"
+        self.replay = replay
+        self.backoff = backoff
+        self.sock = None  # Non-blocking, paired; None while disconnected
+        self.decoder = None
+        self.out = bytearray()  # Written as soon as the socket takes it
+        self.events = 0  # Selector interest currently registered
+        self.in_flight = {}  # seq -> FanoutPending
+        self.connecting = False
+        self.next_attempt = 0.0
+        self.last_received = 0.0
+        self.last_ping = 0.0
+        self.acked = 0
+        self.failed = 0
+        self.rtt = None  # Smoothed round trip, seconds
+        self.lag = 0.0  # Smoothed time this server ran commands after the fastest one, seconds
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+
+class FanoutSender:
+    """
+    Sends every command to all `targets` ((host, port) pairs) at once. Thread-safe.
+
+    handshake(sock, decoder), e.g. pairing, runs on each new (blocking) connection and returns
+    True if it is one of our servers. Commands a server does not ACK within ack_timeout seconds,
+    or that are too old to replay after it reconnects, are reported through on_failure.
+
+    Callbacks run on the I/O thread:
+      on_reply(target_name, command, reply, rtt_seconds)
+      on_failure(target_name, command, reason)
+      on_target(target_name, connected)
+    """
+
+    def __init__(self, targets, handshake=None, ack_timeout=3.0, max_attempts=2, connect_timeout=CONNECT_TIMEOUT,
+                 heartbeat_interval=None, heartbeat_misses=3, replay_max_age=None, replay_deadlines=None,
+                 backoff_initial=None, backoff_max=None, on_reply=None, on_failure=None, on_target=None,
+                 bufsize=1024, metrics=None, tag="[FANOUT]"):
+        self.handshake = handshake
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.connect_timeout = connect_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.on_reply = on_reply
+        self.on_failure = on_failure
+        self.on_target = on_target
+        self.bufsize = bufsize
+        self.metrics = metrics
+        self.tag = tag
+        replay_args = {"deadlines": replay_deadlines}
+        if replay_max_age is not None:
+            replay_args["max_age"] = replay_max_age
+        backoff_args = {}
+        if backoff_initial is not None:
+            backoff_args["initial"] = backoff_initial
+        if backoff_max is not None:
+            backoff_args["maximum"] = backoff_max
+        self.targets = [FanoutTarget(address, ReplayBuffer(**replay_args), Backoff(**backoff_args))
+                        for address in targets]
+        self.sent = 0
+        self.skew = None  # Spread of the last command that reached two or more servers, seconds
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._next_seq = 1
+        self._commands = {}  # seq -> [command, {target: estimated execution time}, set of targets still to ACK]
+        self._adopt = []  # (target, sock, decoder) connected by a connect thread, for the I/O thread
+        self._stopped = False
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._tick = min(0.2, ack_timeout, heartbeat_interval / 2 if heartbeat_interval else 0.2)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="fanout-io", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        self._wake()
+
+    def connected_count(self):
+        with self._lock:
+            return sum(1 for target in self.targets if target.connected)
+
+    def wait_connected(self, count=1, timeout=None):
+        """Blocks until at least `count` servers are connected (True) or timeout seconds passed (False)."""
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: sum(1 for target in self.targets if target.connected) >= count, timeout)
+
+    def send(self, command, captured_at=None):
+        """Writes a command to every connected server and returns its sequence number; never blocks."""
+        now = time.perf_counter()
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            frame = protocol.encode_command(command, seq, int(now * 1_000_000))  # Encoded once for all
+            waiting = set()
+            for target in self.targets:
+                if target.connected:
+                    target.in_flight[seq] = FanoutPending(command, time.perf_counter(), 1, captured_at)
+                    self._write_locked(target, frame)
+                    waiting.add(target)
+                else:
+                    target.replay.add(command, captured_at)
+                    log.debug("%s %s is not connected; %s will be sent when it is back.", self.tag, target.name,
+                              command)
+            if len(waiting) > 1:
+                self._commands[seq] = [command, {}, waiting]
+            self.sent += 1
+        return seq
+
+    def send_frame(self, frame):
+        """Writes a frame that needs no ACK (a pointer position) to every connected server that keeps up."""
+        with self._lock:
+            for target in self.targets:
+                if target.connected and len(target.out) < MAX_BUFFERED:
+                    self._write_locked(target, frame)
+
+    def stats(self):
+        with self._lock:
+            return {"targets": len(self.targets), "connected": sum(1 for t in self.targets if t.connected),
+                    "sent": self.sent, "acked": sum(t.acked for t in self.targets),
+                    "failed": sum(t.failed for t in self.targets),
+                    "skew_ms": round(self.skew * 1000, 3) if self.skew is not None else 0}
+
+    def report(self):
+        """One dict per server: name, connected, acked, failed, rtt_ms and lag_ms behind the fastest server."""
+        with self._lock:
+            return [{"name": t.name, "connected": t.connected, "acked": t.acked, "failed": t.failed,
+                     "rtt_ms": round(t.rtt * 1000, 3) if t.rtt is not None else None,
+                     "lag_ms": round(t.lag * 1000, 3)} for t in self.targets]
+
+    # --- Called with _lock held ---
+
+    def _write_locked(self, target, data):
+        was_empty = not target.out
+        target.out += data
+        try:
+            sent = target.sock.send(target.out)
+            del target.out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            return  # The I/O thread notices the broken connection
+        if target.out and was_empty:
+            self._wake()  # So the I/O thread waits for the socket to take the rest
+
+    def _close_locked(self, target):
+        # Returns the unacknowledged commands of a connection that is going away
+        try:
+            self._selector.unregister(target.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            target.sock.close()
+        except OSError:
+            pass
+        target.sock = None
+        target.decoder = None
+        target.events = 0
+        target.out.clear()
+        pending = list(target.in_flight.values())
+        target.in_flight.clear()
+        for seq, record in list(self._commands.items()):
+            record[2].discard(target)
+            if not record[2]:
+                self._finish_command_locked(seq)
+        self._changed.notify_all()
+        return pending
+
+    def _finish_command_locked(self, seq):
+        command, estimates, _ = self._commands.pop(seq)
+        if len(estimates) < 2:
+            return
+        first = min(estimates.values())
+        self.skew = max(estimates.values()) - first
+        for target, estimate in estimates.items():
+            target.lag += (estimate - first - target.lag) / SKEW_SMOOTHING
+        if self.metrics is not None:
+            self.metrics.observe("fanout_skew", command, self.skew)
+
+    # --- I/O thread ---
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass  # Already full (a wakeup is pending anyway) or closed
+
+    def _run(self):
+        for target in self.targets:
+            self._start_connect(target)
+        while True:
+            with self._lock:
+                if self._stopped:
+                    break
+                self._update_interest_locked()
+            for key, events in self._selector.select(self._tick):
+                if key.data is None:
+                    try:
+                        self._wake_r.recv(4096)
+                    except OSError:
+                        pass
+                    continue
+                target = key.data
+                if events & selectors.EVENT_WRITE:
+                    with self._lock:
+                        if target.sock is not None and target.out:
+                            self._write_locked(target, b"")
+                if events & selectors.EVENT_READ:
+                    self._read(target)
+            self._adopt_connections()
+            now = time.perf_counter()
+            self._expire_overdue(now)
+            self._check_heartbeats(now)
+            for target in self.targets:
+                if not target.connected and not target.connecting and now >= target.next_attempt:
+                    self._start_connect(target)
+        with self._lock:
+            for target in self.targets:
+                if target.connected:
+                    self._close_locked(target)
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _update_interest_locked(self):
+        for target in self.targets:
+            if target.sock is None:
+                continue
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if target.out else 0)
+            if events != target.events:
+                self._selector.modify(target.sock, events, target)
+                target.events = events
+
+    def _start_connect(self, target):
+        target.connecting = True
+        threading.Thread(target=self._connect, args=(target,), name="fanout-connect", daemon=True).start()
+
+    def _connect(self, target):
+        # Blocking connect and handshake, off the I/O thread
+        sock = None
+        try:
+            sock = socket.create_connection(target.address, timeout=self.connect_timeout)
+            tune_tcp_socket(sock)
+            decoder = protocol.FrameDecoder()
+            if self.handshake is not None and not self.handshake(sock, decoder):
+                raise ConnectionError("handshake rejected")
+            sock.setblocking(False)
+        except (OSError, protocol.ProtocolError) as e:
+            if sock is not None:
+                sock.close()
+            delay = target.backoff.next()
+            log.debug("%s %s not reachable (%s). Retrying in %.1f s.", self.tag, target.name, e, delay)
+            target.next_attempt = time.perf_counter() + delay
+            target.connecting = False
+            return
+        with self._lock:
+            self._adopt.append((target, sock, decoder))
+        self._wake()
+
+    def _adopt_connections(self):
+        with self._lock:
+            adopt, self._adopt = self._adopt, []
+            replays = []
+            for target, sock, decoder in adopt:
+                if self._stopped:
+                    sock.close()
+                    continue
+                target.sock, target.decoder = sock, decoder
+                target.connecting = False
+                target.last_received = time.perf_counter()
+                target.backoff.reset()
+                self._selector.register(sock, selectors.EVENT_READ, target)
+                target.events = selectors.EVENT_READ
+                live, expired = target.replay.take()
+                for entry in live:  # Commands this server missed while it was away
+                    seq = self._next_seq
+                    self._next_seq += 1
+                    now = time.perf_counter()
+                    target.in_flight[seq] = FanoutPending(entry.command, now, entry.attempts + 1, entry.captured_at)
+                    self._write_locked(target, protocol.encode_command(entry.command, seq, int(now * 1_000_000)))
+                replays.append((target, len(live), expired))
+            self._changed.notify_all()
+        for target, replayed, expired in replays:
+            log.info("%s Connected to %s%s", self.tag, target.name,
+                     f"; re-sent {replayed} missed command(s)" if replayed else "")
+            for entry in expired:
+                self._report_failure(target, entry.command, "dropped, too old to replay after reconnecting")
+            if self.on_target:
+                self.on_target(target.name, True)
+
+    def _read(self, target):
+        try:
+            data = target.sock.recv(self.bufsize)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._drop(target, e)
+            return
+        if not data:
+            self._drop(target, "server closed the connection")
+            return
+        target.last_received = time.perf_counter()
+        try:
+            frames = target.decoder.feed(data)
+        except protocol.ProtocolError as e:
+            self._drop(target, e)
+            return
+        for frame in frames:
+            self._handle_frame(target, frame)
+
+    def _handle_frame(self, target, frame):
+        received_at = time.perf_counter()
+        if frame.opcode == protocol.OP_PONG:
+            sent_us, _ = protocol.parse_ping(frame)
+            if self.metrics is not None and sent_us:
+                self.metrics.observe("heartbeat_rtt", target.name, received_at - sent_us / 1_000_000)
+            return
+        reply = protocol.parse_reply(frame)
+        if reply is None:
+            return
+        with self._lock:
+            entry = target.in_flight.pop(reply.seq, None)
+            if entry is None:
+                return  # Already reported as failed
+            rtt = received_at - entry.sent_at
+            target.rtt = rtt if target.rtt is None else target.rtt + (rtt - target.rtt) / 8
+            if reply.ok:
+                target.acked += 1
+            record = self._commands.get(reply.seq)
+            if record is not None:
+                if reply.ok:
+                    server_time = (reply.server_queue_us + reply.injection_us) / 1_000_000
+                    network = max(0.0, rtt - server_time)
+                    record[1][target] = entry.sent_at + network / 2 + reply.server_queue_us / 1_000_000
+                record[2].discard(target)
+                if not record[2]:
+                    self._finish_command_locked(reply.seq)
+        if self.metrics is not None:
+            self.metrics.observe("target_rtt", target.name, rtt)
+        record_reply(self.metrics, entry.command, reply, received_at, entry.captured_at)
+        if self.on_reply:
+            self.on_reply(target.name, entry.command, reply, rtt)
+
+    def _expire_overdue(self, now):
+        expired = []
+        with self._lock:
+            for target in self.targets:
+                for seq, entry in list(target.in_flight.items()):
+                    if now - entry.sent_at >= self.ack_timeout:
+                        del target.in_flight[seq]
+                        expired.append((target, entry.command))
+                        record = self._commands.get(seq)
+                        if record is not None:
+                            record[2].discard(target)
+                            if not record[2]:
+                                self._finish_command_locked(seq)
+        for target, command in expired:
+            self._report_failure(target, command, f"no ACK within {self.ack_timeout} s")
+
+    def _check_heartbeats(self, now):
+        if not self.heartbeat_interval:
+            return
+        silent = []
+        with self._lock:
+            for target in self.targets:
+                if not target.connected:
+                    continue
+                silence = now - target.last_received
+                if silence >= self.heartbeat_interval * self.heartbeat_misses:
+                    silent.append((target, silence))
+                elif now - target.last_ping >= self.heartbeat_interval:
+                    target.last_ping = now
+                    self._write_locked(target, protocol.encode_ping(int(now * 1_000_000),
+                                                                    int(self.heartbeat_interval * 1000)))
+        for target, silence in silent:
+            self._drop(target, f"no heartbeat reply for {silence:.1f} s")
+
+    def _drop(self, target, error):
+        with self._lock:
+            if not target.connected:
+                return
+            pending = self._close_locked(target)
+            delay = target.backoff.next()
+            target.next_attempt = time.perf_counter() + delay
+            for entry in pending:
+                if entry.attempts < self.max_attempts:
+                    target.replay.add(entry.command, entry.captured_at, entry.attempts)
+        log.warning("%s Lost %s: %s. Reconnecting in %.1f s.", self.tag, target.name, error, delay)
+        for entry in pending:
+            if entry.attempts >= self.max_attempts:
+                self._report_failure(target, entry.command, "gave up after connection loss")
+        if self.on_target:
+            self.on_target(target.name, False)
+
+    def _report_failure(self, target, command, reason):
+        target.failed += 1
+        if self.on_failure:
+            self.on_failure(target.name, command, reason)
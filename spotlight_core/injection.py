@@ -0,0 +1,138 @@
+# injection.py
+# Input-injection worker for the Spotlight servers.
+#
+# COMMAND_ACTIONS lambdas used to call pyautogui.press() on whichever thread read the
+# command, and pyautogui sleeps PAUSE (0.1 s by default) after every call. Five quick NEXTs
+# therefore held the socket reader for half a second. Now a single worker thread owns all
+# keystroke synthesis. Connections hand it commands through a queue. When it finds a run of
+# identical navigation commands waiting, it sends them as one multi-press with a short,
+# configurable interval instead of paying the full pause per key.
+
+import queue
+import threading
+import time
+
+from spotlight_core.log import get_logger
+
+log = get_logger("injection")
+
+# When the client gets its ACK
+ACK_QUEUED = "queued"  # As soon as the command is in the injection queue (lowest latency, no error reporting)
+ACK_COMPLETED = "completed"  # After the key press has returned (NACK if it raised)
+ACK_MODES = (ACK_QUEUED, ACK_COMPLETED)
+
+# Commands whose repeats may be folded into one multi-press
+BATCHABLE_COMMANDS = ("NEXT", "PREVIOUS")
+
+
+class InjectionJob:
+    """One command waiting for the worker. on_done(error, dispatched_at, done_at) runs on the worker thread."""
+    __slots__ = ("command", "action", "on_done")
+
+    def __init__(self, command, action, on_done):
+        self.command = command
+        self.action = action
+        self.on_done = on_done
+
+
+class InjectionWorker(threading.Thread):
+    """
+    Runs every injected key press on one thread, in arrival order.
+
+    press      - press(key, presses=1, interval=0.0), e.g. pyautogui.press
+    keys       - {command: key name} for commands that are plain key presses (COMMAND_KEYS)
+    pause      - seconds between the presses of a multi-press
+    batch      - fold runs of identical BATCHABLE_COMMANDS into one press() call
+    max_batch  - most presses folded into one call
+
+    Commands that are not in `keys` (placeholders such as LASER_ON) run their own action.
+    """
+
+    def __init__(self, press, keys, pause=0.0, batch=True, max_batch=16, name="injection-worker"):
+        super().__init__(name=name, daemon=True)
+        self.press = press
+        self.keys = keys
+        self.pause = pause
+        self.batch = batch
+        self.max_batch = max_batch
+        self._jobs = queue.SimpleQueue()
+        self._stopping = False
+        self.submitted = 0
+        self.press_calls = 0
+        self.collapsed = 0  # Presses saved by batching (n presses in one call counts n - 1)
+
+    def submit(self, command, action=None, on_done=None):
+        """Queues a command for injection. Safe to call from any thread; never blocks."""
+        self.submitted += 1
+        self._jobs.put(InjectionJob(command, action, on_done))
+
+    def depth(self):
+        return self._jobs.qsize()
+
+    def stats(self):
+        return {
+            "depth": self._jobs.qsize(),
+            "submitted": self.submitted,
+            "press_calls": self.press_calls,
+            "collapsed": self.collapsed,
+        }
+
+    def stop(self):
+        self._stopping = True
+        self._jobs.put(None)  # Wake the worker
+
+    def run(self):
+        while not self._stopping:
+            job = self._jobs.get()
+            if job is None:
+                continue
+            # Take whatever else is already waiting so runs of repeats can be folded together
+            pending = [job]
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None:
+                    pending.append(job)
+            self._run_jobs(pending)
+
+    def _run_jobs(self, jobs):
+        index = 0
+        while index < len(jobs):
+            job = jobs[index]
+            key = self.keys.get(job.command)
+            run = 1
+            if key is not None and self.batch and job.command in BATCHABLE_COMMANDS:
+                while (index + run < len(jobs) and run < self.max_batch
+                       and jobs[index + run].command == job.command):
+                    run += 1
+            group = jobs[index:index + run]
+            index += run
+
+            dispatched_at = time.perf_counter()
+            error = None
+            try:
+                if key is not None:
+                    if run > 1:
+                        self.press(key, presses=run, interval=self.pause)
+                        self.collapsed += run - 1
+                        log.debug("[INJECTION] Pressed '%s' x%s for %s", key, run, job.command)
+                    else:
+                        self.press(key)
+                    self.press_calls += 1
+                elif job.action is not None:
+                    job.action()
+                else:
+                    raise KeyError(f"no key or action for command {job.command}")
+            except Exception as e:
+                error = e
+            done_at = time.perf_counter()
+
+            for grouped in group:
+                if grouped.on_done is None:
+                    continue
+                try:
+                    grouped.on_done(error, dispatched_at, done_at)
+                except Exception as e:  # A reply callback must never take the worker down
+                    log.error("[INJECTION] Error finishing %s: %s", grouped.command, e)
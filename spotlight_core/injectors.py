@@ -0,0 +1,280 @@
+# injectors.py
+# Keystroke injection backends for the Spotlight servers.
+#
+# The servers used to call pyautogui directly, which needs a display and is slow per call.
+# Every backend here has the same small interface:
+#
+#   press(key, presses=1, interval=0.0)  - key names as pyautogui spells them ('right', 'f5', 'b', ...)
+#   move(dx, dy)                         - moves the mouse pointer by whole pixels (streamed pointer motion)
+#   close()
+#
+# and get_injector(name) picks one:
+#   pyautogui  - the original behaviour (Windows / macOS / X11)
+#   xdotool    - Linux X11, runs the xdotool binary (no Python dependencies)
+#   uinput     - Linux kernel uinput device via python-evdev (works without X, e.g. Wayland or a console)
+#   recording  - no real key presses; records each press with a timestamp in memory (and optionally
+#                to a JSON-lines file) so the whole client -> server -> injection path can run
+#                headless in CI and throughput benchmarks
+#
+# LazyInjector opens a backend on a background thread, so importing pyautogui (hundreds of
+# milliseconds on Windows) does not hold up a server's start.
+
+import json
+import threading
+import time
+from collections import deque
+
+from spotlight_core.log import get_logger
+
+log = get_logger("injectors")
+
+
+class InjectorUnavailable(RuntimeError):
+    """Raised when a backend's library, binary or device is missing on this machine."""
+
+
+class PyAutoGuiInjector:
+    name = "pyautogui"
+
+    def __init__(self, pause=None):
+        try:
+            import pyautogui
+        except ImportError as e:
+            raise InjectorUnavailable(f"pyautogui is not installed (pip install pyautogui): {e}")
+        except Exception as e:  # e.g. no display on Linux; pyautogui raises various errors on import
+            raise InjectorUnavailable(f"pyautogui could not be loaded: {e}")
+        self._pyautogui = pyautogui
+        if pause is not None:
+            pyautogui.PAUSE = pause  # pyautogui sleeps this long after every call (default 0.1 s)
+
+    def press(self, key, presses=1, interval=0.0):
+        self._pyautogui.press(key, presses=presses, interval=interval)
+
+    def move(self, dx, dy):
+        self._pyautogui.moveRel(dx, dy, _pause=False)  # No PAUSE: motion arrives every tick
+
+    def close(self):
+        pass
+
+
+# pyautogui key names -> X keysyms used by xdotool (names not listed are passed through)
+XDOTOOL_KEYS = {
+    "right": "Right", "left": "Left", "up": "Up", "down": "Down",
+    "esc": "Escape", "escape": "Escape", "enter": "Return", "return": "Return", "space": "space",
+    "pageup": "Prior", "pgup": "Prior", "pagedown": "Next", "pgdn": "Next",
+    "home": "Home", "end": "End", "tab": "Tab", "backspace": "BackSpace",
+    **{f"f{n}": f"F{n}" for n in range(1, 13)},
+}
+
+
+class XdotoolInjector:
+    name = "xdotool"
+
+    def __init__(self, binary="xdotool"):
+        import shutil
+        import subprocess  # Only this backend needs it; the servers import this module at start
+
+        self._run = subprocess.run
+        self.binary = shutil.which(binary)
+        if not self.binary:
+            raise InjectorUnavailable("xdotool was not found on PATH (e.g. apt install xdotool)")
+
+    def press(self, key, presses=1, interval=0.0):
+        keysym = XDOTOOL_KEYS.get(key, key)
+        # One process for the whole multi-press; --delay is in milliseconds
+        command = [self.binary, "key", "--delay", str(int(interval * 1000))] + [keysym] * presses
+        result = self._run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"xdotool failed: {result.stderr.strip() or result.returncode}")
+
+    def move(self, dx, dy):
+        result = self._run([self.binary, "mousemove_relative", "--", str(dx), str(dy)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"xdotool failed: {result.stderr.strip() or result.returncode}")
+
+    def close(self):
+        pass
+
+
+# pyautogui key names -> Linux input event codes (names not listed map to KEY_<NAME>)
+UINPUT_KEYS = {
+    "esc": "KEY_ESC", "escape": "KEY_ESC", "return": "KEY_ENTER", "pgup": "KEY_PAGEUP", "pgdn": "KEY_PAGEDOWN",
+}
+
+
+class UinputInjector:
+    name = "uinput"
+
+    def __init__(self):
+        try:
+            from evdev import UInput, ecodes
+        except ImportError as e:
+            raise InjectorUnavailable(f"python-evdev is not installed (pip install evdev): {e}")
+        self._ecodes = ecodes
+        # Register every key we may send so the virtual keyboard advertises them, plus relative
+        # X/Y axes for pointer motion
+        try:
+            self._device = UInput({ecodes.EV_KEY: list(ecodes.keys), ecodes.EV_REL: [ecodes.REL_X, ecodes.REL_Y]},
+                                  name="spotlight-injector")
+        except Exception as e:  # Usually permissions on /dev/uinput
+            raise InjectorUnavailable(f"could not open /dev/uinput (check permissions): {e}")
+        self._codes = {}
+
+    def _code(self, key):
+        code = self._codes.get(key)
+        if code is None:
+            name = UINPUT_KEYS.get(key, f"KEY_{key.upper()}")
+            code = self._ecodes.ecodes.get(name)
+            if code is None:
+                raise KeyError(f"no uinput key code for '{key}'")
+            self._codes[key] = code
+        return code
+
+    def press(self, key, presses=1, interval=0.0):
+        code = self._code(key)
+        for i in range(presses):
+            if i and interval:
+                time.sleep(interval)
+            self._device.write(self._ecodes.EV_KEY, code, 1)
+            self._device.write(self._ecodes.EV_KEY, code, 0)
+            self._device.syn()
+
+    def move(self, dx, dy):
+        self._device.write(self._ecodes.EV_REL, self._ecodes.REL_X, dx)
+        self._device.write(self._ecodes.EV_REL, self._ecodes.REL_Y, dy)
+        self._device.syn()
+
+    def close(self):
+        self._device.close()
+
+
+class RecordingInjector:
+    """
+    Presses nothing; remembers (time.perf_counter(), key, presses) for every call. Pointer
+    motion is only added up in `moved`. `delay` simulates the per-call cost of a real backend in benchmarks.
+    """
+    name = "recording"
+
+    def __init__(self, log_path=None, delay=0.0, max_events=100000):
+        self.delay = delay
+        self.events = deque(maxlen=max_events)
+        self.calls = 0
+        self.presses = 0
+        self.moves = 0
+        self.moved = (0, 0)  # Sum of all move() deltas
+        self._log_file = open(log_path, "a", encoding="utf-8", buffering=1) if log_path else None  # Line buffered
+        self._lock = threading.Lock()
+
+    def press(self, key, presses=1, interval=0.0):
+        if self.delay:
+            time.sleep(self.delay)
+        now = time.perf_counter()
+        with self._lock:
+            self.events.append((now, key, presses))
+            self.calls += 1
+            self.presses += presses
+            if self._log_file:
+                self._log_file.write(json.dumps({"t": now, "key": key, "presses": presses}) + "\n")
+
+    def move(self, dx, dy):
+        now = time.perf_counter()
+        with self._lock:
+            self.moves += 1
+            self.moved = (self.moved[0] + dx, self.moved[1] + dy)
+            if self._log_file:
+                self._log_file.write(json.dumps({"t": now, "move": [dx, dy]}) + "\n")
+
+    def stats(self):
+        return {"calls": self.calls, "presses": self.presses, "moves": self.moves}
+
+    def close(self):
+        if self._log_file:
+            self._log_file.close()
+            self._log_file = None
+
+
+INJECTORS = {
+    "pyautogui": PyAutoGuiInjector,
+    "xdotool": XdotoolInjector,
+    "uinput": UinputInjector,
+    "recording": RecordingInjector,
+}
+
+
+def get_injector(name, pause=None, record_path=None):
+    """
+    Creates the named backend. `pause` is pyautogui's per-call pause; `record_path` is the
+    recording backend's optional JSON-lines log. Raises InjectorUnavailable if the backend
+    cannot run on this machine and ValueError if the name is unknown.
+    """
+    if name not in INJECTORS:
+        raise ValueError(f"Unknown injector backend {name!r}; expected one of {sorted(INJECTORS)}")
+    if name == "pyautogui":
+        injector = PyAutoGuiInjector(pause)
+    elif name == "recording":
+        injector = RecordingInjector(record_path)
+    else:
+        injector = INJECTORS[name]()
+    log.info("[INJECTION] Using '%s' input backend", injector.name)
+    return injector
+
+
+class LazyInjector:
+    """
+    get_injector() on a background thread, started by load(). press() and move() wait until the
+    backend is open and raise InjectorUnavailable if it could not be. on_error(exception) is
+    called on the loading thread if opening fails.
+    """
+
+    def __init__(self, name, pause=None, record_path=None, on_error=None):
+        if name not in INJECTORS:
+            raise ValueError(f"Unknown injector backend {name!r}; expected one of {sorted(INJECTORS)}")
+        self.name = name
+        self.pause = pause
+        self.record_path = record_path
+        self.on_error = on_error
+        self.error = None
+        self._injector = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Starts opening the backend. Returns at once."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._load, name="injector-load", daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout=None):
+        """The opened backend, or None if it is still loading after timeout seconds."""
+        self.load()
+        if not self._ready.wait(timeout):
+            return None
+        if self.error is not None:
+            raise InjectorUnavailable(str(self.error))
+        return self._injector
+
+    def press(self, key, presses=1, interval=0.0):
+        self.wait().press(key, presses, interval)
+
+    def move(self, dx, dy):
+        self.wait().move(dx, dy)
+
+    def close(self):
+        if self._injector is not None:
+            self._injector.close()
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            self._injector = get_injector(self.name, pause=self.pause, record_path=self.record_path)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._ready.set()
+        if self.error is not None:
+            log.error("[INJECTION] Input backend '%s' is not usable: %s", self.name, self.error)
+            if self.on_error is not None:
+                self.on_error(self.error)
+        else:
+            log.debug("[INJECTION] '%s' backend opened in %.0f ms", self.name, (time.perf_counter() - started) * 1000)
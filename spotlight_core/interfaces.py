@@ -0,0 +1,180 @@
+# interfaces.py
+# Local IPv4 interfaces, for choosing the address a discovery response advertises.
+#
+# The servers used to pick one IP at startup by "connecting" a UDP socket to 8.8.8.8, with
+# gethostbyname() and a getaddrinfo() scan as fallbacks. That depends on an internet route
+# (slow or wrong offline). On a presenter PC with Wi-Fi + Ethernet + VPN it often picked a NIC
+# the client is not on, and it never changed afterwards. Now every discovery response carries
+# the address of the interface facing that requester:
+#   1. the local interface whose subnet contains the requester's IP,
+#   2. else the source address the OS would use to reach the requester (a UDP connect(),
+#      which sends nothing): the interface the response leaves through,
+#   3. else the first non-loopback address.
+# Interfaces come from psutil when it is installed, else from ioctls on Linux, else from the
+# host name's addresses (without netmasks). The list is re-read at most every REFRESH_INTERVAL
+# seconds when it is used, so a plugged-in cable or a new Wi-Fi network is picked up.
+
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from spotlight_core.log import get_logger
+
+log = get_logger("interfaces")
+
+REFRESH_INTERVAL = 5.0  # Seconds before the interface list is re-read
+
+Interface = namedtuple("Interface", "name ip netmask")  # netmask is None when the source doesn't report it
+
+# Linux ioctl request numbers (from <linux/sockios.h>)
+_SIOCGIFADDR = 0x8915
+_SIOCGIFNETMASK = 0x891B
+
+
+def _ip_to_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def _from_psutil():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return [Interface(name, addr.address, addr.netmask)
+            for name, addrs in psutil.net_if_addrs().items()
+            for addr in addrs if addr.family == socket.AF_INET]
+
+
+def _from_ioctl():
+    if not sys.platform.startswith("linux"):
+        return None
+    import fcntl
+    interfaces = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            request = struct.pack("256s", name.encode()[:15])
+            try:
+                ip = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), _SIOCGIFADDR, request)[20:24])
+                netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), _SIOCGIFNETMASK, request)[20:24])
+            except OSError:  # Interface without an IPv4 address
+                continue
+            interfaces.append(Interface(name, ip, netmask))
+    finally:
+        sock.close()
+    return interfaces
+
+
+def _from_hostname():
+    interfaces = [Interface("lo", "127.0.0.1", "255.0.0.0")]
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)}
+    except OSError:
+        addresses = set()
+    interfaces.extend(Interface("?", ip, None) for ip in sorted(addresses) if not ip.startswith("127."))
+    return interfaces
+
+
+def list_interfaces():
+    """The machine's IPv4 interfaces as Interface(name, ip, netmask) tuples."""
+    for source in (_from_psutil, _from_ioctl):
+        try:
+            interfaces = source()
+        except OSError as e:
+            log.debug("[INTERFACES] %s failed: %s", source.__name__, e)
+            continue
+        if interfaces:
+            return interfaces
+    return _from_hostname()
+
+
+def route_address(peer_ip):
+    """The local address the OS would send from to reach peer_ip, or None. No packet is sent."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((peer_ip, 9))  # Any port; UDP connect only looks up the route
+        ip = sock.getsockname()[0]
+        return ip if ip != "0.0.0.0" else None
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def _usable(interface):
+    return not interface.ip.startswith("127.") and not interface.ip.startswith("169.254.")
+
+
+class InterfaceTable:
+    """The interface list, re-read when older than refresh_interval. Thread-safe."""
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._interfaces = []
+        self._loaded_at = None
+
+    def interfaces(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_interval:
+                self._refresh_locked()
+            return list(self._interfaces)
+
+    def _refresh_locked(self):
+        interfaces = list_interfaces()
+        if self._loaded_at is not None and set(interfaces) != set(self._interfaces):
+            log.info("[INTERFACES] Network interfaces changed: %s", describe(interfaces))
+        self._interfaces = interfaces
+        self._loaded_at = time.monotonic()
+
+    def address_for(self, peer_ip):
+        """The local address a peer at peer_ip should be told to connect to."""
+        if peer_ip.startswith("127."):
+            return "127.0.0.1"
+        interfaces = self.interfaces()
+        try:
+            peer = _ip_to_int(peer_ip)
+        except OSError:
+            peer = None
+        if peer is not None:
+            for interface in interfaces:
+                if interface.netmask and _usable(interface):
+                    mask = _ip_to_int(interface.netmask)
+                    if _ip_to_int(interface.ip) & mask == peer & mask:
+                        return interface.ip
+        return route_address(peer_ip) or self.primary_address()
+
+    def primary_address(self):
+        """First non-loopback, non-link-local address (127.0.0.1 if there is none)."""
+        for interface in self.interfaces():
+            if _usable(interface):
+                return interface.ip
+        return "127.0.0.1"
+
+
+def describe(interfaces):
+    """e.g. "eth0 192.168.1.20/255.255.255.0, wlan0 10.0.0.7/255.255.0.0" for log messages."""
+    text = ", ".join(f"{i.name} {i.ip}/{i.netmask or '?'}" for i in interfaces if not i.ip.startswith("127."))
+    return text or "no network interfaces"
+
+
+_default_table = InterfaceTable()
+
+
+def address_for_peer(peer_ip):
+    """The address of the local interface facing peer_ip (see the module comment)."""
+    return _default_table.address_for(peer_ip)
+
+
+def describe_local_interfaces():
+    return describe(_default_table.interfaces())
+
+
+def describe_advertised_ip(advertised_ip):
+    """Startup message text for a server's ADVERTISED_IP setting."""
+    if advertised_ip:
+        return advertised_ip
+    return f"the address of the interface facing each client ({describe_local_interfaces()})"
@@ -0,0 +1,255 @@
+# keymap.py
+# External keymaps, compiled ahead and swapped in while running.
+#
+# Which remote key sends which command (client side) and which key each command presses
+# (server side) used to be dicts written into every script, so supporting another remote meant
+# editing the script and restarting it, which dropped the connection. A keymap file now holds
+# them per device profile:
+#
+#   {
+#     "profile": "logitech-spotlight",
+#     "profiles": {
+#       "logitech-spotlight": {
+#         "keys": {"right": "NEXT", "left": "PREVIOUS", "f5": "START_PRESENTATION", "b": "BLACK_SCREEN"},
+#         "commands": {"NEXT": "right", "PREVIOUS": "left", "START_PRESENTATION": "f5", "BLACK_SCREEN": "b"}
+#       },
+#       "generic-clicker": {
+#         "extends": "logitech-spotlight",
+#         "keys": {"PageDown": "NEXT", "PageUp": "PREVIOUS", "b": null}
+#       }
+#     }
+#   }
+#
+# "profile" is the one used unless the script names another. "keys" (client) maps key names to
+# commands and "commands" (server) maps commands to the key to press; a profile may extend
+# another and override entries, or drop them with null. Loading a profile resolves "extends",
+# normalizes the key names (normalize_key: "PageDown" and "pgdn" are pynput's "page_down") and
+# checks every entry, then compiles flat dicts keyed exactly as they are looked up: by
+# keys.key_name() on the client, by command name on the server.
+#
+# KeymapWatcher polls the file and does all of that on its own thread. A script swaps the new
+# dicts in with one assignment each, so a key press still costs a single dict lookup, and a
+# remap takes effect on the next key press without reconnecting. A file that does not load
+# (e.g. half-saved) is reported and the keymap in use stays.
+
+import json
+import os
+import threading
+
+from spotlight_core.log import get_logger
+
+log = get_logger("keymap")
+
+RELOAD_INTERVAL = 1.0  # Seconds between checks of the keymap file for changes
+
+# Other spellings of pynput's keyboard.Key names, as people write them in a keymap
+KEY_ALIASES = {
+    "pagedown": "page_down", "pgdn": "page_down", "next": "page_down",
+    "pageup": "page_up", "pgup": "page_up", "prior": "page_up",
+    "escape": "esc", "return": "enter", "spacebar": "space", "del": "delete", "ins": "insert",
+    "arrow_right": "right", "arrowright": "right",
+    "arrow_left": "left", "arrowleft": "left",
+    "arrow_up": "up", "arrowup": "up",
+    "arrow_down": "down", "arrowdown": "down",
+    "control": "ctrl", "win": "cmd", "super": "cmd",
+    "volumeup": "media_volume_up", "volumedown": "media_volume_down", "volumemute": "media_volume_mute",
+    "playpause": "media_play_pause", "nexttrack": "media_next", "prevtrack": "media_previous",
+}
+
+
+class KeymapError(ValueError):
+    """A keymap file or profile that cannot be used; the message says which entry and why."""
+
+
+class Keymap:
+    """
+    One compiled profile: keys ({key name: command}, the client's dispatch table) and commands
+    ({command: key}, what the server presses). Both are plain dicts, never changed after compile.
+    """
+    __slots__ = ("profile", "keys", "commands", "source")
+
+    def __init__(self, profile, keys, commands, source=None):
+        self.profile = profile
+        self.keys = keys
+        self.commands = commands
+        self.source = source
+
+    def __repr__(self):
+        return f"Keymap({self.profile!r}, {len(self.keys)} keys, {len(self.commands)} commands)"
+
+
+def normalize_key(name):
+    """
+    The name keys.key_name() gives for the key written as `name`: single characters as they
+    are ('b', 'B'), '<vk>' codes as they are, other names lower case with aliases resolved
+    ('PageDown' -> 'page_down', 'Escape' -> 'esc').
+    """
+    if not isinstance(name, str) or not name.strip():
+        raise KeymapError(f"key {name!r}: expected a key name")
+    if len(name) == 1 or (name.startswith("<") and name.endswith(">")):
+        return name
+    name = name.strip().lower().replace("-", "_").replace(" ", "_")
+    return KEY_ALIASES.get(name, name)
+
+
+def _check_command(command, where):
+    if not isinstance(command, str) or not command.strip() or command != command.strip():
+        raise KeymapError(f"{where}: {command!r} is not a command name")
+    return command
+
+
+def compile_keys(mapping, where="keys"):
+    """{key name: command} with the key names normalized. None values drop the key."""
+    if not isinstance(mapping, dict):
+        raise KeymapError(f"{where}: expected an object of key name -> command")
+    table = {}
+    for name, command in mapping.items():
+        key = normalize_key(name)
+        if command is None:
+            table.pop(key, None)
+            continue
+        table[key] = _check_command(command, f"{where}: key {name!r}")
+    return table
+
+
+def compile_commands(mapping, where="commands"):
+    """{command: key to press}, checked. None values drop the command."""
+    if not isinstance(mapping, dict):
+        raise KeymapError(f"{where}: expected an object of command -> key name")
+    table = {}
+    for command, key in mapping.items():
+        _check_command(command, where)
+        if key is None:
+            table.pop(command, None)
+            continue
+        if not isinstance(key, str) or not key.strip():
+            raise KeymapError(f"{where}: command {command!r}: {key!r} is not a key name")
+        table[command] = key.strip()
+    return table
+
+
+def compile_profile(data, profile=None, base_keys=None, base_commands=None, source=None):
+    """
+    Compiles one profile of a parsed keymap document into a Keymap. profile=None takes the
+    document's "profile". A section the profile chain does not define at all falls back to
+    base_keys / base_commands (the script's built-in mappings).
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("profiles"), dict):
+        raise KeymapError('expected an object with "profiles"')
+    profiles = data["profiles"]
+    name = profile or data.get("profile")
+    if not name:
+        raise KeymapError(f'no profile selected (set "profile"; available: {sorted(profiles)})')
+
+    chain = []  # The profile and the ones it extends, the base first
+    while name is not None:
+        if name in chain:
+            raise KeymapError(f"profile {name!r} extends itself")
+        entry = profiles.get(name)
+        if not isinstance(entry, dict):
+            raise KeymapError(f"unknown profile {name!r}; available: {sorted(profiles)}")
+        chain.insert(0, name)
+        name = entry.get("extends")
+
+    keys = commands = None
+    for name in chain:
+        entry = profiles[name]
+        unknown = set(entry) - {"extends", "keys", "commands", "description"}
+        if unknown:
+            raise KeymapError(f"profile {name!r}: unknown entries {sorted(unknown)}")
+        if "keys" in entry:
+            keys = dict(keys or {})
+            keys.update(compile_keys(entry["keys"], f"profile {name!r} keys"))
+            for key, command in entry["keys"].items():  # null also removes an inherited key
+                if command is None:
+                    keys.pop(normalize_key(key), None)
+        if "commands" in entry:
+            commands = dict(commands or {})
+            commands.update(compile_commands(entry["commands"], f"profile {name!r} commands"))
+            for command, key in entry["commands"].items():
+                if key is None:
+                    commands.pop(command, None)
+    if keys is None:
+        keys = compile_keys(base_keys or {}, "built-in keys")
+    if commands is None:
+        commands = compile_commands(base_commands or {}, "built-in commands")
+    return Keymap(chain[-1], keys, commands, source)
+
+
+def load_keymap(path, profile=None, base_keys=None, base_commands=None):
+    """Reads and compiles a keymap file. Raises KeymapError."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise KeymapError(f"could not read keymap {path}: {e}")
+    try:
+        return compile_profile(data, profile, base_keys, base_commands, source=path)
+    except KeymapError as e:
+        raise KeymapError(f"keymap {path}: {e}")
+
+
+class KeymapWatcher:
+    """
+    Reloads a keymap file when it changes and hands each compiled Keymap to on_load(keymap),
+    on the watcher's own thread. Changes are found by polling the file's size and modification
+    time every `interval` seconds. A version that does not compile is logged and skipped.
+    """
+
+    def __init__(self, path, on_load, profile=None, base_keys=None, base_commands=None,
+                 interval=RELOAD_INTERVAL, tag="[KEYMAP]"):
+        self.path = path
+        self.on_load = on_load
+        self.profile = profile
+        self.base_keys = base_keys
+        self.base_commands = base_commands
+        self.interval = interval
+        self.tag = tag
+        self.reloads = 0
+        self.failures = 0
+        self._signature = self._stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Loads the file now, on the calling thread; for the first load at start. Raises KeymapError."""
+        self._signature = self._stat()
+        return load_keymap(self.path, self.profile, self.base_keys, self.base_commands)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="keymap-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        return {"reloads": self.reloads, "failures": self.failures}
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                keymap = load_keymap(self.path, self.profile, self.base_keys, self.base_commands)
+            except KeymapError as e:
+                self.failures += 1
+                log.error("%s %s; keeping the current keymap", self.tag, e)
+                continue
+            try:
+                self.on_load(keymap)
+            except Exception as e:
+                self.failures += 1
+                log.error("%s Could not apply %s from %s: %s", self.tag, keymap, self.path, e)
+                continue
+            self.reloads += 1
+            log.info("%s Reloaded %s from %s", self.tag, keymap, self.path)
@@ -0,0 +1,65 @@
+# keys.py
+# Key capture backend for the Spotlight clients, loaded lazily.
+#
+# The clients used to import pynput before anything else. It hooks into the platform's input
+# system and takes hundreds of milliseconds to import on Windows, so the search for the server
+# waited for it. Key mappings are now spelled as key names ("right", "f5", "b"), pynput is
+# imported on a background thread (preload_pynput()) while the client looks for its server,
+# and load_pynput() only waits for that import to finish.
+
+import threading
+
+_lock = threading.Lock()
+_thread = None  # Thread importing pynput
+_pynput = None
+_error = None
+
+
+class CaptureUnavailable(RuntimeError):
+    """Raised when pynput is missing or cannot be loaded on this machine."""
+
+
+def key_name(key):
+    """
+    The name a pynput key is mapped by: the character for character keys ('b', 'B'), the
+    keyboard.Key name for special keys ('right', 'f5', 'esc'), and '<vk>' for keys that have
+    neither (pynput's own spelling of them).
+    """
+    char = getattr(key, "char", None)
+    if char:
+        return char
+    name = getattr(key, "name", None)
+    if name:
+        return name
+    vk = getattr(key, "vk", None)
+    return f"<{vk}>" if vk is not None else str(key)
+
+
+def preload_pynput():
+    """Starts importing pynput on a background thread. Returns at once; calling it again does nothing."""
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_import, name="pynput-import", daemon=True)
+            _thread.start()
+
+
+def load_pynput():
+    """The pynput package with its keyboard and mouse modules. Raises CaptureUnavailable."""
+    preload_pynput()
+    _thread.join()
+    if _error is not None:
+        raise CaptureUnavailable(_error)
+    return _pynput
+
+
+def _import():
+    global _pynput, _error
+    try:
+        import pynput.keyboard
+        import pynput.mouse
+        _pynput = pynput
+    except ImportError as e:
+        _error = f"pynput is not installed (pip install pynput): {e}"
+    except Exception as e:  # e.g. no display on Linux; pynput picks its backend on import
+        _error = f"pynput could not be loaded: {e}"
@@ -0,0 +1,136 @@
+# log.py
+# Logging for the Spotlight servers and clients.
+#
+# Console writes are slow (milliseconds per line on some Windows consoles), and every command
+# used to print several lines on both sides. Now the code logs through the standard logging
+# module instead:
+#   - the calling thread only fills in the message and puts the record on a queue
+#     (QueueHandler); a background QueueListener thread does the actual writing,
+#   - per-command messages are DEBUG, so at the default INFO level the command path writes nothing,
+#   - repeated warnings/errors are rate-limited so a failing key press can't flood the console,
+#   - an optional JSON-lines event log records everything (DEBUG and up) for full traces.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+ROOT_LOGGER = "spotlight"
+RATE_LIMIT_INTERVAL = 10.0  # Seconds during which repeats of the same warning/error are suppressed
+
+_listener = None
+
+
+def get_logger(name):
+    """Returns a logger below the shared "spotlight" logger, e.g. get_logger("server")."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets the first WARNING-or-worse record with a given message template through, then
+    suppresses repeats for `interval` seconds. The next one that gets through says how
+    many were suppressed. Records below WARNING always pass.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._seen = {}  # (logger, level, template) -> [last emitted time, suppressed count]
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.interval <= 0:
+            return True
+        key = (record.name, record.levelno, getattr(record, "template", record.msg))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry else 0
+            self._seen[key] = [now, 0]
+        if suppressed:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar message(s))"
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps the unformatted message template for RateLimitFilter."""
+
+    def prepare(self, record):
+        template = record.msg
+        record = super().prepare(record)  # Formats the message on the calling thread
+        record.template = template
+        return record
+
+
+class JsonLinesHandler(logging.FileHandler):
+    """Writes one JSON object per record: time, level, logger, message and any `event` extras."""
+
+    def __init__(self, path):
+        super().__init__(path, mode="a", encoding="utf-8", delay=True)
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        event = getattr(record, "event", None)  # log.debug(..., extra={"event": {...}})
+        if event:
+            entry["event"] = event
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level="INFO", event_log_path=None, rate_limit_interval=RATE_LIMIT_INTERVAL):
+    """
+    Routes all "spotlight.*" loggers through a background writer thread.
+
+    level          - console level ("DEBUG" shows every command, "INFO" only connection events)
+    event_log_path - optional JSON-lines file that receives every record, DEBUG included
+    Safe to call again (e.g. after changing settings); the previous listener is stopped first.
+    """
+    global _listener
+    shutdown_logging()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(level.upper() if isinstance(level, str) else level)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    console.addFilter(RateLimitFilter(rate_limit_interval))
+    handlers = [console]
+    if event_log_path:
+        handlers.append(JsonLinesHandler(event_log_path))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger(ROOT_LOGGER)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    # Only build records the handlers can use: the console level, or everything for the event log
+    root.setLevel(logging.DEBUG if event_log_path else console.level)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """Flushes and stops the background writer (registered with atexit)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,198 @@
+# metrics.py
+# Latency instrumentation for the command path, exportable as JSON or Prometheus text.
+#
+# Stages recorded (all in seconds, time.perf_counter() based):
+#   client: queue_wait       - key callback until the sender thread picks the press up
+#           capture_to_send  - key callback until the frame is written to the socket
+#           round_trip       - frame written until its ACK arrives
+#           network          - round_trip minus the time the server reported spending on it
+#           end_to_end       - key callback until the key press is injected on the server
+#                              (estimated as capture_to_send + network / 2 + server time)
+#           target_rtt       - fan-out: round trip to each server (labelled with the server)
+#           fanout_skew      - fan-out: first to last server starting the same command
+#   server: server_queue     - frame received until its action starts running
+#           injection        - action start until pyautogui.press() (or the backend) returns
+#           server_total     - frame received until the ACK is ready
+# Each stage is tracked per command (NEXT, PREVIOUS, ...).
+
+import json
+import threading
+import time
+from collections import deque
+
+from spotlight_core.log import get_logger
+
+log = get_logger("metrics")
+
+# Histogram bucket upper bounds in seconds (Prometheus "le" labels)
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+RESERVOIR_SIZE = 4096  # Most recent samples kept per series for percentiles
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def prometheus_label(value):
+    """Escapes a label value for the Prometheus text format (backslash, double quote, newline)."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class LatencyHistogram:
+    """Bucketed counts for Prometheus plus a reservoir of recent samples for p50/p95/p99."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.samples.append(seconds)
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    def quantile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max if self.count else None,
+        }
+
+
+class LatencyRecorder:
+    """Thread-safe collection of per-stage, per-command latency histograms for one side (client/server)."""
+
+    def __init__(self, side):
+        self.side = side
+        self._lock = threading.Lock()
+        self._series = {}  # (stage, command) -> LatencyHistogram
+        self._gauge_sources = []  # (prefix, callable returning {name: number})
+
+    def observe(self, stage, command, seconds):
+        if seconds < 0:
+            return  # Clock hiccup or a stage that did not happen
+        with self._lock:
+            histogram = self._series.get((stage, command))
+            if histogram is None:
+                histogram = self._series[(stage, command)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def add_gauge_source(self, prefix, source):
+        """Registers a callable whose dict of numbers is exported alongside the histograms (e.g. queue stats)."""
+        self._gauge_sources.append((prefix, source))
+
+    def _gauges(self):
+        gauges = {}
+        for prefix, source in self._gauge_sources:
+            try:
+                values = source()
+            except Exception:
+                continue
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[f"{prefix}_{name}"] = value
+        return gauges
+
+    def snapshot(self):
+        """Returns {"side": ..., "stages": {stage: {command: summary}}, "gauges": {...}}."""
+        with self._lock:
+            stages = {}
+            for (stage, command), histogram in sorted(self._series.items()):
+                stages.setdefault(stage, {})[command] = histogram.summary()
+        return {"side": self.side, "timestamp": time.time(), "stages": stages, "gauges": self._gauges()}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="spotlight"):
+        """Prometheus text exposition format (histograms + p50/p95/p99 gauges)."""
+        name = f"{prefix}_latency_seconds"
+        lines = [
+            f"# HELP {name} Command path latency per stage and command.",
+            f"# TYPE {name} histogram",
+        ]
+        quantile_lines = []
+        with self._lock:
+            series = sorted(self._series.items())
+            for (stage, command), histogram in series:
+                labels = (f'side="{prometheus_label(self.side)}",stage="{prometheus_label(stage)}",'
+                          f'command="{prometheus_label(command)}"')
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, histogram.buckets):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.total:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+                for q in QUANTILES:
+                    value = histogram.quantile(q)
+                    if value is not None:
+                        quantile_lines.append(f'{prefix}_latency_quantile_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+        if quantile_lines:
+            lines.append(f"# HELP {prefix}_latency_quantile_seconds Recent-sample latency percentiles.")
+            lines.append(f"# TYPE {prefix}_latency_quantile_seconds gauge")
+            lines.extend(quantile_lines)
+        for gauge, value in sorted(self._gauges().items()):
+            lines.append(f"# TYPE {prefix}_{gauge} gauge")
+            lines.append(f'{prefix}_{gauge}{{side="{prometheus_label(self.side)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the metrics to path: Prometheus text for .prom/.txt files, JSON otherwise."""
+        text = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+def now_us():
+    """Current time.perf_counter() in integer microseconds, as carried in command frames."""
+    return int(time.perf_counter() * 1_000_000)
+
+
+def record_reply(recorder, command, reply, received_at, captured_at=None):
+    """
+    Client side: records the stages of one acknowledged command from its protocol.Reply.
+    received_at is perf_counter() when the ACK arrived; captured_at when the key callback ran.
+    Needs the server to echo the send timestamp (binary protocol); does nothing otherwise.
+    """
+    if recorder is None or not reply.ok or not reply.sent_us:
+        return
+    sent_at = reply.sent_us / 1_000_000
+    round_trip = received_at - sent_at
+    server_time = (reply.server_queue_us + reply.injection_us) / 1_000_000
+    network = max(0.0, round_trip - server_time)
+    recorder.observe("round_trip", command, round_trip)
+    recorder.observe("network", command, network)
+    if captured_at is not None:
+        recorder.observe("capture_to_send", command, sent_at - captured_at)
+        recorder.observe("end_to_end", command, (sent_at - captured_at) + network / 2 + server_time)
+
+
+def start_periodic_export(recorder, path, interval=30):
+    """Rewrites the metrics file every `interval` seconds on a daemon thread. Returns the thread."""
+
+    def export_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                recorder.write(path)
+            except OSError as e:
+                log.warning("[METRICS] Could not write metrics to %s: %s", path, e)
+
+    thread = threading.Thread(target=export_loop, name="metrics-export", daemon=True)
+    thread.start()
+    return thread
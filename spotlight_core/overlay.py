@@ -0,0 +1,186 @@
+# overlay.py
+# Virtual spotlight for the Spotlight servers.
+#
+# LASER_ON / LASER_OFF used to be placeholders that only printed. SpotlightOverlay is a
+# borderless, always-on-top window covering the screen: a semi-transparent dark layer with a
+# clear circle that follows the pointer positions streamed by the client (protocol.OP_POINTER),
+# or is pushed around by relative motion (protocol.OP_MOTION, see move_by()).
+#
+# Drawing cost stays flat however fast positions arrive:
+#   - move() only stores the newest position; the Tk thread picks it up at most refresh_hz
+#     times a second and does nothing at all when it has not changed.
+#   - The circle is a single canvas item moved with coords(). The Tk canvas then repaints only
+#     the union of the item's old and new bounding boxes, not the whole screen.
+# With a smoothing.PointerSmoother the positions go through it, and the Tk thread asks it where
+# to draw on every tick, so the spotlight glides on between (jittery) network samples.
+#
+# The clear circle uses the window manager's colour-key transparency: -transparentcolor on
+# Windows and "systemTransparent" on macOS. X11 has neither, so there the circle is drawn as
+# a bright ring on the dimmed screen. The window never takes the keyboard focus (on Windows it
+# is also click-through), so injected key presses still reach the presentation.
+#
+# Needs tkinter and a display; start() raises OverlayUnavailable otherwise.
+
+import sys
+import threading
+
+from spotlight_core.log import get_logger
+
+log = get_logger("overlay")
+
+RADIUS = 150  # Pixels
+DIM = 0.6  # Opacity of the dimmed area: 0 = invisible, 1 = black
+REFRESH_HZ = 60  # Highest redraw rate; match the display's refresh rate
+RING_COLOR = "#ffffff"
+_HOLE_COLOR = "#ff00fe"  # Colour key made transparent on Windows; never drawn anywhere else
+
+# Windows extended window styles
+_GWL_EXSTYLE = -20
+_WS_EX_LAYERED = 0x00080000
+_WS_EX_TRANSPARENT = 0x00000020  # Mouse clicks go through to the window below
+_WS_EX_TOOLWINDOW = 0x00000080  # No taskbar button
+_WS_EX_NOACTIVATE = 0x08000000  # Never becomes the foreground window
+
+
+class OverlayUnavailable(RuntimeError):
+    """Raised when tkinter or a display is missing on this machine."""
+
+
+class SpotlightOverlay:
+    """
+    The spotlight window, run by its own Tk thread. show(), hide(), toggle() and move() may be
+    called from any thread; move() takes x and y as fractions (0.0-1.0) of the screen size,
+    move_by() a relative motion in pixels.
+    """
+
+    def __init__(self, radius=RADIUS, dim=DIM, refresh_hz=REFRESH_HZ, smoother=None):
+        self.radius = radius
+        self.dim = dim
+        self.refresh_hz = refresh_hz
+        self.smoother = smoother
+        self.visible = False
+        self._target = (0.5, 0.5)  # Replaced as a whole, so readers never see half an update
+        self._target_lock = threading.Lock()  # For move_by(), which reads and replaces it
+        self._size = None  # (width, height) in pixels, once the window exists
+        self._moves = 0
+        self._redraws = 0
+        self._stopped = False
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = None
+
+    def start(self, timeout=5.0):
+        """Creates the window (hidden). Raises OverlayUnavailable if it cannot be shown here."""
+        self._thread = threading.Thread(target=self._run, name="spotlight-overlay", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise OverlayUnavailable("the overlay window did not come up")
+        if self._error is not None:
+            raise OverlayUnavailable(str(self._error))
+        log.info("[SPOTLIGHT] Overlay ready (radius %s px, redraws up to %s Hz)", self.radius, self.refresh_hz)
+
+    def stop(self):
+        self._stopped = True
+
+    def show(self):
+        self.visible = True
+
+    def hide(self):
+        self.visible = False
+
+    def toggle(self):
+        self.visible = not self.visible
+
+    def move(self, x, y, sampled_at=None):
+        self._target = (x, y)
+        if self.smoother is not None:
+            self.smoother.update(x, y, sampled_at)
+        self._moves += 1
+
+    def move_by(self, dx, dy):
+        size = self._size
+        if size is None:
+            return
+        with self._target_lock:
+            x, y = self._target
+            self.move(min(max(x + dx / size[0], 0.0), 1.0), min(max(y + dy / size[1], 0.0), 1.0))
+
+    def stats(self):
+        """Positions received and redraws done, for the metrics gauges."""
+        return {"moves": self._moves, "redraws": self._redraws, "visible": int(self.visible)}
+
+    def _run(self):
+        try:
+            import tkinter
+            root = tkinter.Tk()
+        except Exception as e:  # ImportError, or TclError when there is no display
+            self._error = e
+            self._ready.set()
+            return
+        width, height = root.winfo_screenwidth(), root.winfo_screenheight()
+        self._size = (width, height)
+        root.overrideredirect(True)
+        root.geometry(f"{width}x{height}+0+0")
+        root.attributes("-topmost", True)
+        hole = ""  # No fill: X11 shows a ring only
+        if sys.platform == "win32":
+            root.attributes("-transparentcolor", _HOLE_COLOR)
+            hole = _HOLE_COLOR
+        elif sys.platform == "darwin":
+            root.attributes("-transparent", True)
+            hole = "systemTransparent"
+        try:
+            root.attributes("-alpha", self.dim)
+        except tkinter.TclError:  # X11 without a compositing window manager
+            log.warning("[SPOTLIGHT] Window transparency is not supported here; the screen will not be dimmed.")
+        canvas = tkinter.Canvas(root, width=width, height=height, bg="black", highlightthickness=0)
+        canvas.pack(fill="both", expand=True)
+        circle = canvas.create_oval(0, 0, 0, 0, fill=hole, outline=RING_COLOR, width=3)
+        root.withdraw()
+        if sys.platform == "win32":
+            root.update_idletasks()
+            _make_click_through(root)
+
+        shown = False
+        drawn = None
+        period = max(1, int(1000 / self.refresh_hz))
+
+        def tick():
+            nonlocal shown, drawn
+            if self._stopped:
+                root.destroy()
+                return
+            if self.visible != shown:
+                shown = self.visible
+                if shown:
+                    root.deiconify()
+                    root.attributes("-topmost", True)
+                else:
+                    root.withdraw()
+            target = self._target
+            if shown and self.smoother is not None:
+                target = self.smoother.position() or target
+            center = (round(target[0] * width), round(target[1] * height))  # Sub-pixel changes draw nothing
+            if shown and center != drawn:
+                drawn = center
+                cx, cy, r = center[0], center[1], self.radius
+                canvas.coords(circle, cx - r, cy - r, cx + r, cy + r)  # Repaints the old and new area only
+                self._redraws += 1
+            root.after(period, tick)
+
+        self._ready.set()
+        root.after(period, tick)
+        root.mainloop()
+
+
+def _make_click_through(root):
+    """Windows: lets clicks through the overlay and keeps it from taking the focus."""
+    try:
+        import ctypes
+        user32 = ctypes.windll.user32
+        hwnd = user32.GetParent(root.winfo_id())
+        style = user32.GetWindowLongW(hwnd, _GWL_EXSTYLE)
+        user32.SetWindowLongW(hwnd, _GWL_EXSTYLE, style | _WS_EX_LAYERED | _WS_EX_TRANSPARENT
+                              | _WS_EX_TOOLWINDOW | _WS_EX_NOACTIVATE)
+    except Exception as e:
+        log.warning("[SPOTLIGHT] Could not make the overlay click-through: %s", e)
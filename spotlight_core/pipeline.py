@@ -0,0 +1,302 @@
+# pipeline.py
+# Pipelined command sending for Spotlight clients.
+#
+# The original clients used stop-and-wait: sendall() a command, then block on recv() for
+# its ACK before the next key press could go out. PipelinedSender instead numbers every
+# command, writes it immediately and lets a reader thread match the ACKs as they arrive,
+# so a burst of clicks costs one round trip instead of one round trip per click.
+
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque, namedtuple
+
+from spotlight_core import protocol
+from spotlight_core.metrics import record_reply
+
+# A command that has been handed to the sender but not acknowledged yet.
+# `attempts` counts how many connections it has been written to; `captured_at` is the
+# time.perf_counter() of the key press it came from (None if unknown).
+PendingCommand = namedtuple("PendingCommand", ["seq", "command", "sent_at", "attempts", "captured_at"],
+                            defaults=(None,))
+
+
+class PipelinedSender:
+    """
+    Sends commands over an already paired TCP socket without waiting for each ACK.
+
+    - send() never blocks on the network round trip: it writes the frame and returns.
+    - At most `window` commands are in flight. Extra commands wait in a backlog and are
+      written as soon as ACKs free up room.
+    - A reader thread matches ACK/NACK frames to in-flight commands by sequence number.
+    - Commands with no reply after `ack_timeout` seconds are reported through on_failure.
+      TCP already retransmits lost segments, so they are not re-sent on the same connection
+      (that could press the key twice); when the connection drops, take_unacked() hands the
+      outstanding commands back so they can be retried on the next connection.
+
+    Every frame carries its send timestamp, so the server's ACK can report how long it spent
+    on the command; with a `metrics` recorder the per-stage latencies are recorded on every ACK.
+
+    With a `heartbeat_interval` the reader thread also sends an OP_PING whenever that long has
+    passed, and treats heartbeat_interval * heartbeat_misses seconds without any frame from the
+    server as a lost connection (on_disconnect), so a dead link is noticed before the next click.
+
+    The socket stays blocking: a timeout could cut a sendall() off after part of a frame, leaving
+    the server unable to find the next frame boundary. Reads wait in select() instead, and a
+    write that fails at all ends the connection (on_disconnect) rather than being retried on it.
+
+    On a resumed session (see sessions.py) the sequence numbers go on from the previous
+    connection (next_seq), and `in_flight` lists the PendingCommands already written to sock
+    along with the resume, whose ACKs are still to come. Another sender on the same connection
+    (udp_commands.UdpCommandSender) shares the numbers through `seqs`, an iterator used instead
+    of next_seq.
+
+    Callbacks run on the reader thread:
+      on_reply(command, reply, rtt_seconds)
+      on_failure(command, reason)
+      on_disconnect(error)  - called once when the connection is lost
+      on_state(state)       - a protocol.State pushed by the server after subscribe_state()
+    """
+
+    def __init__(self, sock, decoder=None, window=8, ack_timeout=3.0, max_attempts=2,
+                 on_reply=None, on_failure=None, on_disconnect=None, bufsize=1024, metrics=None,
+                 heartbeat_interval=None, heartbeat_misses=3, on_state=None, next_seq=1, in_flight=(),
+                 seqs=None):
+        self.sock = sock
+        self.decoder = decoder or protocol.FrameDecoder()
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.on_reply = on_reply
+        self.on_failure = on_failure
+        self.on_disconnect = on_disconnect
+        self.bufsize = bufsize
+        self.metrics = metrics
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.on_state = on_state
+        self.state = None  # Newest protocol.State received
+
+        self._lock = threading.Lock()
+        self._seqs = seqs if seqs is not None else itertools.count(next_seq)
+        self._next_seq = next_seq
+        self._in_flight = {entry.seq: entry for entry in in_flight}  # seq -> PendingCommand, insertion ordered
+        self._backlog = deque()  # PendingCommand entries waiting for window space
+        self._closed = False
+        self._write_error = None  # Set by the first failed write; nothing more is written after it
+        self._last_received = time.perf_counter()  # Any frame from the server counts as a sign of life
+        self._last_ping = 0.0
+        self._reader = threading.Thread(target=self._read_loop, name="pipelined-ack-reader", daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self):
+        return not self._closed
+
+    @property
+    def next_seq(self):
+        """The sequence number the next command will get."""
+        return self._next_seq
+
+    def in_flight_count(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def send(self, command, attempts=0, captured_at=None, seq=None):
+        """
+        Queues a command for sending. Returns its sequence number, or None if the sender is closed.
+        `seq` re-sends a command under the number it was already sent with (over UDP, say), so the
+        server runs it at most once.
+        """
+        with self._lock:
+            if self._closed:
+                return None
+            if seq is None:
+                seq = next(self._seqs)
+                self._next_seq = seq + 1
+            self._backlog.append(PendingCommand(seq, command, 0.0, attempts, captured_at))
+            self._flush_locked()
+        return seq
+
+    def send_frame(self, frame):
+        """Writes an encoded frame that needs no ACK (e.g. a pointer position). False if it could not be written."""
+        with self._lock:
+            if self._closed:
+                return False
+            return self._write_locked(frame)
+
+    def subscribe_state(self):
+        """Asks the server to push its presentation state (servers with several controllers)."""
+        return self.send_frame(protocol.encode_state())
+
+    def take_unacked(self):
+        """
+        Returns the commands that were never acknowledged (in send order) and forgets them.
+        Commands that already reached max_attempts are reported as failed instead.
+        """
+        with self._lock:
+            pending = list(self._in_flight.values()) + list(self._backlog)
+            self._in_flight.clear()
+            self._backlog.clear()
+        retry = []
+        for entry in pending:
+            if entry.attempts >= self.max_attempts:
+                self._report_failure(entry.command, "gave up after connection loss")
+            else:
+                retry.append(entry)
+        return retry
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _flush_locked(self):
+        # Write backlog entries while there is room in the window. Caller holds _lock.
+        while self._backlog and len(self._in_flight) < self.window:
+            entry = self._backlog.popleft()
+            entry = entry._replace(sent_at=time.perf_counter(), attempts=entry.attempts + 1)
+            self._in_flight[entry.seq] = entry
+            # On failure the entry stays in flight so take_unacked() can return it
+            if not self._write_locked(protocol.encode_command(entry.command, entry.seq,
+                                                              int(entry.sent_at * 1_000_000))):
+                break
+
+    def _write_locked(self, data):
+        # Writes one whole frame. Caller holds _lock. A failed sendall() may have written part of
+        # the frame, so the stream cannot be used any more: the socket is shut down, which ends
+        # the reader thread with on_disconnect, and every later write is refused.
+        if self._write_error is not None:
+            return False
+        try:
+            self.sock.sendall(data)
+        except OSError as e:
+            self._write_error = e
+            self._shutdown()
+            return False
+        return True
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes up the reader and fails any writer still blocked
+        except OSError:
+            pass
+
+    def _read_loop(self):
+        error = None
+        # Wait at most one tick for data, so ACK deadlines and heartbeats are checked even when nothing arrives.
+        tick = min(0.2, self.ack_timeout)
+        if self.heartbeat_interval:
+            tick = min(tick, self.heartbeat_interval / 2)
+        selector = selectors.DefaultSelector()
+        try:
+            self.sock.settimeout(None)  # Blocking; see the class docstring
+            selector.register(self.sock, selectors.EVENT_READ)
+            while not self._closed:
+                frames = self._read_frames(selector, tick)
+                if frames is None:
+                    error = ConnectionResetError("server closed the connection")
+                    break
+                if frames:
+                    self._last_received = time.perf_counter()
+                for frame in frames:
+                    self._handle_frame(frame)
+                self._expire_overdue()
+                error = self._check_heartbeat()
+                if error is not None:
+                    self._shutdown()  # Fail any writer still using the dead connection
+                    break
+        except (OSError, ValueError, protocol.ProtocolError) as e:
+            error = e  # ValueError: the socket was closed under us
+        finally:
+            selector.close()
+        if self._write_error is not None:
+            error = self._write_error  # The reason the connection was shut down
+
+        with self._lock:
+            was_closed = self._closed
+            self._closed = True
+        if not was_closed and self.on_disconnect:
+            self.on_disconnect(error)
+
+    def _read_frames(self, selector, tick):
+        # The frames that are complete after waiting up to `tick` seconds for data ([] if none),
+        # or None if the server closed the connection. Never blocks longer than tick.
+        if self.decoder.pending:  # Arrived along with an earlier frame (e.g. the pairing reply)
+            frames = list(self.decoder.pending)
+            self.decoder.pending.clear()
+            return frames
+        if not selector.select(tick):
+            return []
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            return None
+        return self.decoder.feed(data)
+
+    def _check_heartbeat(self):
+        # Returns an exception if the server has been silent for too long, else sends a PING when one is due
+        if not self.heartbeat_interval:
+            return None
+        now = time.perf_counter()
+        silence = now - self._last_received
+        if silence >= self.heartbeat_interval * self.heartbeat_misses:
+            return TimeoutError(f"no heartbeat reply from the server for {silence:.1f} s")
+        if now - self._last_ping >= self.heartbeat_interval:
+            self._last_ping = now
+            ping = protocol.encode_ping(int(now * 1_000_000), int(self.heartbeat_interval * 1000))
+            # A writer blocked on a full send buffer holds the lock; skip this PING then rather
+            # than stall the silence check behind it
+            if self._lock.acquire(timeout=self.heartbeat_interval / 2):
+                try:
+                    self._write_locked(ping)  # A failure ends the connection; noticed on the next read
+                finally:
+                    self._lock.release()
+        return None
+
+    def _handle_frame(self, frame):
+        if frame.opcode == protocol.OP_PONG:
+            sent_us, _ = protocol.parse_ping(frame)
+            if self.metrics is not None and sent_us:
+                self.metrics.observe("heartbeat_rtt", "PING", time.perf_counter() - sent_us / 1_000_000)
+            return
+        if frame.opcode == protocol.OP_STATE:
+            state = protocol.parse_state(frame)
+            if state is None or (self.state is not None and state.seq < self.state.seq):
+                return  # Nothing has happened yet, or overtaken by a newer state
+            self.state = state
+            if self.on_state:
+                self.on_state(state)
+            return
+        reply = protocol.parse_reply(frame)
+        if reply is None:
+            return
+        with self._lock:
+            entry = self._in_flight.pop(reply.seq, None)
+            self._flush_locked()
+        if entry is None:
+            return  # Late reply for a command we already reported, or an unsequenced frame
+        received_at = time.perf_counter()
+        record_reply(self.metrics, entry.command, reply, received_at, entry.captured_at)
+        if self.on_reply:
+            self.on_reply(entry.command, reply, received_at - entry.sent_at)
+
+    def _expire_overdue(self):
+        now = time.perf_counter()
+        expired = []
+        with self._lock:
+            for seq, entry in list(self._in_flight.items()):
+                if now - entry.sent_at >= self.ack_timeout:
+                    expired.append(self._in_flight.pop(seq))
+            if expired:
+                self._flush_locked()
+        for entry in expired:
+            self._report_failure(entry.command, f"no ACK within {self.ack_timeout} s")
+
+    def _report_failure(self, command, reason):
+        if self.on_failure:
+            self.on_failure(command, reason)
@@ -0,0 +1,168 @@
+# pointer.py
+# Pointer streaming for the virtual spotlight.
+#
+# Absolute positions: while the spotlight is on, PointerStreamer samples the pointer at a fixed
+# rate (by default the display refresh rate) and sends it as an OP_POINTER frame. Nothing is
+# sent while the pointer stands still.
+#
+# Relative motion: a mouse (or gyro) reports movement far more often than anyone can see it,
+# up to 1000 times a second. MotionAccumulator adds the deltas up as they come in and passes
+# the sum on once per tick, so the cost per tick stays the same whatever the polling rate.
+# The client uses it to send one OP_MOTION frame per tick; the server uses it again in front of
+# a slow consumer such as the input backend moving the cursor.
+#
+# Neither kind of frame is ACKed: each carries an increasing sequence number, and the server
+# drops one that arrives after a newer one.
+
+import threading
+import time
+
+from spotlight_core import protocol
+from spotlight_core.log import get_logger
+from spotlight_core.metrics import now_us
+
+log = get_logger("pointer")
+
+RATE_HZ = 60  # Positions sent per second at most
+
+
+def screen_size():
+    """(width, height) of the primary screen in pixels, or None if there is no display (or no tkinter)."""
+    try:
+        import tkinter
+        root = tkinter.Tk()
+    except Exception:  # ImportError, or TclError when there is no display
+        return None
+    try:
+        return root.winfo_screenwidth(), root.winfo_screenheight()
+    finally:
+        root.destroy()
+
+
+class PointerStreamer:
+    """
+    Sends the pointer position from a daemon thread while active.
+
+    position_fn() returns (x, y) as fractions (0.0-1.0) of the screen size;
+    send(frame_bytes) writes an encoded frame and must not block for long.
+    """
+
+    def __init__(self, position_fn, send, rate_hz=RATE_HZ):
+        self.position_fn = position_fn
+        self.send = send
+        self.interval = 1.0 / rate_hz
+        self.sent = 0
+        self._seq = 0
+        self._active = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="pointer-streamer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._active.set()  # Wake the thread so it can exit
+
+    def activate(self):
+        self._active.set()
+
+    def deactivate(self):
+        self._active.clear()
+
+    @property
+    def active(self):
+        return self._active.is_set()
+
+    def _run(self):
+        last = None
+        while True:
+            self._active.wait()
+            if self._stopped:
+                return
+            started = time.perf_counter()
+            sampled_us = now_us()
+            try:
+                position = self.position_fn()
+            except Exception as e:
+                log.debug("[POINTER] Could not read the pointer position: %s", e)
+                position = None
+            if position is not None and position != last:
+                last = position
+                self._seq += 1
+                self.send(protocol.encode_pointer(position[0], position[1], self._seq, sampled_us))
+                self.sent += 1
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - started)))
+
+
+class MotionAccumulator:
+    """
+    Adds up relative motion and calls flush(dx, dy) with the sum, in whole pixels, at most
+    rate_hz times a second from a daemon thread (fractions are carried over to the next tick).
+    add() and on_move() may be called from any thread and only take a lock.
+
+    While inactive, motion is ignored; activate() starts again from the next on_move() position.
+    """
+
+    def __init__(self, flush, rate_hz=RATE_HZ, active=True):
+        self.flush = flush
+        self.interval = 1.0 / rate_hz
+        self.events = 0
+        self.flushes = 0
+        self._active = active
+        self._lock = threading.Lock()
+        self._dx = self._dy = 0.0
+        self._last = None  # Previous on_move() position
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="motion-accumulator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def activate(self):
+        with self._lock:
+            self._active = True
+            self._last = None
+
+    def deactivate(self):
+        with self._lock:
+            self._active = False
+            self._dx = self._dy = 0.0
+
+    def add(self, dx, dy):
+        """Relative motion, e.g. from a gyro."""
+        with self._lock:
+            if self._active:
+                self._dx += dx
+                self._dy += dy
+                self.events += 1
+
+    def on_move(self, x, y):
+        """Absolute pointer position, e.g. from pynput's mouse.Listener; the delta to the previous one is added."""
+        with self._lock:
+            last, self._last = self._last, (x, y)
+            if self._active and last is not None:
+                self._dx += x - last[0]
+                self._dy += y - last[1]
+                self.events += 1
+
+    def stats(self):
+        return {"events": self.events, "flushes": self.flushes}
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                dx, dy = int(self._dx), int(self._dy)
+                self._dx -= dx
+                self._dy -= dy
+            if dx or dy:
+                self.flushes += 1
+                try:
+                    self.flush(dx, dy)
+                except Exception as e:
+                    log.warning("[POINTER] Could not apply pointer motion: %s", e)
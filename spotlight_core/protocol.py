@@ -0,0 +1,533 @@
+# protocol.py
+# Length-prefixed binary wire protocol used between Spotlight clients and servers.
+#
+# Every frame on the TCP stream looks like this:
+#
+#   +--------+----------------------+--------+-----------+
+#   | header | body length (varint) | opcode | payload   |
+#   | 1 byte | 1..10 bytes          | 1 byte | 0+ bytes  |
+#   +--------+----------------------+--------+-----------+
+#
+# The header byte is 0xA0 | PROTOCOL_VERSION. Because it always has the high bit set
+# it can never be confused with the plain ASCII commands ("NEXT", "PAIR_WITH_SERVER:...")
+# sent by older clients, so the decoder can tell both dialects apart from the first byte
+# of a connection and fall back to the legacy text shim when needed.
+
+from collections import deque, namedtuple
+
+PROTOCOL_VERSION = 1
+HEADER_MAGIC = 0xA0
+HEADER_BYTE = HEADER_MAGIC | PROTOCOL_VERSION
+MAX_FRAME_SIZE = 64 * 1024  # Largest body we accept; anything bigger is a corrupt stream
+
+# --- Opcodes ---
+# Control frames
+OP_PAIR = 0x01  # payload: pairing ID (utf-8)
+OP_ACK = 0x02  # payload: opcode of the acknowledged frame + its sequence number (varint) + optional timing (see below)
+OP_NACK = 0x03  # payload: opcode of the rejected frame + its sequence number (varint) + reason (utf-8)
+# Heartbeat. A client sends OP_PING every heartbeat interval; the server echoes the payload in
+# an OP_PONG. Payload: sender timestamp (varint microseconds, sender's clock) + the sender's
+# heartbeat interval (varint milliseconds), which tells the receiver how long silence may last.
+OP_PING = 0x04
+OP_PONG = 0x05
+# UDP command channel. On a paired TCP connection the client sends an empty OP_UDP_SESSION;
+# the server answers with an OP_UDP_SESSION carrying its UDP command port (varint) and a random
+# session token (UDP_TOKEN_SIZE bytes), or NACKs it if it has no UDP channel. Each UDP datagram
+# is then a single OP_DATAGRAM frame: the token followed by one or more complete frames
+# (sequenced commands from the client, ACK/NACKs from the server).
+OP_UDP_SESSION = 0x06
+OP_DATAGRAM = 0x07
+UDP_TOKEN_SIZE = 8
+# Virtual spotlight position, streamed while the spotlight is on and never ACKed.
+# Payload: sequence number (varint; older positions than the last one applied are dropped)
+# + x + y (varints, 0..POINTER_SCALE as fractions of the screen width and height)
+# + optionally the time the position was sampled (varint microseconds, sender's clock), which
+# lets the server smooth by when positions were taken rather than when they happened to arrive.
+OP_POINTER = 0x08
+POINTER_SCALE = 0xFFFF
+# Relative pointer motion (mouse, gyro), the deltas accumulated over one client tick.
+# Payload: sequence number (varint, as for OP_POINTER) + dx + dy (zigzag varints, pixels),
+# so a typical tick of less than 64 pixels each way costs 3 payload bytes.
+OP_MOTION = 0x09
+# Shared presentation state on a server with several controllers. A client sends an empty
+# OP_STATE to subscribe; the server answers with the current state and pushes a new one after
+# every command it accepts from any controller. Payload: global command sequence number
+# (varint) + command name + the controller that sent it + the controller holding the floor
+# (each a varint length and utf-8; empty = none).
+OP_STATE = 0x0A
+# Session resumption. Right after OP_PAIR a client may send an empty OP_RESUME; the server
+# answers with an OP_RESUME carrying a session token (RESUME_TOKEN_SIZE bytes), or NACKs it.
+# After a drop the client opens a new connection with OP_RESUME + token instead of OP_PAIR,
+# followed in the same packet by its unacknowledged commands (original sequence numbers).
+# The server ACKs the OP_RESUME, or NACKs it and closes the connection without running anything.
+OP_RESUME = 0x0B
+RESUME_TOKEN_SIZE = 16
+
+# Presentation commands. Payload: sequence number (varint, 0 = unsequenced) followed by the
+# client's send timestamp (varint microseconds on the client's own clock, 0 = none); both
+# may be omitted. Pipelined clients number their commands so replies can be matched to
+# requests while several commands are in flight.
+#
+# ACK timing: after the sequence number an ACK for a command may carry three varints:
+# the echoed client send timestamp, the microseconds the server spent between receiving
+# the frame and starting its action, and the microseconds the action (the key press) took.
+# The client can then split its round trip into network and server time without the two
+# clocks having to agree.
+OP_NEXT = 0x10
+OP_PREVIOUS = 0x11
+OP_BLACK_SCREEN = 0x12
+OP_START_PRESENTATION = 0x13
+OP_EXIT_SLIDESHOW = 0x14
+OP_LASER_ON = 0x15
+OP_LASER_OFF = 0x16
+OP_NAMED_COMMAND = 0x1F  # payload: sequence number + send timestamp + command name (utf-8), for commands without an opcode
+
+COMMAND_OPCODES = {
+    "NEXT": OP_NEXT,
+    "PREVIOUS": OP_PREVIOUS,
+    "BLACK_SCREEN": OP_BLACK_SCREEN,
+    "START_PRESENTATION": OP_START_PRESENTATION,
+    "EXIT_SLIDESHOW": OP_EXIT_SLIDESHOW,
+    "LASER_ON": OP_LASER_ON,
+    "LASER_OFF": OP_LASER_OFF,
+}
+OPCODE_COMMANDS = {opcode: name for name, opcode in COMMAND_OPCODES.items()}
+
+# --- Legacy text protocol (Version 1 / Version 2 clients) ---
+LEGACY_PAIR_PREFIX = b"PAIR_WITH_SERVER:"
+_LEGACY_COMMANDS = sorted((name.encode() for name in COMMAND_OPCODES), key=len, reverse=True)
+
+Frame = namedtuple("Frame", ["opcode", "payload"])
+Reply = namedtuple("Reply", ["ok", "opcode", "seq", "reason", "sent_us", "server_queue_us", "injection_us"],
+                   defaults=(0, 0, 0))
+# Server side timing carried in an ACK: (echoed sent_us, server_queue_us, injection_us)
+Timing = namedtuple("Timing", ["sent_us", "server_queue_us", "injection_us"])
+# Presentation state pushed in OP_STATE frames
+State = namedtuple("State", ["seq", "command", "controller", "floor"])
+
+
+class ProtocolError(Exception):
+    """Raised when the byte stream cannot be decoded."""
+
+
+def encode_varint(value):
+    """Encodes a non-negative integer as an unsigned LEB128 varint."""
+    if value < 0:
+        raise ValueError("varint values must be non-negative")
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    """Maps a signed integer to a non-negative one (0, -1, 1, -2 ... -> 0, 1, 2, 3 ...) for encode_varint."""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+
+def decode_varint(data, offset=0):
+    """
+    Decodes a varint from data starting at offset.
+    Returns (value, new_offset), or (None, offset) if data ends before the varint does.
+    """
+    value = 0
+    shift = 0
+    position = offset
+    while position < len(data):
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+        if shift > 63:
+            raise ProtocolError("varint is too long")
+    return None, offset
+
+
+def encode_frame(opcode, payload=b""):
+    """Builds one complete frame for the given opcode and payload."""
+    body_length = 1 + len(payload)
+    if body_length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"frame body of {body_length} bytes exceeds {MAX_FRAME_SIZE}")
+    return bytes((HEADER_BYTE,)) + encode_varint(body_length) + bytes((opcode,)) + payload
+
+
+def encode_command(command, seq=0, sent_us=0):
+    """Encodes a command name (e.g. "NEXT") as a frame, optionally with a sequence number and send timestamp."""
+    opcode = COMMAND_OPCODES.get(command)
+    if opcode is not None:
+        if sent_us:
+            return encode_frame(opcode, encode_varint(seq) + encode_varint(sent_us))
+        return encode_frame(opcode, encode_varint(seq) if seq else b"")
+    return encode_frame(OP_NAMED_COMMAND, encode_varint(seq) + encode_varint(sent_us) + command.encode())
+
+
+def encode_pair(pairing_id):
+    return encode_frame(OP_PAIR, pairing_id.encode())
+
+
+def encode_ack(ref_opcode, seq=0, timing=None):
+    payload = bytes((ref_opcode,)) + encode_varint(seq)
+    if timing:
+        payload += b"".join(encode_varint(value) for value in timing)
+    return encode_frame(OP_ACK, payload)
+
+
+def encode_ping(sent_us, interval_ms=0):
+    return encode_frame(OP_PING, encode_varint(sent_us) + encode_varint(interval_ms))
+
+
+def encode_pong(ping_frame):
+    return encode_frame(OP_PONG, ping_frame.payload)
+
+
+def parse_ping(frame):
+    """Returns (sent_us, interval_ms) of an OP_PING or OP_PONG frame (0 for missing fields)."""
+    sent_us, offset = decode_varint(frame.payload)
+    interval_ms, _ = decode_varint(frame.payload, offset)
+    return sent_us or 0, interval_ms or 0
+
+
+def encode_pointer(x, y, seq=0, sampled_us=0):
+    """Encodes a pointer position given as fractions (0.0-1.0) of the screen size."""
+    x = min(max(int(round(x * POINTER_SCALE)), 0), POINTER_SCALE)
+    y = min(max(int(round(y * POINTER_SCALE)), 0), POINTER_SCALE)
+    payload = encode_varint(seq) + encode_varint(x) + encode_varint(y)
+    if sampled_us:
+        payload += encode_varint(sampled_us)
+    return encode_frame(OP_POINTER, payload)
+
+
+def parse_pointer(frame):
+    """
+    Returns (seq, x, y, sampled_us) of an OP_POINTER frame, x and y as fractions of the screen
+    size; sampled_us is 0 if the sender did not include it.
+    """
+    seq, offset = decode_varint(frame.payload)
+    x, offset = decode_varint(frame.payload, offset)
+    y, offset = decode_varint(frame.payload, offset)
+    if y is None:
+        raise ProtocolError("truncated pointer frame")
+    sampled_us, _ = decode_varint(frame.payload, offset)
+    return seq, x / POINTER_SCALE, y / POINTER_SCALE, sampled_us or 0
+
+
+def encode_motion(dx, dy, seq=0):
+    """Encodes a relative pointer motion of (dx, dy) whole pixels."""
+    return encode_frame(OP_MOTION, encode_varint(seq) + encode_varint(zigzag(dx)) + encode_varint(zigzag(dy)))
+
+
+def parse_motion(frame):
+    """Returns (seq, dx, dy) of an OP_MOTION frame."""
+    seq, offset = decode_varint(frame.payload)
+    dx, offset = decode_varint(frame.payload, offset)
+    dy, _ = decode_varint(frame.payload, offset)
+    if dy is None:
+        raise ProtocolError("truncated motion frame")
+    return seq, unzigzag(dx), unzigzag(dy)
+
+
+def encode_state(seq=0, command="", controller="", floor=""):
+    """A state update, or with no arguments the client's subscription request."""
+    if not (seq or command or controller or floor):
+        return encode_frame(OP_STATE)
+    payload = encode_varint(seq)
+    for text in (command, controller, floor):
+        data = text.encode()
+        payload += encode_varint(len(data)) + data
+    return encode_frame(OP_STATE, payload)
+
+
+def parse_state(frame):
+    """Returns the State of an OP_STATE frame, or None for a subscription request."""
+    if not frame.payload:
+        return None
+    seq, offset = decode_varint(frame.payload)
+    texts = []
+    for _ in range(3):
+        length, offset = decode_varint(frame.payload, offset)
+        if length is None or offset + length > len(frame.payload):
+            raise ProtocolError("truncated state frame")
+        texts.append(frame.payload[offset:offset + length].decode(errors="replace"))
+        offset += length
+    return State(seq, *texts)
+
+
+def encode_resume(token=b""):
+    """The client's token request (no argument), the server's grant, or the client's resume on reconnect."""
+    return encode_frame(OP_RESUME, token)
+
+
+def parse_resume(frame):
+    """Returns the token of an OP_RESUME frame, b"" for a token request, or None if it is not OP_RESUME."""
+    if frame.opcode != OP_RESUME:
+        return None
+    if frame.payload and len(frame.payload) != RESUME_TOKEN_SIZE:
+        raise ProtocolError("malformed resume frame")
+    return bytes(frame.payload)
+
+
+def encode_udp_session(port=0, token=b""):
+    """The client's request (no arguments) or the server's grant of a UDP command session."""
+    if not token:
+        return encode_frame(OP_UDP_SESSION)
+    return encode_frame(OP_UDP_SESSION, encode_varint(port) + token)
+
+
+def parse_udp_session(frame):
+    """Returns (port, token) from the server's OP_UDP_SESSION frame, or None if it is not a grant."""
+    if frame.opcode != OP_UDP_SESSION:
+        return None
+    port, offset = decode_varint(frame.payload)
+    token = frame.payload[offset:]
+    if port is None or len(token) != UDP_TOKEN_SIZE:
+        return None
+    return port, token
+
+
+def encode_datagram(token, frames):
+    """One UDP datagram: the session token and the given encoded frames (bytes, concatenated)."""
+    return encode_frame(OP_DATAGRAM, token + frames)
+
+
+def parse_datagram(data):
+    """Returns (token, frames) of a UDP datagram. Raises ProtocolError if it is not a complete OP_DATAGRAM."""
+    decoder = FrameDecoder()
+    if not data or not data[0] & 0x80:
+        raise ProtocolError("not a binary frame")
+    frames = decoder.feed(data)
+    if len(frames) != 1 or frames[0].opcode != OP_DATAGRAM or decoder.has_partial():
+        raise ProtocolError("malformed datagram")
+    payload = frames[0].payload
+    body = payload[UDP_TOKEN_SIZE:]
+    if len(payload) < UDP_TOKEN_SIZE or (body and not body[0] & 0x80):
+        raise ProtocolError("malformed datagram")
+    inner = FrameDecoder()
+    frames = inner.feed(body)
+    if inner.has_partial():
+        raise ProtocolError("truncated frame in datagram")
+    return payload[:UDP_TOKEN_SIZE], frames
+
+
+def encode_nack(ref_opcode, reason="", seq=0):
+    return encode_frame(OP_NACK, bytes((ref_opcode,)) + encode_varint(seq) + reason.encode())
+
+
+def is_command(frame):
+    return frame.opcode in OPCODE_COMMANDS or frame.opcode == OP_NAMED_COMMAND
+
+
+def command_seq(frame):
+    """Returns the sequence number of a command frame (0 if it has none)."""
+    if not is_command(frame) or not frame.payload:
+        return 0
+    seq, _ = decode_varint(frame.payload)
+    return seq or 0
+
+
+def command_sent_us(frame):
+    """Returns the client send timestamp of a command frame in microseconds (0 if it has none)."""
+    if not is_command(frame) or not frame.payload:
+        return 0
+    _, offset = decode_varint(frame.payload)
+    sent_us, _ = decode_varint(frame.payload, offset)
+    return sent_us or 0
+
+
+def command_name(frame):
+    """Returns the command name carried by a command frame, or None for control frames."""
+    if frame.opcode == OP_NAMED_COMMAND:
+        _, offset = decode_varint(frame.payload)
+        _, offset = decode_varint(frame.payload, offset)
+        return frame.payload[offset:].decode(errors="replace")
+    return OPCODE_COMMANDS.get(frame.opcode)
+
+
+def parse_reply(frame):
+    """Interprets an ACK/NACK frame. Returns a Reply, or None if the frame is not a reply."""
+    if frame.opcode not in (OP_ACK, OP_NACK) or not frame.payload:
+        return None
+    seq, offset = decode_varint(frame.payload, 1)
+    if seq is None:
+        seq, offset = 0, len(frame.payload)
+    if frame.opcode == OP_ACK:
+        # Whatever follows the sequence number of an ACK is timing, never a reason
+        timing = []
+        while len(timing) < 3:
+            value, offset = decode_varint(frame.payload, offset)
+            if value is None:
+                break
+            timing.append(value)
+        timing += [0] * (3 - len(timing))
+        return Reply(True, frame.payload[0], seq, "", *timing)
+    reason = frame.payload[offset:].decode(errors="replace")
+    return Reply(False, frame.payload[0], seq, reason)
+
+
+def is_pairing_ack(frame):
+    """True if frame is the server's successful reply to our pairing request."""
+    reply = parse_reply(frame)
+    return reply is not None and reply.ok and reply.opcode == OP_PAIR
+
+
+class FrameDecoder:
+    """
+    Streaming decoder. Feed it whatever recv() returned and it hands back every complete
+    frame, keeping partial frames buffered until the rest arrives. Coalesced frames
+    ("NEXTNEXT" on the old protocol, or several binary frames in one read) are split.
+
+    The dialect is detected from the first byte of the stream: `legacy` is None until
+    then, True for old text clients and False for binary clients.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.legacy = None
+        self.pending = deque()  # Frames decoded by recv_frame() but not returned yet
+
+    def feed(self, data):
+        """Adds received bytes and returns the list of complete frames decoded so far."""
+        self._buffer += data
+        if self.legacy is None:
+            if not self._buffer:
+                return []
+            self.legacy = not self._buffer[0] & 0x80
+        if self.legacy:
+            return self._decode_legacy()
+        return self._decode_binary()
+
+    def has_partial(self):
+        """True if bytes of an incomplete frame are buffered."""
+        return bool(self._buffer)
+
+    def _decode_binary(self):
+        frames = []
+        buffer = self._buffer
+        offset = 0
+        while offset < len(buffer):
+            if buffer[offset] != HEADER_BYTE:
+                if buffer[offset] & 0xF0 == HEADER_MAGIC:
+                    raise ProtocolError(f"unsupported protocol version {buffer[offset] & 0x0F}")
+                raise ProtocolError(f"bad frame header 0x{buffer[offset]:02x}")
+            body_length, body_start = decode_varint(buffer, offset + 1)
+            if body_length is None:
+                break  # Length not complete yet
+            if body_length == 0 or body_length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"invalid frame length {body_length}")
+            body_end = body_start + body_length
+            if body_end > len(buffer):
+                break  # Body not complete yet
+            frames.append(Frame(buffer[body_start], bytes(buffer[body_start + 1:body_end])))
+            offset = body_end
+        del buffer[:offset]
+        return frames
+
+    def _decode_legacy(self):
+        # Compatibility shim for the old bare-string protocol. There are no delimiters, so
+        # commands are split by matching known command names at the front of the buffer.
+        frames = []
+        buffer = bytes(self._buffer).lstrip()
+        while buffer:
+            if buffer.startswith(LEGACY_PAIR_PREFIX):
+                # Old clients wait for the pairing reply before sending anything else,
+                # so everything after the prefix is the pairing ID.
+                frames.append(Frame(OP_PAIR, buffer[len(LEGACY_PAIR_PREFIX):].strip()))
+                buffer = b""
+                break
+            match = next((name for name in _LEGACY_COMMANDS if buffer.startswith(name)), None)
+            if match:
+                frames.append(Frame(COMMAND_OPCODES[match.decode()], b""))
+                buffer = buffer[len(match):].lstrip()
+                continue
+            if any(name.startswith(buffer) for name in _LEGACY_COMMANDS + [LEGACY_PAIR_PREFIX]):
+                break  # Partial command, wait for the rest
+            # Not a built-in command: old servers treated the whole read as one command name,
+            # so pass it through by name (custom COMMAND_ACTIONS entries keep working).
+            frames.append(Frame(OP_NAMED_COMMAND, b"\x00\x00" + buffer.strip()))
+            buffer = b""
+        self._buffer = bytearray(buffer)
+        return frames
+
+
+def recv_frame(sock, decoder, bufsize=1024):
+    """
+    Blocking helper for clients: returns the next frame from sock, or None if the peer
+    closed the connection. Frames that arrived in the same read are kept for later calls.
+    """
+    while not decoder.pending:
+        data = sock.recv(bufsize)
+        if not data:
+            return None
+        decoder.pending.extend(decoder.feed(data))
+    return decoder.pending.popleft()
+
+
+def pair(sock, decoder, pairing_id, bufsize=1024):
+    """
+    Sends the pairing request on a connected socket and waits for the reply (using the
+    socket's timeout). Returns (paired, reply_text); reply_text is None if the server closed.
+    """
+    sock.sendall(encode_pair(pairing_id))
+    reply = recv_frame(sock, decoder, bufsize)
+    if reply is None:
+        return False, None
+    return is_pairing_ack(reply), format_reply(reply)
+
+
+def format_reply(frame):
+    """Human-readable form of an ACK/NACK frame, matching the old text replies."""
+    reply = parse_reply(frame)
+    if reply is None:
+        return f"<opcode 0x{frame.opcode:02x}>"
+    if reply.opcode == OP_PAIR:
+        name = "PAIRING_SUCCESSFUL" if reply.ok else "PAIRING"
+    else:
+        name = OPCODE_COMMANDS.get(reply.opcode, f"opcode 0x{reply.opcode:02x}")
+    if reply.seq:
+        name = f"{name}#{reply.seq}"
+    if reply.ok:
+        return f"ACK:{name}"
+    return f"NACK:{name} - {reply.reason}"
+
+
+def encode_legacy_reply(frame, ok, reason=""):
+    """Builds the text reply an old client expects for the given frame."""
+    if frame.opcode == OP_PAIR:
+        if ok:
+            text = "ACK:PAIRING_SUCCESSFUL"
+        elif reason:
+            text = f"NACK:{reason}"
+        else:  # Server without pairing support: old servers saw this as an unknown command
+            text = f"NACK:Unknown command {LEGACY_PAIR_PREFIX.decode()}{frame.payload.decode(errors='replace')}"
+    else:
+        name = command_name(frame)
+        if ok:
+            text = f"ACK:{name}"
+        elif frame.opcode == OP_NAMED_COMMAND and not reason:
+            text = f"NACK:Unknown command {name}"
+        else:
+            text = f"NACK:{name} - Error: {reason}"
+    return text.encode()
+
+
+def encode_reply(frame, ok, reason="", legacy=False, timing=None):
+    """
+    Builds the ACK/NACK for a received frame in whichever dialect the peer speaks.
+    `timing` is an optional Timing for the ACK (old text clients never get it).
+    """
+    if legacy:
+        return encode_legacy_reply(frame, ok, reason)
+    seq = command_seq(frame)
+    if ok:
+        return encode_ack(frame.opcode, seq, timing)
+    return encode_nack(frame.opcode, reason or "Unknown command", seq)
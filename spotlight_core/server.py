@@ -0,0 +1,502 @@
+# server.py
+# Connection logic shared by every Spotlight server engine.
+#
+# ServerConnection does no I/O of its own: the threaded and asyncio engines feed it the
+# bytes they receive and get back what to execute and what to send. That keeps pairing,
+# command lookup and ACK/NACK formatting in one place, whichever engine is running.
+
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from spotlight_core import protocol
+from spotlight_core.injection import ACK_COMPLETED, ACK_QUEUED
+from spotlight_core.log import get_logger
+from spotlight_core.sockopts import tune_tcp_socket
+
+log = get_logger("server")
+
+HEARTBEAT_MISSES = 3  # A client that announced heartbeats is dropped after this many intervals of silence
+CLOCK_OFFSET_CREEP = 0.0001  # Seconds the client clock offset estimate may rise per pointer sample (clock drift)
+DEDUP_WINDOW = 1024  # Command sequence numbers (and their replies) remembered per client for duplicate suppression
+
+# One unit of work produced by ServerConnection.feed():
+#   frame  - the decoded frame
+#   action - callable to run for a command frame (None if there is nothing to run)
+#   reply  - bytes to send right away (pairing result, unknown command NACK), or None
+#   close  - True if the connection must be closed after sending `reply`
+#   received_at - time.perf_counter() when the frame was decoded (for latency metrics)
+Step = namedtuple("Step", ["frame", "action", "reply", "close", "received_at"], defaults=(0.0,))
+
+
+class DuplicateFilter:
+    """Remembers which sequence numbers a client has already sent (a sliding window)."""
+
+    def __init__(self, window=DEDUP_WINDOW):
+        self.window = window
+        self.base = 0  # Every seq <= base has been seen (or is too old to matter)
+        self.seen_above = set()
+
+    def check(self, seq):
+        """Returns True the first time seq is seen, False for a duplicate."""
+        if seq <= self.base or seq in self.seen_above:
+            return False
+        self.seen_above.add(seq)
+        if seq - self.base > self.window:  # Forget the oldest part of the window
+            self.base = seq - self.window
+            self.seen_above = {s for s in self.seen_above if s > self.base}
+        while self.base + 1 in self.seen_above:
+            self.base += 1
+            self.seen_above.discard(self.base)
+        return True
+
+
+class CommandOutcomes:
+    """
+    Runs each command of one client once, whichever way its copies arrive (a UDP retransmit,
+    the TCP fallback, a re-send after resuming), and answers every later copy with the ACK/NACK
+    of the first one, as soon as that exists. Thread-safe.
+    """
+
+    def __init__(self, window=DEDUP_WINDOW):
+        self.window = window
+        self._seen = DuplicateFilter(window)
+        self._outcomes = {}  # seq -> reply bytes, or the send functions waiting for them; oldest first
+        self._lock = threading.Lock()
+
+    def admit(self, seq, wait):
+        """
+        Returns (True, None) for the first copy of command seq: the caller runs it and passes its
+        ACK/NACK to done(). A later copy gets (False, reply), or (False, None) while the first one
+        has not finished; wait(reply) is then called from done(). A copy older than the window
+        gets (False, None) and nothing more.
+        """
+        with self._lock:
+            if self._seen.check(seq):
+                self._outcomes[seq] = []
+                while len(self._outcomes) > self.window:
+                    del self._outcomes[next(iter(self._outcomes))]
+                return True, None
+            outcome = self._outcomes.get(seq)
+            if isinstance(outcome, list):
+                outcome.append(wait)
+                return False, None
+            return False, outcome
+
+    def done(self, seq, reply):
+        """Stores the ACK/NACK of command seq and hands it to the copies waiting for it."""
+        with self._lock:
+            waiting = self._outcomes.get(seq)
+            if not isinstance(waiting, list):
+                return
+            self._outcomes[seq] = reply
+        for wait in waiting:
+            wait(reply)
+
+
+class CommandTable:
+    """Maps decoded command frames to actions from a COMMAND_ACTIONS style dict."""
+
+    def __init__(self, actions):
+        self.update(actions)
+
+    def update(self, actions):
+        """
+        Replaces every action, e.g. after a keymap reload. The new table is swapped in with one
+        assignment, so connections using this table see either the old or the new actions.
+        """
+        # Keyed by wire opcode so the common case is a single dict lookup per command.
+        # Commands without a dedicated opcode arrive as OP_NAMED_COMMAND and are looked up by name
+        # (names are strings, opcodes ints, so both live in the same dict).
+        dispatch = dict(actions)
+        dispatch.update((protocol.COMMAND_OPCODES[name], action)
+                        for name, action in actions.items() if name in protocol.COMMAND_OPCODES)
+        self.actions = actions
+        self.dispatch = dispatch
+
+    def lookup(self, frame):
+        """Returns the action for a decoded command frame, or None if it is unknown."""
+        if frame.opcode == protocol.OP_NAMED_COMMAND:
+            return self.dispatch.get(protocol.command_name(frame))
+        return self.dispatch.get(frame.opcode)
+
+
+class ServerConnection:
+    """
+    Protocol state for one client connection: pairing first (if the server has a pairing
+    ID), then commands. Speaks whichever dialect (binary or old text) the client uses.
+
+    Commands either run inline through execute(), or, when an injection.InjectionWorker is
+    given, through dispatch(), which hands them to the worker and ACKs them when they are
+    queued or when they have completed (ack_mode).
+
+    OP_PING frames are answered with OP_PONG straight from feed(). Once a client has announced
+    its heartbeat interval, heartbeat_timeout says how long the engine may wait for data
+    before treating the client as gone.
+
+    With udp_sessions (a udp_commands.UdpSessions), a paired client may ask for a UDP command
+    session; its token is valid until close() is called.
+
+    OP_POINTER positions from a paired client go to pointer(x, y, sampled_at) (e.g.
+    overlay.SpotlightOverlay.move), newest first: a position older than the last one applied is
+    dropped. sampled_at is the time.perf_counter() at which the client took the position, as
+    far as the fastest frame so far tells, or the arrival time if the client sent no timestamp.
+    OP_MOTION deltas go to motion(dx, dy) the same way; a lost or late delta is simply skipped,
+    as with a mouse.
+
+    With an arbiter (arbiter.CommandArbiter shared by all connections) every command is admitted
+    and started through it, in one global order; a command it refuses is NACKed. The engine sets
+    `push` to a function that sends bytes unprompted (from any thread), for the state updates
+    of an OP_STATE subscription.
+
+    A command runs once per sequence number (`outcomes`, a CommandOutcomes); a copy of it, over
+    TCP or the UDP channel, gets the first copy's ACK/NACK once that exists, through `push` if
+    it is not there yet.
+
+    With sessions (a sessions.ResumableSessions) a paired client may ask for a session token,
+    and a new connection may present it instead of pairing. The session's `outcomes` then go on
+    across its connections, so a command re-sent after a reconnect is not run again.
+    """
+
+    def __init__(self, commands, pairing_id=None, addr=None, tag="[TCP SERVER]", metrics=None,
+                 injector=None, ack_mode=ACK_COMPLETED, heartbeat_misses=HEARTBEAT_MISSES, udp_sessions=None,
+                 pointer=None, motion=None, arbiter=None, sessions=None):
+        self.commands = commands
+        self.metrics = metrics  # Optional metrics.LatencyRecorder
+        self.injector = injector
+        self.ack_mode = ack_mode
+        self.pairing_id = pairing_id
+        self.addr = addr
+        self.tag = tag
+        self.decoder = protocol.FrameDecoder()
+        self.paired = pairing_id is None  # Servers without a pairing ID accept commands straight away
+        self.heartbeat_misses = heartbeat_misses
+        self.heartbeat_timeout = None  # Seconds; set once the client sends a PING with its interval
+        self.udp_sessions = udp_sessions
+        self.udp_token = None
+        self.pointer = pointer
+        self.pointer_seq = 0  # Sequence number of the last pointer position applied
+        self.clock_offset = None  # Our clock minus the client's, plus the fastest one-way delay seen
+        self.motion = motion
+        self.motion_seq = 0  # Sequence number of the last motion delta applied
+        self.arbiter = arbiter
+        self.push = None
+        self.sessions = sessions
+        self.session = None  # sessions.ResumableSession once issued or resumed
+        self.outcomes = CommandOutcomes()  # The session's once there is one
+
+    def reply(self, frame, ok, reason="", timing=None):
+        """Encodes an ACK/NACK for frame in the client's dialect."""
+        return protocol.encode_reply(frame, ok, reason, legacy=self.decoder.legacy, timing=timing)
+
+    def feed(self, data):
+        """Decodes received bytes. Returns a list of Steps; raises protocol.ProtocolError on garbage."""
+        steps = []
+        received_at = time.perf_counter()
+        for frame in self.decoder.feed(data):
+            if frame.opcode == protocol.OP_PING:
+                _, interval_ms = protocol.parse_ping(frame)
+                if interval_ms:
+                    self.heartbeat_timeout = interval_ms / 1000 * self.heartbeat_misses
+                steps.append(Step(frame, None, protocol.encode_pong(frame), False))
+                continue
+            if frame.opcode == protocol.OP_PONG:
+                continue
+
+            if not self.paired or frame.opcode == protocol.OP_RESUME:
+                step = self._resume(frame) if frame.opcode == protocol.OP_RESUME else self._pair(frame)
+                steps.append(step)
+                if step.close:
+                    break
+                continue
+
+            if frame.opcode == protocol.OP_UDP_SESSION:
+                steps.append(Step(frame, None, self._open_udp_session(frame), False))
+                continue
+            if frame.opcode == protocol.OP_POINTER:
+                self.handle_pointer(frame)
+                continue
+            if frame.opcode == protocol.OP_MOTION:
+                self.handle_motion(frame)
+                continue
+            if frame.opcode == protocol.OP_STATE:
+                steps.append(Step(frame, None, self._subscribe(frame), False))
+                continue
+
+            if protocol.is_command(frame):
+                new, reply = self.admit(frame, self._push_reply)
+                if not new:
+                    if reply:
+                        steps.append(Step(frame, None, reply, False))
+                    continue
+
+            action = self.commands.lookup(frame)
+            if action:
+                log.debug("%s Received command: %s from %s", self.tag, protocol.command_name(frame), self.addr)
+                steps.append(Step(frame, action, None, False, received_at))
+            else:
+                command = protocol.command_name(frame) or f"opcode 0x{frame.opcode:02x}"
+                log.warning("%s Unknown command: %s from %s", self.tag, command, self.addr)
+                steps.append(Step(frame, None, self.settle(frame, self.reply(frame, False)), False))
+        return steps
+
+    def admit(self, frame, wait):
+        """
+        Checks a command frame against the commands already received (see CommandOutcomes.admit).
+        Returns (True, None) if it should run; its ACK/NACK must then go through settle().
+        """
+        seq = protocol.command_seq(frame)
+        if not seq:  # The text dialect has no sequence numbers
+            return True, None
+        new, reply = self.outcomes.admit(seq, wait)
+        if not new:
+            log.debug("%s Already received: %s #%s from %s (%s)", self.tag, protocol.command_name(frame), seq,
+                      self.addr, "answered again" if reply else "answered when it has run")
+        return new, reply
+
+    def settle(self, frame, reply):
+        """Records reply as the outcome of command frame, for its later copies. Returns reply."""
+        seq = protocol.command_seq(frame)
+        if seq:
+            self.outcomes.done(seq, reply)
+        return reply
+
+    def _push_reply(self, reply):
+        if self.push is not None:
+            self.push(reply)
+
+    def _pair(self, frame):
+        # --- Pairing ID Verification over TCP ---
+        # Expect the first frame to be the pairing ID
+        if frame.opcode != protocol.OP_PAIR:
+            log.warning("%s Pairing failed with %s: Bad pairing message format.", self.tag, self.addr)
+            return Step(frame, None, self.reply(frame, False, "PAIRING_FAILED_BAD_FORMAT"), True)
+        client_pairing_id = frame.payload.decode(errors="replace")
+        log.info("%s Received pairing request for ID '%s' from %s", self.tag, client_pairing_id, self.addr)
+        if client_pairing_id != self.pairing_id:
+            log.warning("%s Pairing failed with %s: ID mismatch. Expected '%s', got '%s'.",
+                        self.tag, self.addr, self.pairing_id, client_pairing_id)
+            return Step(frame, None, self.reply(frame, False, "PAIRING_FAILED_MISMATCH"), True)
+        self.paired = True
+        log.info("%s Pairing successful with %s", self.tag, self.addr)
+        return Step(frame, None, self.reply(frame, True), False)
+
+    def _resume(self, frame):
+        token = protocol.parse_resume(frame)
+        if self.sessions is None:
+            # Close if a resume fails: the commands behind it may have run already
+            return Step(frame, None, self.reply(frame, False, "RESUME_UNAVAILABLE"), bool(token))
+        if not token:  # A freshly paired client asks for a token
+            if not self.paired:
+                return self._pair(frame)
+            if self.session is None:
+                self.session = self.sessions.issue(self.pairing_id, self.outcomes)
+                log.info("%s Issued a resumable session to %s", self.tag, self.addr)
+            return Step(frame, None, protocol.encode_resume(self.session.token), False)
+        session = self.sessions.resume(token, self.pairing_id)
+        if session is None:
+            log.warning("%s %s tried to resume an unknown or expired session.", self.tag, self.addr)
+            return Step(frame, None, self.reply(frame, False, "RESUME_FAILED"), True)
+        if self.session is not None:
+            self.sessions.release(self.session)
+        self.session = session
+        self.outcomes = session.outcomes
+        self.paired = True
+        log.info("%s Resumed session with %s (no pairing round trip)", self.tag, self.addr)
+        return Step(frame, None, self.reply(frame, True), False)
+
+    def _open_udp_session(self, frame):
+        if self.udp_sessions is None:
+            return self.reply(frame, False, "UDP_UNAVAILABLE")
+        if self.udp_token is None:
+            self.udp_token = self.udp_sessions.open(self)
+            log.info("%s Opened UDP command session for %s", self.tag, self.addr)
+        return protocol.encode_udp_session(self.udp_sessions.port, self.udp_token)
+
+    def _subscribe(self, frame):
+        if self.arbiter is None or self.push is None:
+            return self.reply(frame, False, "STATE_UNAVAILABLE")
+        log.info("%s %s subscribed to state updates", self.tag, self.addr)
+        return self.arbiter.subscribe(self, self.push)
+
+    def handle_pointer(self, frame):
+        """Applies an OP_POINTER frame (received over TCP or the UDP channel). Never replies."""
+        received_at = time.perf_counter()
+        seq, x, y, sampled_us = protocol.parse_pointer(frame)
+        if seq:
+            if seq <= self.pointer_seq:
+                return  # Reordered or duplicated datagram
+            self.pointer_seq = seq
+        if self.pointer is not None:
+            self.pointer(x, y, self._sampled_at(sampled_us, received_at))
+
+    def _sampled_at(self, sampled_us, received_at):
+        """Maps a client timestamp to our clock, taking the least delayed frame as the reference."""
+        if not sampled_us:
+            return received_at
+        offset = received_at - sampled_us / 1_000_000
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+        else:
+            self.clock_offset += CLOCK_OFFSET_CREEP
+        return min(sampled_us / 1_000_000 + self.clock_offset, received_at)
+
+    def handle_motion(self, frame):
+        """Applies an OP_MOTION frame (received over TCP or the UDP channel). Never replies."""
+        seq, dx, dy = protocol.parse_motion(frame)
+        if seq:
+            if seq <= self.motion_seq:
+                return
+            self.motion_seq = seq
+        if self.motion is not None:
+            self.motion(dx, dy)
+
+    def close(self):
+        """Ends the connection's UDP session and arbiter membership. Engines call this when the connection closes."""
+        if self.session is not None:
+            self.sessions.release(self.session)
+            self.session = None
+        if self.arbiter is not None:
+            self.arbiter.leave(self)
+        if self.udp_token is not None:
+            self.udp_sessions.close(self.udp_token)
+            self.udp_token = None
+
+    def execute(self, step):
+        """Runs a step's action and returns the ACK/NACK bytes to send back."""
+        if self.arbiter is None:
+            return self.settle(step.frame, self._execute(step))
+        result = []
+        refused = self.arbiter.run(self, protocol.command_name(step.frame), lambda: result.append(self._execute(step)))
+        return self.settle(step.frame, self.reply(step.frame, False, refused) if refused else result[0])
+
+    def _execute(self, step):
+        dispatched_at = time.perf_counter()
+        error = None
+        try:
+            step.action()
+        except Exception as e:
+            error = e
+        return self._finish(step, error, dispatched_at, time.perf_counter())
+
+    def dispatch(self, step, send):
+        """
+        Hands a step to the injection worker. send(reply_bytes) is called with the ACK/NACK:
+        right away in "queued" mode, from the worker thread once the press returns otherwise.
+        """
+        def settled(reply):
+            send(self.settle(step.frame, reply))
+
+        if self.arbiter is None:
+            self._dispatch(step, settled)
+            return
+        refused = self.arbiter.run(self, protocol.command_name(step.frame), lambda: self._dispatch(step, settled))
+        if refused:
+            settled(self.reply(step.frame, False, refused))
+
+    def _dispatch(self, step, send):
+        command = protocol.command_name(step.frame)
+        if self.ack_mode == ACK_QUEUED:
+            def on_done(error, dispatched_at, done_at):
+                # The client already has its ACK, so a failed press can only be logged
+                if error is not None:
+                    self._log_failure(command, error)
+                else:
+                    self._record_latency(step, command, dispatched_at, done_at)
+
+            self.injector.submit(command, step.action, on_done)
+            server_queue = time.perf_counter() - step.received_at if step.received_at else 0.0
+            timing = protocol.Timing(protocol.command_sent_us(step.frame), int(server_queue * 1_000_000), 0)
+            send(self.reply(step.frame, True, timing=timing))
+            return
+
+        def on_done(error, dispatched_at, done_at):
+            send(self._finish(step, error, dispatched_at, done_at))
+
+        self.injector.submit(command, step.action, on_done)
+
+    def _finish(self, step, error, dispatched_at, done_at):
+        """Records the latency of an executed step and builds its ACK/NACK."""
+        command = protocol.command_name(step.frame)
+        if error is not None:
+            self._log_failure(command, error)
+            return self.reply(step.frame, False, str(error))
+        log.debug("%s Executed: %s", self.tag, command)
+        server_queue, injection = self._record_latency(step, command, dispatched_at, done_at)
+        timing = protocol.Timing(protocol.command_sent_us(step.frame),
+                                 int(server_queue * 1_000_000), int(injection * 1_000_000))
+        return self.reply(step.frame, True, timing=timing)
+
+    def _log_failure(self, command, error):
+        # On Windows, pyautogui actions can sometimes fail due to permissions
+        # or the target window not being active.
+        log.error("%s Error executing command %s: %s. Ensure the target application window (e.g., PowerPoint) "
+                  "is active and in the foreground; if issues persist, try running this server script "
+                  "with Administrator privileges.", self.tag, command, error)
+
+    def _record_latency(self, step, command, dispatched_at, done_at):
+        """Feeds the metrics recorder. Returns (server_queue, injection) in seconds."""
+        server_queue = dispatched_at - step.received_at if step.received_at else 0.0
+        injection = done_at - dispatched_at
+        if self.metrics is not None:
+            if step.received_at:
+                self.metrics.observe("server_queue", command, server_queue)
+                self.metrics.observe("server_total", command, done_at - step.received_at)
+            self.metrics.observe("injection", command, injection)
+        return server_queue, injection
+
+
+def serve_connection(conn, addr, commands, pairing_id=None, bufsize=1024, tag="[TCP SERVER]", metrics=None,
+                     injector=None, ack_mode=ACK_COMPLETED, udp_sessions=None, pointer=None, motion=None,
+                     arbiter=None, sessions=None):
+    """Blocking per-connection loop used by the thread-per-connection engine."""
+    log.info("%s Accepted connection from %s", tag, addr)
+    tune_tcp_socket(conn)
+    connection = ServerConnection(commands, pairing_id, addr, tag, metrics, injector, ack_mode,
+                                  udp_sessions=udp_sessions, pointer=pointer, motion=motion, arbiter=arbiter,
+                                  sessions=sessions)
+    send_lock = threading.Lock()  # The injection worker sends completed-mode ACKs from its own thread
+
+    def send(reply):
+        with send_lock:
+            try:
+                conn.sendall(reply)
+            except OSError:
+                pass  # Connection already gone; the read loop below notices and cleans up
+
+    connection.push = send
+    try:
+        while True:
+            conn.settimeout(connection.heartbeat_timeout)  # None (block) until the client announces heartbeats
+            data = conn.recv(bufsize)
+            if not data:
+                state = "after pairing" if connection.paired else "before pairing attempt"
+                log.info("%s Connection closed by %s %s.", tag, addr, state)
+                break
+            for step in connection.feed(data):
+                if step.action is not None and injector is not None:
+                    connection.dispatch(step, send)
+                    continue
+                reply = step.reply if step.action is None else connection.execute(step)
+                if reply:
+                    with send_lock:
+                        conn.sendall(reply)
+                if step.close:
+                    return
+    except protocol.ProtocolError as e:
+        log.warning("%s Protocol error from %s: %s. Dropping connection.", tag, addr, e)
+    except ConnectionResetError:
+        log.info("%s Connection reset by %s", tag, addr)
+    except socket.timeout:
+        if connection.heartbeat_timeout:
+            log.info("%s No heartbeat from %s for %.1f s. Dropping connection.", tag, addr,
+                     connection.heartbeat_timeout)
+        else:
+            log.warning("%s Socket timeout during communication with %s.", tag, addr)
+    except Exception as e:
+        log.error("%s Error during TCP communication with %s: %s", tag, addr, e)
+    finally:
+        connection.close()
+        conn.close()
+        log.info("%s Closed connection from %s", tag, addr)
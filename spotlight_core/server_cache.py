@@ -0,0 +1,178 @@
+# server_cache.py
+# On-disk cache of recently used Spotlight servers, for near-instant (re)connects.
+#
+# Discovery costs at least one broadcast round trip, and up to its timeout when packets are lost.
+# Yet the usual case is the same laptop reconnecting to the same presenter PC. The clients now
+# remember every server they worked with, keyed by pairing ID and server name, with the last IP,
+# port and TCP connect RTT. locate_server() connects straight to the cached endpoints while
+# discovery runs in the background, and takes whichever produces a working (paired) connection first.
+
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from spotlight_core import protocol
+from spotlight_core.log import get_logger
+from spotlight_core.sockopts import tune_tcp_socket
+
+log = get_logger("server_cache")
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".spotlight_remote", "servers.json")
+MAX_ENTRIES = 32  # Oldest entries are dropped beyond this
+MAX_AGE = 30 * 24 * 3600  # Seconds after which an entry is no longer tried
+MAX_CACHED_CANDIDATES = 3  # Most recently used endpoints raced per lookup
+CACHED_CONNECT_TIMEOUT = 1.0  # Seconds for a connect to a cached endpoint (discovery runs meanwhile)
+CONNECT_TIMEOUT = 5.0  # Seconds for a connect to a freshly discovered endpoint
+
+# A connected (and, with a handshake, paired) server. source is "cache" or "discovery".
+FoundServer = namedtuple("FoundServer", "ip port name sock decoder source connect_rtt")
+
+
+class ServerCache:
+    """
+    Recently seen servers as a small JSON file. path=None keeps them in memory only.
+    Thread-safe; every change is written straight away (atomically, via a temporary file).
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+            return [entry for entry in entries if isinstance(entry, dict) and {"ip", "port"} <= entry.keys()]
+        except (OSError, ValueError, TypeError) as e:
+            log.warning("[SERVER CACHE] Ignoring unreadable cache file %s: %s", self.path, e)
+            return []
+
+    def _save_locked(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.warning("[SERVER CACHE] Could not write %s: %s", self.path, e)
+
+    def lookup(self, pairing_id=None):
+        """Entries for this pairing ID that are younger than MAX_AGE, most recently used first."""
+        pairing_id = pairing_id or ""
+        oldest = time.time() - MAX_AGE
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries
+                       if entry.get("pairing_id", "") == pairing_id and entry.get("last_seen", 0) >= oldest]
+        return sorted(entries, key=lambda entry: entry.get("last_seen", 0), reverse=True)
+
+    def remember(self, pairing_id, ip, port, name, rtt=None):
+        """Records a server we just connected to (replaces its previous entry)."""
+        pairing_id = pairing_id or ""
+        entry = {"pairing_id": pairing_id, "name": name, "ip": ip, "port": port, "last_seen": time.time(),
+                 "rtt_ms": round(rtt * 1000, 3) if rtt is not None else None}
+        with self._lock:
+            # One entry per (pairing ID, name); a different name at the same endpoint replaces it too
+            self._entries = [old for old in self._entries
+                             if old.get("pairing_id", "") != pairing_id
+                             or (old.get("name") != name and (old["ip"], old["port"]) != (ip, port))]
+            self._entries.insert(0, entry)
+            del self._entries[self.max_entries:]
+            self._save_locked()
+
+    def forget(self, pairing_id, ip, port):
+        """Drops a cached endpoint that turned out to be the wrong server."""
+        pairing_id = pairing_id or ""
+        with self._lock:
+            before = len(self._entries)
+            self._entries = [old for old in self._entries
+                             if old.get("pairing_id", "") != pairing_id or (old["ip"], old["port"]) != (ip, port)]
+            if len(self._entries) != before:
+                self._save_locked()
+
+
+def locate_server(cache, pairing_id, discover_fn, handshake=None, connect_timeout=CONNECT_TIMEOUT,
+                  cached_connect_timeout=CACHED_CONNECT_TIMEOUT, tag="[TCP CLIENT]"):
+    """
+    Returns a FoundServer with a connected socket, or None if nothing could be reached.
+
+    discover_fn(cancel)       - runs discovery and returns (ip, port, name) or None; should give
+                                up early once the threading.Event `cancel` is set
+    handshake(sock, decoder)  - optional, e.g. pairing; returns True if this is our server
+
+    Cached endpoints are connected (and handshaken) at the same time as discovery runs. The
+    first connection that completes wins; the others are closed. The winner is remembered in the cache.
+    """
+    candidates = cache.lookup(pairing_id)[:MAX_CACHED_CANDIDATES]
+    results = queue.SimpleQueue()
+    cancel = threading.Event()
+    claim_lock = threading.Lock()
+    claimed = []
+
+    def attempt(ip, port, name, source, timeout):
+        started = time.perf_counter()
+        sock = None
+        try:
+            sock = socket.create_connection((ip, port), timeout=timeout)
+            rtt = time.perf_counter() - started
+            tune_tcp_socket(sock)
+            sock.settimeout(connect_timeout)  # For the handshake
+            decoder = protocol.FrameDecoder()
+            if handshake is not None and not handshake(sock, decoder):
+                if source == "cache":
+                    cache.forget(pairing_id, ip, port)
+                raise ConnectionError("handshake rejected")
+            sock.settimeout(None)
+        except (OSError, protocol.ProtocolError) as e:
+            log.debug("%s %s endpoint %s:%s not usable: %s", tag, source.capitalize(), ip, port, e)
+            if sock is not None:
+                sock.close()
+            results.put(None)
+            return
+        with claim_lock:
+            won = not claimed
+            claimed.append(source)
+        if not won:  # Someone else was faster
+            sock.close()
+            results.put(None)
+            return
+        results.put(FoundServer(ip, port, name, sock, decoder, source, rtt))
+
+    def run_discovery():
+        try:
+            server = discover_fn(cancel)
+        except Exception as e:
+            log.error("%s Discovery failed: %s", tag, e)
+            server = None
+        if server is None or cancel.is_set():
+            results.put(None)
+            return
+        attempt(server[0], server[1], server[2], "discovery", connect_timeout)
+
+    for entry in candidates:
+        log.debug("%s Trying cached server '%s' at %s:%s (last RTT %s ms)", tag, entry.get("name"),
+                  entry["ip"], entry["port"], entry.get("rtt_ms"))
+        threading.Thread(target=attempt, args=(entry["ip"], entry["port"], entry.get("name"), "cache",
+                                               cached_connect_timeout), name="cached-connect", daemon=True).start()
+    threading.Thread(target=run_discovery, name="background-discovery", daemon=True).start()
+
+    started = time.perf_counter()
+    for _ in range(len(candidates) + 1):
+        found = results.get()
+        if found is not None:
+            cancel.set()
+            log.info("%s Connected to '%s' at %s:%s via %s in %.1f ms", tag, found.name, found.ip, found.port,
+                     found.source, (time.perf_counter() - started) * 1000)
+            cache.remember(pairing_id, found.ip, found.port, found.name, found.connect_rtt)
+            return found
+    return None
@@ -0,0 +1,133 @@
+# sessions.py
+# Resumable sessions: reconnecting without the pairing round trip.
+#
+# Every reconnect used to repeat the pairing exchange and wait for its ACK before a command
+# could go out, and a click that was in flight when the connection dropped was either lost or,
+# if re-sent, possibly run twice. Now:
+#   - A client pairs and asks for a session token in the same packet (protocol.OP_RESUME).
+#   - After a drop it reconnects and sends OP_RESUME with the token, followed in the same packet
+#     by its unacknowledged commands with their original sequence numbers (0-RTT): they are on
+#     their way before the server has said a word.
+#   - The server keeps each session's commands across its connections (server.CommandOutcomes).
+#     A command received before the drop is not run a second time; the re-sent copy gets the
+#     original's ACK/NACK, once it exists, so a click pending during the drop runs exactly once.
+# A session can be resumed for `ttl` seconds after its last connection closed. A server that
+# restarted knows no sessions: it NACKs the resume and closes without running anything, and
+# the client pairs again.
+
+import os
+import threading
+import time
+
+from spotlight_core import protocol
+from spotlight_core.server import CommandOutcomes
+
+SESSION_TTL = 300  # Seconds a session stays resumable after its last connection closed
+MAX_SESSIONS = 256  # Oldest idle sessions are forgotten beyond this
+
+
+class ResumeRejected(protocol.ProtocolError):
+    """The server does not know the session (it restarted, or the session expired)."""
+
+
+class ResumableSession:
+    """One client session: its token and the outcomes of the commands it has sent."""
+
+    def __init__(self, token, pairing_id, outcomes=None):
+        self.token = token
+        self.pairing_id = pairing_id
+        self.connections = 0
+        self.released_at = 0.0
+        self.outcomes = outcomes if outcomes is not None else CommandOutcomes()
+
+
+class ResumableSessions:
+    """The server's sessions, shared by all connections. Thread-safe."""
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.issued = 0
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._sessions = {}  # token -> ResumableSession
+
+    def issue(self, pairing_id, outcomes=None):
+        """A new session for a freshly paired connection, going on with its command outcomes."""
+        session = ResumableSession(os.urandom(protocol.RESUME_TOKEN_SIZE), pairing_id, outcomes)
+        session.connections = 1
+        with self._lock:
+            self._expire_locked()
+            self._sessions[session.token] = session
+            self.issued += 1
+        return session
+
+    def resume(self, token, pairing_id):
+        """The session for token, attached to one more connection, or None if it is unknown or expired."""
+        with self._lock:
+            self._expire_locked()
+            session = self._sessions.get(token)
+            if session is None or session.pairing_id != pairing_id:
+                return None
+            session.connections += 1
+            self.resumed += 1
+        return session
+
+    def release(self, session):
+        """One of the session's connections closed."""
+        with self._lock:
+            session.connections -= 1
+            session.released_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "issued": self.issued, "resumed": self.resumed}
+
+    def _expire_locked(self):
+        now = time.monotonic()
+        idle = [s for s in self._sessions.values() if s.connections <= 0]
+        for session in idle:
+            if now - session.released_at > self.ttl:
+                del self._sessions[session.token]
+        if len(self._sessions) >= self.max_sessions:
+            for session in sorted(idle, key=lambda s: s.released_at):
+                if len(self._sessions) < self.max_sessions:
+                    break
+                self._sessions.pop(session.token, None)
+
+
+def pair_resumable(sock, decoder, pairing_id, bufsize=1024):
+    """
+    protocol.pair() that also asks for a session token, in the same packet. Uses the socket's
+    timeout. Returns (paired, reply_text, token); token is None if the server has no sessions.
+    """
+    sock.sendall(protocol.encode_pair(pairing_id) + protocol.encode_resume())
+    reply = protocol.recv_frame(sock, decoder, bufsize)
+    if reply is None:
+        return False, None, None
+    if not protocol.is_pairing_ack(reply):
+        return False, protocol.format_reply(reply), None
+    grant = protocol.recv_frame(sock, decoder, bufsize)  # Sent right behind the pairing ACK
+    token = protocol.parse_resume(grant) if grant is not None else None
+    return True, protocol.format_reply(reply), token or None
+
+
+def resume(sock, decoder, token, commands=(), bufsize=1024):
+    """
+    Resumes a session on a fresh connection (e.g. as locate_server's handshake), sending
+    `commands` ((seq, command) pairs not acknowledged before the drop) in the same packet. Uses
+    the socket's timeout. Returns True once the server accepted the session; the commands' ACKs
+    follow on the connection. Raises ResumeRejected if the server refused.
+    """
+    sent_us = int(time.perf_counter() * 1_000_000)
+    sock.sendall(protocol.encode_resume(token)
+                 + b"".join(protocol.encode_command(command, seq, sent_us) for seq, command in commands))
+    reply = protocol.recv_frame(sock, decoder, bufsize)
+    if reply is None:
+        raise ResumeRejected("server closed the connection")
+    parsed = protocol.parse_reply(reply)
+    if parsed is None or parsed.opcode != protocol.OP_RESUME:
+        raise protocol.ProtocolError("unexpected reply to resume")
+    if not parsed.ok:
+        raise ResumeRejected(parsed.reason or "session unknown")
+    return True
@@ -0,0 +1,134 @@
+# smoothing.py
+# Smoothing and prediction for the streamed spotlight pointer.
+#
+# Pointer positions arrive with Wi-Fi jitter: bunched up, late, now and then not at all for a
+# few frames. Drawn as they come, the spotlight stutters. PointerSmoother sits between the
+# receiver and the overlay:
+#   - A One-Euro filter per axis (Casiez, Roussel & Vogel, CHI 2012): a low-pass filter whose
+#     cutoff rises with speed. A resting pointer gets strong smoothing and stays steady; a fast
+#     sweep gets little and barely lags. min_cutoff and beta set that trade-off.
+#   - Dead reckoning: the overlay asks for the position on every frame, and between samples the
+#     filtered velocity carries the spotlight on. `prediction` seconds of lead make up for the
+#     filter lag (and part of the network delay). The client stops sending while the pointer
+#     stands still, so when samples stop coming (two usual intervals) the spotlight eases onto
+#     the last position received over max_extrapolation seconds.
+#   - Samples are placed at the time the client took them (see server.ServerConnection), not at
+#     their arrival, so a late packet does not look like a jerk of the pointer.
+#
+# The lag the filter adds (its time constant at the current cutoff, minus the prediction lead)
+# is recorded per sample as the "pointer_smoothing" stage of a metrics.LatencyRecorder, next to
+# gauges for the arrival jitter it is smoothing out.
+
+import math
+import threading
+import time
+
+MIN_CUTOFF = 1.0  # Hz at rest; lower = steadier, but a slow pointer lags more
+BETA = 20.0  # Cutoff increase per screen width per second of speed; higher = less lag when moving fast
+D_CUTOFF = 1.0  # Hz, for the velocity estimate
+PREDICTION = 0.0  # Seconds to extrapolate ahead of the filtered position
+MAX_EXTRAPOLATION = 0.1  # Seconds past the last sample the position is extrapolated at most
+
+
+def _alpha(cutoff, dt):
+    tau = 1.0 / (2 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter:
+    """One axis. filter(value, t) returns the smoothed value; velocity is in units per second."""
+
+    def __init__(self, min_cutoff=MIN_CUTOFF, beta=BETA, d_cutoff=D_CUTOFF):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.value = None
+        self.velocity = 0.0
+        self.cutoff = min_cutoff
+        self._t = None
+
+    def filter(self, value, t):
+        if self._t is None:
+            self.value, self._t = value, t
+            return value
+        dt = t - self._t
+        if dt <= 0:
+            return self.value  # Same-instant sample (a burst); keep the current estimate
+        self._t = t
+        raw_velocity = (value - self.value) / dt
+        a = _alpha(self.d_cutoff, dt)
+        self.velocity = a * raw_velocity + (1 - a) * self.velocity
+        self.cutoff = self.min_cutoff + self.beta * abs(self.velocity)
+        a = _alpha(self.cutoff, dt)
+        self.value = a * value + (1 - a) * self.value
+        return self.value
+
+
+class PointerSmoother:
+    """
+    Smooths (x, y) pointer positions given as screen fractions. update() is called for each
+    received position, position() by the renderer on each frame; both are thread-safe.
+    """
+
+    def __init__(self, min_cutoff=MIN_CUTOFF, beta=BETA, d_cutoff=D_CUTOFF, prediction=PREDICTION,
+                 max_extrapolation=MAX_EXTRAPOLATION, metrics=None):
+        self.prediction = prediction
+        self.max_extrapolation = max_extrapolation
+        self.metrics = metrics
+        self._x = OneEuroFilter(min_cutoff, beta, d_cutoff)
+        self._y = OneEuroFilter(min_cutoff, beta, d_cutoff)
+        self._lock = threading.Lock()
+        self._last_at = None  # Sample time of the newest position
+        self._last = None  # Newest position as received
+        self._arrived_at = None
+        self._last_interval = None
+        self._sample_interval = 0.0  # Average time between samples
+        self.samples = 0
+        self.lag = 0.0  # Seconds the filter adds at the current speed (after the prediction lead)
+        self.jitter = 0.0  # Smoothed variation of the time between samples, in seconds
+
+    def update(self, x, y, sampled_at=None, now=None):
+        """A received position. sampled_at is when the client took it (our clock); None = now."""
+        now = time.perf_counter() if now is None else now
+        sampled_at = now if sampled_at is None else sampled_at
+        with self._lock:
+            if self._arrived_at is not None:
+                interval = now - self._arrived_at
+                if self._last_interval is not None:  # Inter-arrival jitter as in RFC 3550
+                    self.jitter += (abs(interval - self._last_interval) - self.jitter) / 16
+                self._last_interval = interval
+            self._arrived_at = now
+            if self._last_at is not None and sampled_at <= self._last_at:
+                return  # Taken no later than the newest one we have
+            if self._last_at is not None:
+                self._sample_interval += (sampled_at - self._last_at - self._sample_interval) / 8
+            self._last_at = sampled_at
+            self._last = (x, y)
+            self._x.filter(x, sampled_at)
+            self._y.filter(y, sampled_at)
+            self.samples += 1
+            cutoff = max(self._x.cutoff, self._y.cutoff)  # The axis that is moving (a still one has no lag)
+            self.lag = max(0.0, 1.0 / (2 * math.pi * cutoff) - self.prediction)
+        if self.metrics is not None:
+            self.metrics.observe("pointer_smoothing", "POINTER", self.lag)
+
+    def position(self, now=None):
+        """The position to draw now, or None before the first sample."""
+        now = time.perf_counter() if now is None else now
+        with self._lock:
+            if self._last_at is None:
+                return None
+            since = now - self._last_at
+            ahead = min(since + self.prediction, self.max_extrapolation)
+            x = self._x.value + self._x.velocity * ahead
+            y = self._y.value + self._y.velocity * ahead
+            overdue = since - 2 * self._sample_interval
+            settle = min(max(overdue / self.max_extrapolation, 0.0), 1.0) if self.max_extrapolation else 1.0
+            if settle > 0:  # The stream has paused: ease onto the last position received
+                x += (self._last[0] - x) * settle
+                y += (self._last[1] - y) * settle
+        return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+    def stats(self):
+        return {"samples": self.samples, "lag_ms": round(self.lag * 1000, 3),
+                "jitter_ms": round(self.jitter * 1000, 3)}
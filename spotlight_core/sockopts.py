@@ -0,0 +1,42 @@
+# sockopts.py
+# TCP socket options for the Spotlight command connections.
+#
+# Commands are a few bytes each. With Nagle's algorithm on, a frame written while an earlier
+# one is still unacknowledged waits for that ACK, and the peer delays ACKs by up to 40-200 ms.
+# TCP_NODELAY turns that off. TCP keepalive lets the OS notice a peer that disappeared without
+# closing the connection (Wi-Fi drop, laptop lid closed) even when the heartbeat is disabled.
+
+import socket
+import sys
+
+from spotlight_core.log import get_logger
+
+log = get_logger("sockopts")
+
+KEEPALIVE_IDLE = 10  # Seconds of silence before the first keepalive probe
+KEEPALIVE_INTERVAL = 3  # Seconds between probes
+KEEPALIVE_COUNT = 3  # Unanswered probes before the OS drops the connection
+
+
+def tune_tcp_socket(sock, nodelay=True, keepalive=True, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL,
+                    count=KEEPALIVE_COUNT):
+    """Applies TCP_NODELAY and keepalive settings to a connected TCP socket. Failures are logged, not raised."""
+    try:
+        if nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not keepalive:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if sys.platform == "win32":
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, int(idle * 1000), int(interval * 1000)))
+            return
+        if hasattr(socket, "TCP_KEEPIDLE"):  # Linux, recent macOS
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle))
+        elif hasattr(socket, "TCP_KEEPALIVE"):  # Older macOS name for the same option
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, int(idle))
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(interval))
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, int(count))
+    except (OSError, ValueError, AttributeError) as e:  # AttributeError: asyncio's socket wrapper has no ioctl()
+        log.debug("[SOCKET] Could not apply TCP options: %s", e)
@@ -0,0 +1,165 @@
+# startup.py
+# Fast cold start for the Spotlight servers.
+#
+# A server used to import everything (asyncio, pyautogui, tkinter for the overlay) and open its
+# input backend before it bound a single socket, so a client started at the same moment found
+# nothing for half a second or more. Now:
+#   - EarlyListener binds the command and discovery sockets first thing and answers discovery
+#     from a small thread. Connections made meanwhile wait in the listen backlog.
+#   - The engine (asyncio or threaded) takes both sockets over once it is imported and ready.
+#   - The input backend opens in the background (injectors.LazyInjector); a command that
+#     arrives first waits for it.
+#
+# The benchmark starts a server process and times how long until it answers discovery:
+#   python -m spotlight_core.startup spotlight_server.py
+#   python -m spotlight_core.startup --pairing-id 1234 Version2/spotlight_server.py
+
+import socket
+import sys
+import threading
+import time
+
+from spotlight_core.discovery import DISCOVERY_MESSAGE, DISCOVERY_PREFIX, join_multicast_group
+from spotlight_core.log import get_logger
+
+log = get_logger("startup")
+
+STARTUP_TARGET = 0.05  # Seconds from process start to the first discovery answer
+POLL_INTERVAL = 0.02  # Seconds the early responder blocks at most before checking for a take-over
+
+
+class EarlyListener:
+    """
+    The command (TCP) and discovery (UDP) sockets, bound before the server imports its engine.
+    reply(message, client_address) returns the bytes to answer a discovery datagram with, or None.
+    """
+
+    def __init__(self, command_port, discovery_port, reply, multicast_group=None, backlog=128,
+                 host="0.0.0.0", bufsize=1024, tag="[UDP DISCOVERY]"):
+        self.command_port = command_port
+        self.discovery_port = discovery_port
+        self.reply = reply
+        self.multicast_group = multicast_group
+        self.backlog = backlog
+        self.host = host
+        self.bufsize = bufsize
+        self.tag = tag
+        self.tcp_socket = None
+        self.udp_socket = None
+        self.answered = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Binds both sockets and starts answering discovery. Raises OSError if a port is taken."""
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcp_socket.bind((self.host, self.command_port))
+            tcp_socket.listen(self.backlog)
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp_socket.bind(("", self.discovery_port))
+        except OSError:
+            tcp_socket.close()
+            udp_socket.close()
+            raise
+        join_multicast_group(udp_socket, self.multicast_group, self.tag)
+        udp_socket.settimeout(POLL_INTERVAL)
+        self.tcp_socket, self.udp_socket = tcp_socket, udp_socket
+        self._thread = threading.Thread(target=self._answer, name="early-discovery", daemon=True)
+        self._thread.start()
+
+    def take_over(self):
+        """Stops answering and returns (tcp_socket, udp_socket) for the engine."""
+        self._stopped.set()
+        self._thread.join()
+        self.udp_socket.settimeout(None)  # Datagrams sent meanwhile wait in the socket's buffer
+        if self.answered:
+            log.debug("%s Answered %s discovery request(s) during start-up", self.tag, self.answered)
+        return self.tcp_socket, self.udp_socket
+
+    def _answer(self):
+        while not self._stopped.is_set():
+            try:
+                message, client_address = self.udp_socket.recvfrom(self.bufsize)
+            except socket.timeout:
+                continue
+            except OSError as e:  # e.g. a reset reported for an earlier reply on Windows
+                log.debug("%s Error during start-up: %s", self.tag, e)
+                continue
+            try:
+                response = self.reply(message, client_address)
+                if response:
+                    self.udp_socket.sendto(response, client_address)
+                    self.answered += 1
+            except Exception as e:
+                log.error("%s Error handling discovery message from %s: %s", self.tag, client_address, e)
+
+
+def measure(command, discovery_port=50000, message=DISCOVERY_MESSAGE, timeout=10.0, interval=0.002, cwd=None):
+    """
+    Starts `command` (an argument list) and sends a discovery request to 127.0.0.1 every
+    `interval` seconds. Returns the seconds from starting the process to the first answer, or
+    None if none came within timeout. The process is terminated afterwards.
+    """
+    import subprocess  # The benchmark's imports stay out of the servers that import this module
+
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(interval)
+    data = message.encode()
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout and process.poll() is None:
+            try:
+                probe.sendto(data, ("127.0.0.1", discovery_port))
+                probe.recvfrom(1024)
+                return time.perf_counter() - started
+            except socket.timeout:
+                continue
+            except ConnectionResetError:  # Windows: nothing listening on the port yet
+                time.sleep(interval)
+        return None
+    finally:
+        probe.close()
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(argv=None):
+    import argparse
+    import statistics
+
+    parser = argparse.ArgumentParser(prog="python -m spotlight_core.startup",
+                                     description="Times how long a Spotlight server takes to answer discovery.")
+    parser.add_argument("script", help="server script to start, e.g. spotlight_server.py")
+    parser.add_argument("args", nargs="*", help="arguments for the script")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=50000, help="the server's discovery port")
+    parser.add_argument("--pairing-id", help="pairing ID, for servers that require one (Version 2)")
+    parser.add_argument("--target", type=float, default=STARTUP_TARGET * 1000, help="milliseconds")
+    options = parser.parse_args(argv)
+
+    message = DISCOVERY_PREFIX + options.pairing_id if options.pairing_id else DISCOVERY_MESSAGE
+    results = []
+    for run in range(options.runs):
+        elapsed = measure([sys.executable, options.script] + options.args, options.port, message)
+        if elapsed is None:
+            print(f"run {run + 1}: no answer (did the server start? is the port free?)")
+            return 1
+        results.append(elapsed * 1000)
+        print(f"run {run + 1}: {results[-1]:.1f} ms")
+    median = statistics.median(results)
+    print(f"median {median:.1f} ms, min {min(results):.1f} ms, max {max(results):.1f} ms "
+          f"(target {options.target:.0f} ms)")
+    return 0 if median <= options.target else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+# udp_commands.py
+# Optional UDP command channel, next to the TCP command connection.
+#
+# Over TCP a lost segment holds back every later click until it is retransmitted
+# (head-of-line blocking), which on lossy Wi-Fi means 200 ms+ stalls. Here each click is a
+# datagram of its own:
+#   - The session is set up on the paired TCP connection (protocol.OP_UDP_SESSION), so only
+#     a client that passed pairing gets a token, and it stops working when that connection closes.
+#   - Commands carry the same sequence numbers as on TCP, from one counter per connection. The
+#     server executes each one once (server.CommandOutcomes, shared with the TCP connection) and
+#     ACKs it over UDP; a duplicate is not executed but gets the same ACK/NACK, once it exists.
+#   - The client repeats its most recent unacknowledged commands in every datagram it sends
+#     (so the next click also carries a lost one), and re-sends only the commands that are
+#     still unacknowledged after retransmit_interval (selective retransmit).
+# The TCP connection stays open for pairing, heartbeats and as the fallback: a command that
+# gets no UDP ACK is sent over TCP under its own sequence number, so it still runs only once.
+
+import itertools
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from spotlight_core import protocol
+from spotlight_core.log import get_logger
+from spotlight_core.metrics import record_reply
+from spotlight_core.server import Step
+
+log = get_logger("udp_commands")
+
+REDUNDANCY = 2  # Unacknowledged earlier commands repeated in each new datagram
+RETRANSMIT_INTERVAL = 0.05  # Seconds without an ACK before a command is sent again
+MAX_TRANSMISSIONS = 6  # Sends per command (first one included) before it counts as failed
+
+# A command sent over UDP and not acknowledged yet
+UdpPending = namedtuple("UdpPending", "seq command frame first_sent_at last_sent_at transmissions captured_at")
+
+
+class UdpSessions:
+    """Session tokens handed out over paired TCP connections. Thread-safe."""
+
+    def __init__(self, port):
+        self.port = port  # UDP command port sent to clients with their token
+        self._lock = threading.Lock()
+        self._sessions = {}  # token -> server.ServerConnection
+
+    def open(self, connection):
+        token = os.urandom(protocol.UDP_TOKEN_SIZE)
+        with self._lock:
+            self._sessions[token] = connection
+        return token
+
+    def close(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def get(self, token):
+        with self._lock:
+            return self._sessions.get(token)
+
+
+def run_step(connection, step, reply):
+    """Runs a UDP command like the threaded TCP engine does: on the injection worker, else inline."""
+    if connection.injector is not None:
+        connection.dispatch(step, reply)
+    else:
+        reply(connection.execute(step))
+
+
+class UdpCommandHandler:
+    """
+    Server side of the channel, without I/O of its own. handle() gets each received datagram
+    and a send(bytes) function that answers its sender; run(connection, step, reply) executes
+    a new command and passes its ACK/NACK to reply(bytes). send() must work from any thread:
+    a duplicate is answered by whichever thread finishes the first copy.
+    """
+
+    def __init__(self, sessions, run=run_step, tag="[UDP COMMANDS]"):
+        self.sessions = sessions
+        self.run = run
+        self.tag = tag
+
+    def handle(self, data, addr, send):
+        received_at = time.perf_counter()
+        try:
+            token, frames = protocol.parse_datagram(data)
+        except protocol.ProtocolError as e:
+            log.debug("%s Ignoring datagram from %s: %s", self.tag, addr, e)
+            return
+        connection = self.sessions.get(token)
+        if connection is None:
+            log.debug("%s Ignoring datagram with an unknown session token from %s", self.tag, addr)
+            return
+
+        def reply(frame_bytes):
+            send(protocol.encode_datagram(token, frame_bytes))
+
+        for frame in frames:
+            if frame.opcode in (protocol.OP_POINTER, protocol.OP_MOTION):
+                try:
+                    if frame.opcode == protocol.OP_POINTER:
+                        connection.handle_pointer(frame)
+                    else:
+                        connection.handle_motion(frame)
+                except protocol.ProtocolError as e:
+                    log.debug("%s Ignoring pointer frame from %s: %s", self.tag, addr, e)
+                continue
+            if not protocol.is_command(frame):
+                continue
+            new, earlier_reply = connection.admit(frame, reply)
+            if not new:
+                if earlier_reply:
+                    reply(earlier_reply)  # The first one may have been lost
+                continue
+            action = connection.commands.lookup(frame)
+            if action is None:
+                log.warning("%s Unknown command: %s from %s", self.tag, protocol.command_name(frame), addr)
+                reply(connection.settle(frame, connection.reply(frame, False)))
+                continue
+            log.debug("%s Received command: %s from %s", self.tag, protocol.command_name(frame), addr)
+            self.run(connection, Step(frame, action, None, False, received_at), reply)
+
+
+def serve_udp_commands(sock, handler, bufsize=1024):
+    """Blocking receive loop for the threaded engine."""
+    def send(reply, addr):
+        try:
+            sock.sendto(reply, addr)
+        except OSError:
+            pass  # Socket closed, or an ICMP error from an earlier send; the client retransmits
+
+    while True:
+        try:
+            data, addr = sock.recvfrom(bufsize)
+        except ConnectionResetError:  # Windows reports an ICMP port unreachable from an earlier send
+            continue
+        except OSError:
+            break  # Socket closed
+        handler.handle(data, addr, lambda reply, addr=addr: send(reply, addr))
+
+
+def start_udp_command_server(sessions, host="", bufsize=1024, tag="[UDP COMMANDS]"):
+    """Binds sessions.port and serves it on a daemon thread. Returns the socket, or None if binding failed."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((host, sessions.port))
+    except OSError as e:
+        log.error("%s Error binding to UDP port %s: %s. UDP commands disabled.", tag, sessions.port, e)
+        sock.close()
+        return None
+    handler = UdpCommandHandler(sessions, tag=tag)
+    threading.Thread(target=serve_udp_commands, args=(sock, handler, bufsize), name="udp-commands",
+                     daemon=True).start()
+    log.info("%s Listening for commands on UDP port %s", tag, sessions.port)
+    return sock
+
+
+def request_udp_session(sock, decoder, bufsize=1024, timeout=2.0):
+    """
+    Asks the server for a UDP session on a paired TCP connection that has no reader thread yet.
+    Returns (port, token), or None if the server has no UDP channel.
+    """
+    sock.settimeout(timeout)
+    try:
+        sock.sendall(protocol.encode_udp_session())
+        frame = protocol.recv_frame(sock, decoder, bufsize)
+    finally:
+        sock.settimeout(None)
+    if frame is None:
+        raise ConnectionResetError("server closed the connection")
+    return protocol.parse_udp_session(frame)
+
+
+class UdpCommandSender:
+    """
+    Client side of the channel. send() returns as soon as the datagram is out; a reader thread
+    matches ACKs, repeats unacknowledged commands and gives up after max_transmissions sends.
+
+    `seqs` is the iterator of sequence numbers shared with the connection's
+    pipeline.PipelinedSender, so a command can fall back to TCP under the number it had here.
+
+    Callbacks run on the reader thread:
+      on_reply(command, reply, rtt_seconds)
+      on_failure(command, captured_at, reason, seq) - e.g. to send the command over TCP instead
+    """
+
+    def __init__(self, server_address, token, redundancy=REDUNDANCY, retransmit_interval=RETRANSMIT_INTERVAL,
+                 max_transmissions=MAX_TRANSMISSIONS, on_reply=None, on_failure=None, bufsize=1024, metrics=None,
+                 seqs=None):
+        self.token = token
+        self.redundancy = redundancy
+        self.retransmit_interval = retransmit_interval
+        self.max_transmissions = max_transmissions
+        self.on_reply = on_reply
+        self.on_failure = on_failure
+        self.bufsize = bufsize
+        self.metrics = metrics
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(server_address)
+        self.sock.settimeout(retransmit_interval / 2)
+
+        self._lock = threading.Lock()
+        self._seqs = seqs if seqs is not None else itertools.count(1)
+        self._unacked = {}  # seq -> UdpPending, in send order
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_loop, name="udp-command-reader", daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self):
+        return not self._closed
+
+    def send(self, command, captured_at=None):
+        """Sends a command. Returns its sequence number, or None if the sender is closed."""
+        now = time.perf_counter()
+        with self._lock:
+            if self._closed:
+                return None
+            seq = next(self._seqs)
+            frame = protocol.encode_command(command, seq, int(now * 1_000_000))
+            # Piggyback the newest earlier commands that are still unacknowledged
+            extra = list(self._unacked.values())[-self.redundancy:] if self.redundancy else []
+            self._unacked[seq] = UdpPending(seq, command, frame, now, now, 1, captured_at)
+            self._send_locked([frame] + [entry.frame for entry in extra])
+        return seq
+
+    def send_unreliable(self, frame):
+        """Sends an encoded frame that needs no ACK (e.g. a pointer position) in a datagram of its own."""
+        with self._lock:
+            if not self._closed:
+                self._send_locked([frame])
+
+    def take_unacked(self):
+        """Returns the unacknowledged commands (UdpPending, in send order) and forgets them."""
+        with self._lock:
+            pending = list(self._unacked.values())
+            self._unacked.clear()
+        return pending
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self.sock.close()
+
+    def _send_locked(self, frames):
+        try:
+            self.sock.send(protocol.encode_datagram(self.token, b"".join(frames)))
+        except OSError as e:  # e.g. ICMP port unreachable from an earlier datagram; retransmits cover it
+            log.debug("[UDP COMMANDS] Send failed: %s", e)
+
+    def _read_loop(self):
+        while not self._closed:
+            try:
+                data = self.sock.recv(self.bufsize)
+            except socket.timeout:
+                data = None
+            except OSError:
+                if self._closed:
+                    break
+                data = None  # ConnectionRefused etc. from an ICMP error; keep going
+            if data:
+                self._handle_datagram(data)
+            self._retransmit_overdue()
+
+    def _handle_datagram(self, data):
+        try:
+            token, frames = protocol.parse_datagram(data)
+        except protocol.ProtocolError:
+            return
+        if token != self.token:
+            return
+        for frame in frames:
+            reply = protocol.parse_reply(frame)
+            if reply is None:
+                continue
+            with self._lock:
+                entry = self._unacked.pop(reply.seq, None)
+            if entry is None:
+                continue  # Duplicate ACK
+            received_at = time.perf_counter()
+            if reply.sent_us:  # Replies without timing (older servers) are not recorded
+                record_reply(self.metrics, entry.command, reply, received_at, entry.captured_at)
+            if self.on_reply:
+                self.on_reply(entry.command, reply, received_at - entry.first_sent_at)
+
+    def _retransmit_overdue(self):
+        now = time.perf_counter()
+        failed = []
+        with self._lock:
+            due = []
+            for seq, entry in list(self._unacked.items()):
+                if now - entry.last_sent_at < self.retransmit_interval:
+                    continue
+                if entry.transmissions >= self.max_transmissions:
+                    failed.append(self._unacked.pop(seq))
+                    continue
+                entry = entry._replace(last_sent_at=now, transmissions=entry.transmissions + 1)
+                self._unacked[seq] = entry
+                due.append(entry.frame)
+            if due:
+                self._send_locked(due)
+        for entry in failed:
+            if self.on_failure:
+                self.on_failure(entry.command, entry.captured_at,
+                                f"no UDP ACK after {entry.transmissions} transmissions", entry.seq)
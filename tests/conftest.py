@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts import spotlight_core from the repository root; so do the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+import pytest
+
+from spotlight_core import protocol
+from spotlight_core.aio_server import AsyncSpotlightServer
+from spotlight_core.injectors import RecordingInjector
+from spotlight_core.server import CommandTable
+
+
+def run_server(test, **kwargs):
+    """Runs test(server, port) against an AsyncSpotlightServer on a free loopback port."""
+    injector = RecordingInjector()
+    commands = CommandTable({"NEXT": lambda: injector.press("right")})
+
+    async def main():
+        server = AsyncSpotlightServer(commands, "1234", host="127.0.0.1", port=0, discovery_port=None, **kwargs)
+        await server.start()
+        try:
+            port = server._tcp_server.sockets[0].getsockname()[1]
+            await asyncio.wait_for(test(server, port), 5.0)
+        finally:
+            await server.stop()
+            server._executor.shutdown()
+
+    asyncio.run(main())
+    return injector
+
+
+async def connect(port, pair=True):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    decoder = protocol.FrameDecoder()
+    if pair:
+        writer.write(protocol.encode_pair("1234"))
+        [reply] = await read_frames(reader, decoder, 1)
+        assert protocol.is_pairing_ack(reply)
+    return reader, writer, decoder
+
+
+async def read_frames(reader, decoder, count):
+    frames = []
+    while len(frames) < count:
+        data = await reader.read(1024)
+        if not data:
+            break
+        frames += decoder.feed(data)
+    return frames
+
+
+async def closed_within(reader, seconds):
+    """Seconds until the server closed the connection; fails if it stays open longer."""
+    started = time.monotonic()
+    assert await asyncio.wait_for(reader.read(1024), seconds) == b""
+    return time.monotonic() - started
+
+
+def test_commands_are_run_and_acknowledged():
+    async def test(server, port):
+        reader, writer, decoder = await connect(port)
+        writer.write(b"".join(protocol.encode_command("NEXT", seq) for seq in range(1, 11)))
+        replies = [protocol.parse_reply(f) for f in await read_frames(reader, decoder, 10)]
+        assert [(r.ok, r.seq) for r in replies] == [(True, seq) for seq in range(1, 11)]
+        writer.close()
+
+    assert run_server(test).presses == 10
+
+
+def test_connections_beyond_the_cap_are_refused():
+    async def test(server, port):
+        first = await connect(port)
+        reader, writer, _ = await connect(port, pair=False)
+        await closed_within(reader, 1.0)
+        first[1].close()
+        await asyncio.sleep(0.05)
+        assert server.connection_count == 0
+        writer.close()
+
+    run_server(test, max_connections=1)
+
+
+def test_connection_that_never_pairs_is_dropped():
+    async def test(server, port):
+        reader, writer, _ = await connect(port, pair=False)
+        await closed_within(reader, 1.0)
+        writer.close()
+
+    run_server(test, pairing_timeout=0.2)
+
+
+def test_pairing_deadline_covers_the_whole_handshake():
+    async def test(server, port):
+        reader, writer, _ = await connect(port, pair=False)
+        pairing = protocol.encode_pair("1234")
+
+        async def trickle():
+            for byte in pairing[:-1]:  # Never completes the frame
+                writer.write(bytes([byte]))
+                await asyncio.sleep(0.05)
+
+        feeding = asyncio.ensure_future(trickle())
+        assert await closed_within(reader, 1.0) < 0.5
+        feeding.cancel()
+        writer.close()
+
+    run_server(test, pairing_timeout=0.2)
+
+
+def test_idle_paired_connection_is_dropped():
+    async def test(server, port):
+        reader, writer, _ = await connect(port)
+        await closed_within(reader, 1.0)
+        writer.close()
+
+    run_server(test, idle_timeout=0.2)
+
+
+def test_missed_heartbeats_drop_the_connection_before_the_idle_timeout():
+    async def test(server, port):
+        reader, writer, decoder = await connect(port)
+        writer.write(protocol.encode_ping(1, interval_ms=50))
+        [pong] = await read_frames(reader, decoder, 1)
+        assert pong.opcode == protocol.OP_PONG
+        assert await closed_within(reader, 1.0) < 0.5  # 3 missed intervals, not idle_timeout
+
+    run_server(test, idle_timeout=60)
+
+
+@pytest.mark.parametrize("bad", [b"\xa1\x00", b"\xa2\x01\x10"])
+def test_protocol_error_drops_only_that_connection(bad):
+    async def test(server, port):
+        good_reader, good_writer, decoder = await connect(port)
+        reader, writer, _ = await connect(port)
+        writer.write(bad)
+        await closed_within(reader, 1.0)
+        good_writer.write(protocol.encode_command("NEXT", 1))
+        [reply] = await read_frames(good_reader, decoder, 1)
+        assert protocol.parse_reply(reply).ok
+        good_writer.close()
+
+    run_server(test)
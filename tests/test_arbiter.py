@@ -0,0 +1,138 @@
+import pytest
+
+from spotlight_core import arbiter, protocol
+from spotlight_core.arbiter import CommandArbiter
+
+
+class Connection:
+    def __init__(self, ip, port=5000):
+        self.addr = (ip, port)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(arbiter, "time", clock)
+    return clock
+
+
+def decode_one(data):
+    [frame] = protocol.FrameDecoder().feed(data)
+    return frame
+
+
+def run(arb, connection, command, started):
+    return arb.run(connection, command, lambda: started.append(command))
+
+
+def test_first_navigating_controller_takes_the_floor(clock):
+    arb = CommandArbiter(floor_idle_timeout=30)
+    a, b = Connection("10.0.0.1"), Connection("10.0.0.2")
+    started = []
+    assert run(arb, a, "NEXT", started) is None
+    assert run(arb, b, "NEXT", started) == "FLOOR_HELD:10.0.0.1:5000"
+    assert started == ["NEXT"]
+    assert arb.floor is a
+    assert arb.stats()["rejected"] == 1
+
+
+def test_commands_without_the_floor_pass(clock):
+    arb = CommandArbiter()
+    a, b = Connection("10.0.0.1"), Connection("10.0.0.2")
+    started = []
+    run(arb, a, "NEXT", started)
+    assert run(arb, b, "LASER_ON", started) is None
+    assert started == ["NEXT", "LASER_ON"]
+    assert arb.seq == 2
+
+
+def test_idle_holder_loses_the_floor(clock):
+    arb = CommandArbiter(floor_idle_timeout=30)
+    a, b = Connection("10.0.0.1"), Connection("10.0.0.2")
+    started = []
+    run(arb, a, "NEXT", started)
+    clock.now += 29
+    assert run(arb, b, "NEXT", started) is not None
+    clock.now += 1
+    assert run(arb, b, "NEXT", started) is None
+    assert arb.floor is b
+
+
+def test_higher_priority_takes_the_floor(clock):
+    arb = CommandArbiter(priorities={"10.0.0.9": 10})
+    presenter, stage = Connection("10.0.0.1"), Connection("10.0.0.9")
+    started = []
+    run(arb, presenter, "NEXT", started)
+    assert run(arb, stage, "PREVIOUS", started) is None
+    assert run(arb, presenter, "NEXT", started) == "FLOOR_HELD:10.0.0.9:5000"
+
+
+def test_holder_keeps_the_floor_for_a_while_after_leaving(clock):
+    arb = CommandArbiter(floor_idle_timeout=30)
+    a, b = Connection("10.0.0.1"), Connection("10.0.0.2")
+    started = []
+    run(arb, a, "NEXT", started)
+    clock.now += 20
+    arb.leave(a)
+    clock.now += 29
+    assert run(arb, b, "NEXT", started) == "FLOOR_HELD:10.0.0.1:5000"
+    clock.now += 1
+    assert run(arb, b, "NEXT", started) is None
+
+
+def test_holder_gets_the_floor_back_on_a_new_connection(clock):
+    arb = CommandArbiter()
+    a, b = Connection("10.0.0.1"), Connection("10.0.0.2")
+    started = []
+    run(arb, a, "NEXT", started)
+    arb.leave(a)
+    back = Connection("10.0.0.1", 5001)  # Reconnected after a Wi-Fi blip
+    assert run(arb, back, "NEXT", started) is None
+    assert arb.floor is back
+    assert arb.stats()["floor_changes"] == 1
+    assert run(arb, b, "NEXT", started) == "FLOOR_HELD:10.0.0.1:5001"
+
+
+def test_floor_follows_the_resumable_session(clock):
+    class Session:
+        token = b"session-a"
+
+    arb = CommandArbiter()
+    a, other = Connection("10.0.0.1"), Connection("10.0.0.1", 6000)
+    a.session = Session()
+    resumed = Connection("10.0.0.7")  # Same session, new network
+    resumed.session = a.session
+    started = []
+    run(arb, a, "NEXT", started)
+    assert run(arb, other, "NEXT", started) == "FLOOR_HELD:10.0.0.1:5000"  # Same host, other controller
+    arb.leave(a)
+    assert run(arb, resumed, "NEXT", started) is None
+
+
+def test_floor_control_off(clock):
+    arb = CommandArbiter(floor_commands=())
+    started = []
+    assert run(arb, Connection("10.0.0.1"), "NEXT", started) is None
+    assert run(arb, Connection("10.0.0.2"), "NEXT", started) is None
+    assert arb.floor is None
+
+
+def test_subscribers_get_each_state_in_order(clock):
+    arb = CommandArbiter()
+    a = Connection("10.0.0.1")
+    pushed = []
+    initial = protocol.parse_state(decode_one(arb.subscribe(a, pushed.append)))
+    assert initial is None or initial.seq == 0
+    run(arb, a, "NEXT", [])
+    run(arb, a, "LASER_ON", [])
+    states = [protocol.parse_state(decode_one(data)) for data in pushed]
+    assert [(s.seq, s.command, s.floor) for s in states] == [(1, "NEXT", "10.0.0.1:5000"),
+                                                             (2, "LASER_ON", "10.0.0.1:5000")]
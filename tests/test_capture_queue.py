@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from spotlight_core.capture import COALESCE, DROP_OLDEST, CaptureQueue, SenderThread
+
+
+def drain(queue):
+    events = []
+    while True:
+        event = queue.get(timeout=0)
+        if event is None:
+            return events
+        events.append(event)
+
+
+def test_unknown_overflow_policy_is_rejected():
+    with pytest.raises(ValueError):
+        CaptureQueue(overflow="block")
+
+
+def test_drop_oldest_keeps_the_newest_presses():
+    queue = CaptureQueue(capacity=2, overflow=DROP_OLDEST)
+    for command in ("NEXT", "PREVIOUS", "BLACK_SCREEN"):
+        queue.put(command)
+    assert [event.command for event in drain(queue)] == ["PREVIOUS", "BLACK_SCREEN"]
+    assert queue.stats()["dropped"] == 1
+    assert queue.stats()["high_watermark"] == 2
+
+
+def test_coalesce_folds_repeats_of_the_newest_press():
+    queue = CaptureQueue(capacity=2, overflow=COALESCE)
+    for command in ("PREVIOUS", "NEXT", "NEXT", "NEXT", "BLACK_SCREEN"):
+        queue.put(command)
+    events = drain(queue)
+    assert [(event.command, event.count) for event in events] == [("NEXT", 3), ("BLACK_SCREEN", 1)]
+    assert queue.stats()["coalesced"] == 2
+    assert queue.stats()["dropped"] == 1  # PREVIOUS, to make room for BLACK_SCREEN
+
+
+def test_coalesce_never_loses_a_press_the_sender_is_taking():
+    queue = CaptureQueue(capacity=1, overflow=COALESCE)
+    sent = []
+    sender = SenderThread(queue, lambda command, captured_at: sent.append(command))
+    sender.start()
+    for _ in range(20000):
+        queue.put("NEXT")
+    deadline = time.monotonic() + 5.0
+    while len(sent) < 20000 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    sender.stop()
+    assert len(sent) == 20000
+
+
+def test_get_times_out_on_an_empty_queue():
+    assert CaptureQueue().get(timeout=0.01) is None
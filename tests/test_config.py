@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from spotlight_core.config import ConfigError, check_value, load_config, parse_value
+
+
+@pytest.mark.parametrize("text, default, expected", [
+    ("50011", 50001, 50011),
+    ("0.5", 0.25, 0.5),
+    ("2", 0.25, 2.0),
+    ("yes", False, True),
+    ("off", True, False),
+    ("hello", "", "hello"),
+    ("none", "239.255.0.1", "none"),  # Just text, unless the setting is nullable
+    ('{"a": 1}', {}, {"a": 1}),
+    ("[1, 2]", (), (1, 2)),
+    ("12", None, 12),
+    ("keymap.json", None, "keymap.json"),
+    ("none", None, None),
+])
+def test_parse_value_takes_the_type_of_the_default(text, default, expected):
+    value = parse_value("option", text, default)
+    assert value == expected
+    assert type(value) is type(expected)
+
+
+@pytest.mark.parametrize("text, default", [
+    ("5000.5", 50001),
+    ("x", 50001),
+    ("none", 50001),
+    ("maybe", True),
+    ("[1]", {}),
+])
+def test_parse_value_rejects_what_does_not_fit(text, default):
+    with pytest.raises(ConfigError):
+        parse_value("option", text, default)
+
+
+def test_none_only_where_the_setting_allows_it():
+    assert parse_value("udp-command-port", "none", 50001, nullable=True) is None
+    assert check_value("udp-command-port", None, 50001, nullable=True) is None
+    with pytest.raises(ConfigError):
+        check_value("command-port", None, 50001)
+
+
+def test_fractions_only_for_seconds():
+    assert parse_value("idle-timeout", "0.5", 3600, seconds=True) == 0.5
+    assert parse_value("idle-timeout", "60", 3600, seconds=True) == 60
+    assert check_value("idle-timeout", 0.5, 3600, seconds=True) == 0.5
+    with pytest.raises(ConfigError):
+        check_value("command-port", 5000.5, 50001)
+
+
+@pytest.mark.parametrize("value, default", [(True, 50001), ("5000.5", 50001), (1, "text"), ([1], {})])
+def test_check_value_rejects_the_wrong_type(value, default):
+    with pytest.raises(ConfigError):
+        check_value("option", value, default)
+
+
+def test_load_config_later_sources_win(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text(json.dumps({"command-port": 50010, "pairing_id": "from-file", "idle-timeout": 1.5}))
+    settings = {"COMMAND_PORT": 50001, "PAIRING_ID": "", "IDLE_TIMEOUT": 3600, "UDP_PORT": 50001}
+    options = {"command-port": "COMMAND_PORT", "pairing-id": "PAIRING_ID", "idle-timeout": "IDLE_TIMEOUT",
+               "udp-port": "UDP_PORT"}
+    sources = load_config(settings, options, argv=["--command-port", "50030"], default_path=str(path),
+                          environ={"SPOTLIGHT_COMMAND_PORT": "50020", "SPOTLIGHT_UDP_PORT": "none"},
+                          nullable={"udp-port"}, seconds={"idle-timeout"})
+    assert settings == {"COMMAND_PORT": 50030, "PAIRING_ID": "from-file", "IDLE_TIMEOUT": 1.5, "UDP_PORT": None}
+    assert sources["command-port"] == "command line"
+    assert sources["udp-port"] == "SPOTLIGHT_UDP_PORT"
+
+
+def test_load_config_rejects_unknown_options(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text(json.dumps({"comand-port": 1}))
+    with pytest.raises(ConfigError, match="unknown option"):
+        load_config({"COMMAND_PORT": 50001}, {"command-port": "COMMAND_PORT"}, argv=[], environ={},
+                    default_path=str(path))
@@ -0,0 +1,66 @@
+import threading
+
+from spotlight_core import connection
+from spotlight_core.connection import DISCONNECTED, READY, Backoff, ConnectionManager, ReplayBuffer
+
+
+def make_manager(monkeypatch, on_connected):
+    servers = iter(range(1, 100))
+    monkeypatch.setattr(connection, "locate_server", lambda *args, **kwargs: next(servers))
+    states = []
+    manager = ConnectionManager(None, None, on_connected, backoff=Backoff(0.01, jitter=0), on_state=states.append)
+    return manager, states
+
+
+def test_connects_and_reconnects_after_a_drop(monkeypatch):
+    connected = []
+    manager, states = make_manager(monkeypatch, connected.append)
+    manager.start()
+    try:
+        assert manager.wait_ready(5.0)
+        manager.connection_lost("reset")
+        assert manager.state == DISCONNECTED
+        manager.connection_lost("reset")  # Reported twice: still one reconnect
+        assert manager.wait_ready(5.0)
+        assert connected == [1, 2]
+    finally:
+        manager.stop()
+
+
+def test_drop_while_the_connection_is_being_set_up_is_not_lost(monkeypatch):
+    connected, second = [], threading.Event()
+
+    def on_connected(server):
+        connected.append(server)
+        if server == 1:
+            manager.connection_lost("reset by the reader thread")  # Before the manager is READY
+        else:
+            second.set()
+
+    manager, states = make_manager(monkeypatch, on_connected)
+    manager.start()
+    try:
+        assert second.wait(5.0)
+        assert manager.wait_ready(5.0)
+        assert connected == [1, 2]
+        assert states.index(DISCONNECTED) < states.index(READY)  # Never READY with the dead connection
+    finally:
+        manager.stop()
+
+
+def test_backoff_grows_to_the_cap():
+    backoff = Backoff(0.25, factor=2, maximum=1.0, jitter=0)
+    assert [backoff.next() for _ in range(4)] == [0.25, 0.5, 1.0, 1.0]
+    backoff.reset()
+    assert backoff.next() == 0.25
+
+
+def test_replay_buffer_drops_stale_commands():
+    buffer = ReplayBuffer(max_age=2.0, deadlines={"LASER_ON": 0.5})
+    buffer.add("NEXT", captured_at=-1.0)  # Long ago
+    buffer.add("LASER_ON")
+    buffer.add("NEXT")
+    live, expired = buffer.take()
+    assert [entry.command for entry in live] == ["LASER_ON", "NEXT"]
+    assert [entry.command for entry in expired] == ["NEXT"]
+    assert len(buffer) == 0
@@ -0,0 +1,142 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from spotlight_core.fanout import FanoutSender, parse_targets
+from spotlight_core.injectors import RecordingInjector
+from spotlight_core.metrics import LatencyRecorder
+from spotlight_core.server import CommandTable, serve_connection
+
+
+class LoopbackServer:
+    """A thread-per-connection Spotlight server on loopback that records its key presses."""
+
+    def __init__(self, port=0, answer=True):
+        self.injector = RecordingInjector()
+        self.commands = CommandTable({"NEXT": lambda: self.injector.press("right")})
+        self.answer = answer  # False: accept and read, but never reply (a hung machine)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(8)
+        self.address = self.sock.getsockname()
+        self.conns = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            self.conns.append(conn)
+            target = serve_connection if self.answer else self._swallow
+            threading.Thread(target=target, args=(conn, addr, self.commands), daemon=True).start()
+
+    @staticmethod
+    def _swallow(conn, addr, commands):
+        try:
+            while conn.recv(1024):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+        for conn in self.conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(*args, **kwargs):
+        server = LoopbackServer(*args, **kwargs)
+        started.append(server)
+        return server
+
+    yield start
+    for server in started:
+        server.close()
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def make_sender(addresses, **kwargs):
+    events = {"replies": [], "failures": []}
+    sender = FanoutSender(addresses, backoff_initial=0.05, backoff_max=0.1,
+                          on_reply=lambda name, command, reply, rtt: events["replies"].append((name, reply.seq)),
+                          on_failure=lambda name, command, reason: events["failures"].append((name, command)),
+                          **kwargs)
+    sender.start()
+    return sender, events
+
+
+def test_parse_targets():
+    assert parse_targets(["a", "b:6000", ("c", "7000"), "a:50001"], 50001) == [
+        ("a", 50001), ("b", 6000), ("c", 7000)]
+
+
+def test_every_command_reaches_every_server(servers):
+    targets = [servers() for _ in range(3)]
+    metrics = LatencyRecorder("client")
+    sender, events = make_sender([t.address for t in targets], metrics=metrics)
+    try:
+        assert sender.wait_connected(3, timeout=3.0)
+        seqs = [sender.send("NEXT") for _ in range(5)]
+        assert wait_for(lambda: len(events["replies"]) == 15)
+    finally:
+        sender.stop()
+    assert seqs == [1, 2, 3, 4, 5]
+    assert [t.injector.presses for t in targets] == [5, 5, 5]
+    assert sender.stats()["acked"] == 15
+    assert metrics.snapshot()["stages"]["fanout_skew"]["NEXT"]["count"] == 5
+    assert all(row["rtt_ms"] is not None for row in sender.report())
+
+
+def test_hung_server_does_not_hold_up_the_others(servers):
+    good, hung = servers(), servers(answer=False)
+    sender, events = make_sender([good.address, hung.address], ack_timeout=0.2)
+    try:
+        assert sender.wait_connected(2, timeout=3.0)
+        sender.send("NEXT")
+        assert wait_for(lambda: events["failures"])
+    finally:
+        sender.stop()
+    assert events["replies"] == [(f"{good.address[0]}:{good.address[1]}", 1)]
+    assert events["failures"] == [(f"{hung.address[0]}:{hung.address[1]}", "NEXT")]
+    assert good.injector.presses == 1
+
+
+def test_server_that_comes_back_catches_up(servers):
+    up = servers()
+    placeholder = socket.socket()
+    placeholder.bind(("127.0.0.1", 0))
+    late_address = placeholder.getsockname()
+    placeholder.close()  # Nothing listens here yet
+    sender, events = make_sender([up.address, late_address])
+    try:
+        assert sender.wait_connected(1, timeout=3.0)
+        sender.send("NEXT")
+        sender.send("NEXT")
+        late = servers(port=late_address[1])
+        assert sender.wait_connected(2, timeout=3.0)
+        assert wait_for(lambda: late.injector.presses == 2)
+    finally:
+        sender.stop()
+    assert up.injector.presses == 2
+    assert events["failures"] == []
@@ -0,0 +1,84 @@
+import threading
+
+from spotlight_core.injection import InjectionWorker
+from spotlight_core.injectors import RecordingInjector
+
+KEYS = {"NEXT": "right", "PREVIOUS": "left", "BLACK_SCREEN": "b"}
+
+
+def run_queued(worker, commands, actions=None):
+    """Submits all commands before the worker starts, so it finds them waiting together."""
+    actions = actions or {}
+    finished = threading.Event()
+    results = []
+
+    def on_done(command):
+        def done(error, dispatched_at, done_at):
+            results.append((command, error))
+            if len(results) == len(commands):
+                finished.set()
+        return done
+
+    for command in commands:
+        worker.submit(command, actions.get(command), on_done(command))
+    worker.start()
+    try:
+        assert finished.wait(2.0)
+    finally:
+        worker.stop()
+    return results
+
+
+def test_runs_of_repeats_are_pressed_in_one_call():
+    injector = RecordingInjector()
+    worker = InjectionWorker(injector.press, KEYS, pause=0.01)
+    commands = ["NEXT"] * 5 + ["PREVIOUS"] * 2 + ["BLACK_SCREEN"] * 2 + ["NEXT"]
+    results = run_queued(worker, commands)
+    assert [command for command, _ in results] == commands  # Every job is finished, in order
+    assert [(key, presses) for _, key, presses in injector.events] == [
+        ("right", 5), ("left", 2), ("b", 1), ("b", 1), ("right", 1)]  # BLACK_SCREEN is not batchable
+    assert worker.stats()["collapsed"] == 5
+    assert worker.stats()["press_calls"] == 5
+
+
+def test_batches_are_capped_at_max_batch():
+    injector = RecordingInjector()
+    run_queued(InjectionWorker(injector.press, KEYS, max_batch=4), ["NEXT"] * 10)
+    assert [presses for _, _, presses in injector.events] == [4, 4, 2]
+    assert injector.presses == 10
+
+
+def test_without_batching_every_command_is_one_press():
+    injector = RecordingInjector()
+    run_queued(InjectionWorker(injector.press, KEYS, batch=False), ["NEXT"] * 3)
+    assert [presses for _, _, presses in injector.events] == [1, 1, 1]
+
+
+def test_errors_are_reported_to_the_jobs_they_belong_to():
+    def fail():
+        raise RuntimeError("no window")
+
+    injector = RecordingInjector()
+    worker = InjectionWorker(injector.press, KEYS)
+    results = run_queued(worker, ["LASER_ON", "UNKNOWN", "NEXT"], {"LASER_ON": fail})
+    assert [(command, type(error)) for command, error in results] == [
+        ("LASER_ON", RuntimeError), ("UNKNOWN", KeyError), ("NEXT", type(None))]
+    assert injector.presses == 1
+
+
+def test_failing_reply_callback_does_not_stop_the_worker():
+    injector = RecordingInjector()
+    worker = InjectionWorker(injector.press, KEYS, batch=False)
+    done = threading.Event()
+
+    def broken(error, dispatched_at, done_at):
+        raise OSError("connection gone")
+
+    worker.submit("NEXT", on_done=broken)
+    worker.submit("NEXT", on_done=lambda *args: done.set())
+    worker.start()
+    try:
+        assert done.wait(2.0)
+    finally:
+        worker.stop()
+    assert injector.presses == 2
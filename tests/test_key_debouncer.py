@@ -0,0 +1,137 @@
+import threading
+
+import pytest
+
+from spotlight_core.capture import (REPEAT_HOLD, REPEAT_IGNORE, REPEAT_RATE_LIMIT, CaptureQueue,
+                                    KeyDebouncer)
+
+BOUNCE = 0.03
+
+
+def make(policy, released=None, bounce_time=BOUNCE):
+    return KeyDebouncer(policy, repeat_interval=0.25, bounce_time=bounce_time,
+                        on_release=None if released is None else released.append)
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        KeyDebouncer("twice")
+    with pytest.raises(ValueError):
+        KeyDebouncer(REPEAT_IGNORE, policies={"NEXT": "twice"})
+
+
+def test_ignore_sends_each_press_once():
+    d = make(REPEAT_IGNORE)
+    assert d.press("right", "NEXT", now=0.0)
+    assert not d.press("right", "NEXT", now=0.5)  # OS auto-repeat
+    assert not d.press("right", "NEXT", now=0.55)
+    d.release("right", now=0.6)
+    assert d.press("right", "NEXT", now=1.0)
+    assert d.stats()["repeats_suppressed"] == 2
+
+
+@pytest.mark.parametrize("policy", [REPEAT_IGNORE, REPEAT_RATE_LIMIT, REPEAT_HOLD])
+def test_release_press_release_within_bounce_time_is_one_press(policy):
+    released = []
+    d = make(policy, released)
+    assert d.press("b", "BLACK_SCREEN", now=0.0)
+    d.release("b", now=0.01)
+    assert not d.press("b", "BLACK_SCREEN", now=0.02)  # Bounce
+    d.release("b", now=0.03)
+    assert d.releases_due(now=0.05) == []  # 0.02 s after the last release: not final yet
+    assert d.releases_due(now=0.1) == (["b"] if policy == REPEAT_HOLD else [])
+    assert released == (["b"] if policy == REPEAT_HOLD else [])
+    assert d.stats()["sent"] == 1
+    assert d.stats()["bounces_suppressed"] == 1
+
+
+@pytest.mark.parametrize("policy", [REPEAT_IGNORE, REPEAT_RATE_LIMIT, REPEAT_HOLD])
+def test_bounce_after_a_long_press_is_dropped(policy):
+    d = make(policy, [])
+    assert d.press("right", "NEXT", now=0.0)
+    d.release("right", now=0.6)  # Held longer than repeat_interval
+    assert not d.press("right", "NEXT", now=0.61)
+
+
+def test_rate_limit_lets_repeats_through_at_the_interval():
+    d = make(REPEAT_RATE_LIMIT)
+    assert d.press("right", "NEXT", now=0.0)
+    assert not d.press("right", "NEXT", now=0.1)
+    assert d.press("right", "NEXT", now=0.3)
+    assert not d.press("right", "NEXT", now=0.4)
+    assert d.press("right", "NEXT", now=0.55)
+
+
+def test_hold_release_is_reported_once_the_key_stays_up():
+    released = []
+    d = make(REPEAT_HOLD, released)
+    assert d.press("l", "LASER_ON", now=0.0)
+    d.release("l", now=1.0)
+    assert released == []  # Not final yet
+    assert d.releases_due(now=1.01) == []
+    assert d.releases_due(now=1.0 + BOUNCE) == ["l"]
+    assert released == ["l"]
+    assert d.releases_due(now=2.0) == []  # Reported once
+
+
+def test_hold_survives_x11_auto_repeat():
+    # X11 delivers the auto-repeat of a held key as release/press pairs
+    released = []
+    d = make(REPEAT_HOLD, released)
+    assert d.press("l", "LASER_ON", now=0.0)
+    for t in (0.5, 0.53, 0.56, 0.59):
+        d.release("l", now=t)
+        assert not d.press("l", "LASER_ON", now=t)
+        assert d.releases_due(now=t + 0.02) == []
+    d.release("l", now=2.0)
+    assert released == []
+    assert d.releases_due(now=2.1) == ["l"]
+    assert released == ["l"]
+
+
+def test_hold_release_due_before_the_next_press_is_reported_first():
+    events = []
+    d = KeyDebouncer(REPEAT_HOLD, bounce_time=BOUNCE, on_release=lambda key: events.append(("up", key)))
+    d.press("l", "LASER_ON", now=0.0)
+    d.release("l", now=1.0)
+    if d.press("l", "LASER_ON", now=1.5):  # The timer has not run yet
+        events.append(("down", "l"))
+    assert events == [("up", "l"), ("down", "l")]
+    assert d.releases_due(now=1.6) == []
+
+
+def test_hold_without_bounce_time_reports_the_release_at_once():
+    released = []
+    d = make(REPEAT_HOLD, released, bounce_time=0)
+    d.press("l", "LASER_ON", now=0.0)
+    d.release("l", now=1.0)
+    assert released == ["l"]
+
+
+def test_policy_per_command():
+    released = []
+    d = KeyDebouncer(REPEAT_IGNORE, bounce_time=BOUNCE, policies={"LASER_ON": REPEAT_HOLD}, on_release=released.append)
+    d.press("right", "NEXT", now=0.0)
+    d.press("l", "LASER_ON", now=0.0)
+    d.release("right", now=1.0)
+    d.release("l", now=1.0)
+    assert d.releases_due(now=2.0) == ["l"]
+
+
+def test_release_timer_reports_without_a_caller():
+    reported = threading.Event()
+    d = KeyDebouncer(REPEAT_HOLD, bounce_time=0.01, on_release=lambda key: reported.set())
+    d.press("l", "LASER_ON")
+    d.release("l")
+    assert reported.wait(2.0)
+
+
+def test_capture_queue_takes_puts_from_two_threads():
+    queue = CaptureQueue(capacity=10000)
+    threads = [threading.Thread(target=lambda: [queue.put("NEXT") for _ in range(2000)]) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert queue.depth() == 4000
+    assert queue.stats()["enqueued"] == 4000
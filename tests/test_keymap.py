@@ -0,0 +1,75 @@
+import pytest
+
+from spotlight_core.keymap import KeymapError, compile_profile, load_keymap, normalize_key
+
+DOCUMENT = {
+    "profile": "spotlight",
+    "profiles": {
+        "spotlight": {
+            "keys": {"right": "NEXT", "left": "PREVIOUS", "b": "BLACK_SCREEN"},
+            "commands": {"NEXT": "right", "PREVIOUS": "left", "BLACK_SCREEN": "b"},
+        },
+        "clicker": {
+            "extends": "spotlight",
+            "keys": {"PageDown": "NEXT", "PageUp": "PREVIOUS", "b": None},
+        },
+        "clicker-no-black": {
+            "extends": "clicker",
+            "commands": {"BLACK_SCREEN": None},
+        },
+    },
+}
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("PageDown", "page_down"), ("pgdn", "page_down"), ("Escape", "esc"), ("arrow-left", "left"),
+    ("F5", "f5"), ("b", "b"), ("B", "B"), ("<65>", "<65>"),
+])
+def test_normalize_key(name, expected):
+    assert normalize_key(name) == expected
+
+
+def test_default_profile():
+    keymap = compile_profile(DOCUMENT)
+    assert keymap.profile == "spotlight"
+    assert keymap.keys == {"right": "NEXT", "left": "PREVIOUS", "b": "BLACK_SCREEN"}
+
+
+def test_extends_overrides_and_null_drops_inherited_entries():
+    keymap = compile_profile(DOCUMENT, "clicker")
+    assert keymap.keys == {"right": "NEXT", "left": "PREVIOUS", "page_down": "NEXT", "page_up": "PREVIOUS"}
+    assert keymap.commands == DOCUMENT["profiles"]["spotlight"]["commands"]  # Inherited untouched
+
+
+def test_extends_chain_of_three():
+    keymap = compile_profile(DOCUMENT, "clicker-no-black")
+    assert "b" not in keymap.keys
+    assert keymap.commands == {"NEXT": "right", "PREVIOUS": "left"}
+
+
+def test_sections_no_profile_defines_fall_back_to_the_built_in_mappings():
+    document = {"profiles": {"keys-only": {"keys": {"n": "NEXT"}}}}
+    keymap = compile_profile(document, "keys-only", base_keys={"x": "NEXT"}, base_commands={"NEXT": "right"})
+    assert keymap.keys == {"n": "NEXT"}
+    assert keymap.commands == {"NEXT": "right"}
+
+
+@pytest.mark.parametrize("document, profile, message", [
+    ({"profiles": {}}, None, "no profile selected"),
+    (DOCUMENT, "missing", "unknown profile 'missing'"),
+    ({"profiles": {"a": {"extends": "b"}, "b": {"extends": "a"}}}, "a", "extends itself"),
+    ({"profiles": {"a": {"key": {}}}}, "a", "unknown entries"),
+    ({"profiles": {"a": {"keys": {"right": 5}}}}, "a", "is not a command name"),
+    ({"profiles": {"a": {"commands": {"NEXT": ""}}}}, "a", "is not a key name"),
+    ([], None, "profiles"),
+])
+def test_bad_profiles_are_reported(document, profile, message):
+    with pytest.raises(KeymapError, match=message):
+        compile_profile(document, profile)
+
+
+def test_load_keymap_reports_the_file(tmp_path):
+    path = tmp_path / "keymap.json"
+    path.write_text('{"profiles": ')  # Half saved
+    with pytest.raises(KeymapError, match="could not read keymap"):
+        load_keymap(str(path))
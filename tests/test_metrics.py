@@ -0,0 +1,26 @@
+from spotlight_core.metrics import LatencyRecorder, prometheus_label
+
+
+def test_label_values_are_escaped():
+    assert prometheus_label('Room "A"\\1\nB') == 'Room \\"A\\"\\\\1\\nB'
+
+
+def test_prometheus_text_escapes_server_names():
+    recorder = LatencyRecorder("client")
+    recorder.observe("target_rtt", 'Stage "left"\nPC', 0.004)
+    text = recorder.to_prometheus()
+    assert 'command="Stage \\"left\\"\\nPC"' in text
+    assert all(line.startswith(("#", "spotlight_")) for line in text.splitlines())
+    assert 'spotlight_latency_seconds_bucket{side="client",stage="target_rtt",command="Stage \\"left\\"\\nPC",le="0.005"} 1' in text
+
+
+def test_histogram_counts_and_gauges():
+    recorder = LatencyRecorder("server")
+    recorder.add_gauge_source("queue", lambda: {"depth": 3, "policy": "coalesce"})
+    for seconds in (0.001, 0.003, 0.2):
+        recorder.observe("injection", "NEXT", seconds)
+    text = recorder.to_prometheus()
+    assert 'spotlight_latency_seconds_count{side="server",stage="injection",command="NEXT"} 3' in text
+    assert 'spotlight_latency_seconds_bucket{side="server",stage="injection",command="NEXT",le="0.005"} 2' in text
+    assert 'spotlight_queue_depth{side="server"} 3' in text
+    assert "policy" not in text  # Only numbers become gauges
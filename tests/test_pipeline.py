@@ -0,0 +1,142 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from spotlight_core import protocol
+from spotlight_core.pipeline import PipelinedSender
+
+
+class Peer:
+    """The server end of a socketpair; the test decides what it answers."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.settimeout(2.0)
+        self.decoder = protocol.FrameDecoder()
+
+    def read(self, count):
+        frames = []
+        while len(frames) < count:
+            frames += self.decoder.feed(self.sock.recv(1024))
+        return frames
+
+    def quiet(self):
+        """True if nothing more arrives for a moment."""
+        self.sock.settimeout(0.1)
+        try:
+            return not self.sock.recv(1024)
+        except socket.timeout:
+            return True
+        finally:
+            self.sock.settimeout(2.0)
+
+    def ack(self, seq, opcode=protocol.OP_NEXT):
+        self.sock.sendall(protocol.encode_ack(opcode, seq))
+
+
+@pytest.fixture
+def pair():
+    client, server = socket.socketpair()
+    senders = []
+    events = {"replies": [], "failures": [], "disconnected": threading.Event(), "errors": []}
+
+    def make(**kwargs):
+        def on_disconnect(error):
+            events["errors"].append(error)
+            events["disconnected"].set()
+
+        sender = PipelinedSender(client, on_reply=lambda command, reply, rtt: events["replies"].append(reply.seq),
+                                 on_failure=lambda command, reason: events["failures"].append((command, reason)),
+                                 on_disconnect=on_disconnect, **kwargs)
+        senders.append(sender)
+        return sender, Peer(server), events
+
+    yield make
+    for sender in senders:
+        sender.close()
+    server.close()
+    client.close()
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_window_limits_commands_in_flight(pair):
+    sender, peer, events = pair(window=2)
+    seqs = [sender.send("NEXT") for _ in range(5)]
+    assert seqs == [1, 2, 3, 4, 5]
+    assert [protocol.command_seq(f) for f in peer.read(2)] == [1, 2]
+    assert peer.quiet()
+    assert sender.in_flight_count() == 2
+    peer.ack(1)
+    assert [protocol.command_seq(f) for f in peer.read(1)] == [3]
+    assert peer.quiet()
+
+
+def test_acks_are_matched_by_sequence_number(pair):
+    sender, peer, events = pair()
+    for _ in range(3):
+        sender.send("NEXT")
+    peer.read(3)
+    for seq in (3, 1, 99, 2):  # 99 was never sent
+        peer.ack(seq)
+    assert wait_for(lambda: len(events["replies"]) == 3)
+    assert events["replies"] == [3, 1, 2]
+    assert sender.in_flight_count() == 0
+
+
+def test_missing_ack_is_reported_once(pair):
+    sender, peer, events = pair(ack_timeout=0.05)
+    sender.send("PREVIOUS")
+    peer.read(1)
+    assert wait_for(lambda: events["failures"])
+    peer.ack(1, protocol.OP_PREVIOUS)  # Too late
+    assert peer.quiet()
+    assert events["failures"] == [("PREVIOUS", "no ACK within 0.05 s")]
+    assert events["replies"] == []
+
+
+def test_take_unacked_returns_commands_that_may_be_retried(pair):
+    sender, peer, events = pair(window=1, max_attempts=2)
+    sender.send("NEXT")
+    sender.send("PREVIOUS", attempts=1)  # Already written to an earlier connection
+    sender.send("BLACK_SCREEN", attempts=2)
+    peer.read(1)
+    retry = sender.take_unacked()
+    assert [(entry.seq, entry.command, entry.attempts) for entry in retry] == [(1, "NEXT", 1), (2, "PREVIOUS", 1)]
+    assert events["failures"] == [("BLACK_SCREEN", "gave up after connection loss")]
+    assert sender.take_unacked() == []
+
+
+def test_resent_command_keeps_its_sequence_number(pair):
+    sender, peer, events = pair(seqs=iter([10, 11]))
+    assert sender.send("NEXT") == 10
+    assert sender.send("NEXT", seq=4) == 4
+    assert sender.send("NEXT") == 11
+    assert [protocol.command_seq(f) for f in peer.read(3)] == [10, 4, 11]
+
+
+def test_heartbeat_pings_and_detects_a_silent_server(pair):
+    sender, peer, events = pair(heartbeat_interval=0.05, heartbeat_misses=3)
+    ping = peer.read(1)[0]
+    assert ping.opcode == protocol.OP_PING
+    peer.sock.sendall(protocol.encode_pong(ping))  # One sign of life, then silence
+    assert events["disconnected"].wait(2.0)
+    assert isinstance(events["errors"][0], TimeoutError)
+    assert not sender.alive
+    assert sender.send("NEXT") is None
+
+
+def test_server_closing_the_connection_ends_the_sender(pair):
+    sender, peer, events = pair()
+    peer.sock.close()
+    assert events["disconnected"].wait(2.0)
+    assert isinstance(events["errors"][0], ConnectionResetError)
@@ -0,0 +1,138 @@
+import pytest
+
+from spotlight_core import protocol
+from spotlight_core.protocol import Frame, FrameDecoder, ProtocolError
+
+
+def decode_in_chunks(data, sizes):
+    decoder = FrameDecoder()
+    frames, offset = [], 0
+    for size in sizes:
+        frames += decoder.feed(data[offset:offset + size])
+        offset += size
+    frames += decoder.feed(data[offset:])
+    return frames, decoder
+
+
+@pytest.mark.parametrize("value", [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63])
+def test_varint_round_trip(value):
+    data = protocol.encode_varint(value)
+    assert protocol.decode_varint(data) == (value, len(data))
+
+
+def test_incomplete_varint_is_none():
+    assert protocol.decode_varint(protocol.encode_varint(300)[:1])[0] is None
+
+
+def test_command_frame_round_trip():
+    [frame] = FrameDecoder().feed(protocol.encode_command("NEXT", seq=7, sent_us=123456))
+    assert frame.opcode == protocol.OP_NEXT
+    assert protocol.command_name(frame) == "NEXT"
+    assert protocol.command_seq(frame) == 7
+    assert protocol.command_sent_us(frame) == 123456
+
+
+def test_command_without_an_opcode_travels_by_name():
+    [frame] = FrameDecoder().feed(protocol.encode_command("SHOW_NOTES", seq=3))
+    assert frame.opcode == protocol.OP_NAMED_COMMAND
+    assert protocol.command_name(frame) == "SHOW_NOTES"
+    assert protocol.command_seq(frame) == 3
+
+
+def test_frame_split_at_every_byte():
+    data = protocol.encode_command("PREVIOUS", seq=300, sent_us=2 ** 40)
+    for split in range(1, len(data)):
+        frames, decoder = decode_in_chunks(data, [split])
+        assert [protocol.command_seq(f) for f in frames] == [300]
+        assert not decoder.has_partial()
+
+
+def test_partial_frame_stays_buffered():
+    data = protocol.encode_pair("1234")
+    decoder = FrameDecoder()
+    assert decoder.feed(data[:-1]) == []
+    assert decoder.has_partial()
+    assert decoder.feed(data[-1:]) == [Frame(protocol.OP_PAIR, b"1234")]
+
+
+def test_merged_frames_are_split():
+    data = b"".join(protocol.encode_command(name, seq) for seq, name in
+                    enumerate(["NEXT", "NEXT", "LASER_ON", "CUSTOM"], 1))
+    frames = FrameDecoder().feed(data)
+    assert [protocol.command_name(f) for f in frames] == ["NEXT", "NEXT", "LASER_ON", "CUSTOM"]
+    assert [protocol.command_seq(f) for f in frames] == [1, 2, 3, 4]
+
+
+def test_merged_and_split_across_reads():
+    data = b"".join(protocol.encode_command("NEXT", seq) for seq in range(1, 51))
+    frames, _ = decode_in_chunks(data, [1, 5, 2, 17, 3, 40, 9])
+    assert [protocol.command_seq(f) for f in frames] == list(range(1, 51))
+
+
+@pytest.mark.parametrize("data, message", [
+    (b"\xa2\x01\x10", "unsupported protocol version 2"),
+    (b"\xa1\x00", "invalid frame length 0"),
+    (b"\xa1" + protocol.encode_varint(protocol.MAX_FRAME_SIZE + 1), "invalid frame length"),
+    (protocol.encode_command("NEXT") + b"\xb5", "bad frame header 0xb5"),
+])
+def test_corrupt_stream_raises(data, message):
+    with pytest.raises(ProtocolError, match=message):
+        FrameDecoder().feed(data)
+
+
+def test_binary_stream_is_not_legacy():
+    decoder = FrameDecoder()
+    decoder.feed(protocol.encode_pair("1"))
+    assert decoder.legacy is False
+
+
+def test_legacy_commands_merged_and_split():
+    decoder = FrameDecoder()
+    assert decoder.feed(b"NEXTPREV") == [Frame(protocol.OP_NEXT, b"")]
+    assert decoder.legacy is True
+    assert decoder.feed(b"IOUS") == [Frame(protocol.OP_PREVIOUS, b"")]
+    assert decoder.feed(b"LASER_ONLASER_OFF") == [Frame(protocol.OP_LASER_ON, b""), Frame(protocol.OP_LASER_OFF, b"")]
+
+
+def test_legacy_unknown_command_is_passed_by_name():
+    [frame] = FrameDecoder().feed(b"SHOW_NOTES")
+    assert frame.opcode == protocol.OP_NAMED_COMMAND
+    assert protocol.command_name(frame) == "SHOW_NOTES"
+
+
+def test_legacy_pairing_split_across_reads():
+    decoder = FrameDecoder()
+    assert decoder.feed(b"PAIR_WITH_SER") == []
+    assert decoder.feed(b"VER:1234") == [Frame(protocol.OP_PAIR, b"1234")]
+
+
+def test_legacy_replies():
+    pair = Frame(protocol.OP_PAIR, b"1234")
+    assert protocol.encode_reply(pair, True, legacy=True) == b"ACK:PAIRING_SUCCESSFUL"
+    assert protocol.encode_reply(pair, False, "Pairing ID mismatch", legacy=True) == b"NACK:Pairing ID mismatch"
+    assert protocol.encode_reply(Frame(protocol.OP_NEXT, b""), True, legacy=True) == b"ACK:NEXT"
+    named = FrameDecoder().feed(b"SHOW_NOTES")[0]
+    assert protocol.encode_reply(named, False, legacy=True) == b"NACK:Unknown command SHOW_NOTES"
+
+
+def test_binary_ack_carries_seq_and_timing():
+    command = FrameDecoder().feed(protocol.encode_command("NEXT", seq=5))[0]
+    data = protocol.encode_reply(command, True, timing=protocol.Timing(1, 2, 3))
+    [frame] = FrameDecoder().feed(data)
+    reply = protocol.parse_reply(frame)
+    assert (reply.ok, reply.opcode, reply.seq) == (True, protocol.OP_NEXT, 5)
+    assert (reply.sent_us, reply.server_queue_us, reply.injection_us) == (1, 2, 3)
+    assert protocol.format_reply(frame) == "ACK:NEXT#5"
+
+
+def test_binary_nack_carries_reason():
+    command = FrameDecoder().feed(protocol.encode_command("NEXT", seq=9))[0]
+    [frame] = FrameDecoder().feed(protocol.encode_reply(command, False, "FLOOR_HELD:10.0.0.2:5000"))
+    reply = protocol.parse_reply(frame)
+    assert (reply.ok, reply.seq, reply.reason) == (False, 9, "FLOOR_HELD:10.0.0.2:5000")
+
+
+def test_pairing_ack():
+    [frame] = FrameDecoder().feed(protocol.encode_ack(protocol.OP_PAIR))
+    assert protocol.is_pairing_ack(frame)
+    assert protocol.format_reply(frame) == "ACK:PAIRING_SUCCESSFUL"
@@ -0,0 +1,128 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from spotlight_core import server_cache
+from spotlight_core.server_cache import ServerCache, locate_server
+
+
+@pytest.fixture
+def listener():
+    """A loopback TCP server that accepts connections and keeps them open."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(8)
+    accepted = []
+
+    def accept():
+        while True:
+            try:
+                accepted.append(sock.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield sock.getsockname()
+    sock.close()
+    for conn in accepted:
+        conn.close()
+
+
+def closed_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def slow_discovery(calls):
+    def discover(cancel):
+        calls.append(cancel)
+        cancel.wait(2.0)
+        return None
+    return discover
+
+
+def test_cache_persists_and_orders_by_last_use(tmp_path):
+    path = str(tmp_path / "servers.json")
+    cache = ServerCache(path)
+    cache.remember("1234", "10.0.0.1", 50001, "stage", rtt=0.002)
+    cache.remember("1234", "10.0.0.2", 50001, "monitor")
+    cache.remember("other", "10.0.0.3", 50001, "elsewhere")
+    entries = ServerCache(path).lookup("1234")
+    assert [(e["ip"], e["name"]) for e in entries] == [("10.0.0.2", "monitor"), ("10.0.0.1", "stage")]
+    assert entries[1]["rtt_ms"] == 2.0
+
+
+def test_server_that_moved_replaces_its_entry():
+    cache = ServerCache(None)
+    cache.remember("1234", "10.0.0.1", 50001, "stage")
+    cache.remember("1234", "10.0.0.9", 50001, "stage")
+    cache.forget("1234", "10.0.0.7", 50001)  # Not cached: nothing happens
+    assert [e["ip"] for e in cache.lookup("1234")] == ["10.0.0.9"]
+
+
+def test_old_entries_are_not_tried(monkeypatch):
+    cache = ServerCache(None)
+    cache.remember("1234", "10.0.0.1", 50001, "stage")
+    later = time.time() + server_cache.MAX_AGE + 1
+    monkeypatch.setattr(server_cache.time, "time", lambda: later)
+    assert cache.lookup("1234") == []
+
+
+def test_unreadable_cache_file_is_ignored(tmp_path):
+    path = tmp_path / "servers.json"
+    path.write_text("{not json")
+    assert ServerCache(str(path)).lookup() == []
+
+
+def test_cached_server_wins_without_waiting_for_discovery(listener):
+    cache = ServerCache(None)
+    cache.remember("1234", listener[0], listener[1], "stage")
+    calls = []
+    started = time.monotonic()
+    found = locate_server(cache, "1234", slow_discovery(calls))
+    try:
+        assert (found.ip, found.port, found.source) == (listener[0], listener[1], "cache")
+        assert time.monotonic() - started < 1.0
+        assert calls[0].is_set()  # Discovery was told to stop
+    finally:
+        found.sock.close()
+
+
+def test_discovered_server_is_remembered(listener):
+    cache = ServerCache(None)
+    found = locate_server(cache, "1234", lambda cancel: (listener[0], listener[1], "stage"))
+    found.sock.close()
+    assert found.source == "discovery"
+    [entry] = cache.lookup("1234")
+    assert (entry["ip"], entry["port"], entry["name"]) == (listener[0], listener[1], "stage")
+
+
+def test_rejected_cached_server_is_forgotten(listener):
+    cache = ServerCache(None)
+    cache.remember("1234", "127.0.0.1", closed_port(), "gone")
+    cache.remember("1234", listener[0], listener[1], "impostor")
+    discovered = []
+
+    def discover(cancel):
+        time.sleep(0.1)  # Let the cached attempts finish first
+        discovered.append(True)
+        return listener[0], listener[1], "stage"
+
+    def handshake(sock, decoder):
+        return bool(discovered)  # Only the discovered connection pairs
+
+    found = locate_server(cache, "1234", discover, handshake=handshake)
+    found.sock.close()
+    assert (found.source, found.name) == ("discovery", "stage")
+    assert [e["name"] for e in cache.lookup("1234")] == ["stage", "gone"]
+
+
+def test_nothing_reachable_returns_none():
+    cache = ServerCache(None)
+    cache.remember("1234", "127.0.0.1", closed_port(), "gone")
+    assert locate_server(cache, "1234", lambda cancel: None) is None
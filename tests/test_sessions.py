@@ -0,0 +1,164 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from spotlight_core import protocol, sessions
+from spotlight_core.server import CommandTable, ServerConnection, serve_connection
+from spotlight_core.sessions import ResumableSessions, ResumeRejected, pair_resumable, resume
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+class HeldInjector:
+    """Keeps submitted jobs until the test finishes them."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, command, action=None, on_done=None):
+        self.jobs.append((action, on_done))
+
+    def finish(self):
+        action, on_done = self.jobs.pop(0)
+        action()
+        now = time.perf_counter()
+        on_done(None, now, now)
+
+
+def decode(data):
+    return [protocol.parse_reply(frame) for frame in protocol.FrameDecoder().feed(data)]
+
+
+def connect(registry, presses, injector=None):
+    connection = ServerConnection(CommandTable({"NEXT": lambda: presses.append("right")}), "1234",
+                                  injector=injector, sessions=registry)
+    pushed = []
+    connection.push = pushed.append
+    return connection, pushed
+
+
+def run(connection, steps):
+    """Runs steps like the threaded engine does; returns the bytes sent back."""
+    sent = []
+    for step in steps:
+        if step.action is not None and connection.injector is not None:
+            connection.dispatch(step, sent.append)
+        elif step.action is not None:
+            sent.append(connection.execute(step))
+        elif step.reply:
+            sent.append(step.reply)
+    return sent
+
+
+def paired_session(registry, presses, injector=None):
+    connection, pushed = connect(registry, presses, injector)
+    sent = run(connection, connection.feed(protocol.encode_pair("1234") + protocol.encode_resume()))
+    [grant] = protocol.FrameDecoder().feed(sent[1])
+    return connection, pushed, protocol.parse_resume(grant)
+
+
+def test_sessions_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions, "time", clock)
+    registry = ResumableSessions(ttl=10)
+    session = registry.issue("1234")
+    registry.release(session)
+    clock.now += 5
+    assert registry.resume(session.token, "1234") is session
+    assert registry.resume(session.token, "other") is None  # Another pairing ID
+    registry.release(session)
+    clock.now += 11
+    assert registry.resume(session.token, "1234") is None
+    assert registry.stats() == {"sessions": 0, "issued": 1, "resumed": 1}
+
+
+def test_oldest_idle_sessions_are_forgotten_beyond_max_sessions():
+    registry = ResumableSessions(max_sessions=2)
+    first, second = registry.issue("1"), registry.issue("1")
+    registry.release(first)
+    registry.issue("1")
+    assert registry.resume(first.token, "1") is None
+    assert registry.resume(second.token, "1") is second
+
+
+def test_resent_command_runs_once_and_gets_the_original_reply():
+    registry, presses = ResumableSessions(), []
+    old, _, token = paired_session(registry, presses)
+    [ack] = decode(run(old, old.feed(protocol.encode_command("NEXT", seq=1, sent_us=5)))[0])
+    old.close()
+    new, _ = connect(registry, presses)
+    sent = run(new, new.feed(protocol.encode_resume(token) + protocol.encode_command("NEXT", seq=1, sent_us=9)))
+    resumed, again = decode(b"".join(sent))
+    assert resumed.ok and resumed.opcode == protocol.OP_RESUME
+    assert again == ack  # Timing of the run that happened, not a fresh ACK
+    assert presses == ["right"]
+
+
+def test_resent_command_waits_for_the_outcome_of_the_first_copy():
+    registry, presses, injector = ResumableSessions(), [], HeldInjector()
+    old, _, token = paired_session(registry, presses, injector)
+    run(old, old.feed(protocol.encode_command("NEXT", seq=1)))  # Queued, still running when the link drops
+    old.close()
+    new, pushed = connect(registry, presses, injector)
+    sent = run(new, new.feed(protocol.encode_resume(token) + protocol.encode_command("NEXT", seq=1)))
+    assert len(sent) == 1  # The resume ACK only: nothing for the command until it has run
+    injector.finish()
+    [reply] = decode(pushed[0])
+    assert (reply.ok, reply.seq) == (True, 1)
+    assert presses == ["right"]
+
+
+def test_failed_command_is_nacked_again_after_resuming():
+    def fail():
+        raise RuntimeError("no window")
+
+    registry = ResumableSessions()
+    old, _, token = paired_session(registry, [])
+    old.commands = CommandTable({"NEXT": fail})
+    run(old, old.feed(protocol.encode_command("NEXT", seq=1)))
+    old.close()
+    new, _ = connect(registry, [])
+    sent = run(new, new.feed(protocol.encode_resume(token) + protocol.encode_command("NEXT", seq=1)))
+    nack = decode(b"".join(sent))[1]
+    assert (nack.ok, nack.reason) == (False, "no window")
+
+
+def serve(registry, presses):
+    server_sock, client_sock = socket.socketpair()
+    thread = threading.Thread(target=serve_connection, args=(server_sock, ("test", 0), CommandTable(
+        {"NEXT": lambda: presses.append("right")}), "1234"), kwargs={"sessions": registry}, daemon=True)
+    thread.start()
+    client_sock.settimeout(5.0)
+    return client_sock, thread
+
+
+def test_client_pairs_and_resumes_with_commands_in_the_same_packet():
+    registry, presses = ResumableSessions(), []
+    sock, thread = serve(registry, presses)
+    paired, _, token = pair_resumable(sock, protocol.FrameDecoder(), "1234")
+    assert paired and token
+    sock.close()
+    thread.join(5.0)
+
+    sock, thread = serve(registry, presses)
+    decoder = protocol.FrameDecoder()
+    assert resume(sock, decoder, token, [(1, "NEXT")])
+    reply = protocol.parse_reply(protocol.recv_frame(sock, decoder))
+    assert (reply.ok, reply.seq) == (True, 1)
+    assert presses == ["right"]
+    sock.close()
+
+
+def test_unknown_session_is_rejected():
+    sock, _ = serve(ResumableSessions(), [])
+    with pytest.raises(ResumeRejected):
+        resume(sock, protocol.FrameDecoder(), b"x" * protocol.RESUME_TOKEN_SIZE, [(1, "NEXT")])
+    sock.close()
@@ -0,0 +1,146 @@
+import threading
+
+from spotlight_core import protocol
+from spotlight_core.injectors import RecordingInjector
+from spotlight_core.server import CommandOutcomes, CommandTable, DuplicateFilter, ServerConnection
+from spotlight_core.udp_commands import UdpCommandHandler, UdpCommandSender, UdpSessions, start_udp_command_server
+
+
+def test_first_sight_passes_and_repeats_do_not():
+    dedup = DuplicateFilter()
+    assert dedup.check(1)
+    assert not dedup.check(1)
+    assert dedup.check(2)
+    assert not dedup.check(2)
+    assert not dedup.check(1)
+
+
+def test_out_of_order_sequence_numbers():
+    dedup = DuplicateFilter()
+    assert [dedup.check(seq) for seq in (3, 1, 2, 5, 4)] == [True] * 5
+    assert [dedup.check(seq) for seq in (1, 2, 3, 4, 5)] == [False] * 5
+    assert dedup.base == 5
+    assert not dedup.seen_above
+
+
+def test_gap_stays_open_until_filled():
+    dedup = DuplicateFilter()
+    for seq in (1, 2, 4, 5):
+        dedup.check(seq)
+    assert dedup.base == 2
+    assert dedup.check(3)  # The missing one still gets through once
+    assert not dedup.check(3)
+    assert dedup.base == 5
+
+
+def test_window_forgets_the_oldest_numbers():
+    dedup = DuplicateFilter(window=4)
+    assert dedup.check(1)
+    assert dedup.check(10)  # Jumps past the window: everything up to 6 now counts as seen
+    assert dedup.base == 6
+    assert not dedup.check(5)
+    assert dedup.check(7)
+    assert not dedup.check(10)
+    assert len(dedup.seen_above) <= dedup.window
+
+
+def test_outcome_is_replayed_to_every_later_copy():
+    outcomes, waiting = CommandOutcomes(), []
+    assert outcomes.admit(1, waiting.append) == (True, None)
+    assert outcomes.admit(1, waiting.append) == (False, None)  # Still running
+    outcomes.done(1, b"NACK")
+    assert waiting == [b"NACK"]
+    assert outcomes.admit(1, waiting.append) == (False, b"NACK")
+    assert waiting == [b"NACK"]
+
+
+def test_outcomes_beyond_the_window_are_forgotten():
+    outcomes = CommandOutcomes(window=2)
+    for seq in (1, 2, 3):
+        outcomes.admit(seq, None)
+        outcomes.done(seq, b"ACK%d" % seq)
+    assert outcomes.admit(1, None) == (False, None)
+    assert outcomes.admit(3, None) == (False, b"ACK3")
+
+
+def make_connection(actions):
+    connection = ServerConnection(CommandTable(actions))
+    sessions = UdpSessions(0)
+    return connection, sessions, sessions.open(connection)
+
+
+def datagram(token, *frames):
+    return protocol.encode_datagram(token, b"".join(frames))
+
+
+def replies(sent):
+    return [protocol.parse_reply(frame) for data in sent for frame in protocol.parse_datagram(data)[1]]
+
+
+def test_duplicate_waits_for_the_first_copy_and_gets_its_reply():
+    connection, sessions, token = make_connection({"NEXT": lambda: None})
+    running, sent = [], []
+    handler = UdpCommandHandler(sessions, run=lambda *args: running.append(args))
+    frame = protocol.encode_command("NEXT", seq=1, sent_us=123)
+    handler.handle(datagram(token, frame), ("127.0.0.1", 1), sent.append)
+    handler.handle(datagram(token, frame, frame), ("127.0.0.1", 1), sent.append)
+    assert len(running) == 1
+    assert sent == []  # No ACK before the command has run
+    _, step, reply = running[0]
+    reply(connection.execute(step))
+    assert [(r.ok, r.seq, r.sent_us) for r in replies(sent)] == [(True, 1, 123)] * 3
+
+
+def test_duplicate_of_a_failed_command_is_nacked():
+    def fail():
+        raise RuntimeError("no window")
+
+    connection, sessions, token = make_connection({"NEXT": fail})
+    sent = []
+    handler = UdpCommandHandler(sessions)
+    frame = protocol.encode_command("NEXT", seq=1)
+    handler.handle(datagram(token, frame), ("127.0.0.1", 1), sent.append)
+    handler.handle(datagram(token, frame), ("127.0.0.1", 1), sent.append)
+    assert [(r.ok, r.reason) for r in replies(sent)] == [(False, "no window")] * 2
+
+
+def test_tcp_fallback_does_not_run_a_udp_command_again():
+    presses = []
+    connection, sessions, token = make_connection({"NEXT": lambda: presses.append(1)})
+    pushed = []
+    connection.push = pushed.append
+    running = []
+    handler = UdpCommandHandler(sessions, run=lambda *args: running.append(args))
+    frame = protocol.encode_command("NEXT", seq=7)
+    handler.handle(datagram(token, frame), ("127.0.0.1", 1), lambda data: None)
+    assert connection.feed(frame) == []  # The UDP copy has not run yet
+    _, step, reply = running[0]
+    reply(connection.execute(step))
+    [tcp_reply] = protocol.FrameDecoder().feed(pushed[0])
+    assert protocol.parse_reply(tcp_reply).seq == 7
+    [step] = connection.feed(frame)  # Once it has run, the reply comes straight back
+    assert step.action is None and step.reply == pushed[0]
+    assert presses == [1]
+
+
+def test_sender_and_handler_over_loopback():
+    injector = RecordingInjector()
+    connection, sessions, token = make_connection({"NEXT": lambda: injector.press("right")})
+    sock = start_udp_command_server(sessions, host="127.0.0.1")
+    done = threading.Event()
+    acked = []
+
+    def on_reply(command, reply, rtt):
+        acked.append(reply.seq)
+        if len(acked) == 20:
+            done.set()
+
+    sender = UdpCommandSender(sock.getsockname(), token, on_reply=on_reply)
+    try:
+        seqs = [sender.send("NEXT") for _ in range(20)]
+        assert done.wait(5.0)
+    finally:
+        sender.close()
+        sock.close()
+    assert sorted(acked) == seqs == list(range(1, 21))
+    assert injector.presses == 20